@@ -61,7 +61,7 @@ if __name__ == "__main__":
                                 solver_params=solver_params,
                                 params_file='temp')
 
-        signal = Model.model_params[vox_idx]
+        signal = Model.model_params[Model.mask][0]
         plotter = maya.plot_odf_interp
         
     elif params.mode == 'dti':
@@ -72,7 +72,7 @@ if __name__ == "__main__":
                                 mask=mask,
                                 params_file='temp')
         
-        signal = Model.model_adc[vox_idx]
+        signal = Model.model_adc[Model.mask][0]
         plotter = maya.plot_signal_interp
 
     elif params.mode == 'signal': 
@@ -0,0 +1,24 @@
+"""
+
+Benchmarks of the throughput of model fitting, prediction, cross-validation,
+precision (EMD) and fiber I/O, on simulated data
+
+To run the suite and write the results into a file:
+
+    python -m osmosis.benchmarks --scales small medium --out results.json
+
+To also time the import of the main modules (in fresh interpreters):
+
+    python -m osmosis.benchmarks --imports
+
+To compare the results with those of another commit:
+
+    python -m osmosis.benchmarks --out new.json --compare old.json
+
+See `harness.run` and `harness.compare` to do the same from Python.
+
+"""
+from osmosis.benchmarks.harness import (CASES, SCALES, IMPORT_MODULES,
+                                        benchmark, run_case, run_import, run,
+                                        compare, read_results, write_results)
+import osmosis.benchmarks.cases
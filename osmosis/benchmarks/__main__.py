@@ -0,0 +1,70 @@
+"""
+
+Run the osmosis benchmarks from the command line (see
+`python -m osmosis.benchmarks --help`)
+
+"""
+import argparse
+import sys
+
+from osmosis.benchmarks import CASES, SCALES, IMPORT_MODULES, run, compare
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m osmosis.benchmarks',
+        description='Time model fitting, prediction, cross-validation, '
+                    'precision and I/O on simulated volumes')
+    parser.add_argument('cases', nargs='*',
+                        help="Names of the cases to run (default: all). A "
+                             "name ending with '*' selects all the cases "
+                             "that start with it")
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'],
+                        choices=SCALES.keys(),
+                        help='The sizes of the simulated volumes')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='How many times to time each case')
+    parser.add_argument('--out', default='osmosis_benchmarks.json',
+                        help='The file to write the results into')
+    parser.add_argument('--imports', nargs='*', metavar='MODULE',
+                        help='Also time the import of these modules (of '
+                             'the main osmosis modules, if none are given)')
+    parser.add_argument('--compare', metavar='OLD',
+                        help='Results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.8,
+                        help='Mark cases that are slower than this fraction '
+                             'of their old throughput as regressions')
+    parser.add_argument('--list', action='store_true',
+                        help='List the cases and exit')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, case in CASES.items():
+            print("%s (%s)" % (name, case['unit']))
+        return 0
+
+    if args.imports is None:
+        imports = []
+    else:
+        imports = args.imports or IMPORT_MODULES
+    results = run(args.cases or None, scales=args.scales, repeat=args.repeat,
+                  out_file=args.out, imports=imports)
+    print("Results written into %s" % args.out)
+    failed = [r for r in results['results'] if 'error' in r]
+
+    regressions = []
+    if args.compare is not None:
+        print("\nCompared with %s:" % args.compare)
+        for c in compare(args.compare, results, threshold=args.threshold):
+            print("%-50s %6.2fx%s" % ("%s [%s]" % (c['name'], c['scale']),
+                                     c['ratio'],
+                                     '  REGRESSION' if c['regression']
+                                     else ''))
+            if c['regression']:
+                regressions.append(c)
+
+    return 1 if (failed or regressions) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+
+The benchmark cases
+
+All the cases run on volumes simulated with
+`osmosis.simulation.multi_shell_volume` (three shells, with 30 directions
+each, and two fibers crossing through each voxel), so that they don't need
+any data files. The seeds are fixed, so every run of a case processes the
+same data.
+
+"""
+import os
+import tempfile
+
+import numpy as np
+
+import osmosis.fibers as ozf
+import osmosis.io as oio
+import osmosis.precision as prc
+import osmosis.predict_n as pn
+import osmosis.simulation as sim
+import osmosis.model.dti as dti
+import osmosis.model.canonical_tensor as ct
+import osmosis.model.sparse_deconvolution as sfm
+from osmosis.model.fiber import FiberModel
+from osmosis.benchmarks.harness import benchmark
+
+BVALS = (1000, 2000, 3000)
+SNR = 50
+
+# The diffusivities of the response function in each shell:
+AD = dict((b, sim.AD) for b in BVALS)
+RD = dict((b, sim.RD) for b in BVALS)
+
+
+def _volume(shape, seed=2012):
+    """
+    A simulated volume and a mask that covers all of it
+    """
+    data, bvecs, bvals = sim.multi_shell_volume(shape, bvals=BVALS, snr=SNR,
+                                                seed=seed)
+    mask = np.ones(shape, dtype=bool)
+    return data, bvecs, bvals, mask
+
+
+def _fiber_group(shape, n_fibers, n_nodes=50, seed=2012):
+    """
+    Straight fibers that run through the volume in random directions
+    """
+    prng = np.random.RandomState(seed)
+    shape = np.array(shape, dtype=float)
+    fibers = []
+    for ii in range(n_fibers):
+        start = prng.rand(3) * (shape - 1)
+        end = prng.rand(3) * (shape - 1)
+        coords = (start[:, None] + (end - start)[:, None] *
+                  np.linspace(0, 1, n_nodes))
+        fibers.append(ozf.Fiber(coords,
+                                fiber_stats=dict(length=n_nodes),
+                                node_stats=dict(fa=prng.rand(n_nodes))))
+    return ozf.FiberGroup(fibers)
+
+
+@benchmark('TensorModel.fit')
+def tensor_model(shape):
+    data, bvecs, bvals, mask = _volume(shape)
+
+    def run():
+        dti.TensorModel(data, bvecs, bvals, mask=mask, params_file='temp',
+                        verbose=False).fit
+    return run, int(mask.sum())
+
+
+@benchmark('CanonicalTensorModel.model_params')
+def canonical_tensor_model(shape):
+    data, bvecs, bvals, mask = _volume(shape)
+
+    def run():
+        ct.CanonicalTensorModel(data, bvecs, bvals, mask=mask,
+                                params_file='temp', verbose=False).model_params
+    return run, int(mask.sum())
+
+
+@benchmark('SparseDeconvolutionModel.fit')
+def sparse_deconvolution_model(shape):
+    data, bvecs, bvals, mask = _volume(shape)
+
+    def run():
+        sfm.SparseDeconvolutionModel(data, bvecs, bvals, mask=mask,
+                                     params_file='temp', verbose=False).fit
+    return run, int(mask.sum())
+
+
+@benchmark('SparseDeconvolutionModelMultiB.fit')
+def sparse_deconvolution_model_multi_b(shape):
+    data, bvecs, bvals, mask = _volume(shape)
+
+    def run():
+        sfm.SparseDeconvolutionModelMultiB(data, bvecs, bvals, mask=mask,
+                                           axial_diffusivity=AD,
+                                           radial_diffusivity=RD,
+                                           params_file='temp',
+                                           verbose=False).fit
+    return run, int(mask.sum())
+
+
+@benchmark('SparseDeconvolutionModelMultiB.predict')
+def sparse_deconvolution_model_multi_b_predict(shape):
+    data, bvecs, bvals, mask = _volume(shape)
+    model = sfm.SparseDeconvolutionModelMultiB(data, bvecs, bvals, mask=mask,
+                                               axial_diffusivity=AD,
+                                               radial_diffusivity=RD,
+                                               params_file='temp',
+                                               verbose=False)
+    # Fit once, so that only the prediction is timed:
+    model.model_params
+    # Predict the measurements of one of the shells:
+    new_idx = np.where(bvals == BVALS[1])[0]
+
+    def run():
+        model.predict(bvecs[:, new_idx], bvals[new_idx])
+    return run, int(mask.sum())
+
+
+@benchmark('FiberModel.fit')
+def fiber_model(shape):
+    data, bvecs, bvals, mask = _volume(shape)
+    FG = _fiber_group(shape, n_fibers=int(mask.sum()))
+
+    def run():
+        FiberModel(data, bvecs, bvals, FG, params_file='temp',
+                   chunk_size=1000).fit
+    return run, int(mask.sum())
+
+
+@benchmark('predict_n.kfold_xval')
+def kfold_xval(shape):
+    data, bvecs, bvals, mask = _volume(shape)
+
+    def run():
+        pn.kfold_xval(data, bvals, bvecs, mask, AD, RD, 10, 'single')
+    return run, int(mask.sum())
+
+
+def _fodf_pairs(shape):
+    """
+    The fODFs in two volumes simulated with different seeds, and their
+    rotational vectors
+    """
+    params = []
+    for seed in [2012, 2013]:
+        data, bvecs, bvals, mask = _volume(shape, seed=seed)
+        model = sfm.SparseDeconvolutionModel(data, bvecs, bvals, mask=mask,
+                                             params_file='temp',
+                                             verbose=False)
+        params.append(np.asarray(model.model_params[mask]))
+    return params[0], params[1], model.rot_vecs
+
+
+@benchmark('precision.fODF_EMD_batch')
+def emd_precision(shape):
+    fODF1, fODF2, rot_vecs = _fodf_pairs(shape)
+
+    def run():
+        prc.fODF_EMD_batch(fODF1, fODF2, rot_vecs, rot_vecs)
+    return run, fODF1.shape[0]
+
+
+@benchmark('precision.fODF_EMD_batch.sinkhorn')
+def emd_precision_sinkhorn(shape):
+    fODF1, fODF2, rot_vecs = _fodf_pairs(shape)
+
+    def run():
+        prc.fODF_EMD_batch(fODF1, fODF2, rot_vecs, rot_vecs,
+                           solver="sinkhorn")
+    return run, fODF1.shape[0]
+
+
+@benchmark('io.pdb', unit='fibers')
+def pdb_io(shape):
+    n_fibers = 10 * int(np.prod(shape))
+    FG = _fiber_group(shape, n_fibers=n_fibers)
+    file_name = os.path.join(tempfile.gettempdir(), 'osmosis_benchmark.pdb')
+
+    def run():
+        oio.pdb_from_fg(FG, file_name, verbose=False)
+        for chunk in oio.fg_chunks_from_pdb(file_name, chunk_size=1000):
+            pass
+    return run, n_fibers
@@ -0,0 +1,404 @@
+"""
+
+Running benchmarks and recording their results
+
+A benchmark case is a function that takes the spatial shape of a volume,
+does all its setup (simulating the data, etc.) and returns a callable that
+runs the timed part, together with the number of items (voxels, fibers, ...)
+that the callable processes. Cases are registered with the `benchmark`
+decorator.
+
+Each case is run in a process of its own, so that the peak memory that is
+recorded is that of the case alone. The results of a run of the suite are
+written into a JSON file: a dict with the keys 'info' (the commit, the
+versions of the dependencies and the machine) and 'results' (a list with a
+dict for each case and scale, see `run_case`). `compare` reads two such files
+and reports the change in throughput of each case.
+
+"""
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+import traceback
+from collections import OrderedDict
+
+import numpy as np
+import scipy
+
+import osmosis
+import osmosis.instrument as ozi
+
+# The spatial shape of the volumes at each scale. The throughput per voxel is
+# only telling once there are enough voxels to outweigh the fixed cost of
+# setting up a model, so 'medium' is about the size of a region of interest
+# (10^4 voxels) and 'large' is a slab of a brain:
+SCALES = OrderedDict([('small', (10, 10, 10)),
+                      ('medium', (22, 22, 22)),
+                      ('large', (60, 60, 20))])
+
+# The registered cases, by name:
+CASES = OrderedDict()
+
+# The modules whose import time is measured by `run_import`:
+IMPORT_MODULES = ['osmosis',
+                  'osmosis.utils',
+                  'osmosis.model.base',
+                  'osmosis.model.dti',
+                  'osmosis.model.sparse_deconvolution',
+                  'osmosis.predict_n']
+
+# Heavy, optional dependencies, which should only be imported when they are
+# used (see `osmosis.lazy`):
+OPTIONAL_MODULES = ['sklearn', 'dipy.data', 'dipy.reconst.dti', 'numexpr',
+                    'matplotlib', 'IPython', 'paramiko', 'nipy',
+                    'osmosis.cluster', 'osmosis.leastsqbound']
+
+# Run in a fresh interpreter to time an import:
+_IMPORT_SCRIPT = """
+import json, sys, time
+before = set(sys.modules)
+t0 = time.time()
+import %s
+t = time.time() - t0
+loaded = [k for k in set(sys.modules) - before if sys.modules[k] is not None]
+sys.stdout.write(json.dumps(dict(time=t, loaded=loaded)))
+"""
+
+
+def benchmark(name, unit='voxels'):
+    """
+    Decorator to register a benchmark case
+
+    Parameters
+    ----------
+    name: str
+        The name of the case, for example 'TensorModel.fit'.
+
+    unit: str, optional
+        What the items that the case processes are.
+    """
+    def register(setup):
+        CASES[name] = dict(setup=setup, unit=unit)
+        return setup
+    return register
+
+
+def _peak_rss():
+    peak = ozi.peak_rss()
+    return 0 if peak is None else peak
+
+
+def _measure(name, shape, repeat):
+    """
+    Set up a case and time it (this is what runs in the child process)
+    """
+    run, n_items = CASES[name]['setup'](shape)
+    rss0 = _peak_rss()
+    registry = ozi.add_sink(ozi.RegistrySink())
+    times = []
+    try:
+        for ii in range(repeat):
+            t0 = time.time()
+            run()
+            times.append(time.time() - t0)
+    finally:
+        ozi.remove_sink(registry)
+    rss1 = _peak_rss()
+    breakdown = dict((k, v['wall_time'] / repeat)
+                     for k, v in registry.summary().items()
+                     if v['n_compute'] > 0)
+    return dict(n_items=n_items, times=times, best=min(times),
+                items_per_s=n_items / min(times) if min(times) > 0 else None,
+                peak_rss=rss1, peak_rss_delta=rss1 - rss0,
+                breakdown=breakdown)
+
+
+def _child(conn, name, shape, repeat):
+    """
+    Run one case in a child process and send back the result
+    """
+    # The models print all sorts of progress messages:
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        result = _measure(name, shape, repeat)
+    except Exception:
+        result = dict(error=traceback.format_exc())
+    conn.send(result)
+    conn.close()
+
+
+def run_case(name, scale='small', repeat=3, isolate=True):
+    """
+    Run a single benchmark case
+
+    Parameters
+    ----------
+    name: str
+        The name of a registered case.
+
+    scale: str or tuple
+        A key into SCALES, or the spatial shape of the volume.
+
+    repeat: int, optional
+        How many times to time the case. The first repetition is the one that
+        fills the caches (e.g. of basis sets), so the best time is usually a
+        later one.
+
+    isolate: bool, optional
+        Whether to run the case in a process of its own (otherwise, the peak
+        memory is that of the current process).
+
+    Returns
+    -------
+    dict, with the keys:
+
+    'name', 'scale', 'shape', 'unit': the case.
+    'n_items': how many items (voxels, fibers, ...) each repetition processes.
+    'times': the wall time of each repetition (seconds).
+    'best': the shortest of them.
+    'items_per_s': the throughput, based on the best time.
+    'peak_rss': the peak memory of the process that ran the case (bytes).
+    'peak_rss_delta': how much of that was added by the timed part.
+    'breakdown': the average time spent computing each of the attributes of
+        the models (see `osmosis.instrument`).
+    'error': the traceback, if the case failed (instead of the measurements).
+    """
+    if name not in CASES:
+        e_s = "There is no benchmark case called %s. " % name
+        e_s += "The cases are: %s" % ', '.join(CASES.keys())
+        raise ValueError(e_s)
+    shape = tuple(SCALES[scale]) if scale in SCALES else tuple(scale)
+    if isolate:
+        parent_conn, child_conn = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=_child,
+                                       args=(child_conn, name, shape, repeat))
+        proc.start()
+        # So that we hear about it if the child dies without sending
+        # anything:
+        child_conn.close()
+        try:
+            result = parent_conn.recv()
+        except EOFError:
+            result = dict(error="The process running the case exited with "
+                                "code %s" % proc.exitcode)
+        proc.join()
+    else:
+        try:
+            result = _measure(name, shape, repeat)
+        except Exception:
+            result = dict(error=traceback.format_exc())
+    result.update(name=name, scale=scale if scale in SCALES else 'custom',
+                  shape=list(shape), unit=CASES[name]['unit'])
+    return result
+
+
+def run_import(module, repeat=3):
+    """
+    Time the import of a module, in a fresh interpreter
+
+    Parameters
+    ----------
+    module: str
+        The full name of the module.
+
+    repeat: int, optional
+        How many times to time the import (each in an interpreter of its own).
+
+    Returns
+    -------
+    dict with the keys of the results of `run_case` (with 'imports' as the
+    unit, and without 'peak_rss', 'peak_rss_delta' and 'breakdown'), and
+    also:
+
+    'n_modules': how many modules the import loaded.
+    'optional_modules': which of the OPTIONAL_MODULES it loaded.
+    """
+    times = []
+    for ii in range(repeat):
+        proc = subprocess.Popen([sys.executable, '-c',
+                                 _IMPORT_SCRIPT % module],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            return dict(name='import %s' % module, scale='none', shape=[],
+                        unit='imports', error=err)
+        this = json.loads(out)
+        times.append(this['time'])
+    loaded = this['loaded']
+    return dict(name='import %s' % module, scale='none', shape=[],
+                unit='imports', n_items=1, times=times, best=min(times),
+                items_per_s=1 / min(times) if min(times) > 0 else None,
+                n_modules=len(loaded),
+                optional_modules=sorted(m for m in OPTIONAL_MODULES
+                                        if m in loaded))
+
+
+def _git_commit():
+    """
+    The commit of the osmosis source tree (None if it isn't a git checkout)
+    """
+    try:
+        proc = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                cwd=os.path.dirname(osmosis.__file__),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out = proc.communicate()[0]
+    except OSError:
+        return None
+    if proc.returncode != 0:
+        return None
+    return out.strip()
+
+
+def run_info():
+    """
+    Where and on what the benchmarks were run
+    """
+    return dict(commit=_git_commit(),
+                osmosis_version=osmosis.__version__,
+                python=platform.python_version(),
+                numpy=np.__version__,
+                scipy=scipy.__version__,
+                platform=platform.platform(),
+                n_cpus=multiprocessing.cpu_count(),
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def run(names=None, scales=('small',), repeat=3, out_file=None,
+        imports=(), verbose=True):
+    """
+    Run benchmark cases at several scales
+
+    Parameters
+    ----------
+    names: list of str, optional
+        The cases to run (default: all of them). A name that ends with '*'
+        selects all the cases that start with the rest of it.
+
+    scales: sequence, optional
+        Keys into SCALES, or spatial shapes.
+
+    repeat: int, optional
+        How many times to time each case.
+
+    out_file: str, optional
+        If provided, the results are written into this file.
+
+    imports: sequence of str, optional
+        Modules whose import time should also be measured (see
+        `run_import`).
+
+    verbose: bool, optional
+        Whether to print the throughput of each case as it finishes.
+
+    Returns
+    -------
+    dict with 'info' (see `run_info`) and 'results' (see `run_case`).
+    """
+    if names is None:
+        names = CASES.keys()
+    else:
+        selected = []
+        for name in names:
+            if name.endswith('*'):
+                selected.extend([n for n in CASES if n.startswith(name[:-1])])
+            else:
+                selected.append(name)
+        names = selected
+    results = []
+    for module in imports:
+        result = run_import(module, repeat=repeat)
+        if verbose:
+            print(format_result(result))
+            sys.stdout.flush()
+        results.append(result)
+    for scale in scales:
+        for name in names:
+            result = run_case(name, scale, repeat=repeat)
+            if verbose:
+                print(format_result(result))
+                sys.stdout.flush()
+            results.append(result)
+    out = dict(info=run_info(), results=results)
+    if out_file is not None:
+        write_results(out, out_file)
+    return out
+
+
+def format_result(result):
+    """
+    A line of text describing the result of one case
+    """
+    label = "%s [%s]" % (result['name'], result['scale'])
+    if 'error' in result:
+        return "%-50s FAILED: %s" % (label,
+                                     result['error'].strip().split('\n')[-1])
+    if result['unit'] == 'imports':
+        return "%-50s %8.3f s  %5d modules  %s" % (
+            result['name'], result['best'], result['n_modules'],
+            ', '.join(result['optional_modules']))
+    return "%-50s %10.1f %s/s  %8.3f s  peak %7.1f MB" % (
+        label, result['items_per_s'] or np.inf, result['unit'],
+        result['best'], result['peak_rss'] / 2. ** 20)
+
+
+def write_results(results, out_file):
+    """
+    Write the results of `run` into a JSON file
+    """
+    with open(out_file, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+
+def read_results(in_file):
+    """
+    Read results written by `write_results`
+    """
+    with open(in_file) as f:
+        return json.load(f)
+
+
+def compare(old, new, threshold=0.8):
+    """
+    Compare the throughput of the cases in two runs of the benchmarks
+
+    Parameters
+    ----------
+    old, new: dict or str
+        Results of `run`, or the names of files they were written to.
+
+    threshold: float, optional
+        Cases whose throughput in new is less than this fraction of their
+        throughput in old are marked as regressions.
+
+    Returns
+    -------
+    list of dicts with the keys 'name', 'scale', 'old', 'new' (the
+    throughputs), 'ratio' (new / old) and 'regression', for each case that
+    completed in both runs.
+    """
+    if isinstance(old, basestring):
+        old = read_results(old)
+    if isinstance(new, basestring):
+        new = read_results(new)
+    old_by_case = dict(((r['name'], r['scale']), r) for r in old['results']
+                       if 'error' not in r)
+    out = []
+    for r in new['results']:
+        key = (r['name'], r['scale'])
+        if 'error' in r or key not in old_by_case:
+            continue
+        old_rate = old_by_case[key]['items_per_s']
+        new_rate = r['items_per_s']
+        if not old_rate or not new_rate:
+            continue
+        ratio = new_rate / old_rate
+        out.append(dict(name=r['name'], scale=r['scale'], old=old_rate,
+                        new=new_rate, ratio=ratio,
+                        regression=ratio < threshold))
+    return out
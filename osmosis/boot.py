@@ -10,7 +10,7 @@ import scipy.linalg as la
 import osmosis as oz
 import osmosis.utils as ozu
 
-def subsample(bvecs, n_dirs, elec_points=None):
+def subsample(bvecs, n_dirs, elec_points=None, seed=None):
     """
 
     Generate a sub-sample of size n of directions from the provided bvecs
@@ -22,6 +22,8 @@ def subsample(bvecs, n_dirs, elec_points=None):
     n_dirs: int, how many bvecs to sub-sample from this set. 
     elec_points: optional, a set of points read from the camino points, using
     Jones (2003) algorithm for electro-static repulsion
+    seed: int, optional, seed for the random choice of the orientation of the
+    electro-static repulsion points.
     
     Returns 
     -------
@@ -32,46 +34,105 @@ def subsample(bvecs, n_dirs, elec_points=None):
     Notes
     -----
     Directions are chosen from the camino-generated electro-static repulsion
-    points in the directory camino_pts.
+    points in the directory camino_pts (see `subsample_batch`).
 
     """
-    
+    sample_bvecs, bvec_idx = subsample_batch(bvecs, n_dirs, 1,
+                                             elec_points=elec_points,
+                                             seed=seed)
+    return sample_bvecs[0], bvec_idx[0]
+
+
+def subsample_batch(bvecs, n_dirs, n_samples, elec_points=None, seed=None):
+    """
+    Generate many sub-samples of size n of directions from the provided bvecs
+    (for example, for bootstrapping).
+
+    In each sub-sample, the electro-static repulsion points are rotated, so
+    that the first one is aligned with a randomly chosen bvec. Each of the
+    points is then assigned, in turn, to the closest bvec (up to a sign
+    inversion) that hasn't been used yet.
+
+    Parameters
+    ----------
+    bvecs: array (3 by n), a set of cartesian coordinates for a set of bvecs
+    n_dirs: int, how many bvecs to sub-sample from this set.
+    n_samples: int, how many sub-samples to generate.
+    elec_points: optional, a set of points (n_dirs by 3). Defaults to the
+        camino points (see `subsample`).
+    seed: int, optional, seed for the random choice of the orientations.
+
+    Returns
+    -------
+    sample_bvecs: array (n_samples, 3, n_dirs), the coordinates of the
+        sub-samples
+    bvec_idx: int array (n_samples, n_dirs), the indices into the original
+        bvecs that would give these sub-samples
+    """
+    bvecs = np.asarray(bvecs, dtype=float)
+    if n_dirs > bvecs.shape[-1]:
+        e_s = "Can't sub-sample %s directions from %s bvecs"%(n_dirs,
+                                                             bvecs.shape[-1])
+        raise ValueError(e_s)
     if elec_points is None:
         # We need a n by 3 here:
         xyz = ozu.get_camino_pts(n_dirs).T
     else:
-        xyz = elec_points.copy()
-            
-    # Rotate all the points to align with the seed, the bvec relative to which
-    # all the rest are chosen (lots going on in this one line):
-    rot_to_first = ozu.calculate_rotation(
-                              bvecs[:, np.ceil(np.random.randint(xyz.shape[0]))],
-                              xyz[0])
-
-    new_points = np.dot(rot_to_first, bvecs).T
-
-    sample_bvecs = np.zeros((3, n_dirs))
-    bvec_idx = []
-
-    potential_indices = np.arange(bvecs.shape[-1])
-    for vec in xrange(n_dirs):
-        this = new_points[vec]
-        delta = np.zeros(potential_indices.shape)
-        for j in range(delta.shape[0]):
-            delta[j] = ozu.vector_angle(this, bvecs[:, j])
-
-        this_idx = np.where(delta==np.min(delta))
-        
-        bvec_idx.append(potential_indices[this_idx])    
-        sample_bvecs[:, vec] = np.squeeze(bvecs[:, this_idx])
-
-        # Remove bvecs that you've used, so that you don't have them more than
-        # once: 
-        bvecs = np.hstack([bvecs[:, :this_idx[0]],bvecs[:, this_idx[0]+1:]])
-        potential_indices = np.hstack([potential_indices[:this_idx[0]],
-                                            potential_indices[this_idx[0]+1:]])
-        
-    return sample_bvecs, np.array(bvec_idx).squeeze()
+        xyz = np.asarray(elec_points, dtype=float)
+    xyz = xyz / np.sqrt(np.sum(xyz ** 2, -1))[:, None]
+    # The points are only defined up to a sign inversion (and the camino ones
+    # are inverted at random), so put them all on the upper hemisphere. That
+    # way, the result only depends on the seed:
+    xyz = np.where(xyz[:, 2:] < 0, -xyz, xyz)
+    unit_bvecs = bvecs / np.sqrt(np.sum(bvecs ** 2, 0))
+
+    # Rotate all the bvecs so that a randomly chosen one (the seed) is aligned
+    # with the first point. This is the same as rotating the points to the
+    # seed:
+    prng = np.random.RandomState(seed)
+    seeds = unit_bvecs[:, prng.randint(bvecs.shape[-1], size=n_samples)].T
+    rot = _rotations(seeds, np.repeat(xyz[:1], n_samples, 0))
+    new_points = np.einsum('sij,jn->sni', rot, unit_bvecs)
+
+    # The absolute cosine of the angle between each point and each bvec
+    # (n_samples, n_dirs, n_bvecs). The largest is the closest, with antipodal
+    # symmetry:
+    abs_cos = np.abs(np.einsum('di,sni->sdn', xyz, new_points))
+
+    bvec_idx = np.empty((n_samples, n_dirs), dtype=int)
+    used = np.zeros((n_samples, bvecs.shape[-1]), dtype=bool)
+    samples = np.arange(n_samples)
+    # Each point in turn gets the closest bvec that hasn't been used yet (in
+    # all the sub-samples at once):
+    for vec in range(n_dirs):
+        this_idx = np.argmax(np.where(used, -np.inf, abs_cos[:, vec]), -1)
+        bvec_idx[:, vec] = this_idx
+        used[samples, this_idx] = True
+
+    return bvecs[:, bvec_idx].transpose(1, 0, 2), bvec_idx
+
+
+def _rotations(a, b):
+    """
+    Helper function to calculate the rotation matrices that rotate each of the
+    unit vectors in a (n by 3) to the corresponding vector in b, around the
+    axis perpendicular to both (Rodrigues' formula).
+    """
+    v = np.cross(a, b)
+    c = np.sum(a * b, -1)
+    vx = np.zeros((a.shape[0], 3, 3))
+    vx[:, 0, 1], vx[:, 0, 2], vx[:, 1, 2] = -v[:, 2], v[:, 1], -v[:, 0]
+    vx = vx - vx.transpose(0, 2, 1)
+    rot = (np.eye(3) + vx +
+           np.einsum('sij,sjk->sik', vx, vx) / (1 + c)[:, None, None])
+    # Vectors that are (almost) opposite: rotate by pi around any axis
+    # perpendicular to a:
+    opposite = c < -1 + 1e-10
+    for ii in np.where(opposite)[0]:
+        axis = np.cross(a[ii], np.eye(3)[np.argmin(np.abs(a[ii]))])
+        axis = axis / np.sqrt(np.dot(axis, axis))
+        rot[ii] = 2 * np.outer(axis, axis) - np.eye(3)
+    return rot
         
 def dyadic_tensor(eigs,average=True):
     """
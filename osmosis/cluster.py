@@ -15,7 +15,7 @@ import dipy.core.geometry as geo
 import osmosis.utils as ozu
 
 def spkm(data, k, weights=None, seeds=None, antipodal=True, max_iter=1000,
-         calc_sse=True):
+         calc_sse=True, init='random', n_init=1, seed=None):
    """
    Spherical k means. 
 
@@ -34,7 +34,7 @@ def spkm(data, k, weights=None, seeds=None, antipodal=True, max_iter=1000,
 
    seeds : float array (optional).
         If n by k array is provided, these are used as centroids to initialize
-        the algorithm. Otherwise, random centroids are chosen
+        the algorithm. Otherwise, centroids are chosen according to `init`
 
    antipodal : bool
       In cases in which antipodal symmetry can be assumed, we want to cluster
@@ -48,6 +48,19 @@ def spkm(data, k, weights=None, seeds=None, antipodal=True, max_iter=1000,
    calc_sse : bool
       Whether to calculate SSE or not. 
 
+   init : str
+      How to choose the centroids if no seeds are provided: 'random' (random
+      points on the sphere) or 'k-means++' (data points, chosen with
+      probability that increases with their weight and their distance from
+      the centroids chosen so far).
+
+   n_init : int
+      If no seeds are provided, run this many times with different initial
+      centroids and return the solution with the smallest SSE.
+
+   seed : int
+      Seed for the random number generator used for initialization.
+
    Returns
    -------
    mu : the estimated centroid 
@@ -55,87 +68,225 @@ def spkm(data, k, weights=None, seeds=None, antipodal=True, max_iter=1000,
    SSE : the sum of squared error in centroid-to-data-point assignment
    
    """
+   if seeds is not None:
+      seeds = np.asarray(seeds)[np.newaxis]
+   if weights is not None:
+      weights = np.asarray(weights)[np.newaxis]
+   mu, y_n, SSE = spkm_batch(np.asarray(data)[np.newaxis], k,
+                             weights=weights,
+                             seeds=seeds,
+                             antipodal=antipodal,
+                             max_iter=max_iter,
+                             init=init,
+                             n_init=n_init,
+                             seed=seed)
+   if calc_sse:
+      SSE = SSE[0]
+   else:
+      SSE = 0
+   return mu[0], y_n[0], SSE
+
+
+def spkm_batch(data, k, weights=None, mask=None, seeds=None, antipodal=True,
+               max_iter=1000, init='random', n_init=1, seed=None):
+   """
+   Spherical k means for many independent problems at once (for example, one
+   for every voxel).
+
+   Parameters
+   ----------
+   data : 3d float array
+       Of shape (n_problems, n, m): n data points by m features in each
+       problem. Problems with fewer data points can be padded (see `mask`).
+
+   k : int
+       The number of clusters (in all the problems).
+
+   weights : 2d float array, of shape (n_problems, n) (optional)
+       Weights of the data points in each problem.
+
+   mask : 2d bool array, of shape (n_problems, n) (optional)
+       Which data points are real (True) and which are padding (False).
+
+   seeds : 3d float array, of shape (n_problems, k, m) (optional)
+       Initial centroids. Otherwise, these are chosen according to `init`.
+
+   antipodal, max_iter, init, n_init, seed : see `spkm`
+
+   Returns
+   -------
+   mu : (n_problems, k, m) the estimated centroids
+   y_n : (n_problems, n) assignments of data points to centroids (-1 for
+       padding)
+   SSE : (n_problems, ) the sum of squared error in each problem
+
+   """
+   data = np.array(data, dtype=float)
+   n_prob, n_points, n_feat = data.shape
+   if mask is None:
+      mask = np.ones((n_prob, n_points), dtype=bool)
+   else:
+      mask = np.asarray(mask, dtype=bool)
+   if weights is None:
+      weights = np.ones((n_prob, n_points))
+   weights = np.where(mask, weights, 0).astype(float)
+
    # 0. Preliminaries:
    # For the calculation of the centroids, we want to make sure that the data
-   # are all pointing into the same hemisphere (expects 3 by n):
-   data = ozu.vecs2hemi(data.T).T
-   # If no weights are provided treat all data points equally:
-   if weights is None:
-      weights = np.ones(data.shape[0])
-   
-   # 1. Initialization:
-   if seeds is None:
-      # Choose random seeds.
+   # are all pointing into the same hemisphere:
+   if n_feat == 3:
+      data = ozu.vecs2hemi(data.reshape(-1, 3).T).T.reshape(data.shape)
+   # Make sure they're all unit vectors (and zero for the padding), so that
+   # correlations are scaled properly. This only needs to happen once:
+   data = _row_normalize(data) * mask[..., np.newaxis]
+
+   prng = np.random.RandomState(seed)
+   if seeds is not None:
+      return _spkm_batch(data, weights, mask, k, np.asarray(seeds, dtype=float),
+                         antipodal, max_iter)
+
+   best = None
+   for ii in range(n_init):
+      # 1. Initialization:
+      if init == 'random':
+         these_seeds = _random_seeds(n_prob, k, n_feat, prng)
+      elif init == 'k-means++':
+         these_seeds = _kmeanspp_seeds(data, weights, k, antipodal, prng)
+      else:
+         e_s = "init should be 'random' or 'k-means++', not '%s'"%init
+         raise ValueError(e_s)
+      this = _spkm_batch(data, weights, mask, k, these_seeds, antipodal,
+                         max_iter)
+      if best is None:
+         best = this
+      else:
+         # Keep the solution with the smaller SSE in every problem:
+         better = this[2] < best[2]
+         for b, t in zip(best, this):
+            b[better] = t[better]
+   return best
+
+
+def _row_normalize(arr):
+   """
+   Helper function to scale the vectors in the last dimension of arr to unit
+   length (leaving vectors of length 0 alone)
+   """
+   norm = np.sqrt(np.sum(arr ** 2, -1))[..., np.newaxis]
+   return arr / np.where(norm > 0, norm, 1)
+
+
+def _random_seeds(n_prob, k, n_feat, prng):
+   """
+   Helper function to choose random initial centroids on the sphere
+   """
+   if n_feat == 3:
       # thetas are uniform [0,pi]:
-      theta = np.random.rand(k) * np.pi
+      theta = prng.rand(n_prob, k) * np.pi
       # phis are uniform [0, 2pi]
-      phi = np.random.rand(k) * 2 * np.pi
+      phi = prng.rand(n_prob, k) * 2 * np.pi
       # They're all unit vectors:
-      r = np.ones(k)
+      r = np.ones((n_prob, k))
       # et voila:
-      seeds = np.array(geo.sphere2cart(theta, phi, r)).T
-      
+      return np.array(geo.sphere2cart(theta, phi, r)).transpose(1, 2, 0)
+   return _row_normalize(prng.randn(n_prob, k, n_feat))
+
+
+def _kmeanspp_seeds(data, weights, k, antipodal, prng):
+   """
+   Helper function to choose initial centroids from the data points, with
+   k-means++. The distance between unit vectors is taken to be 1 - (absolute,
+   if antipodal) correlation.
+   """
+   n_prob, n_points, n_feat = data.shape
+   probs = np.arange(n_prob)
+   seeds = np.zeros((n_prob, k, n_feat))
+   dist = np.ones((n_prob, n_points))
+   for this_k in range(k):
+      # Choose with probability proportional to weight times distance:
+      p = weights * dist
+      cum_p = np.cumsum(p, -1)
+      total = cum_p[:, -1]
+      # If everything has zero probability, choose uniformly among the points
+      # with weight:
+      cum_p = np.where(total[:, np.newaxis] > 0, cum_p,
+                       np.cumsum(weights > 0, -1))
+      total = cum_p[:, -1]
+      choice = np.sum(cum_p <= (prng.rand(n_prob) * total)[:, np.newaxis], -1)
+      choice = np.minimum(choice, n_points - 1)
+      seeds[:, this_k] = data[probs, choice]
+      corr = np.sum(data * seeds[:, this_k][:, np.newaxis], -1)
+      if antipodal:
+         corr = np.abs(corr)
+      dist = np.minimum(dist, 1 - corr)
+   return seeds
+
+
+def _spkm_batch(data, weights, mask, k, seeds, antipodal, max_iter):
+   """
+   Helper function with the main loop of spherical k-means. Expects data to
+   already be normalized.
+   """
+   n_prob, n_points, n_feat = data.shape
+   w_data = weights[..., np.newaxis] * data
    mu = seeds.copy()
-   is_changing = True
-   last_y_n = False
+   y_n = np.zeros((n_prob, n_points), dtype=int)
+   # The problems in which the assignments are still changing:
+   active = np.arange(n_prob)
    iter = 0
-   while is_changing:
-     
-      # Make sure they're all unit vectors, so that correlation below is scaled
-      # properly: 
-      mu = np.array([ozu.unit_vector(x) for x in mu])
-      data = np.array([ozu.unit_vector(x) for x in data])
-
+   while len(active):
+      this_mask = mask[active]
       # 2. Data assignment:
       # Calculate all the correlations in one swoop:
-      corr = np.dot(data, mu.T)
+      corr = np.einsum('pnm,pkm->pnk', data[active],
+                       _row_normalize(mu[active]))
       # In cases where antipodal symmetry is assumed, 
-      if antipodal==True:
+      if antipodal:
          corr = np.abs(corr)
-
       # This chooses the centroid for each one:
-      y_n = np.argmax(corr, -1)
-      
-      # 3. Centroid estimation:
-      for this_k in range(k):
-         idx = np.where(y_n==this_k)
-         if len(idx[0])>0: 
-            # The average will be based on the data points that are considered
-            # in this centroid with a weighted average: 
-            this_sum = np.dot(weights[idx], data[idx])
-
-            # This goes into the volume of the sphere, so we renormalize to the
-            # surface (or to the origin, if it's 0):
-            this_norm =  ozu.l2_norm(this_sum)
-
-            if this_norm > 0:
-               # Scale by the mean of the weights  
-               mu[this_k] = (this_sum / this_norm) * np.mean(weights[idx]) 
-            elif this_norm < 0:
-               mu[this_k] = np.array([0,0,0])
-               
-      # Did it change?
-      if np.all(y_n == last_y_n):
-         # 4. Stop if there's no change in assignment:
-         is_changing = False
+      this_y_n = np.argmax(corr, -1)
+
+      # 3. Centroid estimation, as a weighted average of the data points
+      # assigned to each centroid. Each (problem, cluster) combination gets a
+      # unique index for the bincounts:
+      n_bins = len(active) * k
+      lin = (this_y_n +
+             (np.arange(len(active)) * k)[:, np.newaxis])[this_mask]
+      n_members = np.bincount(lin, minlength=n_bins)
+      sum_weights = np.bincount(lin, weights=weights[active][this_mask],
+                                minlength=n_bins)
+      this_sum = np.array([np.bincount(lin,
+                                       weights=w_data[active, :, m][this_mask],
+                                       minlength=n_bins)
+                           for m in range(n_feat)]).T
+      this_norm = np.sqrt(np.sum(this_sum ** 2, -1))
+      # This goes into the volume of the sphere, so we renormalize to the
+      # surface and scale by the mean of the weights. Centroids with no data
+      # points (or with a sum at the origin) stay where they were:
+      update = (this_norm > 0) & (n_members > 0)
+      this_mu = mu[active].reshape(-1, n_feat)
+      this_mu[update] = (this_sum[update] / this_norm[update, np.newaxis] *
+                         (sum_weights[update] /
+                          n_members[update])[:, np.newaxis])
+      mu[active] = this_mu.reshape(-1, k, n_feat)
+
+      # 4. Stop if there's no change in assignment:
+      if iter == 0:
+         changed = np.ones(len(active), dtype=bool)
       else:
-         last_y_n = y_n
-         
+         changed = np.any((this_y_n != y_n[active]) & this_mask, -1)
+      y_n[active] = this_y_n
+      active = active[changed]
+
       # Another stopping condition is if this has gone on for a while 
       iter += 1
-      if iter>max_iter:
-         is_changing=False
+      if iter > max_iter:
+         break
 
-      # Once you are done computing 'em all, calculate the resulting SSE: 
-      SSE = 0
-      if calc_sse: 
-         for this_k in range(k):
-            idx = np.where(y_n==this_k)
-            len_idx = len(idx[0])
-            if len_idx > 0:
-               scaled_data = data[idx] * weights[idx].reshape(len_idx,1)
-               SSE += np.sum( (mu[this_k] - scaled_data) ** 2)
-             
+   # Once you are done computing 'em all, calculate the resulting SSE: 
+   resid = np.sum((mu[np.arange(n_prob)[:, np.newaxis], y_n] - w_data) ** 2, -1)
+   SSE = np.sum(resid * mask, -1)
+   y_n[~mask] = -1
    return mu, y_n, SSE
 
     
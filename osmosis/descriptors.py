@@ -20,6 +20,7 @@ Hettinger. http://users.rcn.com/python/download/Descriptor.htm
 
 [2] Python data model, http://docs.python.org/reference/datamodel.html
 """
+import osmosis.instrument as ozi
 
 #-----------------------------------------------------------------------------
 # Classes and Functions
@@ -137,9 +138,12 @@ class OneTimeProperty(object):
             # return func
             return self.getter
 
-        # Errors in the following line are errors in setting a
+        # Errors in the following lines are errors in setting a
         # OneTimeProperty
-        val = self.getter(obj)
+        if ozi._SINKS:
+            val = ozi.compute(obj, self.name, self.getter)
+        else:
+            val = self.getter(obj)
 
         setattr(obj, self.name, val)
         return val
@@ -17,8 +17,11 @@
 
 
 /* DEFINITIONS */
-#define MAX_SIG_SIZE   500
+/* THE SIGNATURES CAN BE OF ANY SIZE: THE SOLVER ALLOCATES ITS WORK SPACE
+   FOR EACH CALL. THE LIMIT ON THE NUMBER OF ITERATIONS GROWS WITH THE SIZE OF
+   THE SIGNATURES, BUT IS NEVER SMALLER THAN MAX_ITERATIONS */
 #define MAX_ITERATIONS 500
+#define ITERATIONS_PER_FEATURE 10
 #define EPSILON        1e-10
 
 /*****************************************************************************/
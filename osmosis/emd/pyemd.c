@@ -1,4 +1,6 @@
 #include <Python.h>
+#include <math.h>
+#include <string.h>
 #include "emd.h"
 
 // define PyInt_* macros for Python 3.x
@@ -15,7 +17,7 @@ static PyObject *compute_emd(PyObject *self, PyObject *args, PyObject *keywds)
   static char *kwlist[] = {"weight1", "weight2", "cost", NULL};
 
   PyObject *weight1, *weight2, *cost;
-  float *w1, *w2, *c;
+  float *w1 = NULL, *w2 = NULL, *c = NULL;
   int length1, length2;
   signature_t signature1, signature2;
   float distance;
@@ -49,16 +51,26 @@ static PyObject *compute_emd(PyObject *self, PyObject *args, PyObject *keywds)
     return NULL;
   }
 
-  w1 = alloca(length1 * sizeof(double));
-  w2 = alloca(length2 * sizeof(double));
-  c = alloca(length1 * length2 * sizeof(double));
-  
+  if(PySequence_Size(cost) != length1 * length2) {
+    PyErr_SetString(PyExc_ValueError, "cost must have length1 * length2 items");
+    return NULL;
+  }
+
+  /* The signatures can be large, so these go on the heap */
+  w1 = malloc((length1 + 1) * sizeof(float));
+  w2 = malloc((length2 + 1) * sizeof(float));
+  c = malloc((length1 * length2 + 1) * sizeof(float));
+  if (w1 == NULL || w2 == NULL || c == NULL) {
+    PyErr_NoMemory();
+    goto fail;
+  }
+
   for(i = 0; i < length1; i ++) {
     item = PySequence_GetItem(weight1, i);
     if(!PyFloat_Check(item) && !PyInt_Check(item)) {
       Py_DECREF(item);
       PyErr_SetString(PyExc_TypeError, "w1 should be a sequence of numbers");
-      return NULL;
+      goto fail;
     }
     w1[i] = PyFloat_AsDouble(item);
     Py_DECREF(item);
@@ -69,7 +81,7 @@ static PyObject *compute_emd(PyObject *self, PyObject *args, PyObject *keywds)
     if(!PyFloat_Check(item) && !PyInt_Check(item)) {
       Py_DECREF(item);
       PyErr_SetString(PyExc_TypeError, "w2 should be a sequence of numbers");
-      return NULL;
+      goto fail;
     }
     w2[i] = PyFloat_AsDouble(item);
     Py_DECREF(item);
@@ -80,7 +92,7 @@ static PyObject *compute_emd(PyObject *self, PyObject *args, PyObject *keywds)
     if(!PyFloat_Check(item) && !PyInt_Check(item)) {
       Py_DECREF(item);
       PyErr_SetString(PyExc_TypeError, "cost should be a sequence of numbers");
-      return NULL;
+      goto fail;
     }
     c[i] = PyFloat_AsDouble(item);
     Py_DECREF(item);
@@ -96,12 +108,180 @@ static PyObject *compute_emd(PyObject *self, PyObject *args, PyObject *keywds)
 
   distance = emd(&signature1, &signature2, c, 0, 0);
 
+  free(w1);
+  free(w2);
+  free(c);
+
+  if (distance < 0)
+    return PyErr_NoMemory();
+
   return Py_BuildValue("d", distance);
+
+ fail:
+  free(w1);
+  free(w2);
+  free(c);
+  return NULL;
+}
+
+/* Get a C-contiguous buffer of doubles with ndim dimensions from obj */
+static int get_double_buffer(PyObject *obj, Py_buffer *view, int ndim,
+			     int writable, const char *name)
+{
+  int flags = PyBUF_C_CONTIGUOUS | PyBUF_FORMAT;
+
+  if (writable)
+    flags |= PyBUF_WRITABLE;
+
+  if (PyObject_GetBuffer(obj, view, flags) < 0)
+    return -1;
+
+  if (view->ndim != ndim || view->itemsize != sizeof(double) ||
+      view->format == NULL || strcmp(view->format, "d") != 0) {
+    PyErr_Format(PyExc_TypeError,
+		 "%s must be a %d-d C-contiguous array of float64", name, ndim);
+    PyBuffer_Release(view);
+    return -1;
+  }
+  return 0;
+}
+
+
+static PyObject *compute_emd_batch(PyObject *self, PyObject *args,
+				   PyObject *keywds)
+{
+  static char *kwlist[] = {"weights1", "weights2", "cost", "out", NULL};
+
+  PyObject *weights1, *weights2, *cost, *out;
+  Py_buffer b_w1, b_w2, b_cost, b_out;
+  double *w1, *w2, *c, *o, *row1, *row2, sum1, sum2;
+  float *sw1 = NULL, *sw2 = NULL, *sc = NULL;
+  int *idx1 = NULL, *idx2 = NULL;
+  Py_ssize_t n_vox, n1, n2, v;
+  int i, j, k1, k2, failed = 0;
+  signature_t signature1, signature2;
+  PyObject *result = NULL;
+
+  if(!PyArg_ParseTupleAndKeywords(args, keywds, "OOOO", kwlist,
+				  &weights1, &weights2, &cost, &out))
+     return NULL;
+
+  if (get_double_buffer(weights1, &b_w1, 2, 0, "weights1") < 0)
+    return NULL;
+  if (get_double_buffer(weights2, &b_w2, 2, 0, "weights2") < 0)
+    goto release_w1;
+  if (get_double_buffer(cost, &b_cost, 2, 0, "cost") < 0)
+    goto release_w2;
+  if (get_double_buffer(out, &b_out, 1, 1, "out") < 0)
+    goto release_cost;
+
+  n_vox = b_w1.shape[0];
+  n1 = b_w1.shape[1];
+  n2 = b_w2.shape[1];
+
+  if (b_w2.shape[0] != n_vox || b_out.shape[0] != n_vox ||
+      b_cost.shape[0] != n1 || b_cost.shape[1] != n2) {
+    PyErr_SetString(PyExc_ValueError,
+		    "weights1 (n_vox, n), weights2 (n_vox, m), cost (n, m) "
+		    "and out (n_vox,) have inconsistent shapes");
+    goto release_out;
+  }
+
+  idx1 = malloc((n1 + 1) * sizeof(int));
+  idx2 = malloc((n2 + 1) * sizeof(int));
+  sw1 = malloc((n1 + 1) * sizeof(float));
+  sw2 = malloc((n2 + 1) * sizeof(float));
+  sc = malloc((n1 * n2 + 1) * sizeof(float));
+  if (idx1 == NULL || idx2 == NULL || sw1 == NULL || sw2 == NULL ||
+      sc == NULL) {
+    PyErr_NoMemory();
+    goto release_out;
+  }
+
+  w1 = (double *) b_w1.buf;
+  w2 = (double *) b_w2.buf;
+  c = (double *) b_cost.buf;
+  o = (double *) b_out.buf;
+
+  /* Nothing below touches Python objects, so other threads can run */
+  Py_BEGIN_ALLOW_THREADS
+
+  for (v = 0; v < n_vox; v++) {
+    row1 = w1 + v * n1;
+    row2 = w2 + v * n2;
+
+    /* The signatures are built only over the positive weights */
+    k1 = 0;
+    sum1 = 0;
+    for (i = 0; i < n1; i++)
+      if (row1[i] > 0) {
+	idx1[k1++] = i;
+	sum1 += row1[i];
+      }
+    k2 = 0;
+    sum2 = 0;
+    for (j = 0; j < n2; j++)
+      if (row2[j] > 0) {
+	idx2[k2++] = j;
+	sum2 += row2[j];
+      }
+
+    if (k1 == 0 || k2 == 0) {
+      o[v] = NAN;
+      continue;
+    }
+
+    for (i = 0; i < k1; i++)
+      sw1[i] = row1[idx1[i]] / sum1;
+    for (j = 0; j < k2; j++)
+      sw2[j] = row2[idx2[j]] / sum2;
+    for (i = 0; i < k1; i++)
+      for (j = 0; j < k2; j++)
+	sc[i * k2 + j] = c[idx1[i] * n2 + idx2[j]];
+
+    signature1.n = k1;
+    signature1.Weights = sw1;
+    signature2.n = k2;
+    signature2.Weights = sw2;
+
+    o[v] = emd(&signature1, &signature2, sc, 0, 0);
+    if (o[v] < 0) {
+      failed = 1;
+      o[v] = NAN;
+    }
+  }
+
+  Py_END_ALLOW_THREADS
+
+  if (failed) {
+    PyErr_NoMemory();
+    goto release_out;
+  }
+
+  Py_INCREF(Py_None);
+  result = Py_None;
+
+ release_out:
+  free(idx1);
+  free(idx2);
+  free(sw1);
+  free(sw2);
+  free(sc);
+  PyBuffer_Release(&b_out);
+ release_cost:
+  PyBuffer_Release(&b_cost);
+ release_w2:
+  PyBuffer_Release(&b_w2);
+ release_w1:
+  PyBuffer_Release(&b_w1);
+  return result;
 }
 
 static PyMethodDef functions[] = {
     {"emd", (PyCFunction)compute_emd, METH_VARARGS | METH_KEYWORDS,
      "Compute the Earth Mover's Distance.\n\nParameters\n----------\nw1 : list (length n) \n\t The first set of weights \nw2 : list (length m)\n\tSecond set of weights\ndist : list (length n times m)\n\tAny distance metric between item i in w1 and item j in w2.\n"},
+    {"emd_batch", (PyCFunction)compute_emd_batch, METH_VARARGS | METH_KEYWORDS,
+     "Compute the Earth Mover's Distance between many pairs of signatures that\nshare their ground distance, releasing the GIL while computing.\n\nThe signatures are built over the positive weights in each row, and are\nnormalized to sum to 1. Pairs in which either row has no positive weights\nget a NaN.\n\nParameters\n----------\nweights1 : float64 array (n_vox, n)\n\tThe first set of weights\nweights2 : float64 array (n_vox, m)\n\tSecond set of weights\ncost : float64 array (n, m)\n\tThe distance between item i in weights1 and item j in weights2.\nout : float64 array (n_vox,)\n\tThe EMD of each pair of rows is written here.\n"},
     {NULL, NULL, 0, NULL}
 };
 
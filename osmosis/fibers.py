@@ -386,6 +386,18 @@ class FiberGroup(desc.ResetMixin):
         """
         return self.fibers[i]
 
+    def iter_chunks(self, chunk_size):
+        """
+        Iterate over the fibers in this FiberGroup, chunk_size fibers at a
+        time. Each chunk is a FiberGroup with the same affine as this one.
+        """
+        for start in range(0, self.n_fibers, chunk_size):
+            yield FiberGroup(self.fibers[start:start + chunk_size],
+                             name=self.name,
+                             color=self.color,
+                             thickness=self.thickness,
+                             affine=self.affine)
+
     def _get_coords(self):
         """
         Helper function which can be used to get the coordinates of the
@@ -0,0 +1,323 @@
+"""
+
+Lightweight instrumentation of the computations in osmosis
+
+Every computation of an `auto_attr` (e.g. `model_params`, `fit`,
+`regressors`) is recorded, together with progress through long voxel-wise (or
+fiber-wise) loops and the hits and misses of the caches (params files, basis
+sets, etc.). Records are dicts, which are handed to each of the registered
+sinks. Nothing is recorded (and the cost is a single check) as long as no sink
+is registered.
+
+Each record has the following keys:
+
+'event': 'compute', 'cache' or 'progress'.
+'name': what the record is about, for example 'TensorModel.model_params'.
+'time': when the record was made (seconds since the epoch).
+
+'compute' records also have:
+
+'wall_time': how long the computation took (seconds), including the
+    computations that it triggered.
+'peak_rss_delta': how much the peak memory (resident set size) of the process
+    grew during the computation (bytes, or None where this isn't available).
+'n_vox': the number of voxels in the mask of the object, if it has one (None
+    otherwise).
+'vox_per_s': n_vox / wall_time.
+'parent': the name of the computation that triggered this one (None at the
+    top level).
+'cache': 'miss' (the value was not there, so it was computed).
+
+'cache' records also have 'cache' ('hit' or 'miss') and 'source' (where the
+value came from, for example the name of a params file).
+
+'progress' records also have 'done' and 'total'.
+
+Examples
+--------
+>>> import osmosis.instrument as ozi
+>>> registry = ozi.add_sink(ozi.RegistrySink())
+>>> # ... fit some models ...
+>>> ozi.remove_sink(registry)
+>>> summary = registry.summary() # doctest: +SKIP
+
+"""
+import json
+import logging
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows:
+    resource = None
+
+# The registered sinks. Everything checks this list before doing any work:
+_SINKS = []
+
+# The names of the computations that are currently running in each thread
+# (innermost last), see `_stack`:
+_LOCAL = threading.local()
+
+
+def add_sink(sink):
+    """
+    Start sending records to a sink.
+
+    Parameters
+    ----------
+    sink: object
+        Anything with a `write(record)` method (for example, `LogSink`,
+        `JSONLinesSink` or `RegistrySink`).
+
+    Returns
+    -------
+    sink, for convenience.
+    """
+    if not hasattr(sink, 'write'):
+        e_s = "A sink needs to have a write method"
+        raise ValueError(e_s)
+    _SINKS.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    """
+    Stop sending records to a sink
+    """
+    _SINKS.remove(sink)
+
+
+def clear_sinks():
+    """
+    Stop sending records to all the sinks
+    """
+    del _SINKS[:]
+
+
+def is_enabled():
+    """
+    Whether anything is being recorded
+    """
+    return len(_SINKS) > 0
+
+
+def emit(event, name, **info):
+    """
+    Send a record to all the sinks (a no-op if there are none)
+    """
+    if not _SINKS:
+        return
+    record = dict(event=event, name=name, time=time.time())
+    record.update(info)
+    for sink in list(_SINKS):
+        sink.write(record)
+
+
+def cache_event(name, hit, source=None):
+    """
+    Record a hit (or a miss) of a cache.
+    """
+    if _SINKS:
+        emit('cache', name, cache='hit' if hit else 'miss', source=source)
+
+
+def progress(name, done, total):
+    """
+    Record progress through a loop of `total` iterations
+    """
+    if _SINKS:
+        emit('progress', name, done=done, total=total)
+
+
+def label(obj, name):
+    """
+    The label of an attribute (or method) of an object: 'ClassName.name'
+    """
+    return obj.__class__.__name__ + '.' + name
+
+
+def peak_rss():
+    """
+    The peak resident set size of this process so far, in bytes (None where
+    this isn't available).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports this in kilobytes, OS X in bytes:
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
+
+
+def _stack():
+    """
+    The stack of running computations of this thread (so that computations in
+    the workers of a thread pool don't get each other as parents)
+    """
+    try:
+        return _LOCAL.stack
+    except AttributeError:
+        _LOCAL.stack = []
+        return _LOCAL.stack
+
+
+def _n_vox(obj):
+    """
+    The number of voxels in the mask of obj (None if it doesn't have one yet)
+    """
+    mask = getattr(obj, '__dict__', {}).get('mask')
+    if mask is None or not hasattr(mask, 'dtype') or mask.dtype != bool:
+        return None
+    return int(mask.sum())
+
+
+def compute(obj, name, func):
+    """
+    Compute func(obj), recording how long it took, how much memory it used
+    and the voxel throughput, under the label of obj.name.
+    """
+    this_label = label(obj, name)
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    stack.append(this_label)
+    rss0 = peak_rss()
+    t0 = time.time()
+    try:
+        val = func(obj)
+    finally:
+        stack.pop()
+    wall_time = time.time() - t0
+    rss1 = peak_rss()
+    n_vox = _n_vox(obj)
+    emit('compute', this_label,
+         wall_time=wall_time,
+         peak_rss_delta=None if rss0 is None else rss1 - rss0,
+         n_vox=n_vox,
+         vox_per_s=(n_vox / wall_time if n_vox is not None and wall_time > 0
+                    else None),
+         parent=parent,
+         cache='miss')
+    return val
+
+
+class LogSink(object):
+    """
+    Write the records to a logger (from the standard library logging module)
+    """
+    def __init__(self, logger=None, level=logging.INFO):
+        """
+        Parameters
+        ----------
+        logger: logging.Logger, optional
+            Defaults to the 'osmosis' logger.
+
+        level: int, optional
+            The logging level of the records.
+        """
+        if logger is None:
+            logger = logging.getLogger('osmosis')
+        self.logger = logger
+        self.level = level
+
+    def write(self, record):
+        if record['event'] == 'compute':
+            msg = "%s: %.3f s" % (record['name'], record['wall_time'])
+            if record['vox_per_s'] is not None:
+                msg += ", %.1f voxels/s" % record['vox_per_s']
+            if record['peak_rss_delta']:
+                msg += ", peak memory +%.1f MB" % (record['peak_rss_delta']
+                                                   / 2. ** 20)
+        elif record['event'] == 'progress':
+            msg = "%s: %s of %s" % (record['name'], record['done'],
+                                    record['total'])
+        else:
+            msg = "%s: cache %s" % (record['name'], record['cache'])
+            if record.get('source') is not None:
+                msg += " (%s)" % record['source']
+        self.logger.log(self.level, msg)
+
+
+class JSONLinesSink(object):
+    """
+    Write each record as a line of JSON into a file
+    """
+    def __init__(self, f, progress=False):
+        """
+        Parameters
+        ----------
+        f: str or file
+            The name of a file to append to, or an open file.
+
+        progress: bool, optional
+            Whether to also write the (many) progress records.
+        """
+        if isinstance(f, str):
+            f = open(f, 'a')
+        self.file = f
+        self.progress = progress
+
+    def write(self, record):
+        if record['event'] == 'progress' and not self.progress:
+            return
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class RegistrySink(object):
+    """
+    Keep the records in memory
+    """
+    def __init__(self, progress=False):
+        """
+        Parameters
+        ----------
+        progress: bool, optional
+            Whether to also keep the (many) progress records.
+        """
+        self.records = []
+        self.progress = progress
+
+    def write(self, record):
+        if record['event'] == 'progress' and not self.progress:
+            return
+        self.records.append(record)
+
+    def clear(self):
+        self.records = []
+
+    def summary(self):
+        """
+        Aggregate the records by name
+
+        Returns
+        -------
+        dict
+            For each name: the number of computations ('n_compute'), their
+            total wall time ('wall_time'), the largest growth of the peak
+            memory ('peak_rss_delta'), and the number of cache hits ('hits')
+            and misses ('misses').
+        """
+        out = {}
+        for record in self.records:
+            if record['event'] == 'progress':
+                continue
+            this = out.setdefault(record['name'],
+                                  dict(n_compute=0, wall_time=0.0,
+                                       peak_rss_delta=0, hits=0, misses=0))
+            if record['event'] == 'compute':
+                this['n_compute'] += 1
+                this['wall_time'] += record['wall_time']
+                this['peak_rss_delta'] = max(this['peak_rss_delta'],
+                                             record['peak_rss_delta'] or 0)
+            if record['cache'] == 'hit':
+                this['hits'] += 1
+            else:
+                this['misses'] += 1
+        return out
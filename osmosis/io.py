@@ -65,7 +65,6 @@ completely ignored.
 # Import from standard lib:
 import struct
 import os
-import inspect
 import warnings
 import urllib
 import zipfile
@@ -85,9 +84,6 @@ import osmosis.model.dti as dti
 from .utils import ProgressBar
 import osmosis.volume as ozv
 
-from dipy.reconst.dti import TensorModel
-from dipy.core.gradients import gradient_table
-
 osmosis_path =  os.path.split(oz.__file__)[0]
 
 data_path = osmosis_path + '/data/'
@@ -114,57 +110,13 @@ def fg_from_pdb(file_name, verbose=True):
     f_obj = file(file_name, 'r')
     f_read = f_obj.read()
     f_obj.close()
-    # This is an updatable index into this read:
-    idx = 0
-
-    # First part is an int encoding the offset to the fiber part:
-    offset, idx = _unpacker(f_read, idx, 1)
-
-    # Next bit are doubles, encoding the xform (4 by 4 = 16 of them):
-    xform, idx  = _unpacker(f_read, idx, 16, 'double')
-    xform = np.reshape(xform, (4, 4))
-
-    # Next is an int encoding the number of stats:
-    numstats, idx = _unpacker(f_read, idx, 1)
-
-    # The stats header is a dict with lists holding the stat per
-    stats_header = dict(luminance_encoding=[],  # int => bool
-                        computed_per_point=[],  # int => bool
-                        viewable=[],  # int => bool
-                        agg_name=[],  # char array => string
-                        local_name=[],  # char array => string
-                        uid=[]  # int
-        )
-
-    # Read the stats header:
-    counter = 0
-    while counter < numstats:
-        counter += 1
-        for k in ["luminance_encoding",
-                  "computed_per_point",
-                  "viewable"]:
-            this, idx = _unpacker(f_read, idx, 1)
-            stats_header[k].append(np.bool(this))
-
-        for k in ["agg_name", "local_name"]:
-            this, idx = _unpacker(f_read, idx, 255, 'char')
-            stats_header[k].append(_word_maker(this))
-        # Must have integer reads be word aligned (?):
-        idx += 2
-        this, idx = _unpacker(f_read, idx, 1)
-        stats_header["uid"].append(this)
-
-    # We skip the whole bit with the algorithms and go straight to the version
-    # number, which is one int length before the fibers:
-    idx = offset - 4
-    version, idx = _unpacker(f_read, idx, 1)
-    if int(version) < 2:
-        raise ValueError("Can only read PDB version 2 or version 3 files")
-    elif verbose:
+    offset, xform, stats_header, version = _pdb_header(f_read)
+    numstats = len(stats_header["uid"])
+    if verbose:
         print("Loading a PDB version %s file from: %s"%(int(version), file_name))
 
-    if int(version) == 2:
-        idx = offset
+    # The fibers start right after the version number:
+    idx = offset
 
     # How many fibers?
     numpaths, idx = _unpacker(f_read, idx, 1)
@@ -173,7 +125,7 @@ def fg_from_pdb(file_name, verbose=True):
         pts = []
         if verbose:
                 prog_bar = ProgressBar(numpaths[0])
-                f_name = inspect.stack()[0][3]
+                f_name = 'fg_from_pdb'
 
         f_stats = []
         n_stats = []
@@ -237,7 +189,7 @@ def fg_from_pdb(file_name, verbose=True):
 
         if verbose:
             prog_bar = ProgressBar(numpaths[0])
-            f_name = inspect.stack()[0][3]
+            f_name = 'fg_from_pdb'
         for p_idx in range(numpaths):
             n_nodes = pts_per_fiber[p_idx]
             pts.append(np.reshape(
@@ -286,8 +238,183 @@ def fg_from_pdb(file_name, verbose=True):
     if verbose:
         print("Done reading from file")
 
-    name = os.path.split(file_name)[-1].split('.')[0]
-    return ozf.FiberGroup(fibers, name=name, affine=xform)
+    return ozf.FiberGroup(fibers, name=_fg_name(file_name), affine=xform)
+
+
+def _fg_name(file_name):
+    """
+    Helper function to name a fiber-group after the file it was read from
+    """
+    return os.path.split(file_name)[-1].split('.')[0]
+
+
+def _pdb_header(f_read):
+    """
+    Helper function to read the header of a pdb file
+
+    Parameters
+    ----------
+    f_read: str
+        The binary content of the file (at least the first `offset` bytes of
+        it, where offset is the first int in the file).
+
+    Returns
+    -------
+    offset: int, the offset to the beginning of the fibers part of the file.
+    xform: 4 by 4 array
+    stats_header: dict with lists holding the stats header information.
+    version: int
+
+    """
+    # This is an updatable index into this read:
+    idx = 0
+
+    # First part is an int encoding the offset to the fiber part:
+    offset, idx = _unpacker(f_read, idx, 1)
+    offset = int(offset[0])
+
+    # Next bit are doubles, encoding the xform (4 by 4 = 16 of them):
+    xform, idx  = _unpacker(f_read, idx, 16, 'double')
+    xform = np.reshape(xform, (4, 4))
+
+    # Next is an int encoding the number of stats:
+    numstats, idx = _unpacker(f_read, idx, 1)
+
+    # The stats header is a dict with lists holding the stat per
+    stats_header = dict(luminance_encoding=[],  # int => bool
+                        computed_per_point=[],  # int => bool
+                        viewable=[],  # int => bool
+                        agg_name=[],  # char array => string
+                        local_name=[],  # char array => string
+                        uid=[]  # int
+        )
+
+    # Read the stats header:
+    counter = 0
+    while counter < numstats:
+        counter += 1
+        for k in ["luminance_encoding",
+                  "computed_per_point",
+                  "viewable"]:
+            this, idx = _unpacker(f_read, idx, 1)
+            stats_header[k].append(np.bool(this))
+
+        for k in ["agg_name", "local_name"]:
+            this, idx = _unpacker(f_read, idx, 255, 'char')
+            stats_header[k].append(_word_maker(this))
+        # Must have integer reads be word aligned (?):
+        idx += 2
+        this, idx = _unpacker(f_read, idx, 1)
+        stats_header["uid"].append(this)
+
+    # We skip the whole bit with the algorithms and go straight to the version
+    # number, which is one int length before the fibers:
+    idx = offset - 4
+    version, idx = _unpacker(f_read, idx, 1)
+    version = int(version)
+    if version < 2:
+        raise ValueError("Can only read PDB version 2 or version 3 files")
+
+    return offset, xform, stats_header, version
+
+
+def fg_chunks_from_pdb(file_name, chunk_size=1000, verbose=False):
+    """
+    Read a .pdb file in chunks of fibers, without ever holding the entire
+    fiber-group in memory
+
+    Parameters
+    ----------
+    file_name: str
+       Full path to the .pdb file
+
+    chunk_size: int, optional
+       How many fibers in each chunk. Default: 1000
+
+    verbose: bool, optional
+
+    Returns
+    -------
+    A generator of FiberGroup objects, each holding (at most) chunk_size of
+    the fibers in the file, with their fiber-stats and node-stats.
+
+    Note
+    ----
+    Only version 3 files are streamed from disk. Version 2 files are read with
+    `fg_from_pdb` and the fiber-group is then split into chunks.
+
+    """
+    f_obj = file(file_name, 'rb')
+    hdr_sz = struct.unpack(_fmt_dict['int'][0],
+                           f_obj.read(_fmt_dict['int'][1]))[0]
+    f_obj.seek(0)
+    offset, xform, stats_header, version = _pdb_header(f_obj.read(hdr_sz))
+
+    if version == 2:
+        f_obj.close()
+        for chunk in fg_from_pdb(file_name,
+                                 verbose=verbose).iter_chunks(chunk_size):
+            yield chunk
+        return
+
+    if verbose:
+        print("Streaming a PDB version %s file from: %s"%(version, file_name))
+
+    int_dt = np.dtype(_fmt_dict['int'][0])
+    dbl_dt = np.dtype(_fmt_dict['double'][0])
+    f_obj.seek(offset)
+    numpaths = int(np.fromfile(f_obj, int_dt, 1)[0])
+    pts_per_fiber = np.fromfile(f_obj, int_dt, numpaths).astype(int)
+    # The index of the first node of each fiber (and the total, at the end):
+    first_pt = np.concatenate([[0], np.cumsum(pts_per_fiber)])
+    total_pts = first_pt[-1]
+    # Where each section of the file starts:
+    coords_start = f_obj.tell()
+    f_stats_start = coords_start + total_pts * 3 * dbl_dt.itemsize
+    n_stats_start = f_stats_start + (len(stats_header["uid"]) * numpaths *
+                                     dbl_dt.itemsize)
+    per_point = [stat_idx for stat_idx, pp in
+                 enumerate(stats_header["computed_per_point"]) if pp]
+
+    for c_start in range(0, numpaths, chunk_size):
+        c_end = np.min([c_start + chunk_size, numpaths])
+        n_pts = first_pt[c_end] - first_pt[c_start]
+        f_obj.seek(coords_start + first_pt[c_start] * 3 * dbl_dt.itemsize)
+        chunk_pts = np.fromfile(f_obj, dbl_dt, n_pts * 3).reshape((n_pts, 3))
+
+        f_stats = {}
+        for stat_idx, name in enumerate(stats_header["local_name"]):
+            # This is a fiber-stat only if it's not computed per point:
+            if stats_header["computed_per_point"][stat_idx]:
+                continue
+            f_obj.seek(f_stats_start +
+                       (stat_idx * numpaths + c_start) * dbl_dt.itemsize)
+            f_stats[name] = np.fromfile(f_obj, dbl_dt, c_end - c_start)
+
+        n_stats = {}
+        for pp_idx, stat_idx in enumerate(per_point):
+            f_obj.seek(n_stats_start +
+                       (pp_idx * total_pts + first_pt[c_start]) *
+                       dbl_dt.itemsize)
+            n_stats[stats_header["local_name"][stat_idx]] = np.fromfile(
+                f_obj, dbl_dt, n_pts)
+
+        fibers = []
+        for p_idx in range(c_start, c_end):
+            # Indices of this fiber's nodes within the chunk:
+            n_start = first_pt[p_idx] - first_pt[c_start]
+            n_end = first_pt[p_idx + 1] - first_pt[c_start]
+            fibers.append(ozf.Fiber(chunk_pts[n_start:n_end].T,
+                            xform,
+                            fiber_stats=dict([(k, v[p_idx - c_start])
+                                              for k, v in f_stats.items()]),
+                            node_stats=dict([(k, v[n_start:n_end])
+                                             for k, v in n_stats.items()])))
+
+        yield ozf.FiberGroup(fibers, name=_fg_name(file_name), affine=xform)
+
+    f_obj.close()
+
 
 # This one's a global used in both packing and unpacking the data
 
@@ -507,7 +634,108 @@ def fg_from_trk(trk_file, affine=None):
     for f in fibers_trk:
         fibers.append(ozf.Fiber(np.array(f[0]).T,affine=aff))
 
-    return ozf.FiberGroup(fibers, affine=aff)
+    return ozf.FiberGroup(fibers, name=_fg_name(trk_file), affine=aff)
+
+def fg_chunks_from_trk(trk_file, chunk_size=1000, affine=None):
+    """
+    Read a trackvis .trk file in chunks of fibers, without ever holding the
+    entire fiber-group in memory
+
+    Parameters
+    ----------
+    trk_file: str
+        Full path to the .trk file
+
+    chunk_size: int, optional
+        How many fibers in each chunk. Default: 1000
+
+    affine: 4 by 4 array, optional
+        Per default, the affine is read from the file header.
+
+    Returns
+    -------
+    A generator of FiberGroup objects, each holding (at most) chunk_size of
+    the fibers in the file. Per-point scalars stored in the file are attached
+    to the fibers as node-stats.
+    """
+    fibers_trk, hdr = tv.read(trk_file, as_generator=True)
+
+    if affine is not None:
+        aff = affine
+    else:
+        aff = tv.aff_from_hdr(hdr)
+        try:
+            np.matrix(aff).getI()
+        except np.linalg.LinAlgError:
+            e_s = "trk file contains bogus header, reverting to np.eye(4)"
+            warnings.warn(e_s)
+            aff = np.eye(4)
+
+    fg_name = _fg_name(trk_file)
+    scalar_names = [str(n).strip('\x00') for n in
+                    hdr['scalar_name'][:hdr['n_scalars']]]
+
+    fibers = []
+    for f in fibers_trk:
+        node_stats = {}
+        if f[1] is not None:
+            for s_idx in range(f[1].shape[-1]):
+                if s_idx < len(scalar_names) and scalar_names[s_idx]:
+                    name = scalar_names[s_idx]
+                else:
+                    name = 'scalar%s'%s_idx
+                node_stats[name] = f[1][:, s_idx]
+        fibers.append(ozf.Fiber(np.array(f[0]).T, affine=aff,
+                                node_stats=node_stats))
+        if len(fibers) == chunk_size:
+            yield ozf.FiberGroup(fibers, name=fg_name, affine=aff)
+            fibers = []
+
+    if len(fibers):
+        yield ozf.FiberGroup(fibers, name=fg_name, affine=aff)
+
+
+def fg_from_file(file_name, verbose=False):
+    """
+    Read a fiber-group from a .pdb or .trk file (see `fg_from_pdb` and
+    `fg_from_trk`)
+    """
+    if file_name.endswith('.pdb'):
+        return fg_from_pdb(file_name, verbose=verbose)
+    if file_name.endswith('.trk'):
+        return fg_from_trk(file_name)
+    e_s = "Can only read fibers from .pdb or .trk files, not: %s"%file_name
+    raise ValueError(e_s)
+
+
+def fg_chunks(fg, chunk_size=1000, verbose=False):
+    """
+    Iterate over the fibers in a fiber-group in chunks
+
+    Parameters
+    ----------
+    fg: FiberGroup, str or iterable
+        A FiberGroup class instance, a full path to a .pdb or .trk file, or
+        an iterable of FiberGroup chunks (which is passed through as is).
+
+    chunk_size: int, optional
+        How many fibers in each chunk. Default: 1000
+
+    Returns
+    -------
+    An iterable of FiberGroup objects
+    """
+    if isinstance(fg, ozf.FiberGroup):
+        return fg.iter_chunks(chunk_size)
+    if isinstance(fg, str):
+        if fg.endswith('.pdb'):
+            return fg_chunks_from_pdb(fg, chunk_size, verbose=verbose)
+        if fg.endswith('.trk'):
+            return fg_chunks_from_trk(fg, chunk_size)
+        e_s = "Can only read fibers from .pdb or .trk files, not: %s"%fg
+        raise ValueError(e_s)
+    return fg
+
 
 def trk_from_fg(fg, trk_file, affine=None):
     """
@@ -917,13 +1145,14 @@ def rm_ventricles(wm_data_file, bvals, bvecs, data, data_path):
                          params_file = "temp")
 
     # Find the median, and 25th and 75th percentiles of mean diffusivities
-    md_median = np.median(tm.mean_diffusivity[np.where(wm_data)])
-    q1 = stats.scoreatpercentile(tm.mean_diffusivity[np.where(wm_data)],25)
-    q3 = stats.scoreatpercentile(tm.mean_diffusivity[np.where(wm_data)],75)
+    wm_md = np.asarray(tm.mean_diffusivity)[np.where(wm_data)]
+    md_median = np.median(wm_md)
+    q1 = stats.scoreatpercentile(wm_md,25)
+    q3 = stats.scoreatpercentile(wm_md,75)
 
     # Exclude voxels with MDs above median + 2*interquartile range
     md_exclude = md_median + 2*(q3 - q1)
-    md_include = np.where(tm.mean_diffusivity[np.where(wm_data)] < md_exclude)
+    md_include = np.where(wm_md < md_exclude)
     new_wm_mask = np.zeros(wm_data.shape)
     new_wm_mask[np.where(wm_data)[0][md_include],
                 np.where(wm_data)[1][md_include],
@@ -0,0 +1,86 @@
+"""
+
+Deferred imports of heavy and optional dependencies
+
+Modules such as sklearn, dipy.data or matplotlib take a while to import (and
+pull in hundreds of other modules), but are only needed by some of the code
+paths in osmosis. `lazy_import` returns a stand-in for a module, which imports
+the module the first time one of its attributes is used, so that importing
+osmosis (in a script, or in each of the processes of a pool) only costs what
+is actually used:
+
+>>> import osmosis.lazy as ozl
+>>> lm = ozl.lazy_import('sklearn.linear_model')
+>>> solver = lm.ElasticNet() # doctest: +SKIP
+
+If the module is not installed, the ImportError is raised on first use. Use
+`has_module` to check whether an optional dependency is there, without
+importing it.
+
+"""
+import importlib
+import pkgutil
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    A stand-in for a module that is imported on first attribute access
+    """
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_lazy_name'] = name
+
+    def _load(self):
+        module = importlib.import_module(self._lazy_name)
+        # From now on, attributes are found without going through __getattr__:
+        self.__dict__.update(module.__dict__)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return "<lazily imported module '%s'>" % self._lazy_name
+
+
+def lazy_import(name):
+    """
+    A module that is only imported when it is first used
+
+    Parameters
+    ----------
+    name: str
+        The full (dotted) name of the module.
+
+    Returns
+    -------
+    The module itself, if it has already been imported, otherwise a
+    `LazyModule` stand-in for it.
+    """
+    if name in sys.modules and sys.modules[name] is not None:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+def is_loaded(module):
+    """
+    Whether a module returned by `lazy_import` has been imported yet
+    """
+    if not isinstance(module, LazyModule):
+        return True
+    return module._lazy_name in sys.modules
+
+
+def has_module(name):
+    """
+    Whether a module can be imported, without importing it (only its parent
+    packages are imported, for dotted names)
+    """
+    if name in sys.modules:
+        return sys.modules[name] is not None
+    try:
+        return pkgutil.find_loader(name) is not None
+    except ImportError:
+        return False
@@ -0,0 +1,203 @@
+"""
+
+Batched Levenberg-Marquardt non-linear least-squares
+
+`levenberg_marquardt` fits a model to many signals (for example, the voxels
+of a model) at once. All the signals in a block take their steps together,
+each with its own damping and convergence criteria, so that every iteration
+is a few vectorized operations on (n_signals, n_measurements, n_params)
+arrays, instead of a call to `scipy.optimize.leastsq` for each signal.
+
+The model is a function `func(params, *args)`, which takes an array of
+parameters (n_signals, n_params) and returns the predicted signals (n_signals,
+n_measurements) together with their Jacobian (n_signals, n_measurements,
+n_params). Parameter settings that violate the constraints of the model are
+marked by predicting a non-finite signal and steps to such settings are
+rejected (as in the error functions that the models use with
+`scipy.optimize.leastsq`).
+
+Both `levenberg_marquardt` and `fit_blocks` return a tuple `(params, info)`,
+where info is a dict with the following keys (each an array (n_signals,)):
+
+'ssr': the sum of squared residuals at the returned parameters.
+'n_iterations': how many iterations were run for each signal.
+'converged': whether an accepted step met ftol or xtol before max_iter.
+'stalled': whether the fit stopped because no step decreases the residuals
+    any more, even with very large damping. These fits have not converged,
+    and neither have fits from nan or infeasible starting points (which are
+    neither converged nor stalled).
+
+"""
+import numpy as np
+
+import osmosis.parallel.pool as ozp
+
+
+def levenberg_marquardt(func, params0, data, args=(), max_iter=200, ftol=1e-4,
+                        xtol=1e-8, damping=1e-3):
+    """
+    Fit func to each of the signals in data with the Levenberg-Marquardt
+    algorithm.
+
+    Parameters
+    ----------
+    func : callable
+        `func(params, *args)` returns the predicted signals and their
+        Jacobian (see module docstring).
+
+    params0 : array (n_params,) or (n_signals, n_params)
+        The starting point. A 1-d array is used as the starting point for all
+        the signals.
+
+    data : array (n_signals, n_measurements)
+
+    args : tuple, optional
+        Additional arguments to func.
+
+    max_iter : int, optional
+        Maximal number of iterations.
+
+    ftol : float, optional
+        Stop when an accepted step decreases the sum of squared residuals by
+        less than this fraction.
+
+    xtol : float, optional
+        Stop when an accepted step is smaller than this fraction of the
+        parameters.
+
+    damping : float, optional
+        The initial damping. It is divided by 10 after each accepted step and
+        multiplied by 10 after each rejected step.
+
+    Returns
+    -------
+    params, info (see module docstring)
+
+    Notes
+    -----
+    The damping is scaled by the diagonal of J'J (Marquardt, 1963), so that
+    the steps don't depend on the units of the parameters. The Jacobian is
+    only re-evaluated where a step was accepted.
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=float))
+    n_signals = data.shape[0]
+    params0 = np.asarray(params0, dtype=float)
+    params = np.array(np.broadcast_to(params0,
+                                      (n_signals, params0.shape[-1])))
+    pred, jac = func(params, *args)
+    with np.errstate(invalid='ignore', over='ignore'):
+        ssr = np.sum((data - pred) ** 2, -1)
+
+    lam = damping * np.ones(n_signals)
+    n_iterations = np.zeros(n_signals, dtype=int)
+    active = np.isfinite(ssr)
+    stalled = np.zeros(n_signals, dtype=bool)
+    diag = np.arange(params.shape[-1])
+
+    for iteration in range(max_iter):
+        idx = np.where(active)[0]
+        if len(idx) == 0:
+            break
+        J = jac[idx]
+        JtJ = np.einsum('vmi,vmj->vij', J, J)
+        Jtr = np.einsum('vmi,vm->vi', J, data[idx] - pred[idx])
+        # Keep the damped matrix positive definite even where one of the
+        # parameters has no effect on the signal:
+        scale = JtJ[:, diag, diag]
+        scale = np.maximum(scale, 1e-12 * np.max(scale, -1)[:, None] + 1e-300)
+        A = JtJ.copy()
+        A[:, diag, diag] += lam[idx][:, None] * scale
+        step = np.linalg.solve(A, Jtr[..., None])[..., 0]
+
+        new_params = params[idx] + step
+        new_pred, new_jac = func(new_params, *args)
+        with np.errstate(invalid='ignore', over='ignore'):
+            new_ssr = np.sum((data[idx] - new_pred) ** 2, -1)
+            better = new_ssr < ssr[idx]
+            small_f = (ssr[idx] - new_ssr) <= ftol * ssr[idx]
+        small_x = (np.sqrt(np.sum(step ** 2, -1)) <=
+                   xtol * (np.sqrt(np.sum(params[idx] ** 2, -1)) + xtol))
+        n_iterations[idx] += 1
+
+        accept = idx[better]
+        params[accept] = new_params[better]
+        pred[accept] = new_pred[better]
+        jac[accept] = new_jac[better]
+        ssr[accept] = new_ssr[better]
+        lam[accept] /= 10.
+        lam[idx[~better]] *= 10.
+
+        # No step decreases the residuals any more once the damping is this
+        # large, so we give up on these:
+        met = better & (small_f | small_x)
+        stall = ~met & (lam[idx] > 1e16)
+        stalled[idx[stall]] = True
+        active[idx[met | stall]] = False
+
+    converged = np.isfinite(ssr) & ~active & ~stalled
+    return params, dict(ssr=ssr, n_iterations=n_iterations,
+                        converged=converged, stalled=stalled)
+
+
+def _lm_block(block):
+    """
+    Helper function to fit one block of signals (this is what gets sent to
+    the workers in `fit_blocks`)
+    """
+    func, params0, data, args, kwargs = block
+    return levenberg_marquardt(func, params0, data, args=args, **kwargs)
+
+
+def fit_blocks(func, params0, data, args=(), n_jobs=1, block_size=1000,
+               backend='process', **kwargs):
+    """
+    Fit func to each of the signals in data with `levenberg_marquardt`, in
+    blocks of signals, which can be processed in parallel.
+
+    Parameters
+    ----------
+    func : callable
+        As in `levenberg_marquardt`. To use more than one process, func needs
+        to be a module-level function (so that it can be pickled).
+
+    params0 : array (n_params,) or (n_signals, n_params)
+
+    data : array (n_signals, n_measurements)
+
+    args : tuple, optional
+        Additional arguments to func.
+
+    n_jobs : int, optional
+        How many workers to use. Defaults to 1 (no pool is started). If this
+        is None, all the CPUs are used.
+
+    block_size : int, optional
+        How many signals are fit together.
+
+    backend : str, optional
+        'thread' or 'process' (see `osmosis.parallel.pool.map_blocks`).
+
+    kwargs : passed on to `levenberg_marquardt`.
+
+    Returns
+    -------
+    params, info (see module docstring)
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=float))
+    params0 = np.asarray(params0, dtype=float)
+    params0 = np.broadcast_to(params0, (data.shape[0], params0.shape[-1]))
+    blocks = [(func, params0[start:start + block_size],
+               data[start:start + block_size], args, kwargs)
+              for start in range(0, data.shape[0], block_size)]
+    results = list(ozp.map_blocks(_lm_block, blocks, n_jobs=n_jobs,
+                                  backend=backend))
+    if len(results) == 0:
+        return (np.empty(params0.shape),
+                dict(ssr=np.empty(0), n_iterations=np.zeros(0, dtype=int),
+                     converged=np.zeros(0, dtype=bool),
+                     stalled=np.zeros(0, dtype=bool)))
+
+    params = np.concatenate([r[0] for r in results])
+    info = dict((k, np.concatenate([r[1][k] for r in results]))
+                for k in results[0][1])
+    return params, info
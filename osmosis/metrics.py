@@ -0,0 +1,214 @@
+"""
+
+Vectorized voxel-wise metrics for comparing signals, model fits and model
+parameters.
+
+All the functions in this module take arrays of shape (n_vox, n) (or any
+shape, with the measurements on the last dimension) and return one value for
+each row. They are computed in blocks of rows, so that the temporary arrays
+stay small even for whole-brain data.
+
+"""
+import numpy as np
+import scipy.stats as stats
+
+import osmosis.utils as ozu
+
+# Number of rows in each block:
+BLOCK_SIZE = 10000
+
+
+def _rowwise(func, *arrays, **kwargs):
+    """
+    Helper function to apply func, which computes a value for each row of its
+    (2-d) inputs, to blocks of rows of arrays with any number of leading
+    dimensions.
+    """
+    block_size = kwargs.pop('block_size', BLOCK_SIZE)
+    arrays = [np.asarray(a, dtype=float) for a in arrays]
+    out_shape = np.broadcast(*[a[..., 0] for a in arrays]).shape
+    arrays = [np.broadcast_to(a, out_shape + a.shape[-1:]).reshape(
+                                          -1, a.shape[-1]) for a in arrays]
+    n_rows = arrays[0].shape[0]
+    out = None
+    for start in range(0, n_rows, block_size):
+        block = func(*[a[start:start + block_size] for a in arrays], **kwargs)
+        if out is None:
+            if isinstance(block, tuple):
+                out = tuple(np.empty(n_rows) for b in block)
+            else:
+                out = np.empty(n_rows)
+        if isinstance(block, tuple):
+            for o, b in zip(out, block):
+                o[start:start + block_size] = b
+        else:
+            out[start:start + block_size] = block
+
+    if out is None:
+        return np.empty(out_shape)
+    if isinstance(out, tuple):
+        return tuple(o.reshape(out_shape) for o in out)
+    return out.reshape(out_shape)
+
+
+def _demean(x):
+    return x - np.mean(x, -1)[:, None]
+
+
+def _pearson_r(x, y):
+    x = _demean(x)
+    y = _demean(y)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(x * y, -1) / np.sqrt(np.sum(x ** 2, -1) *
+                                           np.sum(y ** 2, -1))
+
+
+def pearson_r(x, y, block_size=BLOCK_SIZE):
+    """
+    The Pearson correlation coefficient between x and y in each row.
+
+    Parameters
+    ----------
+    x, y : arrays (..., n)
+
+    Returns
+    -------
+    r : array (...)
+        nan in rows where either x or y is constant.
+    """
+    return _rowwise(_pearson_r, x, y, block_size=block_size)
+
+
+def _linregress(x, y):
+    x_dm = _demean(x)
+    y_dm = _demean(y)
+    ssx = np.sum(x_dm ** 2, -1)
+    sxy = np.sum(x_dm * y_dm, -1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = sxy / ssx
+        r = sxy / np.sqrt(ssx * np.sum(y_dm ** 2, -1))
+    intercept = np.mean(y, -1) - slope * np.mean(x, -1)
+    return slope, intercept, r
+
+
+def linregress(x, y, block_size=BLOCK_SIZE):
+    """
+    A least-squares linear regression of y on x in each row (as in
+    `scipy.stats.linregress`).
+
+    Parameters
+    ----------
+    x, y : arrays (..., n)
+
+    Returns
+    -------
+    slope, intercept, r : arrays (...)
+       r is the correlation coefficient, so that R squared is r ** 2.
+    """
+    return _rowwise(_linregress, x, y, block_size=block_size)
+
+
+def _coeff_of_determination(data, model):
+    ss_err = np.sum((data - model) ** 2, -1)
+    ss_tot = np.sum(_demean(data) ** 2, -1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cod = 1 - ss_err / ss_tot
+    # There's no point in any of this where there's nothing there:
+    cod[ss_tot == 0] = np.nan
+    return cod
+
+
+def coeff_of_determination(data, model, block_size=BLOCK_SIZE):
+    """
+    The coefficient of determination of the model for the data in each row
+    (see `osmosis.utils.coeff_of_determination`).
+
+    Parameters
+    ----------
+    data, model : arrays (..., n)
+
+    Returns
+    -------
+    cod : array (...)
+        1 - (sum of the squared residuals / sum of the squared demeaned data).
+        nan in rows where the data is constant.
+    """
+    return _rowwise(_coeff_of_determination, data, model,
+                    block_size=block_size)
+
+
+def _rmse(x, y):
+    return np.sqrt(np.mean((x - y) ** 2, -1))
+
+
+def rmse(x, y, block_size=BLOCK_SIZE):
+    """
+    The root mean squared error between x and y in each row.
+
+    Parameters
+    ----------
+    x, y : arrays (..., n)
+
+    Returns
+    -------
+    rmse : array (...)
+    """
+    return _rowwise(_rmse, x, y, block_size=block_size)
+
+
+def _vector_angle(a, b, antipodal=False):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cos = np.sum(a * b, -1) / np.sqrt(np.sum(a ** 2, -1) *
+                                          np.sum(b ** 2, -1))
+    if antipodal:
+        cos = np.abs(cos)
+    return np.arccos(np.clip(cos, -1, 1))
+
+
+def vector_angle(a, b, antipodal=False, block_size=BLOCK_SIZE):
+    """
+    The angle between the vectors in each row of a and b.
+
+    Parameters
+    ----------
+    a, b : arrays (..., n)
+
+    antipodal : bool, optional
+        Whether a vector and its antipode are the same direction (as for
+        diffusion directions). If True, the angles lie in [0, pi/2].
+
+    Returns
+    -------
+    angle : array (...)
+        In radians. nan in rows where either vector is all zeros.
+    """
+    return _rowwise(_vector_angle, a, b, antipodal=antipodal,
+                    block_size=block_size)
+
+
+def rowwise_correlator(correlator, r_idx):
+    """
+    Get the vectorized equivalent of a voxel-by-voxel correlator.
+
+    Parameters
+    ----------
+    correlator : callable
+        A function that is applied to each pair of 1-d arrays, such as
+        `scipy.stats.pearsonr` or `scipy.stats.linregress`.
+
+    r_idx : int
+        The index of the value of interest in the tuple returned by the
+        correlator (negative for correlators that return the value itself).
+
+    Returns
+    -------
+    A function that takes two (n_vox, n) arrays and returns the value of
+    interest for each row, or None, if there is no vectorized equivalent.
+    """
+    if correlator is stats.pearsonr and r_idx == 0:
+        return pearson_r
+    if correlator is stats.linregress and r_idx in (0, 1, 2):
+        return lambda x, y: linregress(x, y)[r_idx]
+    if correlator is ozu.coeff_of_determination and not r_idx >= 0:
+        return coeff_of_determination
+    return None
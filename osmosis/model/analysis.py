@@ -4,7 +4,9 @@ Functions for analyzing one model or (usually) more.
 
 """
 import numpy as np
+import scipy.stats as stats
 
+import osmosis.metrics as metrics
 import osmosis.utils as ozu
 import osmosis.snr as snr
 import osmosis.model.sparse_deconvolution as sfm
@@ -34,10 +36,7 @@ def overfitting_index(model1, model2):
     # error on the testing data:
     overfit = (fit_rmse - predict_rmse) / (fit_rmse + predict_rmse) 
     
-    out = ozu.nans(model1.shape[:-1])    
-    out[model1.mask] = overfit
-
-    return out
+    return model1._masked(overfit)
     
 def relative_mae(model1, model2):
     """
@@ -46,8 +45,6 @@ def relative_mae(model1, model2):
     """
     # Assume that the last dimension is the signal dimension, so the dimension
     # across which the mae will be calculated: 
-    out = ozu.nans(model1.shape[:-1])
-    
     sig1 = model1.signal[model1.mask]
     sig2 = model2.signal[model2.mask]
     fit1 = model1.fit[model1.mask]
@@ -62,9 +59,7 @@ def relative_mae(model1, model2):
 
     rel_mae = fit_mae/signal_mae
 
-    out[model1.mask] = rel_mae
-
-    return out
+    return model1._masked(rel_mae)
 
 
 def rsquared(model1, model2):
@@ -78,16 +73,10 @@ def rsquared(model1, model2):
     fit1 = model1.fit[model1.mask]
     fit2 = model2.fit[model2.mask]
 
-    out_flat = np.empty(fit1.shape[0])
-    
-    for vox in xrange(fit1.shape[0]):
-        out_flat[vox] = np.mean([np.corrcoef(fit1[vox], sig2[vox])[0,1],
-                                 np.corrcoef(fit2[vox], sig1[vox])[0,1]])
-        
-    out = ozu.nans(model1.shape[:-1])
+    out_flat = np.mean([metrics.pearson_r(fit1, sig2),
+                        metrics.pearson_r(fit2, sig1)], 0)
 
-    out[model1.mask] = out_flat
-    return out
+    return model1._masked(out_flat)
     
 def cross_predict(model1, model2):
     """
@@ -99,8 +88,6 @@ def cross_predict(model1, model2):
 
     """
 
-    out = ozu.nans(model1.shape[:-1])
-    
     sig1 = model1.signal[model1.mask]
     sig2 = model2.signal[model2.mask]
     # Cross predict, using the parameters from one model to predict the
@@ -116,9 +103,7 @@ def cross_predict(model1, model2):
     predict_rmse = (predict1_rmse + predict2_rmse) / 2.
     rel_rmse = predict_rmse/signal_rmse
 
-    out[model1.mask] = rel_rmse
-
-    return out
+    return model1._masked(rel_rmse)
 
 
 def relative_rmse(model1, model2):
@@ -147,8 +132,6 @@ def relative_rmse(model1, model2):
     """
     # Assume that the last dimension is the signal dimension, so the dimension
     # across which the rmse will be calculated: 
-    out = ozu.nans(model1.shape[:-1])
-    
     sig1 = model1.signal[model1.mask]
     sig2 = model2.signal[model2.mask]
     fit1 = model1.fit[model1.mask]
@@ -163,12 +146,11 @@ def relative_rmse(model1, model2):
 
     rel_rmse = fit_rmse/signal_rmse
 
-    out[model1.mask] = rel_rmse
-
-    return out
+    return model1._masked(rel_rmse)
 
 
-def noise_ceiling(model1, model2, n_sims=1000, alpha=0.05):
+def noise_ceiling(model1, model2, n_sims=1000, alpha=0.05, seed=None,
+                  method='simulation', block_size=None):
     """
     Calculate the maximal model accuracy possible, given the noise in the
     signal. This is based on the method described by Kay et al. (in review).
@@ -181,7 +163,21 @@ def noise_ceiling(model1, model2, n_sims=1000, alpha=0.05):
     n_sims: int
        How many simulations of the signal to perform in each voxel.
 
-    alpha:
+    alpha: float
+       The confidence interval is the central (1-alpha) part of the
+       distribution.
+
+    seed: int, optional
+       Seed for the random number generator, for reproducible simulations.
+
+    method: str, optional
+       'simulation': Monte Carlo simulation (see Notes).
+       'analytic': skip the simulations, and use a normal approximation of the
+       distribution of the coefficient of determination (see Notes).
+
+    block_size: int, optional
+       How many voxels to simulate at a time. Per default, this is set so that
+       each block holds about 10 million random numbers.
 
     Returns
     -------
@@ -236,45 +232,70 @@ def noise_ceiling(model1, model2, n_sims=1000, alpha=0.05):
     noise ceiling. The 95% central values represent a confidence interval on
     this value.  
 
-    This is performed over each voxel in the mask.
+    This is performed over each voxel in the mask. The simulations for a block
+    of voxels are all drawn at once.
 
+    With method='analytic', for $d$ directions, we use
+    $a = \sigma^2_{signal} / (\sigma^2_{signal} + \sigma^2_{noise})$ and
+    $b = 1 - a$. The coefficient of determination is then approximately
+    normally distributed, with mean $1 - b d / (d-1)$ and standard deviation
+    $2 b \sqrt{a / d}$ (using the delta method for the ratio of the sum of
+    squared noise and the sum of squared demeaned signal).
     """
     # Extract the relative signal 
     sig1 = model1.relative_signal[model1.mask]
     sig2 = model2.relative_signal[model1.mask]
-
-    noise_ceil_flat = np.empty(sig1.shape[0])
-    ub_flat = np.empty(sig1.shape[0])
-    lb_flat = np.empty(sig1.shape[0])
-
-    for vox in xrange(sig1.shape[0]):
-        sigma_noise = np.sqrt(np.mean(np.var([sig1[vox],sig2[vox]],0)))
-        mean_sig_w_noise = np.mean([sig1[vox], sig2[vox]], 0)
-        var_sig_w_noise = np.var(mean_sig_w_noise)
-        sigma_signal = np.sqrt(np.max([0, var_sig_w_noise - sigma_noise**2]))
-        # Create the simulated signal over many iterations:
-        sim_signal = sigma_signal * np.random.randn(sig1[vox].shape[0] * n_sims)
-        sim_signal_w_noise = (sim_signal +
-                    sigma_noise * np.random.randn(sig1[vox].shape[0] * n_sims))
-
-        # Reshape it so that you have n_sims separate simulations of this voxel:
-        sim_signal = np.reshape(sim_signal, (n_sims, -1))
-        sim_signal_w_noise = np.reshape(sim_signal_w_noise, (n_sims, -1))
-        coeffs = ozu.coeff_of_determination(sim_signal_w_noise, sim_signal)
-        sort_coeffs = np.sort(coeffs)
-        lb_flat[vox] = sort_coeffs[alpha/2 * coeffs.shape[-1]]
-        ub_flat[vox] = sort_coeffs[1-alpha/2 * coeffs.shape[-1]]
-        noise_ceil_flat[vox] = np.median(coeffs)
-
-    out_coeffs = ozu.nans(model1.mask.shape)
-    out_ub = ozu.nans(out_coeffs.shape)
-    out_lb = ozu.nans(out_coeffs.shape)
-    
-    out_coeffs[model1.mask] = noise_ceil_flat
-    out_lb[model1.mask] = lb_flat
-    out_ub[model1.mask] = ub_flat
-
-    return out_coeffs, out_lb, out_ub
+    n_vox, n_dirs = sig1.shape
+
+    sigma_noise = np.sqrt(np.mean(np.var([sig1, sig2], 0), -1))
+    mean_sig_w_noise = np.mean([sig1, sig2], 0)
+    var_sig_w_noise = np.var(mean_sig_w_noise, -1)
+    sigma_signal = np.sqrt(np.maximum(0, var_sig_w_noise - sigma_noise**2))
+
+    percentiles = [100 * alpha/2., 50, 100 * (1 - alpha/2.)]
+    if method == 'analytic':
+        z = stats.norm.ppf(1 - alpha/2.)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            a = sigma_signal**2 / (sigma_signal**2 + sigma_noise**2)
+        b = 1 - a
+        noise_ceil_flat = 1 - b * n_dirs / (n_dirs - 1.)
+        ci = z * 2 * b * np.sqrt(a / n_dirs)
+        lb_flat = noise_ceil_flat - ci
+        ub_flat = np.minimum(noise_ceil_flat + ci, 1)
+
+    elif method == 'simulation':
+        prng = np.random.RandomState(seed)
+        if block_size is None:
+            block_size = max(1, int(1e7 // (n_sims * n_dirs)))
+        noise_ceil_flat = np.empty(n_vox)
+        ub_flat = np.empty(n_vox)
+        lb_flat = np.empty(n_vox)
+        for start in xrange(0, n_vox, block_size):
+            block = slice(start, start + block_size)
+            this_n = sigma_signal[block].shape[0]
+            # Create the simulated signal and noise, n_sims times for each
+            # voxel. The draws for each voxel are consecutive, so that the
+            # result doesn't depend on the block size:
+            draws = prng.randn(this_n, 2, n_sims, n_dirs)
+            sim_signal = sigma_signal[block][:, None, None] * draws[:, 0]
+            sim_noise = sigma_noise[block][:, None, None] * draws[:, 1]
+            sim_signal_w_noise = sim_signal + sim_noise
+
+            # The coefficient of determination of each simulation:
+            ss_err = np.sum(sim_noise ** 2, -1)
+            ss_tot = np.sum((sim_signal_w_noise -
+                    np.mean(sim_signal_w_noise, -1)[..., None]) ** 2, -1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                coeffs = 1 - ss_err / ss_tot
+
+            (lb_flat[block], noise_ceil_flat[block],
+             ub_flat[block]) = np.percentile(coeffs, percentiles, axis=-1)
+    else:
+        e_s = "method should be 'simulation' or 'analytic', not '%s'"%method
+        raise ValueError(e_s)
+
+    return (model1._masked(noise_ceil_flat), model1._masked(lb_flat),
+            model1._masked(ub_flat))
 
         
 def coeff_of_determination(model1, model2):
@@ -282,8 +303,6 @@ def coeff_of_determination(model1, model2):
     Calculate the voxel-wise coefficient of determination between on model fit
     and the other model signal, averaged across both ways.
     """
-    out = ozu.nans(model1.shape[:-1])
-    
     sig1 = model1.signal[model1.mask]
     sig2 = model2.signal[model2.mask]
     fit1 = model1.fit[model1.mask]
@@ -295,9 +314,7 @@ def coeff_of_determination(model1, model2):
     # Average in each element:
     fit_R_sq = np.mean([fit1_R_sq, fit2_R_sq],0)
 
-    out[model1.mask] = fit_R_sq
-
-    return out
+    return model1._masked(fit_R_sq)
 
 
 def rmse(model1, model2):
@@ -305,17 +322,9 @@ def rmse(model1, model2):
     Calculate the voxel-wise RMSE between one model signal and the other model
     signal. 
     """
-    out = ozu.nans(model1.shape[:-1])
-    
     sig1 = model1.signal[model1.mask]
     sig2 = model2.signal[model2.mask]
-    out_flat = np.empty(sig1.shape[0])
-    
-    for vox in xrange(sig1.shape[0]):
-        out_flat[vox] = ozu.rmse(sig1[vox], sig2[vox])
-
-    out[model1.mask] = out_flat
-    return out
+    return model1._masked(metrics.rmse(sig1, sig2))
 
 
 def pdd_reliability(model1, model2):
@@ -334,7 +343,6 @@ def pdd_reliability(model1, model2):
        that voxel. 
     
     """
-    vol_shape = model1.shape[:3]
     pdd1 = model1.principal_diffusion_direction[model1.mask]
     pdd2 = model2.principal_diffusion_direction[model2.mask]
 
@@ -345,14 +353,9 @@ def pdd_reliability(model1, model2):
     if len(pdd2.shape) == 3:
         pdd2 = pdd2[:, 0]
 
-    out_flat = np.empty(pdd1.shape[0])    
-    for vox in xrange(pdd1.shape[0]):
-        this_ang = np.rad2deg(ozu.vector_angle(pdd1[vox], pdd2[vox]))
-        out_flat[vox] = np.min([this_ang, 180-this_ang])
+    out_flat = np.rad2deg(metrics.vector_angle(pdd1, pdd2, antipodal=True))
 
-    out = ozu.nans(vol_shape)
-    out[model1.mask] = out_flat
-    return out
+    return model1._masked(out_flat)
 
 
 def model_params_reliability(model1, model2):
@@ -360,36 +363,21 @@ def model_params_reliability(model1, model2):
     Compute the vector angle between the sets of model params for two model
     instances in each voxel as a measure of model reliability.
     """
-    vol_shape = model1.shape[:3]
-
     mp1 = model1.model_params[model1.mask]
     mp2 = model2.model_params[model1.mask]
     
-    out_flat = np.empty(mp1.shape[0])
-    
-    for vox in xrange(out_flat.shape[0]):
-        out_flat[vox]= np.rad2deg(ozu.vector_angle(mp1[vox], mp2[vox]))
+    out_flat = np.rad2deg(metrics.vector_angle(mp1, mp2))
 
-    out = ozu.nans(vol_shape)
-    out[model1.mask] = out_flat
-    return out
+    return model1._masked(out_flat)
 
 def fit_reliability(model1, model2):
     """
     Compute the vector angle between the model-predicted signal in each voxel
     as a measure of model reliability. 
     """
-    vol_shape = model1.shape[:3]
-
     fit1 = model1.fit[model1.mask]
     fit2 = model2.fit[model1.mask]
     
-    out_flat = np.empty(fit1.shape[0])
-    
-    for vox in xrange(out_flat.shape[0]):
-        out_flat[vox]= np.corrcoef(fit1[vox], fit2[vox])[0,1]
-        
+    out_flat = metrics.pearson_r(fit1, fit2)
 
-    out = ozu.nans(vol_shape)
-    out[model1.mask] = out_flat
-    return out
+    return model1._masked(out_flat)
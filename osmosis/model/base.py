@@ -8,29 +8,63 @@ import warnings
 import numpy as np
 import scipy.stats as stats
 
-# We want to try importing numexpr for some array computations, but we can do
-# without:
-try:
-    import numexpr
-    has_numexpr = True
-except ImportError:
-    e_s = "Could not import numexpr. Get it! "
-    warnings.warn(e_s)
-    has_numexpr = False
-
 import nibabel as ni
 
 import osmosis.boot as boot
 import osmosis.descriptors as desc
+import osmosis.instrument as ozi
+import osmosis.lazy as ozl
+import osmosis.metrics as metrics
+import osmosis.parallel.pool as ozp
 import osmosis.utils as ozu
+import osmosis.volume as ozv
 from osmosis.model.io import params_file_resolver
 
+# We want to use numexpr for some array computations, but we can do without
+# (it's only imported when it's first used):
+has_numexpr = ozl.has_module('numexpr')
+if not has_numexpr:
+    e_s = "Could not import numexpr. Get it! "
+    warnings.warn(e_s)
+numexpr = ozl.lazy_import('numexpr')
 
 # This converts b values from s/mm^2 to ms/um^2 so that it matches the units
 # of ADC we use in the Stejskal/Tanner equation: 
 SCALE_FACTOR = 1000
 
 
+def _apply_correlator(correlator, r_idx, flat1, flat2):
+    """
+    Helper function to apply a correlator to each pair of rows of two flat
+    (n_vox, n) arrays, using its vectorized equivalent from osmosis.metrics if
+    there is one.
+    """
+    rowwise = metrics.rowwise_correlator(correlator, r_idx)
+    if rowwise is not None:
+        return rowwise(flat1, flat2)
+
+    val = np.empty(flat1.shape[0])
+    for ii in xrange(len(val)):
+        if r_idx>=0:
+            val[ii] = correlator(flat1[ii], flat2[ii])[r_idx]
+        else:
+            val[ii] = correlator(flat1[ii], flat2[ii])
+    return val
+
+
+def _map_block(block):
+    """
+    Helper function to apply a function to each of the voxels in a block (this
+    is what gets sent to the workers in `BaseModel._voxel_map`)
+    """
+    func, inputs, args, out_shape = block
+    out = np.empty((inputs[0].shape[0],) + out_shape)
+    for vox in xrange(out.shape[0]):
+        out[vox] = func(*([this_input[vox] for this_input in inputs] +
+                          list(args)))
+    return out
+
+
 class DWI(desc.ResetMixin):
     """
     A class for representing dwi data
@@ -250,6 +284,18 @@ class DWI(desc.ResetMixin):
             warnings.warn(w_s)
             return np.matrix(np.eye(4))
 
+    def _masked(self, flat):
+        """
+        Put values computed in the voxels of the mask (for example, from
+        self._flat_signal) into a `osmosis.volume.MaskedVolume`
+        """
+        if not isinstance(self.mask, np.ndarray):
+            # Single-voxel data, there is no volume to speak of:
+            return flat
+        # Only read the affine if it's there to be read:
+        affine = self.affine if hasattr(self, 'data_file') else None
+        return ozv.MaskedVolume(flat, self.mask, affine=affine)
+
     @desc.auto_attr
     def _flat_data(self):
         """
@@ -302,18 +348,15 @@ class DWI(desc.ResetMixin):
             If square is True, that means that the value returned from
             the correlator should be squared before returning it, otherwise,
             the value itself is returned.
-            
-        """
-                
-        val = np.empty(self._flat_signal.shape[0])
 
-        for ii in xrange(len(val)):
-            if r_idx>=0:
-                val[ii] = correlator(self._flat_signal[ii],
-                                     DWI2._flat_signal[ii])[r_idx] 
-            else:
-                val[ii] = correlator(self._flat_signal[ii],
-                                     DWI2._flat_signal[ii]) 
+        Notes
+        -----
+        For the correlators that have a vectorized equivalent in
+        `osmosis.metrics` (e.g. stats.pearsonr and stats.linregress), all the
+        voxels are computed at once.
+        """
+        val = _apply_correlator(correlator, r_idx, self._flat_signal,
+                                DWI2._flat_signal)
 
         if square:
             if has_numexpr:
@@ -324,13 +367,7 @@ class DWI(desc.ResetMixin):
             r_squared = val
         
         # Re-package it into a volume:
-        out = ozu.nans(self.shape[:3])
-        out[self.mask] = r_squared
-
-        out[out<-1]=-1.0
-        out[out>1]=1.0
-
-        return out 
+        return self._masked(np.clip(r_squared, -1.0, 1.0))
 
     def relative_signal_rmse(self, DWI2):
         """
@@ -343,16 +380,11 @@ class DWI(desc.ResetMixin):
         
         """
         
-        flat_sig1 = self._flat_relative_signal
-        flat_sig2 = DWI2._flat_relative_signal
-        rmse = np.empty(flat_sig2.shape[0])
-        for vox in xrange(flat_sig1.shape[0]):
-            rmse[vox] = ozu.rmse(flat_sig1[vox], flat_sig2[vox])
-            
+        rmse = metrics.rmse(self._flat_relative_signal,
+                        DWI2._flat_relative_signal)
+
         # Re-package it into a volume:
-        out = ozu.nans(self.shape[:3])
-        out[self.mask] = rmse
-        return out
+        return self._masked(rmse)
 
     @desc.auto_attr
     def b_idx(self):
@@ -438,6 +470,13 @@ class BaseModel(DWI):
     """
     Base-class for models.
     """
+    # Defaults for the voxel-wise computations (see `_voxel_map`). Set these
+    # on an instance, before its attributes are computed, to use several
+    # workers:
+    n_jobs = 1
+    voxel_block_size = 1000
+    voxel_backend = 'thread'
+
     def __init__(self,
                  data,
                  bvecs,
@@ -474,13 +513,99 @@ class BaseModel(DWI):
         if params_file == 'temp':
             self.params_file='temp'
         else:
-            # Introspect to figure out what name the current class has:
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
+            # The name of the current class:
+            this_class = self.__class__.__name__
             self.params_file = params_file_resolver(self,
                                                     this_class,
                                                     params_file=params_file)
 
 
+    def _load_params(self):
+        """
+        Read the model params from the params file (which is recorded as a
+        cache hit, see `osmosis.instrument`)
+        """
+        ozi.cache_event(ozi.label(self, 'model_params'), True,
+                        source=self.params_file)
+        return self._masked(ni.load(self.params_file).get_data()[self.mask])
+
+    def _voxel_map(self, func, inputs, out_shape=(), block_size=None,
+                   n_jobs=None, args=(), backend=None):
+        """
+        Apply a function to each of the voxels in the mask and put the results
+        into a volume.
+
+        Parameters
+        ----------
+        func: callable
+            Called as `func(inputs[0][vox], inputs[1][vox], ..., *args)` for
+            each voxel, returning an array of shape out_shape. To run in
+            processes, func needs to be a module-level function (so that it
+            can be pickled).
+
+        inputs: array or list of arrays
+            Flat arrays, with one row for each voxel in the mask (for example,
+            self._flat_signal).
+
+        out_shape: tuple, optional
+            The shape of the output of func in each voxel.
+
+        block_size: int, optional
+            How many voxels are sent to a worker at a time. Defaults to
+            self.voxel_block_size.
+
+        n_jobs: int, optional
+            How many workers to use (1 runs in this process). Defaults to
+            self.n_jobs. If that is None, all the CPUs are used.
+
+        args: tuple, optional
+            Additional arguments to func (the same in all voxels).
+
+        backend: str, optional
+            'thread' or 'process'. Defaults to self.voxel_backend.
+
+        Returns
+        -------
+        out: MaskedVolume
+            Of shape self.signal.shape[:3] + out_shape.
+        """
+        if isinstance(inputs, np.ndarray):
+            inputs = [inputs]
+        inputs = [np.asarray(this_input) for this_input in inputs]
+        out_shape = tuple(out_shape)
+        if block_size is None:
+            block_size = self.voxel_block_size
+        if n_jobs is None:
+            n_jobs = self.n_jobs
+        if backend is None:
+            backend = self.voxel_backend
+
+        n_vox = inputs[0].shape[0]
+        blocks = [(func, [this_input[start:start + block_size]
+                          for this_input in inputs], args, out_shape)
+                  for start in xrange(0, n_vox, block_size)]
+        results = ozp.map_blocks(_map_block, blocks, n_jobs=n_jobs,
+                                 backend=backend)
+
+        if self.verbose:
+            prog_bar = ozu.ProgressBar(n_vox)
+            this_class = self.__class__.__name__
+            f_name = this_class + '.' + func.__name__
+
+        out_flat = np.empty((n_vox,) + out_shape)
+        try:
+            start = 0
+            for result in results:
+                out_flat[start:start + result.shape[0]] = result
+                start += result.shape[0]
+                if self.verbose:
+                    prog_bar.animate(start - 1, f_name=f_name)
+        finally:
+            # Stops the workers if anything goes wrong on the way:
+            results.close()
+
+        return self._masked(out_flat)
+
     @desc.auto_attr
     def adc(self):
         """
@@ -491,12 +616,8 @@ class BaseModel(DWI):
             ADC = -log \frac{S}{b S0}
 
         """
-        out = ozu.nans(self.signal.shape)
-        
-        out[self.mask] = ((-1/self.bvals[self.b_idx][0]) *
-                        np.log(self._flat_relative_signal))
-
-        return out
+        return self._masked((-1/self.bvals[self.b_idx][0]) *
+                            np.log(self._flat_relative_signal))
 
     @desc.auto_attr
     def fit(self):
@@ -516,7 +637,7 @@ class BaseModel(DWI):
         Extract a flattened version of the fit, defined for masked voxels
         """
         
-        return self.fit[self.mask].reshape((-1, self.signal.shape[-1])) 
+        return self.fit[self.mask].reshape((-1, self.signal.shape[-1]))
     
 
     def _correlator(self, correlator, r_idx=0, square=True):
@@ -525,16 +646,8 @@ class BaseModel(DWI):
         arrays. These 1-d arrays can have different outputs and the one we
         always want is the one which is r_idx into the output tuple 
         """
-
-        val = np.empty(self._flat_signal.shape[0])
-
-        for ii in xrange(len(val)):
-            if r_idx>=0:
-                val[ii] = correlator(self._flat_signal[ii],
-                                     self._flat_fit[ii])[r_idx] 
-            else:
-                val[ii] = correlator(self._flat_signal[ii],
-                                     self._flat_fit[ii]) 
+        val = _apply_correlator(correlator, r_idx, self._flat_signal,
+                                self._flat_fit)
         if square:
             if has_numexpr:
                 r_squared = numexpr.evaluate('val**2')
@@ -544,13 +657,7 @@ class BaseModel(DWI):
             r_squared = val
         
         # Re-package it into a volume:
-        out = ozu.nans(self.shape[:3])
-        out[self.mask] = r_squared
-
-        out[out<-1]=-1.0
-        out[out>1]=1.0
-
-        return out 
+        return self._masked(np.clip(r_squared, -1.0, 1.0))
 
     @desc.auto_attr
     def r_squared(self):
@@ -585,18 +692,7 @@ class BaseModel(DWI):
         The square-root of the mean of the squared residuals
         """
 
-        # Preallocate the output:
-
-        out = ozu.nans(self.data.shape[:3])
-        res = self.residuals[self.mask]
-        
-        if has_numexpr:
-            out[self.mask] = np.sqrt(np.mean(
-                             numexpr.evaluate('res ** 2'), -1))
-        else:
-            out[self.mask] = np.sqrt(np.mean(np.power(res, 2), -1))
-        
-        return out
+        return self._masked(metrics.rmse(self._flat_signal, self._flat_fit))
 
     
     @desc.auto_attr
@@ -604,17 +700,14 @@ class BaseModel(DWI):
         """
         The prediction-subtracted residual in each voxel
         """
-        out = ozu.nans(self.signal.shape)
         sig = self._flat_signal
         fit = self._flat_fit
         
         if has_numexpr:
-            out[self.mask] = numexpr.evaluate('sig - fit')
+            return self._masked(numexpr.evaluate('sig - fit'))
 
         else:
-            out[self.mask] = sig - fit
-            
-        return out
+            return self._masked(sig - fit)
 
     @desc.auto_attr
     def rRMSE(self):
@@ -626,14 +719,14 @@ class BaseModel(DWI):
         """
         
         # Get the RMSE of the model relative to the actual data: 
-        rmse_model = np.sqrt(np.mean(self.residuals**2, -1))
+        rmse_model = self.RMSE[self.mask]
 
         # Normalize that to the variance in the b0, which is an estimate of data
         # reliability:
-        rms_b0 = ozu.rms(self.data[...,self.b0_idx]-
+        rms_b0 = ozu.rms(self._flat_data[:, self.b0_idx]-
                          np.mean(self.S0)[...,np.newaxis])
 
-        return rmse_model/rms_b0
+        return self._masked(rmse_model/rms_b0)
 
 
 class SphereModel(BaseModel):
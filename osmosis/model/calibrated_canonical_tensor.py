@@ -1,18 +1,69 @@
-import inspect
-
 import numpy as np
-import scipy.optimize as opt
 
 import nibabel as ni
-import dipy.core.geometry as geo
 
-import osmosis.tensor as ozt
 import osmosis.utils as ozu
 import osmosis.descriptors as desc
-from osmosis.model.canonical_tensor import CanonicalTensorModel
+import osmosis.levmar as levmar
+from osmosis.model.canonical_tensor import (CanonicalTensorModel,
+                                            rotated_tensor_signal)
 from osmosis.model.base import SCALE_FACTOR
 
 
+def calibrated_signal(params, bvecs, bvals, check_constraints=True):
+    """
+    The relative signal predicted by the calibration model of
+    CalibratedCanonicalTensorModel for many settings of the parameters at
+    once, and its Jacobian.
+
+    Parameters
+    ----------
+    params : array (n, 5)
+        theta, phi, beta, lambda1, lambda2
+
+    bvecs : array (3, m)
+    bvals : array (m,)
+        The isotropic component is computed with the first b value.
+
+    check_constraints : bool, optional
+        Whether to predict an infinite signal for parameters that are out of
+        bounds, or that predict a relative signal outside of [0, 1] (as the
+        error function used in calibration does).
+
+    Returns
+    -------
+    pred : array (n, m)
+    jac : array (n, m, 5)
+    """
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    theta, phi, beta, lambda1, lambda2 = params.T
+    sig, s_theta, s_phi, s_l1, s_l2 = rotated_tensor_signal(theta, phi, bvecs,
+                                                            bvals, lambda1,
+                                                            lambda2)
+    iso_sig = np.exp(-bvals[0] * lambda1)[:, None]
+    beta = beta[:, None]
+    pred = beta * iso_sig + (1 - beta) * sig
+    jac = np.stack([(1 - beta) * s_theta,
+                    (1 - beta) * s_phi,
+                    iso_sig - sig,
+                    -bvals[0] * beta * iso_sig + (1 - beta) * s_l1,
+                    (1 - beta) * s_l2], -1)
+
+    if check_constraints:
+        # Angles are 0=<theta<=pi and -pi<=phi<= pi, no negative
+        # diffusivities, the axial diffusivity needs to be larger than the
+        # radial diffusivity and the weights are between 0 and 1:
+        lb = np.array([0, -np.pi, 0, 0, 0])
+        ub = np.array([np.pi, np.pi, 1, np.inf, np.inf])
+        out = (np.any((params < lb) | (params > ub), -1) |
+               (lambda2 > lambda1))
+        # The predicted signal needs to be between 0 and 1 (relative signal!):
+        out |= np.any((pred > 1) | (pred < 0), -1)
+        pred[out] = np.inf
+    return pred, jac
+
+
+
 class CalibratedCanonicalTensorModel(CanonicalTensorModel):
     """
     This is another extension of the CanonicalTensorModel, which extends the
@@ -77,6 +128,10 @@ class CalibratedCanonicalTensorModel(CanonicalTensorModel):
         except ones where the calibration ROI is defined. Should be already
         registered and xformed to the DWI data resolution/alignment. 
 
+        The voxels in the calibration ROI are fit in blocks (see
+        `osmosis.levmar.fit_blocks`), in self.n_jobs workers (see
+        `BaseModel._voxel_map`).
+
         """
         # Initialize the super-class, we set AD and RD to None, to prevent
         # things from going forward before calibration has occurred. This will
@@ -109,73 +164,21 @@ class CalibratedCanonicalTensorModel(CanonicalTensorModel):
         """
         Error function for the non-linear optimization 
         """
-
-        # The fit parameters: 
-        theta, phi, beta, lambda1, lambda2 = params
         # Additional argument
         vox_sig = args
-
-        # Constraints to stabilize the fit 
-        # Angles are 0=<theta<=pi 
-        if theta>np.pi or theta<0:
-            return np.inf
-        # ... and -pi<=phi<= pi:
-        if phi>np.pi or phi<-np.pi:
-            return np.inf
-        # No negative diffusivities: 
-        if lambda1<0 or lambda2<0:
-             return np.inf
-        # The axial diffusivity needs to be larger than the radial diffusivity
-        if lambda2 > lambda1:
-            return np.inf
-        # Weights between 0 and 1:
-        if beta>1 or beta<0:
-             return np.inf
-
-        # Predict the signal based on the current parameter setting
-        this_pred = self._pred_sig(theta, phi, beta, lambda1, lambda2)
-
-        # The predicted signal needs to be between 0 and 1 (relative signal!):
-        if np.any(this_pred>1) or np.any(this_pred<0):
-            return np.inf
-
-        # Finally, if everything is alright, return the error (leastsq will take
-        # care of squaring and summing it for you):
-        return (this_pred - vox_sig)
+        # Out of bounds parameters predict an infinite signal (leastsq will take
+        # care of squaring and summing the error for you):
+        return calibrated_signal(params, self.bvecs[:, self.b_idx],
+                                 self.bvals[self.b_idx])[0][0] - vox_sig
 
     def _pred_sig(self, theta, phi, beta, lambda1, lambda2):
         """
         The predicted signal for a particular setting of the parameters
         """
-
-        Q = np.array([[lambda1, 0, 0],
-                      [0, lambda2, 0],
-                      [0, 0, lambda2]])
-
-        # If for some reason this is not symmetrical, then something is wrong
-        # (in all likelihood, this means that the optimization process is
-        # trying out some crazy value, such as nan). In that case, abort and
-        # return a nan:
-        if not np.allclose(Q.T, Q):
-            return np.nan
-        
-        response_function = ozt.Tensor(Q,
-                                        self.bvecs[:,self.b_idx],
-                                        self.bvals[:,self.b_idx])
-                                        
-        # Convert theta and phi to cartesian coordinates:
-        x,y,z = geo.sphere2cart(1, theta, phi)
-        bvec = [x,y,z]
-        evals, evecs = response_function.decompose
-
-        rot_tensor = ozt.tensor_from_eigs(
-            evecs * ozu.calculate_rotation(bvec, evecs[0]),
-            evals, self.bvecs[:,self.b_idx], self.bvals[:,self.b_idx])
-
-        iso_sig = np.exp(-self.bvals[self.b_idx][0] * lambda1)
-        tensor_sig =  rot_tensor.predicted_signal(1)
-
-        return beta * iso_sig + (1-beta) * tensor_sig
+        return calibrated_signal([theta, phi, beta, lambda1, lambda2],
+                                 self.bvecs[:, self.b_idx],
+                                 self.bvals[self.b_idx],
+                                 check_constraints=False)[0][0]
         
 
     @desc.auto_attr
@@ -208,29 +211,19 @@ class CalibratedCanonicalTensorModel(CanonicalTensorModel):
 
         """
 
-        out = np.empty((self.calibration_signal.shape[0],
-                        len(self.start_params)))
-        
         if self.verbose:
             print('Calibrating for AD/RD')
-            prog_bar = ozu.ProgressBar(self.calibration_signal.shape[0])
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-            f_name = this_class + '.' + inspect.stack()[0][3]
-
-        for vox in xrange(self.calibration_signal.shape[0]):
-            # Perform the fitting itself:
-            #out[vox], ier = leastsqbound(self._err_func,
-            #                             self.start_params,
-            #                             bounds = bounds,
-            #                             args=(self.calibration_signal[vox]),
-            #                             **optim_kwds)
-
-            out[vox], ier = opt.leastsq(self._err_func,
-                                        self.start_params,
-                                        args=(self.calibration_signal[vox]))
-            
-            if self.verbose: 
-                prog_bar.animate(vox, f_name=f_name)
+
+        out, info = levmar.fit_blocks(calibrated_signal, self.start_params,
+                                      self.calibration_signal,
+                                      args=(self.bvecs[:, self.b_idx],
+                                            self.bvals[self.b_idx]),
+                                      n_jobs=self.n_jobs,
+                                      block_size=self.voxel_block_size,
+                                      backend=self.voxel_backend)
+
+        # Keep the number of iterations, etc. in each voxel around:
+        self.calibration_info = info
 
         # Set the object's AD/RD according to the calibration:
         self.ad = np.median(out[:, -2])
@@ -249,16 +242,7 @@ class CalibratedCanonicalTensorModel(CanonicalTensorModel):
         target
         """
 
-        out = np.empty((self.calibration_signal.shape[0],
-                        self.relative_signal.shape[-1]))
-
-        # Get the calibration parameters: 
-        theta, phi, beta, lambda1, lambda2 = self.calibrate.T
-
-        for vox in xrange(out.shape[0]):
-            out[vox] = self._pred_sig(theta[vox],
-                                      phi[vox],
-                                      beta[vox],
-                                      lambda1[vox],
-                                      lambda2[vox])
-        return out        
+        return calibrated_signal(self.calibrate,
+                                 self.bvecs[:, self.b_idx],
+                                 self.bvals[self.b_idx],
+                                 check_constraints=False)[0]
@@ -1,28 +1,190 @@
 
 import os
-import inspect
 
 import numpy as np
-import scipy.optimize as opt
 
 import nibabel as ni
 import dipy.core.geometry as geo
-import dipy.data as dpd
 
 import osmosis as oz
 import osmosis.utils as ozu
 import osmosis.tensor as ozt
 import osmosis.descriptors as desc
+import osmosis.lazy as ozl
+import osmosis.levmar as levmar
 from osmosis.model.base import BaseModel
 from osmosis.model.io import params_file_resolver
 from osmosis.model.base import SCALE_FACTOR
 
+# Only imported when it's first used:
+dpd = ozl.lazy_import('dipy.data')
+
 
 # Global constants for this module:
 AD = 1.5
 RD = 0.5
 
 
+def _fit_canonical_vox(sig, b_w, i_w, S0, rotations, iso_regressor, mode):
+    """
+    Choose the best of the OLS solutions (one for each rotation) in one
+    voxel of a CanonicalTensorModel.
+
+    Parameters
+    ----------
+    sig: the signal in the voxel
+    b_w, i_w: the weights on the rotation and on the isotropic component
+        in each of the OLS solutions (nan where they are negative)
+    S0: the signal in the b0 scans in the voxel
+    rotations: the rotated tensor regressors of the model
+    iso_regressor: the isotropic regressor of the model
+    mode: the mode of the model ('log', 'relative_signal', etc.)
+
+    Returns
+    -------
+    The index of the rotation and its two weights
+    """
+    if mode == 'log':
+        vox_fits = (np.exp(b_w[:, None] * rotations +
+                           iso_regressor * i_w[:, None]) * S0)
+    else:
+        this_relative = (b_w[:, None] * rotations +
+                         iso_regressor * i_w[:, None])
+        if mode == 'signal_attenuation':
+            this_relative = 1 - this_relative
+
+        vox_fits = this_relative * S0
+
+    # Find the predicted signal that best matches the original
+    # relative signal. That will choose the direction for the
+    # tensor we use:
+    corrs = ozu.coeff_of_determination(sig, vox_fits)
+    idx = np.where(corrs==np.nanmax(corrs))[0]
+
+    # Sometimes there is no good solution (maybe we need to fit
+    # just an isotropic to all of these?):
+    if len(idx):
+        # In case more than one fits the bill, just choose the
+        # first one:
+        idx = idx[0]
+        return np.array([idx, b_w[idx], i_w[idx]])
+    else:
+        return np.array([np.nan, np.nan, np.nan])
+
+
+def rotated_tensor_signal(theta, phi, bvecs, bvals, ad, rd):
+    """
+    The relative signal (S/S0) of axially symmetric tensors pointing in many
+    directions, and its derivatives.
+
+    Parameters
+    ----------
+    theta, phi : arrays (n,)
+        The inclination and azimuth of the principal diffusion direction of
+        each tensor.
+
+    bvecs : array (3, m)
+    bvals : array (m,)
+
+    ad, rd : floats or arrays (n,)
+        The axial and radial diffusivities of each tensor.
+
+    Returns
+    -------
+    sig, d_theta, d_phi, d_ad, d_rd : arrays (n, m)
+        The signal and its derivatives with respect to theta, phi, ad and rd.
+
+    Notes
+    -----
+    With $\vec{v}$ the principal diffusion direction, the ADC in the
+    direction $\vec{b}$ is $rd + (ad - rd) (\vec{b} \cdot \vec{v})^2$.
+    """
+    theta = np.asarray(theta, dtype=float)
+    phi = np.asarray(phi, dtype=float)
+    st, ct = np.sin(theta), np.cos(theta)
+    sp, cp = np.sin(phi), np.cos(phi)
+    # Same convention as dipy.core.geometry.sphere2cart:
+    v = np.array([st * cp, st * sp, ct]).T
+    v_theta = np.array([ct * cp, ct * sp, -st]).T
+    v_phi = np.array([-st * sp, st * cp, np.zeros_like(st)]).T
+    c = np.dot(v, bvecs)
+    ad = np.asarray(ad, dtype=float)[..., None]
+    rd = np.asarray(rd, dtype=float)[..., None]
+    bvals = np.asarray(bvals, dtype=float)
+    sig = np.exp(-bvals * (rd + (ad - rd) * c ** 2))
+    d_c = -2 * bvals * (ad - rd) * c * sig
+    return (sig, d_c * np.dot(v_theta, bvecs), d_c * np.dot(v_phi, bvecs),
+            -bvals * c ** 2 * sig, -bvals * (1 - c ** 2) * sig)
+
+
+def opt_signal(params, bvecs, bvals, model_form='flexible', ad=AD, rd=RD,
+               iso_diffusivity=3.0, check_constraints=True):
+    """
+    The relative signal predicted by one of the model forms of
+    CanonicalTensorModelOpt for many settings of the parameters at once, and
+    its Jacobian.
+
+    Parameters
+    ----------
+    params : array (n, n_params)
+        (theta, phi, tensor_w, iso_w) for 'flexible', (theta, phi, w) for
+        'constrained' and (theta, phi, w, d) for 'ball_and_stick'.
+
+    bvecs : array (3, m)
+    bvals : array (m,)
+        The isotropic component is computed with the first b value.
+
+    model_form : str, optional
+    ad, rd : float, optional
+        The diffusivities of the canonical tensor (not used for
+        'ball_and_stick').
+    iso_diffusivity : float, optional
+
+    check_constraints : bool, optional
+        Whether to predict an infinite signal for parameters that are out of
+        bounds (as the error function used in fitting does).
+
+    Returns
+    -------
+    pred : array (n, m)
+    jac : array (n, m, n_params)
+    """
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    theta, phi = params[:, 0], params[:, 1]
+    iso_pred_sig = np.exp(-bvals[0] * iso_diffusivity)
+    if model_form == 'flexible':
+        tensor_w, iso_w = params[:, 2:3], params[:, 3:4]
+        sig, s_theta, s_phi = rotated_tensor_signal(theta, phi, bvecs, bvals,
+                                                    ad, rd)[:3]
+        pred = tensor_w * sig + iso_w * iso_pred_sig
+        jac = [tensor_w * s_theta, tensor_w * s_phi, sig,
+               iso_pred_sig * np.ones_like(sig)]
+        bounds = [[0, np.pi], [-np.pi, np.pi], [0, np.inf], [0, np.inf]]
+    elif model_form == 'constrained':
+        w = params[:, 2:3]
+        sig, s_theta, s_phi = rotated_tensor_signal(theta, phi, bvecs, bvals,
+                                                    ad, rd)[:3]
+        pred = (1 - w) * iso_pred_sig + w * sig
+        jac = [w * s_theta, w * s_phi, sig - iso_pred_sig]
+        bounds = [[0, np.pi], [-np.pi, np.pi], [0, 1]]
+    elif model_form == 'ball_and_stick':
+        w, d = params[:, 2:3], params[:, 3:4]
+        # A stick is a tensor with no radial diffusivity:
+        sig, s_theta, s_phi, s_d = rotated_tensor_signal(theta, phi, bvecs,
+                                                         bvals, d[:, 0], 0)[:4]
+        pred = (1 - w) * d + w * sig
+        jac = [w * s_theta, w * s_phi, sig - d, (1 - w) + w * s_d]
+        bounds = [[0, np.pi], [-np.pi, np.pi], [0, 1], [0, np.inf]]
+    else:
+        e_s = "%s is not a recognized model form"% model_form
+        raise ValueError(e_s)
+
+    if check_constraints:
+        lb, ub = np.array(bounds).T
+        pred[np.any((params < lb) | (params > ub), -1)] = np.inf
+    return pred, np.stack(jac, -1)
+
+
 class CanonicalTensorModel(BaseModel):
     """
     This is a simplified bi-tensor model, where one tensor is constrained to be a
@@ -352,72 +514,29 @@ class CanonicalTensorModel(BaseModel):
                 print("Loading params from file: %s"%self.params_file)
 
             # Get the cached values and be done with it:
-            return ni.load(self.params_file).get_data()
+            return self._load_params()
         else:
             # Looks like we might need to do some fitting...
             # Get the bvec weights and the isotropic weights
-            b_w = self.ols[:,0,:].copy().squeeze()
-            i_w = self.ols[:,1,:].copy().squeeze()
+            b_w = self.ols[:,0,:].copy()
+            i_w = self.ols[:,1,:].copy()
 
             # nan out the places where weights are negative: 
             b_w[b_w<0] = np.nan
             i_w[i_w<0] = np.nan
 
-            params = np.empty((self._flat_signal.shape[0],3))
             if self.verbose:
                 print("Fitting CanonicalTensorModel:")
-                prog_bar = ozu.ProgressBar(self._flat_signal.shape[0])
-                this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-                f_name = this_class + '.' + inspect.stack()[0][3]
             # Find the best OLS solution in each voxel:
-            for vox in xrange(self._flat_signal.shape[0]):
-                # We do this in each voxel (instead of all at once, which is
-                # possible...) to not blow up the memory:
-                vox_fits = np.empty(self.rotations.shape)
-                for rot_i, rot in enumerate(self.rotations):
-                    if self.mode == 'log':
-                        this_sig = (np.exp(b_w[rot_i,vox] * rot +
-                                    self.regressors[0][0] * i_w[rot_i,vox]) *
-                                    self._flat_S0[vox])
-                    else:
-                        this_relative = (b_w[rot_i,vox] * rot +
-                                    self.regressors[0][0] * i_w[rot_i,vox])
-                        if self.mode == 'signal_attenuation':
-                            this_relative = 1 - this_relative
-
-                        this_sig = this_relative * self._flat_S0[vox]
-
-                    vox_fits[rot_i] = this_sig
-                    
-                # Find the predicted signal that best matches the original
-                # relative signal. That will choose the direction for the
-                # tensor we use:
-                corrs = ozu.coeff_of_determination(self._flat_signal[vox],
-                                                   vox_fits)
-                idx = np.where(corrs==np.nanmax(corrs))[0]
-                
-                # Sometimes there is no good solution (maybe we need to fit
-                # just an isotropic to all of these?):
-                if len(idx):
-                    # In case more than one fits the bill, just choose the
-                    # first one:
-                    if len(idx)>1:
-                        idx = idx[0]
-                    
-                    params[vox,:] = np.array([idx,
-                                              b_w[idx, vox],
-                                              i_w[idx, vox]]).squeeze()
-                else:
-                    params[vox,:] = np.array([np.nan, np.nan, np.nan])
-
-                if self.verbose:
-                    prog_bar.animate(vox, f_name=f_name)
-
-            # Save the params for future use: 
-            out_params = ozu.nans(self.signal.shape[:3] + (3,))
-            out_params[self.mask] = np.array(params).squeeze()
-            params_ni = ni.Nifti1Image(out_params, self.affine)
+            out_params = self._voxel_map(_fit_canonical_vox,
+                                         [self._flat_signal, b_w.T, i_w.T,
+                                          self._flat_S0], (3,),
+                                         args=(self.rotations,
+                                               self.regressors[0][0],
+                                               self.mode))
             if self.params_file != 'temp':
+                # Save the params for future use: 
+                params_ni = ni.Nifti1Image(np.asarray(out_params), self.affine)
                 if self.verbose:
                     print("Saving params to file: %s"%self.params_file)
                     params_ni.to_filename(self.params_file)
@@ -453,10 +572,7 @@ class CanonicalTensorModel(BaseModel):
             else:
                 out_flat[vox] = np.nan
                 
-        out = ozu.nans(self.signal.shape)
-        out[self.mask] = out_flat
-
-        return out
+        return self._masked(out_flat)
 
 
     def predict(self, vertices):
@@ -495,10 +611,7 @@ class CanonicalTensorModel(BaseModel):
             else:
                 out_flat[vox] = np.nan
                 
-        out = ozu.nans(self.signal.shape[:3] + (vertices.shape[-1], ))
-        out[self.mask] = out_flat
-
-        return out
+        return self._masked(out_flat)
         
         
     @desc.auto_attr
@@ -516,9 +629,7 @@ class CanonicalTensorModel(BaseModel):
             else: 
                 out_flat[vox] = [np.nan, np.nan, np.nan]
 
-        out = ozu.nans(self.model_params.shape)
-        out[self.mask] = out_flat
-        return out
+        return self._masked(out_flat)
 
 
     @desc.auto_attr
@@ -533,9 +644,9 @@ class CanonicalTensorModel(BaseModel):
         Where T is the value of the tensor parameter and S is the value of the
         sphere parameter.
         """
-        
-        return ((self.model_params[...,1] - self.model_params[...,2])/
-                (self.model_params[...,1] + self.model_params[...,2]))
+        flat_params = self.model_params[self.mask]
+        return self._masked((flat_params[:, 1] - flat_params[:, 2])/
+                            (flat_params[:, 1] + flat_params[:, 2]))
     
     
 class CanonicalTensorModelOpt(CanonicalTensorModel):
@@ -608,6 +719,9 @@ class CanonicalTensorModelOpt(CanonicalTensorModel):
         
         Is a tensor with $FA=1$. That is, without any radial component.
 
+        The voxels are fit in blocks (see `osmosis.levmar.fit_blocks`), in
+        self.n_jobs workers (see `BaseModel._voxel_map`).
+
         """
         CanonicalTensorModel.__init__(self,
                                       data,
@@ -633,8 +747,8 @@ class CanonicalTensorModelOpt(CanonicalTensorModel):
         # that we can add the model form into the file name (and run on all
         # model-forms for the same data...):
 
-        # Introspect to figure out what name the current class has:
-        this_class = str(self.__class__).split("'")[-2].split('.')[-1]
+        # The name of the current class:
+        this_class = self.__class__.__name__
 
         # Go on and set it: 
         self.params_file = params_file_resolver(self,
@@ -663,9 +777,10 @@ class CanonicalTensorModelOpt(CanonicalTensorModel):
 
 
     @desc.auto_attr
-    def model_params(self):
+    def _lm_fit(self):
         """
-        Find the model parameters using least-squares optimization.
+        Fit all the voxels with the batched Levenberg-Marquardt algorithm (see
+        `osmosis.levmar`).
         """
         if self.model_form == 'constrained':
             n_params = 3
@@ -675,43 +790,52 @@ class CanonicalTensorModelOpt(CanonicalTensorModel):
             e_s = "%s is not a recognized model form"% self.model_form
             raise ValueError(e_s)
 
-        params = np.empty((self.fit_signal.shape[0],n_params))
-
         if self.verbose:
             print('Fitting CanonicalTensorModelOpt:')
-            prog_bar = ozu.ProgressBar(self._flat_signal.shape[0])
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-            f_name = this_class + '.' + inspect.stack()[0][3]
 
-        # Initialize the starting conditions for the first voxel
-        if self.model_form == 'constrained':
-            this_params = 0, 0, np.mean(self.fit_signal[0])
-        elif (self.model_form=='flexible' or
-              self.model_form=='ball_and_stick'):
-            this_params = (0, 0, np.mean(self.fit_signal[0]),
-                           np.mean(self.fit_signal[0]))
-
-        for vox in xrange(self.fit_signal.shape[0]):
-            # From the second voxel and onwards, we use the end point of the
-            # last voxel as the starting point for this voxel:
-            start_params = this_params
-
-            # Do the least-squares fitting (setting tolerance to a rather
-            # lenient value?):
-            this_params, status = opt.leastsq(self._err_func,
-                                              start_params,
-                                    args=(self.fit_signal[vox]),
-                                              ftol=10e-5
-                                              )
-            params[vox] = this_params
-
-            if self.verbose: 
-                prog_bar.animate(vox, f_name=f_name)
-
-        out_params = ozu.nans(self.signal.shape[:3] + (n_params,))
-        out_params[self.mask] = np.array(params).squeeze()
-
-        return out_params
+        # Start each voxel with the tensor pointing in the measured direction
+        # with the lowest signal and the weights (and diffusivity) set to the
+        # mean of the signal to fit:
+        bvecs = self.bvecs[:, self.b_idx]
+        pdd = bvecs[:, np.argmin(self._flat_relative_signal, -1)]
+        r, theta, phi = geo.cart2sphere(*pdd)
+        start_params = np.empty((self.fit_signal.shape[0], n_params))
+        start_params[:, 0] = theta
+        start_params[:, 1] = phi
+        start_params[:, 2:] = np.mean(self.fit_signal, -1)[:, None]
+
+        return levmar.fit_blocks(opt_signal, start_params, self.fit_signal,
+                                 args=(bvecs, self.bvals[self.b_idx],
+                                       self.model_form, self.ad, self.rd,
+                                       self.iso_diffusivity),
+                                 n_jobs=self.n_jobs,
+                                 block_size=self.voxel_block_size,
+                                 backend=self.voxel_backend, ftol=10e-5)
+
+    @desc.auto_attr
+    def model_params(self):
+        """
+        Find the model parameters using least-squares optimization.
+        """
+        params, info = self._lm_fit
+        return self._masked(params)
+
+    @desc.auto_attr
+    def fit_info(self):
+        """
+        Information about the fit in each voxel: a dict with volumes of the
+        sum of squared residuals ('ssr'), the number of iterations
+        ('n_iterations'), whether the fit converged ('converged') and
+        whether it stalled ('stalled'), see `osmosis.levmar`.
+        """
+        params, info = self._lm_fit
+        out = {}
+        for k, v in info.items():
+            out[k] = np.zeros(self.signal.shape[:3], dtype=v.dtype)
+            if v.dtype == float:
+                out[k][:] = np.nan
+            out[k][self.mask] = v
+        return out
 
     @desc.auto_attr
     def fit(self):
@@ -723,69 +847,33 @@ class CanonicalTensorModelOpt(CanonicalTensorModel):
             s += "Fit to %s model"%self.model_form
             print(s)
 
-        out_flat = np.empty(self._flat_signal.shape)
         flat_params = self.model_params[self.mask]
-        for vox in xrange(out_flat.shape[0]):
-            this_pred = self.pred_func(flat_params[vox])
-            if self.mode == 'signal_attenuation':
-                this_pred = 1 - this_pred
-            out_flat[vox] = this_pred * self._flat_S0[vox]
+        out_flat = self._opt_signal(flat_params, check_constraints=False)
+        if self.mode == 'signal_attenuation':
+            out_flat = 1 - out_flat
+        out_flat = out_flat * self._flat_S0[:, None]
         
-        out = ozu.nans(self.signal.shape)
-        out[self.mask] = out_flat
+        return self._masked(out_flat)
 
-        return out
-
-    def _tensor_helper(self, theta, phi):
-            """
-            This code is used in all three error functions, so we write it out
-            only once here
-            """
-            # Convert to cartesian coordinates:
-            x,y,z = geo.sphere2cart(1, theta, phi)
-            bvec = [x,y,z]
-            # decompose is an auto-attr of the tensor object, so is only run once
-            # and then cached:
-            evals, evecs = self.response_function.decompose
-            rot = ozu.calculate_rotation(bvec, evecs[0])
-            rot_evecs = evecs * rot
-            rot_tensor = ozt.tensor_from_eigs(rot_evecs,
-                                              evals,
-                                              self.bvecs[:,self.b_idx],
-                                              self.bvals[self.b_idx])
-            return rot_tensor
-
-
-    def _check_constraints(self, constraints):
-        """
-        Helper to check for optimization bounding constraints
-        """
-        # If any one of the constraints is violated:
-        for var, lb, ub in constraints:
-            if var<lb or var>ub:
-                return True
-
-        # Otherwise:
-        return False
-         
+    def _opt_signal(self, params, check_constraints=True):
+        """
+        Helper function to predict the relative signal for the parameters in
+        each row of params with the model form of this object (see
+        `opt_signal`)
+        """
+        return opt_signal(params, self.bvecs[:, self.b_idx],
+                          self.bvals[self.b_idx], self.model_form, self.ad,
+                          self.rd, self.iso_diffusivity,
+                          check_constraints=check_constraints)[0]
 
     def _pred_sig_flexible(self, params, check_constraints=True):
             """
             This is the signal prediction for the fully flexible model. 
             """
-            theta, phi, tensor_w, iso_w = params
-            if check_constraints:
-                if self._check_constraints([[theta, 0, np.pi],
-                                            [phi, -np.pi, np.pi],
-                                            [tensor_w, 0, np.inf], # Weights are
-                                                                   # non-negative
-                                            [iso_w, 0, np.inf]]):
-                    return np.inf
-                
-            rot_tensor = self._tensor_helper(theta, phi)
-            # Relative to an S0=1:
-            return (tensor_w * rot_tensor.predicted_signal(1) +
-                    iso_w * self.iso_pred_sig)
+            return opt_signal(params, self.bvecs[:, self.b_idx],
+                              self.bvals[self.b_idx], 'flexible', self.ad,
+                              self.rd, self.iso_diffusivity,
+                              check_constraints=check_constraints)[0][0]
 
 
     def _pred_sig_constrained(self, params, check_constraints=False):
@@ -796,41 +884,19 @@ class CanonicalTensorModelOpt(CanonicalTensorModel):
             if np.isnan(theta) or np.isnan(phi):
                 return np.inf
             
-            if check_constraints:
-                if self._check_constraints([[theta, 0, np.pi],
-                                       [phi, -np.pi, np.pi],
-                                       [w, 0, 1]]): # Weights are 0-1
-                    return np.inf
-
-
-            rot_tensor = self._tensor_helper(theta, phi)
-            # Relative to an S0=1:
-            return (1-w) * self.iso_pred_sig + w * rot_tensor.predicted_signal(1)
+            return opt_signal(params, self.bvecs[:, self.b_idx],
+                              self.bvals[self.b_idx], 'constrained', self.ad,
+                              self.rd, self.iso_diffusivity,
+                              check_constraints=check_constraints)[0][0]
 
 
     def _pred_sig_ball_and_stick(self, params, check_constraints=False):
             """
             This is the signal prediction for the ball-and-stick model
             """
-            theta, phi, w, d = params
-
-            if check_constraints:
-                if self._check_constraints([[theta, 0, np.pi],
-                                            [phi, -np.pi, np.pi],
-                                            [w, 0, 1], # Weights are 0-1
-                                            [d, 0, np.inf]]): # Diffusivity is
-                                                         # non-negative 
-                    return np.inf
-            
-            # In each one we have a different axial diffusivity for the response
-            # function. Simply multiply it by the current d:
-            # Need to replace the canonical tensor with a 
-            self.response_function =  ozt.Tensor(np.diag([1, 0, 0]),
-                              self.bvecs[:, self.b_idx], self.bvals[self.b_idx])
-
-            self.response_function.Q = self.response_function.Q * d
-            rot_tensor = self._tensor_helper(theta, phi)
-            return (1-w) * d + w * rot_tensor.predicted_signal(1)
+            return opt_signal(params, self.bvecs[:, self.b_idx],
+                              self.bvals[self.b_idx], 'ball_and_stick',
+                              check_constraints=check_constraints)[0][0]
 
         
     def _err_func(self, params, vox_sig):
@@ -871,7 +937,4 @@ class CanonicalTensorModelOpt(CanonicalTensorModel):
             else:
                 out_flat[vox] = np.nan
                 
-        out = ozu.nans(self.signal.shape[:3] + (vertices.shape[-1], ))
-        out[self.mask] = out_flat
-
-        return out
+        return self._masked(out_flat)
@@ -4,19 +4,16 @@ Analyze the CSD model
 
 """
 
-import inspect
-
 import numpy as np
-from scipy.special import sph_harm
 
 import nibabel as ni
-import dipy.core.geometry as geo
-import dipy.reconst.recspeed as recspeed
-import dipy.core.sphere as sphere
 
 import osmosis.tensor as ozt
 import osmosis.utils as ozu
 import osmosis.descriptors as desc
+import osmosis.odf as ozo
+import osmosis.metrics as metrics
+import osmosis.spherical_harmonics as ozh
 
 from osmosis.model.base import BaseModel, SCALE_FACTOR
 from osmosis.model.canonical_tensor import AD,RD
@@ -45,23 +42,11 @@ class _SphericalHarmonicResponseFunction(object):
     def rotations(self):
         """
         Calculate the response function for alignment with each one of the
-        b vectors
+        b vectors. The coefficients are the Y(l, 0) coefficients of the
+        response (its rotational harmonics), so the response aligned with one
+        b vector only depends on the angle to it.
         """
-        out = []
-        for idx, bvec in enumerate(self.bvecs.T):
-            rot = ozu.calculate_rotation(bvec, [1,0,0])
-            bvecs = np.asarray(np.dot(rot, self.bvecs)).squeeze()
-            r, theta, phi = geo.cart2sphere(bvecs[0],bvecs[1],bvecs[2])
-
-            sph_harm_set = []
-            degree = 0        
-            for order in np.arange(0, 2 * self.n_coeffs, 2):
-                sph_harm_set.append(np.real(sph_harm(degree, order, theta, phi)))
-
-            sph_harm_set = np.array(sph_harm_set)
-            out.append(np.dot(self.coeffs, sph_harm_set))
-
-        return np.array(out)
+        return ozh.zonal_rotations(self.bvecs, self.coeffs)
 
     def convolve_odf(self, odf, S0):
         """
@@ -175,29 +160,12 @@ class SphericalHarmonicsModel(BaseModel):
           
         2. Take heed that it seems that scipy's sph_harm actually has the
         order/degree in reverse order than the convention used by mrtrix, so
-        that needs to be taken into account in the calculation below
+        that needs to be taken into account in the calculation.
 
+        The basis set is shared by all the models with the same b vectors
+        (see `osmosis.spherical_harmonics.sph_harm_basis`).
         """
-                
-        # Convert to spherical coordinates:
-        r, theta, phi = geo.cart2sphere(self.bvecs[0, self.b_idx],
-                                      self.bvecs[1, self.b_idx],
-                                      self.bvecs[2, self.b_idx])
-        
-        # Preallocate:
-        b = np.empty((self.model_coeffs.shape[-1], theta.shape[0]))
-    
-        i = 0;
-        # Only even order are taken:
-        for order in np.arange(0, self.L + 1, 2): # Go to L, inclusive!
-           for degree in np.arange(-order,order+1):
-                # In negative degrees, take the imaginary part: 
-                if degree < 0:  
-                    b[i,:] = np.imag(sph_harm(-1 * degree, order, phi, theta));
-                else:
-                    b[i,:] = np.real(sph_harm(degree, order, phi, theta));
-                i = i+1;
-        return b
+        return ozh.sph_harm_basis(self.bvecs[:, self.b_idx], self.L)
 
     @desc.auto_attr
     def odf(self): 
@@ -216,28 +184,27 @@ class SphericalHarmonicsModel(BaseModel):
         convolved with a "response function", a canonical tensor, to calculate
         back the estimated signal. 
         """
-        out = ozu.nans(self.signal.shape)
         # multiply these two matrices together for the estimated odf:  
-        out[self.mask] = np.dot(self.model_coeffs[self.mask], self.sph_harm_set)
+        return self._masked(np.dot(self.model_coeffs[self.mask],
+                                   self.sph_harm_set))
 
-        return out 
+    @desc.auto_attr
+    def _bvecs_neighbors(self):
+        """
+        The neighbors of each of the bvecs on the sphere (see
+        `osmosis.odf.sphere_neighbors`)
+        """
+        return ozo.sphere_neighbors(self.bvecs[:, self.b_idx].T)
 
     @desc.auto_attr
     def odf_peaks(self):
         """
-        Calculate the value of each of the peaks in the ODF using the dipy
-        peak-finding algorithm
+        Calculate the value of each of the peaks in the ODF (with the same
+        peak-finding criteria as dipy)
         """
-        faces = sphere.Sphere(xyz=self.bvecs[:,self.b_idx].T).faces
-        odf_flat = self.odf[self.mask]
-        out_flat = np.zeros(odf_flat.shape)
-        for vox in xrange(odf_flat.shape[0]):
-            if np.all(np.isfinite(odf_flat[vox])):
-                peaks, inds = recspeed.local_maxima(odf_flat[vox], faces)
-                out_flat[vox][inds] = peaks
-            
         out = np.zeros(self.odf.shape)
-        out[self.mask] = out_flat
+        out[self.mask] = ozo.odf_peaks(self.odf[self.mask],
+                                       self._bvecs_neighbors)
         return out
 
     @desc.auto_attr
@@ -248,16 +215,15 @@ class SphericalHarmonicsModel(BaseModel):
         """
         peaks_flat = self.odf_peaks[self.mask]
         out_flat = np.zeros(peaks_flat.shape + (3,))
-        for vox in xrange(peaks_flat.shape[0]):
-           non_zeros = np.where(peaks_flat[vox]>0)[0]
-           idx = np.argsort(peaks_flat[vox])[::-1][:len(non_zeros)]
-           out_flat[vox, :len(idx)] = self.bvecs[:, self.b_idx][:, idx].T
+        # From the largest to the smallest peak, keeping only the positive
+        # ones:
+        idx = np.argsort(-peaks_flat, -1, kind='mergesort')
+        is_pos = np.take_along_axis(peaks_flat, idx, -1) > 0
+        out_flat[is_pos] = self.bvecs[:, self.b_idx].T[idx[is_pos]]
 
         out = np.zeros(self.odf_peaks.shape + (3,))
         out[self.mask] = out_flat
         return out
-       
-
 
 
     @desc.auto_attr
@@ -269,31 +235,7 @@ class SphericalHarmonicsModel(BaseModel):
         standard deviation of the case in which there is only 1 peak with the
         value '1'.
         """
-        # Flatten and sort (small => large) 
-        flat_peaks = self.odf_peaks[self.mask]
-        cross_flat = np.empty(flat_peaks.shape[0])
-        for vox in xrange(cross_flat.shape[0]):
-            # Normalize all the peaks by the 2-norm of the vector:
-            peaks_norm = flat_peaks[vox]/np.sqrt(np.dot(flat_peaks[vox],
-                                                        flat_peaks[vox]))
-            non_zero_idx = np.where(peaks_norm>0)[0]
-
-            # Deal with some corner cases - if there is no peak, we define this
-            # to be 0: 
-            if len(non_zero_idx) == 0:
-                cross_flat[vox] = 0
-            # If there's only one peak, we define it to be 1: 
-            elif len(non_zero_idx) == 1:
-                cross_flat[vox] = 1
-            # Otherwise, we need to do some math: 
-            else: 
-                std_peaks = (np.std(peaks_norm[non_zero_idx]))
-                std_norm = np.std(np.hstack([1, np.zeros(len(non_zero_idx)-1)]))
-                cross_flat[vox] = std_peaks/std_norm
-            
-        cross = ozu.nans(self.data.shape[:3])
-        cross[self.mask] = cross_flat
-        return cross
+        return self._masked(ozo.crossing_index(self.odf_peaks[self.mask]))
         
 
     @desc.auto_attr
@@ -312,40 +254,46 @@ class SphericalHarmonicsModel(BaseModel):
         else:
             return _SphericalHarmonicResponseFunction(self)
         
+    @desc.auto_attr
+    def rh_coeffs(self):
+        """
+        The rotational harmonics of the response function: the Y(l, 0)
+        coefficients of the response aligned with the z axis, for the orders
+        0, 2, ..., L.
+        """
+        if self.response_file is not None:
+            return self.response_function.coeffs
+
+        # The canonical tensor only depends on the angle to its axis:
+        b = self.bvals[self.b_idx][0]
+        return ozh.zonal_coeffs(lambda x: np.exp(-b * (self.rd + (self.ad -
+                                                                  self.rd)
+                                                       * x ** 2)), self.L)
+
     @desc.auto_attr
     def fit(self):
         """
         This is the signal estimated from the odf.
+
+        The odf is convolved with the response function in SH space
+        (multiplying the coefficients of each order by the rotational harmonic
+        of the response of that order) and a scaling and an offset are then
+        fit in each voxel to the signal.
         """
         if self.verbose:
             print("Predicting signal from SphericalHarmonicsModel")
-            prog_bar = ozu.ProgressBar(self._flat_signal.shape[0])
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-            f_name = this_class + '.' + inspect.stack()[0][3]
 
-        # Reshape the odf to be one voxel per row:
-        flat_odf = self.odf[self.mask]
-        pred_sig = np.empty(flat_odf.shape)
-
-            
-        for vox in xrange(pred_sig.shape[0]):
-            # Predict based on the convolution:
-            this_pred_sig = self.response_function.convolve_odf(
-                                                    flat_odf[vox],
-                                                    self._flat_S0[vox])
-
-            # We might have a scaling and an offset in addition, so let's fit
-            # those in each voxel based on the signal:
-            a,b = np.polyfit(this_pred_sig, self._flat_signal[vox], 1)
-            pred_sig[vox] = a*this_pred_sig + b
-            
-            if self.verbose:
-                prog_bar.animate(vox, f_name=f_name)
+        kernel = ozh.convolution_kernel(self.rh_coeffs, self.L)
+        pred_sig = np.dot(self.model_coeffs[self.mask] * kernel,
+                          self.sph_harm_set)
+
+        # We might have a scaling and an offset in addition, so let's fit
+        # those in each voxel based on the signal:
+        a, b, r = metrics.linregress(pred_sig, self._flat_signal)
+        pred_sig = a[:, None] * pred_sig + b[:, None]
 
         # Pack it back into a volume shaped thing: 
-        out = ozu.nans(self.signal.shape)
-        out[self.mask] = pred_sig  
-        return out
+        return self._masked(pred_sig)
         
         
     def _calculate_L(self,n):
@@ -383,15 +331,9 @@ class SphericalHarmonicsModel(BaseModel):
         """
         
         flat_odf = self.odf[self.mask]
-        out_flat = np.empty((flat_odf.shape[0], 3))
-        for vox in xrange(out_flat.shape[0]):
-            this_odf = flat_odf[vox]
-            if np.all(np.isfinite(this_odf)):
-                out_flat[vox] =\
-                self.bvecs[:, self.b_idx][:, np.argmax(this_odf)]
-            else:
-                out_flat[vox] = [np.nan, np.nan, np.nan]
-
-        out = ozu.nans(self.shape[:3] + (3,))
-        out[self.mask] = out_flat
-        return out
+        out_flat = ozu.nans((flat_odf.shape[0], 3))
+        finite = np.all(np.isfinite(flat_odf), -1)
+        out_flat[finite] = self.bvecs[:, self.b_idx].T[
+                                        np.argmax(flat_odf[finite], -1)]
+
+        return self._masked(out_flat)
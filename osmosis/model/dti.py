@@ -4,15 +4,18 @@ import os
 import numpy as np
 
 import nibabel as ni
-import dipy.reconst.dti as dti
 import dipy.core.gradients as gradients
 
 from osmosis.model.base import BaseModel, SCALE_FACTOR
 import osmosis.descriptors as desc
+import osmosis.lazy as ozl
 import osmosis.utils as ozu
 import osmosis.tensor as ozt
 import osmosis.boot as boot
 
+# dipy's tensor fitting is only imported when it's first used:
+dti = ozl.lazy_import('dipy.reconst.dti')
+
 
 class TensorModel(BaseModel):
 
@@ -98,15 +101,13 @@ class TensorModel(BaseModel):
         evecs (9) + evals (3)
         
         """
-        out = ozu.nans((self.data.shape[:3] +  (12,)))
-        
         flat_params = np.empty((self._flat_S0.shape[0], 12))
         
         # The file already exists: 
         if os.path.isfile(self.params_file):
             if self.verbose:
                 print("Loading TensorModel params from: %s" %self.params_file)
-            out[self.mask] = ni.load(self.params_file).get_data()[self.mask]
+            out = self._load_params()
         else:
             if self.verbose:
                 print("Fitting TensorModel params using dipy")
@@ -115,28 +116,28 @@ class TensorModel(BaseModel):
             for vox, vox_data in enumerate(self.data[self.mask]):
                 flat_params[vox] = tensor_model.fit(vox_data).model_params
 
-            out[self.mask] = flat_params
-            # Save the params for future use: 
-            params_ni = ni.Nifti1Image(out, self.affine)
+            out = self._masked(flat_params)
             # If we asked it to be temporary, no need to save anywhere: 
             if self.params_file != 'temp':
+                # Save the params for future use: 
+                params_ni = ni.Nifti1Image(np.asarray(out), self.affine)
                 params_ni.to_filename(self.params_file)
         # And return the params for current use:
         return out
 
     @desc.auto_attr
     def evecs(self):
-        return np.reshape(self.model_params[..., 3:], 
-                          self.model_params.shape[:3] + (3,3))
+        return self._masked(np.reshape(self.model_params[self.mask][:, 3:],
+                                       (-1, 3, 3)))
 
     @desc.auto_attr
     def evals(self):
-        return self.model_params[..., :3]
+        return self._masked(self.model_params[self.mask][:, :3])
 
     @desc.auto_attr
     def mean_diffusivity(self):
         #adc/md = (ev1+ev2+ev3)/3
-        return self.evals.mean(-1)
+        return self._masked(self.evals[self.mask].mean(-1))
 
         
     @desc.auto_attr
@@ -156,83 +157,64 @@ class TensorModel(BaseModel):
                         \lambda_2^2+\lambda_3^2} }
 
         """
-        out = ozu.nans(self.data.shape[:3])
-        
-        lambda_1 = self.evals[..., 0][self.mask]
-        lambda_2 = self.evals[..., 1][self.mask]
-        lambda_3 = self.evals[..., 2][self.mask]
-
-        out[self.mask] = ozu.fractional_anisotropy(lambda_1, lambda_2, lambda_3)
-
-        return out
+        evals = self.evals[self.mask]
+        return self._masked(ozu.fractional_anisotropy(evals[:, 0],
+                                                      evals[:, 1],
+                                                      evals[:, 2]))
 
     @desc.auto_attr
     def radial_diffusivity(self):
-        return np.mean(self.evals[...,1:],-1)
+        return self._masked(np.mean(self.evals[self.mask][:, 1:], -1))
 
     @desc.auto_attr
     def axial_diffusivity(self):
-        return self.evals[...,0]
+        return self._masked(self.evals[self.mask][:, 0])
 
 
     @desc.auto_attr
     def linearity(self):
-        out = ozu.nans(self.data.shape[:3])
-        out[self.mask] = ozu.tensor_linearity(self.evals[..., 0][self.mask],
-                                              self.evals[..., 1][self.mask],
-                                              self.evals[..., 2][self.mask])
-        return out
+        evals = self.evals[self.mask]
+        return self._masked(ozu.tensor_linearity(evals[:, 0],
+                                                 evals[:, 1],
+                                                 evals[:, 2]))
 
     @desc.auto_attr
     def planarity(self):
-        out = ozu.nans(self.data.shape[:3])
-        out[self.mask] = ozu.tensor_planarity(self.evals[..., 0][self.mask],
-                                              self.evals[..., 1][self.mask],
-                                              self.evals[..., 2][self.mask])
-        return out
+        evals = self.evals[self.mask]
+        return self._masked(ozu.tensor_planarity(evals[:, 0],
+                                                 evals[:, 1],
+                                                 evals[:, 2]))
 
     @desc.auto_attr
     def sphericity(self):
-        out = ozu.nans(self.data.shape[:3])
-        out[self.mask] = ozu.tensor_sphericity(self.evals[..., 0][self.mask],
-                                               self.evals[..., 1][self.mask],
-                                               self.evals[..., 2][self.mask])
-        return out
+        evals = self.evals[self.mask]
+        return self._masked(ozu.tensor_sphericity(evals[:, 0],
+                                                  evals[:, 1],
+                                                  evals[:, 2]))
 
     # Self Diffusion Tensor, taken from dipy.reconst.dti:
     @desc.auto_attr
     def tensors(self):
-        out = ozu.nans(self.evecs.shape)
         evals = self.evals[self.mask]
         evecs = self.evecs[self.mask]
-        D_flat = np.empty(evecs.shape)
-        for ii in xrange(len(D_flat)):
-            Q = evecs[ii]
-            L = evals[ii]
-            D_flat[ii] = np.dot(Q*L, Q.T)
-
-        out[self.mask] = D_flat
-        return out
+        # Q L Q' in each voxel:
+        return self._masked(np.einsum('vij,vj,vkj->vik', evecs, evals, evecs))
 
     @desc.auto_attr
     def mode(self):
-        out = ozu.nans(self.data.shape[:3])
-        out[self.mask] = dti.tensor_mode(self.tensors)[self.mask]
-        return out
+        return self._masked(dti.tensor_mode(self.tensors[self.mask]))
 
     @desc.auto_attr
     def model_adc(self):
-        out = np.empty(self.signal.shape)
-        tensors_flat = self.tensors[self.mask].reshape((-1,3,3))
-        adc_flat = np.empty(self.signal[self.mask].shape)
+        tensors_flat = self.tensors[self.mask]
+        adc_flat = np.empty(self._flat_signal.shape)
 
         for ii in xrange(len(adc_flat)):
             adc_flat[ii] = ozt.apparent_diffusion_coef(
                                         self.bvecs[:,self.b_idx],
                                         tensors_flat[ii])
 
-        out[self.mask] = adc_flat
-        return out
+        return self._masked(adc_flat)
 
     def predict_adc(self, sphere):
         """
@@ -240,17 +222,14 @@ class TensorModel(BaseModel):
         The ADC predicted on a sphere (containing points other than the bvecs)
         
         """
-        out = ozu.nans(self.signal.shape[:3] + (sphere.shape[-1],))
-        tensors_flat = self.tensors[self.mask].reshape((-1,3,3))
-        pred_adc_flat = np.empty((np.sum(self.mask), sphere.shape[-1]))
+        tensors_flat = self.tensors[self.mask]
+        pred_adc_flat = np.empty((tensors_flat.shape[0], sphere.shape[-1]))
 
         for ii in xrange(len(pred_adc_flat)):
             pred_adc_flat[ii] = ozt.apparent_diffusion_coef(sphere,
                                                        tensors_flat[ii])
 
-        out[self.mask] = pred_adc_flat
-
-        return out
+        return self._masked(pred_adc_flat)
         
 
     @desc.auto_attr
@@ -264,13 +243,8 @@ class TensorModel(BaseModel):
         54: 1112.
         
         """
-        flat_fvf = ozu.fiber_volume_fraction(
-            self.fractional_anisotropy[self.mask])
-
-        out = np.empty(self.fractional_anisotropy.shape)
-        out[self.mask] = flat_fvf
-
-        return out
+        return self._masked(ozu.fiber_volume_fraction(
+            self.fractional_anisotropy[self.mask]))
 
     @desc.auto_attr
     def principal_diffusion_direction(self):
@@ -279,7 +253,7 @@ class TensorModel(BaseModel):
         of the sphere 
         """
         # It's simply the first eigen-vector
-        return self.evecs[...,0]
+        return self._masked(self.evecs[self.mask][..., 0])
 
 
     @desc.auto_attr
@@ -288,15 +262,13 @@ class TensorModel(BaseModel):
             print("Predicting signal from TensorModel")
         adc_flat = self.model_adc[self.mask]
         fit_flat = np.empty(adc_flat.shape)
-        out = ozu.nans(self.signal.shape)
 
         for ii in xrange(len(fit_flat)):
             fit_flat[ii] = ozt.stejskal_tanner(self._flat_S0[ii],
                                                self.bvals[self.b_idx],
                                                adc_flat[ii])
 
-        out[self.mask] = fit_flat
-        return out
+        return self._masked(fit_flat)
 
     def predict(self, sphere, bvals=None):
         """
@@ -320,14 +292,12 @@ class TensorModel(BaseModel):
         pred_adc_flat = self.predict_adc(sphere)[self.mask]
         predict_flat = np.empty(pred_adc_flat.shape)
 
-        out = ozu.nans(self.signal.shape[:3] + (sphere.shape[-1], ))
         for ii in xrange(len(predict_flat)):
             predict_flat[ii] = ozt.stejskal_tanner(self._flat_S0[ii],
                                                    bvals,
                                                    pred_adc_flat[ii])
 
-        out[self.mask] = predict_flat
-        return out
+        return self._masked(predict_flat)
 
     @desc.auto_attr
     def model_diffusion_distance(self):
@@ -340,10 +310,7 @@ class TensorModel(BaseModel):
         for vox in xrange(len(dist_flat)):
             dist_flat[vox]=ozt.diffusion_distance(self.bvecs[:, self.b_idx],
                                                   tensors_flat[vox])
-        out = ozu.nans(self.signal.shape)
-        out[self.mask] = dist_flat
-
-        return out
+        return self._masked(dist_flat)
             
 
         
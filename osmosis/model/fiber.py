@@ -1,17 +1,19 @@
 
-import inspect
-
 import numpy as np
 import scipy.sparse as sparse
 
-import sklearn.linear_model as lm
-
 import osmosis.utils as ozu
+import osmosis.io as ozio
 import osmosis.descriptors as desc
+import osmosis.lazy as ozl
 import osmosis.sgd as sgd
+import osmosis.nnls as nnls
 from osmosis.model.base import BaseModel, SCALE_FACTOR
 from osmosis.model.canonical_tensor import AD,RD
 
+# Only imported when it's first used:
+lm = ozl.lazy_import('sklearn.linear_model')
+
 
 def _tensors_from_fiber(f, bvecs, bvals, ad, rd):
     """
@@ -40,8 +42,11 @@ class BaseFiber(BaseModel):
 	data : a volume with data (can be diffusion data, but doesn't have to
 	be)
 
-	FG : a osmosis.fibers.FiberGroup object, or the name of a pdb file
-        containing the fibers to be read in using ozf.fg_from_pdb
+	FG : a osmosis.fibers.FiberGroup object, or the name of a pdb/trk file
+        containing the fibers. If a file name is provided, the model matrix
+        is assembled from chunks of fibers read from the file (see
+        `osmosis.io.fg_chunks`). Attributes that need all the fibers at once
+        (such as `voxel2fiber`) read the entire file (see `_fg`).
         """
         # Initialize the super-class:
         BaseModel.__init__(self,
@@ -54,12 +59,26 @@ class BaseFiber(BaseModel):
                             params_file=params_file,
                             sub_sample=sub_sample)
         
-        if affine is not None:
+        self._fg_affine = affine
+        if affine is not None and not isinstance(FG, str):
             # The FG is transformed through the provided affine if need be: 
             self.FG = FG.xform(affine.getI(), inplace=False)
         else:
             self.FG = FG
-	
+
+    @desc.auto_attr
+    def _fg(self):
+        """
+        The fiber-group. If FG is a file name, the fibers are read from the
+        file and transformed through the affine.
+        """
+        if not isinstance(self.FG, str):
+            return self.FG
+        fg = ozio.fg_from_file(self.FG, verbose=self.verbose)
+        if self._fg_affine is not None:
+            fg.xform(np.matrix(self._fg_affine).getI())
+        return fg
+
     @desc.auto_attr
     def fg_idx(self):
         """
@@ -73,7 +92,7 @@ class BaseFiber(BaseModel):
         """
         All the coords of all the fibers  
         """
-        return self.FG.coords
+        return self._fg.coords
 
 
     @desc.auto_attr
@@ -97,20 +116,20 @@ class BaseFiber(BaseModel):
         
         # Make a voxels by fibers grid. If the fiber is in the voxel, the value
         # there will be 1, otherwise 0:
-        v2f = np.zeros((len(self.fg_idx_unique.T), len(self.FG.fibers)))
+        v2f = np.zeros((len(self.fg_idx_unique.T), len(self._fg.fibers)))
 
         # This is a grid of size (fibers, maximal length of a fiber), so that
         # we can capture put in the voxel number in each fiber/node combination:
-        v2fn = ozu.nans((len(self.FG.fibers),
-                         np.max([f.coords.shape[-1] for f in self.FG])))
+        v2fn = ozu.nans((len(self._fg.fibers),
+                         np.max([f.coords.shape[-1] for f in self._fg])))
 
         if self.verbose:
-            prog_bar = ozu.ProgressBar(self.FG.n_fibers)
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-            f_name = this_class + '.' + inspect.stack()[0][3]
+            prog_bar = ozu.ProgressBar(self._fg.n_fibers)
+            this_class = self.__class__.__name__
+            f_name = this_class + '.voxel2fiber'
 
         # In each fiber:
-        for f_idx, f in enumerate(self.FG.fibers):
+        for f_idx, f in enumerate(self._fg.fibers):
             # In each voxel present in there:
             for vv in f.coords.astype(int).T:
                 # What serial number is this voxel in the unique fiber indices:
@@ -148,7 +167,10 @@ class FiberModel(BaseFiber):
                  mask=None,
                  mode='relative_signal',
                  scaling_factor=SCALE_FACTOR,
-                 sub_sample=None):
+                 sub_sample=None,
+                 solver='sgd',
+                 solver_params=None,
+                 chunk_size=None):
         """
         Parameters
         ----------
@@ -159,6 +181,21 @@ class FiberModel(BaseFiber):
         axial_diffusivity: The axial diffusivity of a single fiber population.
 
         radial_diffusivity: The radial diffusivity of a single fiber population.
+
+        solver: str or callable, optional
+            The non-negative least-squares solver used to find the weights. One
+            of the keys of `osmosis.nnls.SOLVERS` ('sgd', 'fista', 'bcd'), or a
+            callable with the same signature. Default: 'sgd'
+
+        solver_params: dict, optional
+            Key-word arguments passed on to the solver.
+
+        chunk_size: int, optional
+            If provided, the model matrix is assembled in a single pass over
+            chunks of this many fibers, so that the per-node signal is only
+            ever held for one chunk at a time. This is always done when FG is
+            a file name (with 1000 fibers per chunk, unless otherwise
+            specified).
         
         """
         # Initialize the super-class:
@@ -176,6 +213,11 @@ class FiberModel(BaseFiber):
         self.axial_diffusivity = axial_diffusivity
         self.radial_diffusivity = radial_diffusivity
         self.mode = mode
+        self.solver = solver
+        if solver_params is None:
+            solver_params = {}
+        self.solver_params = solver_params
+        self.chunk_size = chunk_size
 
     @desc.auto_attr
     def fiber_signal(self):
@@ -184,12 +226,12 @@ class FiberModel(BaseFiber):
         """
 
         if self.verbose:
-            prog_bar = ozu.ProgressBar(self.FG.n_fibers)
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-            f_name = this_class + '.' + inspect.stack()[0][3]
+            prog_bar = ozu.ProgressBar(self._fg.n_fibers)
+            this_class = self.__class__.__name__
+            f_name = this_class + '.fiber_signal'
 
         sig = []
-        for f_idx, f in enumerate(self.FG):
+        for f_idx, f in enumerate(self._fg):
             sig.append(f.predicted_signal(self.bvecs[:, self.b_idx],
                                           self.bvals[self.b_idx],
                                           self.axial_diffusivity,
@@ -200,11 +242,97 @@ class FiberModel(BaseFiber):
 
         return sig
         
+    @desc.auto_attr
+    def _chunked(self):
+        """
+        Whether the model matrix is assembled from chunks of fibers
+        """
+        return self.chunk_size is not None or isinstance(self.FG, str)
+
+    @desc.auto_attr
+    def fg_idx_unique(self):
+        """
+        The *unique* voxel indices
+        """
+        if self._chunked:
+            return self._chunked_matrix[2]
+        return ozu.unique_rows(self.fg_idx.T).T
+
+    @desc.auto_attr
+    def _chunked_matrix(self):
+        """
+        The fiber and isotropic model matrices, and the unique voxel indices
+        (see `matrix` and `fg_idx_unique`), assembled in a single pass over
+        chunks of fibers.
+        """
+        chunk_size = self.chunk_size
+        if chunk_size is None:
+            chunk_size = 1000
+        bvecs = self.bvecs[:, self.b_idx]
+        bvals = self.bvals[self.b_idx]
+        n_bvecs = self.b_idx.shape[0]
+        vol_shape = self.shape[:3]
+        # Each fiber's prediction is demeaned by the mean signal in the voxel,
+        # so that the isotropic part can carry that:
+        mean_sig = np.mean(self.relative_signal, -1)
+
+        # For every fiber-voxel combination, the linear voxel index, the
+        # fiber index and the summed signal from the fiber nodes in the voxel:
+        vox_lin = []
+        fib_idx = []
+        fib_sig = []
+        n_fibers = 0
+        for fg in ozio.fg_chunks(self.FG, chunk_size):
+            if self._fg_affine is not None and isinstance(self.FG, str):
+                fg.xform(np.matrix(self._fg_affine).getI())
+            for f in fg:
+                this_lin = np.ravel_multi_index(f.coords.astype(int),
+                                                vol_shape)
+                pred_sig = f.predicted_signal(bvecs,
+                                              bvals,
+                                              self.axial_diffusivity,
+                                              self.radial_diffusivity)
+                pred_sig = pred_sig - mean_sig.flat[this_lin][:, np.newaxis]
+                if self.mode == 'signal_attenuation':
+                    # (1 - S) - mean(1 - S) = -(S - mean(S)):
+                    pred_sig = -pred_sig
+                u_lin, node2vox = np.unique(this_lin, return_inverse=True)
+                summed = np.zeros((u_lin.shape[0], n_bvecs))
+                np.add.at(summed, node2vox, pred_sig)
+                vox_lin.append(u_lin)
+                fib_idx.append(n_fibers * np.ones(u_lin.shape[0], dtype=int))
+                fib_sig.append(summed)
+                n_fibers += 1
+
+            if self.verbose:
+                print("Assembled model matrix for %s fibers"%n_fibers)
+
+        unique_lin, row_idx = np.unique(np.concatenate(vox_lin),
+                                        return_inverse=True)
+        n_vox = unique_lin.shape[0]
+        rows = (row_idx[:, np.newaxis] * n_bvecs +
+                np.arange(n_bvecs)[np.newaxis]).ravel()
+        cols = np.repeat(np.concatenate(fib_idx), n_bvecs)
+        fiber_matrix = sparse.coo_matrix((np.vstack(fib_sig).ravel(),
+                                          [rows, cols]),
+                                         shape=(n_vox * n_bvecs,
+                                                n_fibers)).tocsr()
+        iso_matrix = sparse.coo_matrix((np.ones(n_vox * n_bvecs),
+                                        [np.arange(n_vox * n_bvecs),
+                                         np.repeat(np.arange(n_vox), n_bvecs)]
+                                        )).tocsr()
+
+        return (fiber_matrix, iso_matrix,
+                np.array(np.unravel_index(unique_lin, vol_shape)))
+
     @desc.auto_attr
     def matrix(self):
         """
         The matrix of fiber-contributions to the DWI signal.
         """
+        if self._chunked:
+            return self._chunked_matrix[:2]
+
         # Assign some local variables, for shorthand:
         vox_coords = self.fg_idx_unique.T
         n_vox = self.fg_idx_unique.shape[-1]
@@ -234,8 +362,8 @@ class FiberModel(BaseFiber):
 
         if self.verbose:
             prog_bar = ozu.ProgressBar(len(vox_coords))
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-            f_name = this_class + '.' + inspect.stack()[0][3]
+            this_class = self.__class__.__name__
+            f_name = this_class + '.matrix'
 
         # In each voxel:
         for v_idx, vox in enumerate(vox_coords):
@@ -254,13 +382,15 @@ class FiberModel(BaseFiber):
                         pred_sig += ((1 - relative_signal) -
                         np.mean(1 - self.relative_signal[vox[0],vox[1],vox[2]]))
                     
-            # For each fiber-voxel combination, we now store the row/column
-            # indices and the signal in the pre-allocated linear arrays
-            f_matrix_row[keep_ct1:keep_ct1+n_bvecs] =\
-                np.arange(n_bvecs) + v_idx * n_bvecs
-            f_matrix_col[keep_ct1:keep_ct1+n_bvecs] = np.ones(n_bvecs) * f_idx 
-            f_matrix_sig[keep_ct1:keep_ct1+n_bvecs] = pred_sig
-            keep_ct1 += n_bvecs
+                # For each fiber-voxel combination, we now store the
+                # row/column indices and the signal in the pre-allocated
+                # linear arrays
+                f_matrix_row[keep_ct1:keep_ct1+n_bvecs] =\
+                    np.arange(n_bvecs) + v_idx * n_bvecs
+                f_matrix_col[keep_ct1:keep_ct1+n_bvecs] =\
+                    np.ones(n_bvecs) * f_idx
+                f_matrix_sig[keep_ct1:keep_ct1+n_bvecs] = pred_sig
+                keep_ct1 += n_bvecs
 
             # Put in the isotropic part in the other matrix: 
             i_matrix_row[keep_ct2:keep_ct2+n_bvecs]=\
@@ -312,29 +442,61 @@ class FiberModel(BaseFiber):
         np.zeros((len(self.b_idx),self.voxel_signal.shape[0]))).T.ravel())
 
     
+    def _solve(self, y, X):
+        """
+        Helper function to solve for non-negative weights with the solver
+        chosen for this model
+        """
+        params = dict(self.solver_params)
+        if self.solver == 'sgd':
+            params.setdefault('verbose', self.verbose)
+        return nnls.solve(y, X, solver=self.solver, **params)
+
     @desc.auto_attr
-    def iso_weights(self):
+    def _iso_solution(self):
         """
-        Get the weights using scipy.sparse.linalg or sklearn.linear_model.sparse
+        The weights for the isotropic part of the matrix and information
+        about the solver run
+        """
+        return self._solve(self.voxel_signal.ravel(), self.matrix[1])
 
+    @desc.auto_attr
+    def _fiber_solution(self):
+        """
+        The weights for the fiber part of the matrix and information about
+        the solver run
         """
+        return self._solve(self.voxel_signal_demeaned, self.matrix[0])
 
-        iso_w =sgd.stochastic_gradient_descent(self.voxel_signal.ravel(),
-                                               self.matrix[1],
-                                               verbose=self.verbose)
-        
-        return iso_w
+    @desc.auto_attr
+    def iso_weights(self):
+        """
+        Get the weights for the isotropic part of the matrix
+        """
+        return self._iso_solution[0]
     
     @desc.auto_attr
     def fiber_weights(self):
         """
         Get the weights for the fiber part of the matrix
         """
-        fiber_w = sgd.stochastic_gradient_descent(self.voxel_signal_demeaned,
-                                                  self.matrix[0],
-                                                  verbose=self.verbose)
+        return self._fiber_solution[0]
+
+    @desc.auto_attr
+    def iso_solver_info(self):
+        """
+        The objective trace, R squared, number of iterations and wall time
+        of the solver for the isotropic weights
+        """
+        return self._iso_solution[1]
 
-        return fiber_w
+    @desc.auto_attr
+    def fiber_solver_info(self):
+        """
+        The objective trace, R squared, number of iterations and wall time
+        of the solver for the fiber weights
+        """
+        return self._fiber_solution[1]
 
     
     @desc.auto_attr
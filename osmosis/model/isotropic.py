@@ -7,9 +7,12 @@ import scipy.optimize as opt
 import inspect
 import osmosis.utils as ozu
 import osmosis.model.dti as dti
-import osmosis.leastsqbound as lsq
+import osmosis.lazy as ozl
 import numpy as np
 
+# Only imported when it's first used:
+lsq = ozl.lazy_import('osmosis.leastsqbound')
+
 # rs within function names means relative signal
 # nf within function names means noise floor
 
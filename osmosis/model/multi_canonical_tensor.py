@@ -1,18 +1,246 @@
 
-import inspect
 import itertools
 import os
 
 import numpy as np
+from scipy.special import comb
 
 import nibabel as ni
 
 import osmosis.utils as ozu
+import osmosis.metrics as metrics
 import osmosis.descriptors as desc
 from osmosis.model.canonical_tensor import CanonicalTensorModel, AD, RD
 from osmosis.model.base import SCALE_FACTOR
 
 
+def combination_rank(combos, n):
+    """
+    The position of combinations of k out of n (sorted in ascending order) in
+    the lexicographic order of `itertools.combinations(range(n), k)`.
+
+    Parameters
+    ----------
+    combos : int array (..., k)
+    n : int
+
+    Returns
+    -------
+    rank : int array (...)
+    """
+    combos = np.asarray(combos)
+    k = combos.shape[-1]
+    rank = comb(n, k, exact=True) - 1
+    for t in range(k):
+        rank = rank - comb(n - 1 - combos[..., t], k - t)
+    return np.round(rank).astype(int)
+
+
+class CombinationOLS(desc.ResetMixin):
+    """
+    OLS fits of many signals with each combination of n of a set of
+    regressors, together with an additional (isotropic) regressor.
+
+    The design matrices of all the combinations are made of the same columns,
+    so everything that is needed for all the fits comes from shared blocks:
+    the Gram matrix of the regressors, their products with the isotropic
+    regressor and their products with the signals. The (n+1) x (n+1)
+    pseudo-inverses are computed once for all the combinations, and the sum of
+    squared residuals of each fit is derived from the same products (as
+    y'y - b'X'y), without computing the residuals themselves.
+    """
+    def __init__(self, regressors, iso_regressor, n):
+        """
+        Parameters
+        ----------
+        regressors : array (n_regressors, n_measurements)
+        iso_regressor : array (n_measurements,)
+        n : int
+            How many of the regressors are in each combination.
+        """
+        self.regressors = np.asarray(regressors, dtype=float)
+        self.iso_regressor = np.asarray(iso_regressor, dtype=float)
+        self.n = n
+
+    @property
+    def n_regressors(self):
+        return self.regressors.shape[0]
+
+    @desc.auto_attr
+    def combinations(self):
+        """
+        All the combinations, as an int array (n_combinations, n), in the
+        order of `itertools.combinations`
+        """
+        combos = itertools.combinations(range(self.n_regressors), self.n)
+        return np.fromiter(itertools.chain.from_iterable(combos),
+                           dtype=int).reshape(-1, self.n)
+
+    @desc.auto_attr
+    def _gram(self):
+        """
+        The Gram matrix of the regressors, bordered by the isotropic regressor
+        (in the last row/column)
+        """
+        X = np.vstack([self.regressors, self.iso_regressor])
+        return np.dot(X, X.T)
+
+    def _pinv_gram(self, combos):
+        """
+        Helper function to get the pseudo-inverse of X'X for each combination
+        in combos (..., n)
+        """
+        idx = np.concatenate([combos, self.n_regressors *
+                              np.ones(combos.shape[:-1] + (1,), dtype=int)],
+                             -1)
+        G = self._gram[idx[..., :, None], idx[..., None, :]]
+        return np.linalg.pinv(G.reshape((-1,) + G.shape[-2:])).reshape(G.shape)
+
+    @desc.auto_attr
+    def pinv_gram(self):
+        """
+        The pseudo-inverse of X'X for each of the combinations
+        """
+        return self._pinv_gram(self.combinations)
+
+    @desc.auto_attr
+    def _single(self):
+        """
+        The fits with one regressor at a time (used for pruning)
+        """
+        return CombinationOLS(self.regressors, self.iso_regressor, 1)
+
+    def _Xy(self, fit_to):
+        """
+        Helper function to get X'y for all the regressors (with the isotropic
+        regressor last), an array (n_signals, n_regressors + 1)
+        """
+        X = np.vstack([self.regressors, self.iso_regressor])
+        return np.dot(X, fit_to).T
+
+    def _solve(self, combos, pinv, Xy):
+        """
+        Helper function to get the weights (..., n + 1) and the explained sum
+        of squares, y'X b, of the fits of the signals in Xy (n_signals,
+        n_regressors + 1) with combos, either shared by all signals (n_combos,
+        n) or different for each signal (n_signals, n_combos, n), with the
+        corresponding pseudo-inverses of X'X.
+        """
+        n_signals = Xy.shape[0]
+        if combos.ndim == 2:
+            this_Xy = Xy[:, combos]
+        else:
+            this_Xy = Xy[np.arange(n_signals)[:, None, None], combos]
+        iso_Xy = np.broadcast_to(Xy[:, -1][:, None, None],
+                                 this_Xy.shape[:-1] + (1,))
+        this_Xy = np.concatenate([this_Xy, iso_Xy], -1)
+        weights = np.einsum('...ij,...j->...i', pinv, this_Xy)
+        return weights, np.sum(weights * this_Xy, -1)
+
+    def solve_all(self, fit_to):
+        """
+        The OLS weights of all the combinations for all the signals.
+
+        Parameters
+        ----------
+        fit_to : array (n_measurements, n_signals)
+
+        Returns
+        -------
+        weights : array (n_combinations, n + 1, n_signals)
+            The weights of the regressors in each combination, followed by
+            the isotropic weight.
+        """
+        weights = self._solve(self.combinations, self.pinv_gram,
+                              self._Xy(fit_to))[0]
+        return weights.transpose(1, 2, 0)
+
+    def fit(self, fit_to, n_candidates=None, block_size=None):
+        """
+        Find the combination that best fits each signal, among the ones with
+        all non-negative weights.
+
+        Parameters
+        ----------
+        fit_to : array (n_measurements, n_signals)
+
+        n_candidates : int, optional
+            If given, only the combinations of the n_candidates regressors
+            that best fit each signal on their own (with the isotropic
+            regressor) are considered.
+
+        block_size : int, optional
+            How many signals to process at a time. Per default, this is set so
+            that the temporary arrays have about a million elements.
+
+        Returns
+        -------
+        combo_idx : float array (n_signals,)
+            The index of the best combination into `combinations` (nan if no
+            combination has all non-negative weights).
+        weights : array (n_signals, n + 1)
+            The weights of the regressors in the best combination, followed
+            by the isotropic weight.
+        """
+        fit_to = np.asarray(fit_to, dtype=float)
+        n_signals = fit_to.shape[-1]
+        if n_candidates is not None:
+            n_candidates = max(min(n_candidates, self.n_regressors), self.n)
+            local_combos = np.array(list(itertools.combinations(
+                                        range(n_candidates), self.n)),
+                                    dtype=int).reshape(-1, self.n)
+            n_combos = local_combos.shape[0]
+        else:
+            n_combos = self.combinations.shape[0]
+        if block_size is None:
+            block_size = max(1, int(1e6 // (n_combos * (self.n + 1))))
+
+        combo_idx = ozu.nans(n_signals)
+        weights = ozu.nans((n_signals, self.n + 1))
+        for start in range(0, n_signals, block_size):
+            this_fit_to = fit_to[:, start:start + block_size]
+            Xy = self._Xy(this_fit_to)
+            yy = np.sum(this_fit_to ** 2, 0)
+            if n_candidates is None:
+                combos = self.combinations
+                these_weights, explained = self._solve(combos,
+                                                       self.pinv_gram, Xy)
+            else:
+                # Rank the regressors according to how well they fit the
+                # signal on their own:
+                single_w, single_explained = self._single._solve(
+                    self._single.combinations, self._single.pinv_gram, Xy)
+                single_ssr = np.where(np.all(single_w >= 0, -1),
+                                      yy[:, None] - single_explained, np.inf)
+                cand = np.sort(np.argsort(single_ssr, -1,
+                                          kind='mergesort')[:, :n_candidates],
+                               -1)
+                global_combos = combination_rank(cand[:, local_combos],
+                                                 self.n_regressors)
+                combos = self.combinations[global_combos]
+                these_weights, explained = self._solve(
+                    combos, self.pinv_gram[global_combos], Xy)
+
+            ssr = yy[:, None] - explained
+            ssr[~np.all(these_weights >= 0, -1)] = np.nan
+            # Signals with no good solution at all:
+            has_fit = np.any(np.isfinite(ssr), -1)
+            best = np.argmin(np.where(np.isfinite(ssr), ssr, np.inf), -1)
+            rows = np.arange(ssr.shape[0])
+            if n_candidates is None:
+                this_idx = best
+            else:
+                this_idx = global_combos[rows, best]
+            this_idx = this_idx.astype(float)
+            this_idx[~has_fit] = np.nan
+            this_weights = these_weights[rows, best]
+            this_weights[~has_fit] = np.nan
+            combo_idx[start:start + block_size] = this_idx
+            weights[start:start + block_size] = this_weights
+
+        return combo_idx, weights
+
+
 class MultiCanonicalTensorModel(CanonicalTensorModel):
     """
     This model extends CanonicalTensorModel with the addition of another
@@ -35,9 +263,21 @@ class MultiCanonicalTensorModel(CanonicalTensorModel):
                  over_sample=None,
                  verbose=True,
                  mode='relative_signal',
-                 n_canonicals=2):
+                 n_canonicals=2,
+                 n_candidates=None):
         """
         Initialize a MultiCanonicalTensorModel class instance.
+
+        Parameters
+        ----------
+        n_canonicals : int, optional
+            How many canonical tensors are combined in each voxel.
+
+        n_candidates : int, optional
+            If given, only the combinations of the n_candidates directions
+            that best fit each voxel with a single canonical tensor are
+            considered in the fit (see `CombinationOLS.fit`). Per default,
+            all combinations are considered.
         """
         # Initialize the super-class:
         CanonicalTensorModel.__init__(self,
@@ -56,54 +296,34 @@ class MultiCanonicalTensorModel(CanonicalTensorModel):
                                       verbose=verbose)
         
         self.n_canonicals = n_canonicals
+        self.n_candidates = n_candidates
 
     @desc.auto_attr
-    def rot_idx(self):
+    def _combination_ols(self):
         """
-        The indices into combinations of rotations of the canonical tensor,
-        according to the order we will use them in fitting
+        The engine used to fit all the combinations of canonical tensors
         """
-        # Use stdlib magic to make the indices into the basis set: 
-        pre_idx = itertools.combinations(range(self.rot_vecs.shape[-1]),
-                                         self.n_canonicals)
-
-        # Generate all of them and store, so you know where you stand
-        rot_idx = []
-        for i in pre_idx:
-            rot_idx.append(i)
+        iso_regressor, tensor_regressor, fit_to = self.regressors
+        return CombinationOLS(tensor_regressor, iso_regressor,
+                              self.n_canonicals)
 
-        return rot_idx
+    @desc.auto_attr
+    def rot_idx(self):
+        """
+        The indices into rot_vecs of the canonical tensors in each
+        combination, an int array (n_combinations, n_canonicals), in the order
+        of `itertools.combinations`
+        """
+        return self._combination_ols.combinations
 
     @desc.auto_attr
     def ols(self):
         """
-        Compute the design matrices the matrices for OLS fitting and the OLS
-        solution. Cache them for reuse in each direction over all voxels.
+        The OLS solution for each combination of canonical tensors in each
+        voxel, an array (n_combinations, n_canonicals + 1, n_voxels), with the
+        isotropic weight last.
         """
-        ols_weights = np.empty((len(self.rot_idx),
-                                self.n_canonicals + 1,
-                                self._flat_signal.shape[0]))
-
-        iso_regressor, tensor_regressor, fit_to = self.regressors
-
-        where_are_we = 0
-        for row, idx in enumerate(self.rot_idx):                
-        # 'row' refers to where we are in ols_weights
-            if self.verbose:
-                if idx[0]==where_are_we:
-                    s = "Starting MultiCanonicalTensorModel fit"
-                    s += " for %sth set of basis functions"%(where_are_we) 
-                    print (s)
-                    where_are_we += 1
-            # The 'design matrix':
-            d = np.vstack([[tensor_regressor[i] for i in idx],
-                           iso_regressor]).T
-            # This is $(X' X)^{-1} X':
-            ols_mat = ozu.ols_matrix(d)
-            # Multiply to find the OLS solution:
-            ols_weights[row] = np.array(np.dot(ols_mat, fit_to)).squeeze()
-
-        return ols_weights
+        return self._combination_ols.solve_all(self.regressors[-1])
 
     @desc.auto_attr
     def model_params(self):
@@ -122,10 +342,17 @@ class MultiCanonicalTensorModel(CanonicalTensorModel):
            $\vec{b}$ combinations, choosing only sets for which all weights are
            non-negative. 
 
-        2. Find the PDD combination that most readily explains the data (highest
-           correlation coefficient between the data and the predicted signal)
-           That will be the combination used to derive the fit for that voxel.
-
+        2. Find the PDD combination that most readily explains the data
+           (smallest sum of squared residuals of the OLS fit). In the signal
+           modes, the residuals of the signal are the residuals of the fit
+           scaled by S0, so this is the combination with the highest
+           coefficient of determination between the data and the predicted
+           signal. That will be the combination used to derive the fit for
+           that voxel.
+
+        The parameters are the index into rot_idx, the weight of each of the
+        canonical tensors and the isotropic weight (nan if no combination has
+        all non-negative weights).
         """
         # The file already exists: 
         if os.path.isfile(self.params_file):
@@ -133,84 +360,20 @@ class MultiCanonicalTensorModel(CanonicalTensorModel):
                 print("Loading params from file: %s"%self.params_file)
 
             # Get the cached values and be done with it:
-            return ni.load(self.params_file).get_data()
+            return self._load_params()
         else:
-            # Looks like we might need to do some fitting... 
-
-            # Get the bvec weights (we don't know how many...) and the
-            # isotropic weights (which are always last): 
-            b_w = self.ols[:,:-1,:].copy().squeeze()
-            i_w = self.ols[:,-1,:].copy().squeeze()
-
-            # nan out the places where weights are negative: 
-            b_w[b_w<0] = np.nan
-            i_w[i_w<0] = np.nan
-
-            # Weight for each canonical tensor, plus a place for the index into
-            # rot_idx and one more slot for the isotropic weight (at the end)
-            params = np.empty((self._flat_signal.shape[0],
-                               self.n_canonicals + 2))
-
             if self.verbose:
                 print("Fitting MultiCanonicalTensorModel:")
-                prog_bar = ozu.ProgressBar(self._flat_signal.shape[0])
-                this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-                f_name = this_class + '.' + inspect.stack()[0][3]
-
-            # Find the best OLS solution in each voxel:
-            for vox in xrange(self._flat_signal.shape[0]):
-                # We do this in each voxel (instead of all at once, which is
-                # possible...) to not blow up the memory:
-                vox_fits = np.empty((len(self.rot_idx), len(self.b_idx)))
-                
-                for idx, rot_idx in enumerate(self.rot_idx):
-                    # The constant regressor gets added in first:
-                    this_relative = i_w[idx,vox] * self.regressors[0][0]
-                    # And we add the different canonicals on top of that:
-                    this_relative += (np.dot(b_w[idx,:,vox],
-                    # The tensor regressors are different in cases where we
-                    # are fitting to relative/attenuation signal, so grab that
-                    # from the regressors attr:
-                    np.array([self.regressors[1][x] for x in rot_idx])))
-
-                    if self.mode == 'relative_signal' or self.mode=='normalize':
-                        vox_fits[idx] = this_relative * self._flat_S0[vox]
-                    elif self.mode == 'signal_attenuation':
-                        vox_fits[idx] = (1 - this_relative) * self._flat_S0[vox]
-                
-                # Find the predicted signal that best matches the original
-                # signal attenuation. That will choose the direction for the
-                # tensor we use:
-                corrs = ozu.coeff_of_determination(self._flat_signal[vox],
-                                                   vox_fits)
-                
-                idx = np.where(corrs==np.nanmax(corrs))[0]
-
-                # Sometimes there is no good solution:
-                if len(idx):
-                    # In case more than one fits the bill, just choose the
-                    # first one:
-                    if len(idx)>1:
-                        idx = idx[0]
-                    
-                    params[vox,:] = np.hstack([idx,
-                        np.array([x for x in b_w[idx,:,vox]]).squeeze(),
-                        i_w[idx, vox]])
-                else:
-                    # In which case we set it to all nans:
-                    params[vox,:] = np.hstack([np.nan,
-                                               self.n_canonicals * (np.nan,),
-                                               np.nan])
-
-                if self.verbose: 
-                    prog_bar.animate(vox, f_name=f_name)
-
-            # Save the params for future use: 
-            out_params = ozu.nans(self.signal.shape[:3]+
-                                        (params.shape[-1],))
-            out_params[self.mask] = np.array(params).squeeze()
-            params_ni = ni.Nifti1Image(out_params, self.affine)
+
+            combo_idx, weights = self._combination_ols.fit(
+                                            self.regressors[-1],
+                                            n_candidates=self.n_candidates)
+            params = np.hstack([combo_idx[:, None], weights])
+
+            out_params = self._masked(params)
             if self.params_file != 'temp':
+                # Save the params for future use: 
+                params_ni = ni.Nifti1Image(np.asarray(out_params), self.affine)
                 if self.verbose:
                     print("Saving params to file: %s"%self.params_file)
                 params_ni.to_filename(self.params_file)
@@ -218,58 +381,56 @@ class MultiCanonicalTensorModel(CanonicalTensorModel):
             # And return the params for current use:
             return out_params
 
+    def _predict_relative(self, b_w, i_w, combos):
+        """
+        Helper function to predict the relative signal (or attenuation) from
+        the weights b_w (..., n_canonicals) of the canonical tensors in combos
+        (..., n_canonicals) and the isotropic weights i_w (...)
+        """
+        return (np.einsum('...k,...kd->...d', b_w, self.regressors[1][combos])
+                + i_w[..., None] * self.regressors[0][0])
+
     @desc.auto_attr
     def predict_all(self):
         """
         Calculate the predicted signal for all the possible OLS solutions
         """
-        # Get the bvec weights (we don't know how many...) and the
-        # isotropic weights (which are always last): 
-        b_w = self.ols[:,:-1,:].copy().squeeze()
-        i_w = self.ols[:,-1,:].copy().squeeze()
-        
-        # nan out the places where weights are negative: 
-        #b_w[b_w<0] = np.nan
-        #i_w[i_w<0] = np.nan
-
-        # A predicted signal for each voxel, for each rot_idx, for each
-        # direction: 
-        flat_out = np.empty((self._flat_signal.shape[0],
-                           len(self.rot_idx),
-                           self._flat_signal.shape[-1]))
-
         if self.verbose:
             print("Predicting all signals for MultiCanonicalTensorModel:")
-            prog_bar = ozu.ProgressBar(self._flat_signal.shape[0])
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-            f_name = this_class + '.' + inspect.stack()[0][3]
-
-        for vox in xrange(flat_out.shape[0]):
-            for idx, rot_idx in enumerate(self.rot_idx):
-                # The constant regressor gets added in first:
-                this_relative = i_w[idx,vox] * self.regressors[0][0]
-                # And we add the different canonicals on top of that:
-                this_relative += (np.dot(b_w[idx,:,vox],
-                # The tensor regressors are different in cases where we
-                # are fitting to relative/attenuation signal, so grab that
-                # from the regressors attr:
-                np.array([self.regressors[1][x] for x in rot_idx])))
-
-                if self.mode == 'relative_signal' or self.mode=='normalize':
-                    flat_out[vox, idx] = this_relative * self._flat_S0[vox]
-                elif self.mode == 'signal_attenuation':
-                    flat_out[vox, idx] = (1-this_relative)*self._flat_S0[vox]
 
-            if self.verbose: 
-                prog_bar.animate(vox, f_name=f_name)
-
-        out = ozu.nans(self.signal.shape[:3] + 
-                       (len(self.rot_idx),) + 
-                       (self.signal.shape[-1],))
-        out[self.mask] = flat_out
-
-        return out
+        # The isotropic weights are always last:
+        ols = self.ols.transpose(2, 0, 1)
 
+        # A predicted signal for each voxel, for each rot_idx, for each
+        # direction: 
+        flat_out = np.empty((self._flat_signal.shape[0],
+                             self.rot_idx.shape[0],
+                             self._flat_signal.shape[-1]))
+        block_size = max(1, int(1e6 // flat_out[0].size))
+        for start in range(0, flat_out.shape[0], block_size):
+            these = slice(start, start + block_size)
+            relative = self._predict_relative(ols[these, :, :-1],
+                                              ols[these, :, -1],
+                                              self.rot_idx)
+            S0 = self._flat_S0[these][:, None, None]
+            if self.mode == 'relative_signal' or self.mode=='normalize':
+                flat_out[these] = relative * S0
+            elif self.mode == 'signal_attenuation':
+                flat_out[these] = (1 - relative) * S0
+
+        return self._masked(flat_out)
+
+    def _flat_best(self):
+        """
+        Helper function to get the voxels with a fit, the combination of
+        canonical tensors in each of them and their weights
+        """
+        flat_params = self.model_params[self.mask]
+        has_fit = ~np.isnan(flat_params[:, 0])
+        # This gets saved as a float, but we can safely assume it's going to
+        # be an integer:
+        combos = self.rot_idx[flat_params[has_fit, 0].astype(int)]
+        return has_fit, combos, flat_params[has_fit]
 
     @desc.auto_attr
     def fit(self):
@@ -277,39 +438,19 @@ class MultiCanonicalTensorModel(CanonicalTensorModel):
         Predict the signal attenuation from the fit of the
         MultiCanonicalTensorModel 
         """
-
         if self.verbose:
             print("Predicting signal from MultiCanonicalTensorModel")
-            prog_bar = ozu.ProgressBar(self._flat_signal.shape[0])
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-            f_name = this_class + '.' + inspect.stack()[0][3]
-            
-        out_flat = np.empty(self._flat_signal.shape)
-        flat_params = self.model_params[self.mask]
-        
-        for vox in xrange(out_flat.shape[0]):
-            # If there's a nan in there, just ignore this voxel and set it to
-            # all nans:
-            if ~np.any(np.isnan(flat_params[vox, 1])):
-                b_w = flat_params[vox,1:1+self.n_canonicals]
-                i_w = flat_params[vox,-1]
-                # This gets saved as a float, but we can safely assume it's
-                # going to be an integer:
-                rot_idx = self.rot_idx[int(flat_params[vox,0])]
-
-                out_flat[vox]=(np.dot(b_w,
-                               np.array([self.rotations[i] for i in rot_idx])) +
-                               self.regressors[0][0] * i_w) * self._flat_S0[vox]
-            else:
-                out_flat[vox] = np.nan  # This gets broadcast to the right
-                                        # length on assigment?
-            if self.verbose: 
-                prog_bar.animate(vox, f_name=f_name)
 
-        out = ozu.nans(self.signal.shape)
-        out[self.mask] = out_flat
+        has_fit, combos, params = self._flat_best()
+        # Voxels without a fit are set to all nans:
+        out_flat = ozu.nans(self._flat_signal.shape)
+        b_w = params[:, 1:1 + self.n_canonicals]
+        out_flat[has_fit] = ((np.einsum('vk,vkd->vd', b_w,
+                                        self.rotations[combos]) +
+                              self.regressors[0][0] * params[:, -1][:, None])
+                             * self._flat_S0[has_fit][:, None])
 
-        return out
+        return self._masked(out_flat)
 
     @desc.auto_attr
     def principal_diffusion_direction(self):
@@ -317,48 +458,30 @@ class MultiCanonicalTensorModel(CanonicalTensorModel):
         The principal diffusion direction is the direction of the tensor with
         the highest weight
         """
-        out_flat = np.empty((self._flat_signal.shape[0] ,3))
-        flat_params = self.model_params[self.mask]
-        for vox in xrange(out_flat.shape[0]):
-            if ~np.isnan(flat_params[vox][0]):
-                # These are the indices into the bvecs:
-                idx = [i for i in self.rot_idx[int(flat_params[vox][0])]]
-                w = flat_params[vox][1:1+self.n_canonicals]
-                # Where's the largest weight:
-                out_flat[vox]=\
-                    self.bvecs[:,self.b_idx].T[int(idx[np.argsort(w)[-1]])]
-                
-        out = ozu.nans(self.signal.shape[:3] + (3,))
-        out[self.mask] = out_flat
-        return out
+        has_fit, combos, params = self._flat_best()
+        w = params[:, 1:1 + self.n_canonicals]
+        # Where's the largest weight:
+        heaviest = combos[np.arange(combos.shape[0]),
+                          np.argsort(w, -1)[:, -1]]
+        out_flat = ozu.nans((self._flat_signal.shape[0], 3))
+        out_flat[has_fit] = self.rot_vecs.T[heaviest]
+
+        return self._masked(out_flat)
         
     @desc.auto_attr
     def fit_angle(self):
         """
         The angle between the tensors that were fitted
         """
-        out_flat = np.empty(self._flat_signal.shape[0])
-        flat_params = self.model_params[self.mask]
-        for vox in xrange(out_flat.shape[0]):
-            if ~np.isnan(flat_params[vox][0]):
-                idx = [i for i in self.rot_idx[int(flat_params[vox][0])]]
-                # Sort them according to their weight and take the two
-                # weightiest ones:
-                w = flat_params[vox,1:1+self.n_canonicals]
-                idx = np.array(idx)[np.argsort(w)]
-                ang = np.rad2deg(ozu.vector_angle(
-                    self.rot_vecs.T[idx[-1]],
-                    self.rot_vecs.T[idx[-2]]))
-
-                ang = np.min([ang, 180-ang])
-                
-                out_flat[vox] = ang
-                
-            else:
-                out_flat[vox] = np.nan
-
-        
-        out = ozu.nans(self.signal.shape[:3])
-        out[self.mask] = out_flat
-
-        return out
+        has_fit, combos, params = self._flat_best()
+        # Sort them according to their weight and take the two weightiest
+        # ones:
+        w = params[:, 1:1 + self.n_canonicals]
+        combos = np.take_along_axis(combos, np.argsort(w, -1), -1)
+        out_flat = ozu.nans(self._flat_signal.shape[0])
+        out_flat[has_fit] = np.rad2deg(metrics.vector_angle(
+                                           self.rot_vecs.T[combos[:, -1]],
+                                           self.rot_vecs.T[combos[:, -2]],
+                                           antipodal=True))
+
+        return self._masked(out_flat)
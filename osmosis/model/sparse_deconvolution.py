@@ -12,43 +12,18 @@ import warnings
 import numpy as np
 from scipy.optimize import nnls
 import scipy.optimize as opt
-# Get stuff from sklearn, if that's available:
-try:
-    from sklearn.linear_model import Lasso, LassoCV
-    # Get other stuff from sklearn.linear_model:
-    from sklearn.linear_model import ElasticNet, Lars, Ridge, ElasticNetCV, LinearRegression
-    # Get OMP:
-    from sklearn.linear_model.omp import OrthogonalMatchingPursuit as OMP
-
-    has_sklearn = True
-
-    # Make a dict with solvers to be used for choosing among them:
-    sklearn_solvers = dict(Lasso=Lasso,
-                           OMP=OMP,
-                           ElasticNet=ElasticNet,
-                           ElasticNetCV=ElasticNetCV,
-                           Lars=Lars,
-                           LR=LinearRegression,
-                           nnls=nnls)
-
-except ImportError:
-    e_s = "Could not import sklearn. Download and install from XXX"
-    warnings.warn(e_s)
-    has_sklearn = False    
-
 
 import nibabel as ni
-import dipy.reconst.recspeed as recspeed
 import dipy.core.sphere as dps
 import dipy.core.geometry as geo
-import dipy.data as dpd
 
 import osmosis.utils as ozu
 import osmosis.descriptors as desc
-import osmosis.cluster as ozc
+import osmosis.instrument as ozi
+import osmosis.lazy as ozl
+import osmosis.odf as ozo
 import osmosis.tensor as ozt
 import osmosis.model.isotropic as mdm
-import osmosis.leastsqbound as lsq
 from osmosis.utils import separate_bvals
 
 import osmosis.model.dti as dti
@@ -57,10 +32,66 @@ from osmosis.model.canonical_tensor import CanonicalTensorModel, AD, RD
 # from osmosis.model.base import SCALE_FACTOR
 from osmosis.model.io import params_file_resolver
 
+# These are only imported when they are first used:
+dpd = ozl.lazy_import('dipy.data')
+ozc = ozl.lazy_import('osmosis.cluster')
+lsq = ozl.lazy_import('osmosis.leastsqbound')
+sk_base = ozl.lazy_import('sklearn.base')
+sk_lm = ozl.lazy_import('sklearn.linear_model')
+
+has_sklearn = ozl.has_module('sklearn')
+if not has_sklearn:
+    e_s = "Could not import sklearn. Download and install from XXX"
+    warnings.warn(e_s)
+
+# The names of the solvers in sklearn.linear_model that can be chosen by
+# name, see `get_solver`:
+sklearn_solvers = dict(Lasso='Lasso',
+                       OMP='OrthogonalMatchingPursuit',
+                       ElasticNet='ElasticNet',
+                       ElasticNetCV='ElasticNetCV',
+                       Lars='Lars',
+                       LR='LinearRegression')
+
+
+def get_solver(name):
+    """
+    The solver class called name: a key into `sklearn_solvers` (which imports
+    sklearn), or 'nnls'
+    """
+    if name == 'nnls':
+        return nnls
+    return getattr(sk_lm, sklearn_solvers[name])
+
 
 SCALE_FACTOR = 1000.0 
 
 
+def _fit_sparse_vox(fit_to, design_matrix, solver, demean):
+    """
+    Fit the weights of the rotations in one voxel of a
+    SparseDeconvolutionModel (a module-level function, so that it can be sent
+    to worker processes).
+
+    Parameters
+    ----------
+    fit_to: the signal in the voxel
+    design_matrix: the regressors, on the columns
+    solver: opt.nnls, or an sklearn estimator (only copies of it are fit)
+    demean: whether to fit the deviations from the mean of the signal
+    """
+    # Fit the deviations from the mean of the fitted signal: 
+    if demean:
+        sig = fit_to - np.mean(fit_to)
+    else:
+        sig = fit_to 
+    if solver is opt.nnls:
+        return solver(design_matrix, sig)[0]
+    else:
+        # Fit a copy of it, so that voxels can be fit concurrently:
+        return sk_base.clone(solver).fit(design_matrix, sig).coef_
+
+
 class SparseDeconvolutionModel(CanonicalTensorModel):
     """
     Use Elastic Net to do spherical deconvolution with a canonical tensor basis
@@ -104,17 +135,17 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
                                       verbose=verbose)
         
         # Name the params file, if needed: 
-        this_class = str(self.__class__).split("'")[-2].split('.')[-1]
+        this_class = self.__class__.__name__
         self.params_file = params_file_resolver(self,
                                                 this_class,
                                                 params_file=params_file)
         # Deal with the solver stuff: 
         # For now, the default is ElasticNet:
         if solver is None:
-            this_solver = sklearn_solvers['ElasticNet']
+            this_solver = get_solver('ElasticNet')
         # Assume it's a key into the dict: 
         elif isinstance(solver, str):
-            this_solver = sklearn_solvers[solver]
+            this_solver = get_solver(solver)
         # Assume it's a class: 
         else:
             this_solver = solver
@@ -151,16 +182,7 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
         """
         The core fitting routine
         """
-        # Fit the deviations from the mean of the fitted signal: 
-        if self.demean:
-            sig = fit_to - np.mean(fit_to)
-        else:
-            sig = fit_to 
-        # Use the solver you created upon initialization:
-        if self.solver is opt.nnls:
-            return self.solver(design_matrix, sig)[0]
-        else:
-            return self.solver.fit(design_matrix, sig).coef_
+        return _fit_sparse_vox(fit_to, design_matrix, self.solver, self.demean)
 
 
     @desc.auto_attr
@@ -189,15 +211,12 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
             if self.verbose:
                 print("Loading params from file: %s"%self.params_file)
             # Get the cached values and be done with it:
-            return ni.load(self.params_file).get_data()
+            return self._load_params()
 
         else:
 
             if self.verbose:
                 print("Fitting SparseDeconvolutionModel:")
-                prog_bar = ozu.ProgressBar(self._flat_signal.shape[0])
-                this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-                f_name = this_class + '.' + inspect.stack()[0][3]
 
             iso_regressor, tensor_regressor, fit_to = self.regressors
 
@@ -206,22 +225,14 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
                 # below works out:
                 fit_to = np.array([fit_to]).T
 
-            # One weight for each rotation
-            params = np.empty((self._n_vox, self.rotations.shape[0]))
-                
-            for vox in xrange(self._n_vox):
-                # Call out to the core fitting routine: 
-                params[vox] = self._fit_it(fit_to.T[vox], self.design_matrix)
-                if self.verbose:
-                    prog_bar.animate(vox, f_name=f_name)
-                    
-            out_params = ozu.nans((self.signal.shape[:3] + 
-                                        (self.design_matrix.shape[-1],)))
-            
-            out_params[self.mask] = params
-            # Save the params to a file: 
-            params_ni = ni.Nifti1Image(out_params, self.affine)
+            # One weight for each rotation, from the core fitting routine:
+            out_params = self._voxel_map(_fit_sparse_vox, fit_to.T,
+                                         (self.design_matrix.shape[-1],),
+                                         args=(self.design_matrix,
+                                               self.solver, self.demean))
             if self.params_file != 'temp':
+                # Save the params to a file: 
+                params_ni = ni.Nifti1Image(np.asarray(out_params), self.affine)
                 if self.verbose:
                     print("Saving params to file: %s"%self.params_file)
                 params_ni.to_filename(self.params_file)
@@ -269,10 +280,7 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
             #a,b = np.polyfit(this_pred_sig, self._flat_signal[vox], 1)
             # out_flat[vox] = a*this_pred_sig + b
             out_flat[vox] = this_pred_sig 
-        out = ozu.nans(self.signal.shape)
-        out[self.mask] = out_flat
-
-        return out
+        return self._masked(out_flat)
 
 
     def predict(self, vertices):
@@ -311,37 +319,29 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
             # out_flat[vox] = a*this_pred_sig + b
             out_flat[vox] = this_pred_sig 
 
-        out = ozu.nans(self.signal.shape[:3]+ (vertices.shape[-1],))
-        out[self.mask] = out_flat
+        return self._masked(out_flat)
 
-        return out
 
+    @desc.auto_attr
+    def _rot_vecs_neighbors(self):
+        """
+        The neighbors of each of the rot_vecs on the sphere (see
+        `osmosis.odf.sphere_neighbors`)
+        """
+        return ozo.sphere_neighbors(self.rot_vecs.T)
 
     @desc.auto_attr
     def fit_angle(self):
         """
         The angle between the tensors that were fitted
         """
-        out_flat = np.empty(self._flat_signal.shape[0])
-        for vox in xrange(out_flat.shape[0]):
-            if ~np.isnan(self._flat_params[vox][0]):
-                idx1 = np.argsort(self._flat_params[vox])[-1]
-                idx2 = np.argsort(self._flat_params[vox])[-2]
-                ang = np.rad2deg(ozu.vector_angle(
-                    self.bvecs[:,self.b_idx].T[idx1],
-                    self.bvecs[:,self.b_idx].T[idx2]))
-
-                ang = np.min([ang, 180-ang])
-                
-                out_flat[vox] = ang
-                
-        else:
-            out_flat[vox] = np.nan
-        
-        out = ozu.nans(self.signal.shape[:3])
-        out[self.mask] = out_flat
+        out_flat = ozu.nans(self._flat_params.shape[0])
+        has_params = ~np.isnan(self._flat_params[:, 0])
+        idx = ozo.top_k(self._flat_params[has_params], 2)
+        out_flat[has_params] = ozo.peak_angle(self.rot_vecs.T, idx[:, 0],
+                                              idx[:, 1])
 
-        return out
+        return self._masked(out_flat)
 
     @desc.auto_attr
     def odf_peaks(self):
@@ -349,24 +349,16 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
         Calculate the value of the peaks in the ODF (in this case, that is
         defined as the weights on the model params 
         """
-        faces = dps.Sphere(xyz=self.bvecs[:,self.b_idx].T).faces
         if self._n_vox == 1: 
             odf_flat = np.array([self.model_params])
         else: 
             odf_flat = self.model_params[self.mask]
-        out_flat = np.zeros(odf_flat.shape)
-        for vox in xrange(odf_flat.shape[0]):
-            if ~np.any(np.isnan(odf_flat[vox])):
-                this_odf = odf_flat[vox].copy()
-                peaks, inds = recspeed.local_maxima(this_odf, faces)
-                out_flat[vox][inds] = peaks 
+        out_flat = ozo.odf_peaks(odf_flat, self._rot_vecs_neighbors)
 
         if self._n_vox == 1:
             return out_flat
         
-        out = ozu.nans(self.model_params.shape)
-        out[self.mask] = out_flat
-        return out
+        return self._masked(out_flat)
 
 
     @desc.auto_attr
@@ -377,22 +369,12 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
         """
         out_flat = ozu.nans(self._flat_signal.shape[0])
         flat_odf_peaks = self.odf_peaks[self.mask]
-        for vox in xrange(out_flat.shape[0]):
-            if ~np.isnan(flat_odf_peaks[vox][0]):
-                idx1 = np.argsort(flat_odf_peaks[vox])[-1]
-                idx2 = np.argsort(flat_odf_peaks[vox])[-2]
-                if idx1 != idx2:
-                    ang = np.rad2deg(ozu.vector_angle(
-                        self.bvecs[:,self.b_idx].T[idx1],
-                        self.bvecs[:,self.b_idx].T[idx2]))
-
-                    ang = np.min([ang, 180-ang])
-                
-                    out_flat[vox] = ang
+        has_peaks = ~np.isnan(flat_odf_peaks[:, 0])
+        idx = ozo.top_k(flat_odf_peaks[has_peaks], 2)
+        out_flat[has_peaks] = ozo.peak_angle(self.rot_vecs.T, idx[:, 0],
+                                             idx[:, 1])
                         
-        out = ozu.nans(self.signal.shape[:3])
-        out[self.mask] = out_flat
-        return out
+        return self._masked(out_flat)
         
 
     def n_peaks(self, threshold=0.1):
@@ -410,15 +392,16 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
         out_flat = ozu.nans(self._flat_signal.shape + (3,))
         # flat_peaks = self.odf_peaks[self.mask]
         flat_peaks = self.model_params[self.mask]
-        for vox in xrange(out_flat.shape[0]):
-            coeff_idx = np.where(flat_peaks[vox]>0)[0]
-            for i, idx in enumerate(coeff_idx):
-                out_flat[vox, i] = self.bvecs[:,self.b_idx].T[idx]
+        with np.errstate(invalid='ignore'):
+            is_pos = flat_peaks > 0
+        # The indices of the positive coefficients come first (in order):
+        coeff_idx = np.argsort(~is_pos, -1, kind='mergesort')
+        n_dirs = min(out_flat.shape[1], coeff_idx.shape[1])
+        coeff_idx = coeff_idx[:, :n_dirs]
+        is_pos = np.take_along_axis(is_pos, coeff_idx, -1)
+        out_flat[:, :n_dirs][is_pos] = self.rot_vecs.T[coeff_idx[is_pos]]
         
-        out = ozu.nans(self.signal.shape + (3,))
-        out[self.mask] = out_flat
-            
-        return out
+        return self._masked(out_flat)
         
         
     def quantitative_anisotropy(self, Np):
@@ -426,25 +409,10 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
         Return the relative size and indices of the Np major param values
         (canonical tensor weights) in the ODF 
         """
-        if self.verbose:
-            print("Calculating quantitative anisotropy:")
-            prog_bar = ozu.ProgressBar(self._flat_signal.shape[0])
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-            f_name = this_class + '.' + inspect.stack()[0][3]
-
-
-        # Allocate space for Np QA values and indices in the entire volume:
-        qa_flat = np.zeros((self._flat_params.shape[0], Np))
-        inds_flat = np.zeros(qa_flat.shape, np.int)  # indices! 
-        
-        for vox in xrange(self._flat_params.shape[0]):
-            this_params = self._flat_params[vox]
-            ii = np.argsort(this_params)[::-1]  # From largest to smallest
-            inds_flat[vox] = ii[:Np]
-            qa_flat[vox] = (this_params/np.sum(this_params))[inds_flat[vox]] 
-
-            if self.verbose:
-                prog_bar.animate(vox, f_name=f_name)
+        # The indices of the Np largest params, from largest to smallest:
+        inds_flat = ozo.top_k(self._flat_params, Np)
+        qa_flat = (np.take_along_axis(self._flat_params, inds_flat, -1) /
+                   np.sum(self._flat_params, -1)[:, None])
 
         qa = np.zeros(self.signal.shape[:3] + (Np,))
         qa[self.mask] = qa_flat
@@ -474,44 +442,10 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
         where now $\alpha_i$ now denotes the angle between 
         
         """
-        di = ozu.nans(self.data.shape[:3])
-        di_flat = np.zeros(self._n_vox)
-        for vox in xrange(self._n_vox):
-            inds = np.argsort(self._flat_params[vox])[::-1] # From largest to
-                                                            # smallest
-            nonzero_idx = np.where(self._flat_params[vox][inds]>0)
-            if len(nonzero_idx[0])>0:
-                # Only look at the non-zero weights:
-                vox_idx = inds[nonzero_idx].astype(int)
-                this_mp = self._flat_params[vox][vox_idx]
-                this_dirs = self.rot_vecs.T[vox_idx]
-                n_idx = len(vox_idx)
-                if all_to_all:
-                    di_s = np.zeros(n_idx)
-                    # Calculate this as all-to-all:
-                    angles = np.arccos(np.dot(this_dirs, this_dirs.T))
-                    for ii in xrange(n_idx):
-                        this_di_s = 0 
-                        for jj in  xrange(ii+1, n_idx): 
-                            ang = angles[ii, jj]
-                            di_s[ii] += np.sin(ang) * ((this_mp[ii]*this_mp[jj])/
-                                               np.sum(this_mp**2))  
-
-                    di_flat[vox] = np.mean(di_s)/n_idx
-                else:
+        di_flat = ozo.dispersion_index(self._flat_params, self.rot_vecs.T,
+                                       all_to_all=all_to_all)
 
-                    #Calculate this from the highest peak to each one of the
-                    #others:
-                    this_pdd, dirs = this_dirs[0], this_dirs[1:] 
-                    angles = np.arccos(np.dot(dirs, this_pdd))
-                    angles = np.min(np.vstack([angles, np.pi-angles]), 0)
-                    angles = angles/(np.pi/2)
-                    di_flat[vox] = np.dot(this_mp[1:]**2/np.sum(this_mp**2),
-                                          np.sin(angles))
-
-        out = ozu.nans(self.signal.shape[:3])
-        out[self.mask] = di_flat
-        return out
+        return self._masked(di_flat)
 
         
     def anisotropy_index(self):
@@ -530,71 +464,61 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
 
     
     @desc.auto_attr
-    def cluster_fodf(self, in_data=None):
+    def fodf_clusters(self):
         """
         Use k-means clustering to find the peaks in the fodf
 
-        Per default, we'll use AIC to determine the value of `k`. However, if
-        an additional data-set is provided, we will use the prediction of this
-        additional data as a criterion for stopping. Once additional k stops
-        improving cross-validation accuracy, that's a good time to stop.
+        In each voxel, the directions of the positive weights are clustered
+        with k = 1, 2, ... clusters (seeded by the k largest weights), and we
+        use AIC to determine the value of `k` (see `osmosis.odf.cluster_odf`).
+        Blocks of voxels are processed in self.n_jobs workers (see
+        `BaseModel._voxel_map`).
 
-        
-        """
-        centroid_arr = np.empty(len(self._flat_signal), dtype=object)
-
-        # If you provided another object that inherits from DWI,  
-        if in_data:
-            comp_data = in_data.data[self.mask]
-        
-        for vox in range(len(self._flat_signal)):
-            this_fodf = self._flat_params[vox]
-            # Find the bvecs for which the parameters are non-zero:
-            nz_idx = np.where(this_fodf>0)
+        Returns
+        -------
+        centroids : array (x, y, z, max(k), 3)
+            The centroids in each voxel, padded with nan.
+        assignments : int array (x, y, z, n_params)
+            The cluster of each of the parameters (-1 for parameters that are
+            not positive, and outside the mask).
+        k : int array (x, y, z)
+            The number of clusters in each voxel (0 where there are no
+            positive parameters, and outside the mask).
+        """
+        flat_centroids, flat_assignments, flat_k = ozo.cluster_odf(
+                                        self._flat_params, self.rot_vecs.T,
+                                        n_jobs=self.n_jobs,
+                                        block_size=self.voxel_block_size,
+                                        backend=self.voxel_backend)
+
+        centroids = ozu.nans(self.signal.shape[:3] + flat_centroids.shape[1:])
+        centroids[self.mask] = flat_centroids
+        assignments = -np.ones(self.signal.shape[:3] +
+                               flat_assignments.shape[1:], dtype=int)
+        assignments[self.mask] = flat_assignments
+        k = np.zeros(self.signal.shape[:3], dtype=int)
+        k[self.mask] = flat_k
+        return centroids, assignments, k
 
-            # If there's nothing here, just give it the origin and move on: 
-            if len(nz_idx[0]) == 0:
+    @desc.auto_attr
+    def cluster_fodf(self):
+        """
+        The peaks of the fodf found with k-means clustering (see
+        `fodf_clusters`), as an object array, with the (k, 3) array of the
+        centroids in each voxel in the mask (the origin where there are no
+        positive parameters) and nan outside of it.
+        """
+        centroids, assignments, k = self.fodf_clusters
+        flat_centroids = centroids[self.mask]
+        flat_k = k[self.mask]
+        centroid_arr = np.empty(flat_k.shape[0], dtype=object)
+        for vox in xrange(flat_k.shape[0]):
+            if flat_k[vox] == 0:
                 centroid_arr[vox] = np.array([0, 0, 0])
-                break
+            else:
+                centroid_arr[vox] = flat_centroids[vox, :flat_k[vox]]
 
-            # Get them in the right orientation and shape:
-            bv = self.bvecs[:, self.b_idx].T[nz_idx].T
-            
-            sort_bv = bv[:, np.argsort(this_fodf[nz_idx])[::-1]]
-            # We keep running k means and stop when adding more clusters stops
-            # being helpful, using the BIC to calculate when to stop:
-            last_bic = np.inf
-            choose = np.array([0,0,0])
-
-            # Deal with the special case of one model parameter: 
-            if bv.shape[-1] == 1:
-                centroids = bv * this_fodf[nz_idx]
-
-            else: 
-                for k in range(1, bv.shape[-1]):
-                    # Use the k largest peaks in the data as seeds:
-                    seeds = sort_bv[:, :k].T
-                    centroids, y_n, sse = ozc.spkm(bv.T, k, seeds=seeds,
-                                                   weights=this_fodf[nz_idx])
-
-                    if in_data is not None:
-                        # We're going to cross-validate against the other
-                        # data-set: 
-                        this_comp = comp_data[vox]
-                        # XXX Need to do linear regression right here?           
-                    else:
-                        # The unexplained variance is the residual sse: 
-                        bic = ozu.aic(sse, bv.shape[-1], k)
-
-                    if bic > last_bic:
-                            break
-                    else:
-                        choose = centroids
-                        last_bic = bic
-                    
-            centroid_arr[vox] = centroids
-
-        # We'll make a special nan/object array for this: 
+        # We'll make a special nan/object array for this:
         out = np.ones(self.signal.shape[:3], dtype=object) * np.nan
         out[self.mask] = centroid_arr
         return out
@@ -618,9 +542,7 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
             this_params[np.isnan(this_params)] = 0.0 
             out_flat[vox] = np.dot(this_params, design_matrix.T)
             
-        out = ozu.nans(self.signal.shape[:3]+ (vertices.shape[-1],))
-        out[self.mask] = out_flat
-        return out
+        return self._masked(out_flat)
 
 
     @desc.auto_attr
@@ -632,9 +554,7 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
         log_rel_sig = np.log(fit_rel_sig)
 
         out_flat = log_rel_sig/(-self.bvals[self.b_idx][0])
-        out = ozu.nans(self.signal.shape)
-        out[self.mask] = out_flat
-        return out
+        return self._masked(out_flat)
 
 
     @desc.auto_attr
@@ -653,35 +573,42 @@ class SparseDeconvolutionModel(CanonicalTensorModel):
             beta0[vox] = (s_bar[vox] - mu * np.sum(self._flat_params[vox])) * bD
 
         
-        out = ozu.nans(self.signal.shape[:3])
-        out[self.mask] = beta0
+        return self._masked(beta0)
 
-        return out
+    @desc.auto_attr
+    def _odf_interpolators(self):
+        """
+        A cache of the interpolation operators from the rot_vecs to the
+        vertices of other spheres (see `odf`)
+        """
+        return {}
 
     def odf(self, sphere, interp_kwargs=dict(function='multiquadric', smooth=0)):
         """
         Interpolate the fiber odf into a provided sphere class instance (from
         dipy)
+
+        The interpolation operator depends only on the rot_vecs, the sphere
+        and the interpolation parameters, so it is computed once for each
+        sphere (see `osmosis.odf.rbf_interpolator`), and applied to all the
+        voxels with one matrix product.
         """
-        s0 = dps.Sphere(xyz=self.bvecs[:, self.b_idx].T)
-        s1 = sphere
+        key = (np.asarray(sphere.vertices).tobytes(),
+               tuple(sorted(interp_kwargs.items())))
+        hit = key in self._odf_interpolators
+        ozi.cache_event(ozi.label(self, '_odf_interpolators'), hit)
+        if not hit:
+            self._odf_interpolators[key] = ozo.rbf_interpolator(
+                self.rot_vecs.T, sphere.vertices, **interp_kwargs)
+        interp = self._odf_interpolators[key]
+
         params_flat = self.model_params[self.mask]
-        out_flat = np.empty((self._n_vox, len(sphere.x)))
+        params_flat = np.where(np.isnan(params_flat), 0, params_flat)
+        out_flat = np.dot(params_flat, interp.T)
         if self._n_vox==1:
-           this_params = params_flat
-           this_params[np.isnan(this_params)] = 0
-           out = dps.interp_rbf(this_params, s0, s1, **interp_kwargs)
-           return np.squeeze(out)
-        else:
-            for vox in range(self._n_vox):
-                this_params = params_flat[vox]
-                this_params[np.isnan(this_params)] = 0
-                out_flat[vox] = dps.interp_rbf(this_params, s0, s1,
-                                           **interp_kwargs)
-            
-            out = ozu.nans(self.model_params.shape[:3] + (len(sphere.x),))
-            out[self.mask] = out_flat
-            return out
+            return np.squeeze(out_flat)
+
+        return self._masked(out_flat)
 
 
 
@@ -740,6 +667,100 @@ class SparseDeconvolutionFitter(object):
             
         return self.cache
 
+
+def shell_means(x, shells):
+    """
+    Average the measurements within each b value shell
+
+    Parameters
+    ----------
+    x: 2 dimensional array
+        Measurements in the last dimension
+    shells: 1 dimensional int array
+        The index of the shell of each of the measurements
+
+    Returns
+    -------
+    means: 2 dimensional array
+        The mean in each of the shells (in the last dimension)
+    """
+    members = (shells[:, None] == np.arange(np.max(shells) + 1)).astype(float)
+    return np.dot(x, members) / np.sum(members, 0)
+
+
+def weighted_gram_ols(design_matrix, fit_to, means=None, weights=None,
+                      block_size=1000, rcond=1e-15):
+    """
+    Least-squares fits of many voxels, computed from their (weighted) Gram
+    matrices, in blocks of voxels
+
+    Parameters
+    ----------
+    design_matrix: 2 dimensional array
+        The design matrix common to all the voxels (n_measurements by
+        n_regressors)
+    fit_to: 2 dimensional array
+        The signal to fit in each voxel (n_vox by n_measurements)
+    means: 2 dimensional array, optional
+        If provided, the design matrix of each voxel is demeaned by these
+        (n_vox by n_measurements): design_matrix - means[vox][:, None]
+    weights: 2 dimensional array, optional
+        If provided, the rows of the design matrix and of the signal in each
+        voxel are multiplied by these (n_vox by n_measurements)
+    block_size: int, optional
+        How many voxels are fit together
+    rcond: float, optional
+        Cutoff for small singular values of the Gram matrices (see
+        `np.linalg.pinv`)
+
+    Returns
+    -------
+    params: 2 dimensional array
+        The minimum-norm least-squares solution in each voxel (n_vox by
+        n_regressors)
+
+    Notes
+    -----
+    Solving the normal equations squares the condition number of the
+    problem, so this is meant for over-determined fits (more measurements
+    than regressors). The weighted design matrix of a voxel is never formed. With
+    $D = diag(w^2)$ and $X = T - m 1^T$:
+
+    .. math::
+
+        X^T D X = T^T D T - a 1^T - 1 a^T + (m^T D m) 1 1^T, a = T^T D m
+
+        X^T D y = T^T D y - (m^T D y) 1
+    """
+    fit_to = np.atleast_2d(fit_to)
+    T = np.asarray(design_matrix, dtype=float)
+    if means is None and weights is None:
+        # All the voxels share one Gram matrix:
+        pinv_gram = np.linalg.pinv(np.dot(T.T, T), rcond=rcond)
+        return np.dot(np.dot(fit_to, T), pinv_gram.T)
+
+    params = np.empty((fit_to.shape[0], T.shape[-1]))
+    for start in range(0, fit_to.shape[0], block_size):
+        block = slice(start, start + block_size)
+        y = fit_to[block]
+        if weights is None:
+            w_sq = np.ones(y.shape)
+        else:
+            w_sq = weights[block] ** 2
+        gram = np.matmul(T.T * w_sq[:, None, :], T)
+        Xty = np.dot(w_sq * y, T)
+        if means is not None:
+            m = means[block]
+            a = np.dot(w_sq * m, T)
+            gram -= a[:, :, None] + a[:, None, :]
+            gram += np.sum(w_sq * m * m, -1)[:, None, None]
+            Xty -= np.sum(w_sq * m * y, -1)[:, None]
+        params[block] = np.matmul(np.linalg.pinv(gram, rcond=rcond),
+                                  Xty[..., None])[..., 0]
+
+    return params
+
+
 class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
     """
     Sparse spherical deconvolution of diffusion data with multiple b values.
@@ -805,7 +826,7 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         self.unique_b = unique_b[1:]
         
         # Name the params file, if needed: 
-        this_class = str(self.__class__).split("'")[-2].split('.')[-1]
+        this_class = self.__class__.__name__
         self.params_file = params_file_resolver(self,
                                                 this_class,
                                                 params_file=params_file)
@@ -821,10 +842,10 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         # Deal with the solver stuff: 
         # For now, the default is ElasticNet:
         if solver is None:
-            this_solver = sklearn_solvers['ElasticNet']
+            this_solver = get_solver('ElasticNet')
         # Assume it's a key into the dict: 
         elif isinstance(solver, str):
-            this_solver = sklearn_solvers[solver]
+            this_solver = get_solver(solver)
         # Assume it's a class: 
         else:
             this_solver = solver
@@ -865,7 +886,7 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         # Get rid of places 
         # Get restraints and initial values for fitting the mean model
         if (bounds == "preset") | (initial == "preset"):
-            all_params = mdm.initial_params(data, bvecs, bvals, self.func_str, mask=self.mask,
+            all_params = mdm.initial_params(data, bvecs, bvals, self.func, mask=self.mask,
                                             params_file="temp")
         if bounds == "preset":
             self.bounds = all_params[0]
@@ -907,6 +928,89 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         
         return tensor_out
         
+    def _response_diffusivities(self, bvals):
+        """
+        The axial and radial diffusivities of the response function in each
+        of the measurements
+
+        Parameters
+        ----------
+        bvals: 1 dimensional array
+            B values scaled by the scaling factor
+
+        Returns
+        -------
+        ad, rd: 1 dimensional arrays
+            Diffusivities for the b value shell of each of the b values
+        """
+        bval_tensor = np.round(bvals) * self.scaling_factor
+        ad = np.empty(bval_tensor.shape)
+        rd = np.empty(bval_tensor.shape)
+        for this_b in np.unique(bval_tensor):
+            ad[bval_tensor == this_b] = self.ad[this_b]
+            rd[bval_tensor == this_b] = self.rd[this_b]
+
+        return ad, rd
+
+    def _tensor_regressors(self, vertices, bvals, ad, rd, mode=None):
+        r"""
+        The response function rotated to each of the rot_vecs, evaluated in
+        all the vertices at once
+
+        Parameters
+        ----------
+        vertices: 2 dimensional array
+            B vectors (3 by n)
+        bvals: 1 dimensional array
+            B values scaled by the scaling factor (one for each vertex)
+        ad, rd: floats or 1 dimensional arrays
+            Diffusivities of the response function in each of the vertices
+
+        Returns
+        -------
+        out: 2 dimensional array
+            Response function at these particular b vectors (one row for each
+            of the rot_vecs)
+
+        Notes
+        -----
+        For an axially symmetric tensor pointing along $\vec{v}$, the ADC in
+        the direction $\vec{b}$ is $rd + (ad - rd) (\vec{b} \cdot \vec{v})^2$.
+        """
+        if mode is None:
+            mode = self.mode
+
+        rot_vecs = self.rot_vecs / np.sqrt(np.sum(self.rot_vecs ** 2, 0))
+        cos_sq = np.dot(rot_vecs.T, vertices) ** 2
+        adc = rd + (ad - rd) * cos_sq
+
+        if mode == 'distance':
+            # This is the special case where we use the diffusion distance
+            # calculation, instead of the predicted signal:
+            return 1 / np.sqrt(1. / rd + (1. / ad - 1. / rd) * cos_sq)
+        elif mode == 'ADC':
+            # This is another special case, calculating the ADC instead of
+            # using the predicted signal:
+            return adc
+
+        pred_sig = np.exp(-bvals * adc)
+        # Otherwise, we do one of these with the predicted signal:
+        if mode == 'signal_attenuation':
+            # Fit to 1 - S/S0
+            return 1 - pred_sig
+        elif mode == 'relative_signal':
+            # Fit to S/S0 using the predicted diffusion attenuated signal:
+            return pred_sig
+        elif mode == 'normalize':
+            # Normalize your regressors to have a maximum of 1:
+            return pred_sig / np.max(pred_sig, -1)[:, None]
+        elif mode == 'log':
+            # Take the log:
+            return -bvals * adc
+        else:
+            e_s = "Unknown mode: %s" % mode
+            raise ValueError(e_s)
+
     def _calc_rotations(self, vertices, bvals, b_idx=None, mode=None, over_sample=None):
         """
         Given the rot_vecs of the object and a set of vertices (for the fitting
@@ -915,75 +1019,34 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         
         Parameters
         ----------
-        bvals: 1 dimensional array
-            B values scaled by the scaling factor
+        bvals: float or 1 dimensional array
+            B values scaled by the scaling factor (either one for all the
+            vertices, or one for each of them)
         vertices: 2 dimensional array
             B vectors
         
         Returns
         -------
-        out: 1 dimensional array
-            Response function at these particular b vectors
+        out: 2 dimensional array
+            Response function at these particular b vectors (one row for each
+            of the rot_vecs)
         """
-        
-        # unless we ask to change it, just use the mode of the object
-        if mode is None:
-            mode = self.mode
-        
-        # We will use the eigen-value/vectors from the response function
-        # and rotate them around to each one of these vectors, calculating
-        # the predicted signal in the bvecs of the actual measurement (even
-        # when over-sampling):
-        
-        if len(vertices.shape) == 1:
-            vertex = np.reshape(vertices, (3,1))
-        
+        vertices = np.reshape(vertices, (3, -1))
+
         if (self.mean == "empirical") | (self.mean_mix == "mm_emp"):
-            bval_list, b_inds, unique_b, rounded_bvals = separate_bvals(bvals)
-            [evals, evecs, these_verts,
-            these_bvals, out] = self._calc_rotations_empirical(bvals, b_inds, vertices, b_idx)
+            [these_verts, these_bvals,
+             bval_tensor] = self._calc_rotations_empirical(bvals, vertices, b_idx)
+            ad = self.ad[bval_tensor]
+            rd = self.rd[bval_tensor]
         else:
-            # Here, bvals is just one b value divided by the scaling factor
-            these_bvals = np.array([bvals])
             these_verts = vertices
-            out = np.empty((self.rot_vecs.shape[-1], vertices.shape[-1])) 
-            bval_tensor = round(bvals)*self.scaling_factor
-            evals, evecs = self.response_function(bval_tensor, these_verts).decompose
-        
-        # bvec within the rotational vectors
-        for idx, bvec in enumerate(self.rot_vecs.T):               
-            # these_bvals needs to be divided by the scaling factor before this operation:
-            this_rot = ozt.rotate_to_vector(bvec, evals, evecs, these_verts, these_bvals)
-            pred_sig = this_rot.predicted_signal(1)
-            
-            #Try saving some memory: 
-            del this_rot
-            
-            if mode == 'distance':
-                    # This is the special case where we use the diffusion distance
-                    # calculation, instead of the predicted signal:
-                    out[idx] = this_rot.diffusion_distance
-            elif mode == 'ADC':
-                    # This is another special case, calculating the ADC instead of
-                    # using the predicted signal: 
-                    out[idx] = this_rot.ADC
-            # Otherwise, we do one of these with the predicted signal: 
-            elif mode == 'signal_attenuation':
-                    # Fit to 1 - S/S0 
-                    out[idx] = 1 - pred_sig
-            elif mode == 'relative_signal':
-                    # Fit to S/S0 using the predicted diffusion attenuated signal:
-                    out[idx] = pred_sig
-            elif mode == 'normalize':
-                    # Normalize your regressors to have a maximum of 1:
-                    out[idx] = pred_sig / np.max(pred_sig)
-            elif mode == 'log':
-                    # Take the log and divide out the b value:
-                    out[idx] = np.log(pred_sig)
-                       
-        return out
+            these_bvals = np.ones(vertices.shape[-1]) * bvals
+            ad, rd = self._response_diffusivities(these_bvals)
+
+        return self._tensor_regressors(these_verts, these_bvals, ad, rd,
+                                       mode=mode)
     
-    def _calc_rotations_empirical(self, bval_arr, b_inds, vertices, b_idx):
+    def _calc_rotations_empirical(self, bval_arr, vertices, b_idx):
         """
         Helper function for _calc_rotations only used of demeaning by the empirical
         mean.
@@ -992,8 +1055,6 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         ----------
         bval_arr: 1 dimensional array
             B values scaled by the scaling factor
-        b_inds: list
-            List of indices corresponding to each b value
         vertices: 2 dimensional array
             B vectors
         b_idx: int
@@ -1001,16 +1062,13 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         
         Returns
         -------
-        evals: 1 dimensional array
-            Eigenvalues from the response function
-        evecs: 2 dimensional array
-            Eigenvectors from the response function
         these_verts: 2 dimensional array
             Reduced b vectors for current b value
         these_bvals: 1 dimensional array
             Reduced b values for current b value
-        out: 2 dimensional array
-            Preallocated array to hold response function at these particular b vectors
+        bval_tensor: float
+            The b value of the response function (not divided by the scaling
+            factor)
         """
         # bval_arr comes in without a scaling factor, comes out with a scaling factor
         bval_list, b_inds, unique_b, rounded_bvals = separate_bvals(bval_arr)
@@ -1019,34 +1077,23 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         else:
             # For predict function.  Input b values don't usually include b = 0 values
             ind = 0
-        bval_list = bval_list[ind:]
         unique_b = unique_b[ind:]
-        all_b_idx = np.squeeze(np.where(rounded_bvals != 0))
         
         if len(unique_b) > 1:
-            b_inds = b_inds[ind:]
-            this_b_inds = b_inds[b_idx]
-            these_verts = vertices[:, this_b_inds]
-            out = np.empty((self.rot_vecs.shape[-1], vertices[:,this_b_inds].shape[-1]))
-            these_bvals = np.squeeze(rounded_bvals)[this_b_inds]/self.scaling_factor
+            this_b_inds = b_inds[ind:][b_idx]
+        elif ind == 1:
+            # If b = 0 values included in input b value array, then take only the
+            # non-b=0 values and vectors.
+            this_b_inds = b_inds[ind]
         else:
-            if ind == 1:
-                # If b = 0 values included in input b value array, then take only the
-                # non-b=0 values and vectors.
-                this_b_inds = b_inds[ind]
-                these_verts = vertices[:, this_b_inds]
-                these_bvals = rounded_bvals[this_b_inds]/self.scaling_factor
-                out = np.empty((self.rot_vecs.shape[-1], vertices[:, this_b_inds].shape[-1]))
-            else:
-                # Otherwise, the input values are already the non-b=0 values.
-                these_verts = vertices
-                these_bvals = rounded_bvals/self.scaling_factor
-                out = np.empty((self.rot_vecs.shape[-1], vertices.shape[-1]))
+            # Otherwise, the input values are already the non-b=0 values.
+            this_b_inds = np.arange(vertices.shape[-1])
+        these_verts = vertices[:, this_b_inds]
+        these_bvals = np.squeeze(rounded_bvals)[this_b_inds]/self.scaling_factor
         
         bval_tensor = int(self.unique_b[b_idx]) # Not divided by scaling factor
-        evals, evecs = self.response_function(bval_tensor, these_verts, bvals=these_bvals).decompose
         
-        return evals, evecs, these_verts, these_bvals, out
+        return these_verts, these_bvals, bval_tensor
         
     def rotations(self, b_idx):
         """
@@ -1080,23 +1127,22 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         ----------
         bvals: 1 dimensional array
             B values at which to evaluate the mean diffusivity at
-        idx: int
-            Index into the b values for the current b value
+        idx: int or 1 dimensional array
+            Index into the b values for the current b value(s)
         md: 1 dimensional array
             Input mean diffusivities if the default mean diffusivity calculated from
             the SFM's b values and b vectors is not desired.
             
         Return
         ------
-        out: 1 dimensional array
-            Relative signal calculated from mean diffusivity
+        out: 1 or 2 dimensional array
+            Relative signal calculated from mean diffusivity in each voxel (and
+            at each of the b values, if idx is an array)
         """
         if md is None:
-            out = np.exp(-bvals[idx]*self.tensor_model.mean_diffusivity[self.mask])
-        else:
-            out = np.exp(-bvals[idx]*md)
+            md = self.tensor_model.mean_diffusivity[self.mask]
 
-        return out
+        return np.exp(-np.multiply.outer(md, bvals[idx]))
 
     def _flat_rel_sig_avg(self, bvals):
         """
@@ -1118,7 +1164,6 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         
         param_num = len(inspect.getargspec(self.func)[0])-1
         params_out = np.zeros((int(np.sum(self.mask)), param_num))
-        sig_out = ozu.nans((int(np.sum(self.mask)),) + (len(self.all_b_idx),))
         
         for vox in np.arange(np.sum(self.mask)).astype(int):
             s0 = np.mean(flat_data[vox, self.b0_inds], -1)
@@ -1142,13 +1187,35 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
                                                     bounds = self.bounds)
                 params = lsq_b_out[0] 
             params_out[vox] = np.squeeze(params)
-            
-            if self.mm_signal == "log":
-                sig_out[vox] = np.exp(self.func(bvals, *params))
-            elif self.mm_signal == "relative_signal":
-                sig_out[vox] = self.func(bvals, *params)
+
+        sig_out = self._mean_model_signal(bvals, params_out)
 
         return sig_out, params_out
+
+    def _mean_model_signal(self, bvals, params):
+        """
+        The relative signal predicted by the mean model
+        
+        Parameters
+        ----------
+        bvals: 1 dimensional array
+            B values at which to evaluate the mean model at
+        params: 2 dimensional array
+            Parameters for the mean model at each voxel
+        
+        Returns
+        -------
+        sig_out: 2 dimensional array
+            Means for each b value in each voxel
+        """
+        sig_out = np.empty((params.shape[0], len(bvals)))
+        for vox in xrange(params.shape[0]):
+            sig_out[vox] = self.func(bvals, *params[vox])
+
+        if self.mm_signal == "log":
+            sig_out = np.exp(sig_out)
+
+        return sig_out
         
     @desc.auto_attr
     def fit_flat_rel_sig_avg(self):
@@ -1182,66 +1249,64 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
             were demeaned
         design_matrix: 2 dimensional array
             Demeaned design matrix for fitting
+
+        Notes
+        -----
+        Demeaning the tensor regressors by the mean signal of a voxel is a
+        rank-1 update of the tensor regressors, so for the mean model, the
+        tensor regressors are shared by all the voxels and the design matrix of
+        each voxel is tensor_regressor - sig_out[vox][:, None].
         """
+        bvals = self.bvals[self.all_b_idx]
         
-        fit_to = np.empty((np.sum(self.mask), len(self.all_b_idx)))
-        fit_to_means = np.empty((np.sum(self.mask), len(self.all_b_idx)))
-        fit_to_demeaned = np.empty(fit_to.shape)
-        
-        n_columns = len(self.rot_vecs[0])
-        if self.mean == "no_demean":
-            n_columns = n_columns + 1
-        tensor_regressor = np.empty((len(self.all_b_idx), n_columns))
-        design_matrix = np.empty(tensor_regressor.shape)
-
-        for idx, b_idx in enumerate(self.all_b_idx):
-            
-            if self.mean == "MD":
-                sig_demean = self._flat_MD_rel_sig_avg(self.bvals, b_idx)
-            else:
-                sig_out, _ = self.fit_flat_rel_sig_avg
-                sig_demean = sig_out[:, idx]
-                
-            if self.mode == 'signal_attenuation':
-                sig_avg = 1 - np.copy(sig_demean)
-                this_fit_to = self._flat_signal_attenuation[:, idx]
-            elif self.mode == 'relative_signal':
-                sig_avg = np.copy(sig_demean)
-                this_fit_to = self._flat_relative_signal[:, idx]
-            elif self.mode == 'normalize':
-                # The only difference between this and the above is that the
-                # iso_regressor is here set to all 1's, which can affect the
-                # weights...
-                sig_avg = np.copy(sig_demean)
-                this_fit_to = self._flat_relative_signal[:, idx]
-            elif self.mode == 'log':
-                #sig_avg = np.log(np.copy(sig_demean))
-                this_fit_to = np.log(self._flat_relative_signal[:, idx])
-            
-            if self.mean_mix != "mm_emp":
-                # Find tensor regressor values
-                this_tensor_regressor = self._calc_rotations(np.reshape(self.bvecs[:, b_idx],
-                                                                       (3,1)), self.bvals[b_idx])
-                if self.mean == "no_demean":
-                    tensor_regressor[idx] = np.concatenate((np.squeeze(this_tensor_regressor),[1]))
-                else:
-                    tensor_regressor[idx] = np.squeeze(this_tensor_regressor)
+        if self.mean == "MD":
+            sig_demean = self._flat_MD_rel_sig_avg(self.bvals, self.all_b_idx)
+        else:
+            sig_demean, _ = self.fit_flat_rel_sig_avg
             
-            # Find the signals to fit to and demean them by mean signal calculated from
-            # the mean diffusivity.
-            fit_to[:, idx] = this_fit_to
-            fit_to_demeaned[:, idx] = this_fit_to - sig_avg
-            fit_to_means[:, idx] = sig_avg
+        if self.mode == 'signal_attenuation':
+            sig_avg = 1 - sig_demean
+            fit_to = np.array(self._flat_signal_attenuation)
+        elif self.mode == 'relative_signal':
+            sig_avg = np.array(sig_demean)
+            fit_to = np.array(self._flat_relative_signal)
+        elif self.mode == 'normalize':
+            # The only difference between this and the above is that the
+            # iso_regressor is here set to all 1's, which can affect the
+            # weights...
+            sig_avg = np.array(sig_demean)
+            fit_to = np.array(self._flat_relative_signal)
+        elif self.mode == 'log':
+            sig_avg = np.log(sig_demean)
+            fit_to = np.log(self._flat_relative_signal)
+        
+        # Find tensor regressor values in all the directions at once:
+        ad, rd = self._response_diffusivities(bvals)
+        tensor_regressor = self._tensor_regressors(self.bvecs[:, self.all_b_idx],
+                                                   bvals, ad, rd).T
+        if self.mean == "no_demean":
+            tensor_regressor = np.concatenate([tensor_regressor,
+                                               np.ones((len(bvals), 1))], -1)
+        
+        # Find the signals to fit to and demean them by mean signal calculated from
+        # the mean diffusivity.
+        fit_to_demeaned = fit_to - sig_avg
+        fit_to_means = sig_avg
 
-            if self.mean == "MD":
-                bval_tensor = round(self.bvals[b_idx])*self.scaling_factor
-                this_MD = (self.ad[bval_tensor]+2*self.rd[bval_tensor])/3.
-                design_matrix[idx] = (np.squeeze(this_tensor_regressor) -
-                                        np.exp(-self.bvals[b_idx]*this_MD))
         if self.mean == "MD":
+            this_MD = (ad + 2 * rd) / 3.
+            design_matrix = tensor_regressor - np.exp(-bvals * this_MD)[:, None]
             return [fit_to, tensor_regressor, fit_to_demeaned, fit_to_means, design_matrix]
         else:
             return [fit_to, tensor_regressor, fit_to_demeaned, fit_to_means]
+
+    @desc.auto_attr
+    def _shells(self):
+        """
+        The index into unique_b of the b value of each of the diffusion
+        weighted measurements
+        """
+        return np.searchsorted(self.unique_b, self.rounded_bvals_rm0)
             
     @desc.auto_attr                  
     def empirical_regressors(self):
@@ -1264,47 +1329,32 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         design_matrix: 2 dimensional array
             Demeaned design matrix for fitting
         """
-        
-        fit_to = np.empty((np.sum(self.mask), len(self.all_b_idx)))
-        fit_to_means = np.empty((np.sum(self.mask), len(self.all_b_idx)))
-        fit_to_demeaned = np.empty(fit_to.shape)
-        
-        n_columns = len(self.rot_vecs[0])
-        tensor_regressor = np.empty((len(self.all_b_idx), n_columns))
-        design_matrix = np.empty(tensor_regressor.shape)
-        
-        for idx, b in enumerate(self.unique_b):
-            if len(self.unique_b) > 1:
-                flat_sig_inds = self.b_inds_rm0[idx]
-            else:
-                flat_sig_inds = self.b_inds_rm0
-                
-            if self.mode == 'signal_attenuation':
-                this_fit_to = self._flat_signal_attenuation[:, flat_sig_inds].T
-            elif self.mode == 'relative_signal':
-                this_fit_to = self._flat_relative_signal[:, flat_sig_inds].T
-            elif self.mode == 'normalize':
-                # The only difference between this and the above is that the
-                # iso_regressor is here set to all 1's, which can affect the
-                # weights... 
-                this_fit_to = self._flat_relative_signal[:, flat_sig_inds].T
-            elif self.mode == 'log':
-                this_fit_to = np.log(self._flat_relative_signal(flat_sig_inds)).T
-            
-            this_tensor_regressor = self.rotations(idx)
-
-            for vox in xrange(self._n_vox):                
-                # Tensor regressors
-                tensor_regressor[flat_sig_inds] = this_tensor_regressor.T
-                
-                # Array of signals to fit to - Means only, demeaned, and normal
-                fit_to[vox, flat_sig_inds] = this_fit_to.T[vox]
-                fit_to_demeaned[vox, flat_sig_inds] = this_fit_to.T[vox] - np.mean(this_fit_to.T[vox])
-                fit_to_means[vox, flat_sig_inds] = np.mean(this_fit_to.T[vox])
-                
-                # Design matrix - tensor regressors with mean subtracted
-                this_design_matrix = this_tensor_regressor.T - np.mean(this_tensor_regressor, -1)
-                design_matrix[flat_sig_inds] = this_design_matrix
+        if self.mode == 'signal_attenuation':
+            fit_to = np.array(self._flat_signal_attenuation)
+        elif self.mode == 'relative_signal':
+            fit_to = np.array(self._flat_relative_signal)
+        elif self.mode == 'normalize':
+            # The only difference between this and the above is that the
+            # iso_regressor is here set to all 1's, which can affect the
+            # weights... 
+            fit_to = np.array(self._flat_relative_signal)
+        elif self.mode == 'log':
+            fit_to = np.log(self._flat_relative_signal)
+
+        # Array of signals to fit to - Means only, demeaned, and normal
+        fit_to_means = shell_means(fit_to, self._shells)[:, self._shells]
+        fit_to_demeaned = fit_to - fit_to_means
+        
+        # Tensor regressors, with the b values rounded to their shell:
+        these_bvals = self.rounded_bvals_rm0 / self.scaling_factor
+        ad, rd = self._response_diffusivities(these_bvals)
+        tensor_regressor = self._tensor_regressors(self.bvecs[:, self.all_b_idx],
+                                                   these_bvals, ad, rd).T
+
+        # Design matrix - tensor regressors with the mean of each shell
+        # subtracted
+        design_matrix = (tensor_regressor -
+                         shell_means(tensor_regressor.T, self._shells)[:, self._shells].T)
                 
         return [fit_to, tensor_regressor, fit_to_demeaned, fit_to_means, design_matrix]
     
@@ -1368,72 +1418,90 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
             if self.verbose:
                 print("Loading params from file: %s"%self.params_file)
             # Get the cached values and be done with it:
-            return ni.load(self.params_file).get_data()
+            return self._load_params()
 
         else:
 
             if self.verbose:
                 print("Fitting SparseDeconvolutionModel:")
                 prog_bar = ozu.ProgressBar(self._flat_signal_b(self.all_b_idx).shape[0])
-                this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-                f_name = this_class + '.' + inspect.stack()[0][3]
+                this_class = self.__class__.__name__
+                f_name = this_class + '.model_params'
             
+            # The mean signal of each voxel, if the design matrix is demeaned
+            # separately in each voxel:
+            vox_means = None
             if self.mean == "MD":
                 _, _, fit_to, _, design_matrix = self.regressors
             elif self.mean == "empirical":
                 _, _, fit_to, _, design_matrix  = self.empirical_regressors
-            elif self.mean == "mean_model":
+            else:
                 sig_out, _ = self.fit_flat_rel_sig_avg
-                fit_to_with_mean, tensor_regressor, fit_to, _ = self.regressors
+                fit_to, tensor_regressor, _, _ = self.regressors
+                if self.mean == "mean_model":
+                    fit_to = fit_to - sig_out
+                    vox_means = sig_out
                 
                 # If mixing the empirical mean for the regressors, grab the regressors
                 # from the empirical regressors
                 if self.mean_mix=="mm_emp":
                     _, _, _, _, design_matrix  = self.empirical_regressors
-            
-            if self._n_vox==1:
-                # We have to be a bit (too) clever here, so that the indexing
-                # below works out:
-                fit_to_with_mean = fit_to_with_mean.T
-                       
-            # One weight for each rotation
-            col_num = self.rot_vecs.shape[-1]
-            if self.mean == "no_demean":
-                col_num = col_num + 1
-            params = np.empty((self._n_vox, col_num))
-                           
-            for vox in xrange(self._n_vox):
-                if np.logical_or(self.mean == "MD", self.mean == "empirical"):
-                    vox_fit_to_demeaned = fit_to[vox]
+                    vox_means = None
+                elif vox_means is None:
+                    design_matrix = tensor_regressor
                 else:
-                    if self.mean == "mean_model":
-                        avg_sig = sig_out[vox][:, None]
-                    elif self.mean == "no_demean":
-                        avg_sig = 0.0
-                    if self.mean_mix != "mm_emp":
-                        design_matrix = tensor_regressor - avg_sig
-                        
-                    vox_fit_to_demeaned = fit_to_with_mean[vox] - np.squeeze(avg_sig)
-                    
-                    if self.fit_method == "WLS":
-                        sig_out = sig_out.astype(float)
-                        weighting_matrix = np.diag(sig_out[vox]/np.max(sig_out[vox]))
-                        design_matrix = np.dot(weighting_matrix, design_matrix)
-                        vox_fit_to_demeaned = np.dot(weighting_matrix, vox_fit_to_demeaned)                   
-                    
-                params[vox] = self._fit_it(vox_fit_to_demeaned, design_matrix, self.solver_str)
-                if self.verbose:
-                    prog_bar.animate(vox, f_name=f_name)
+                    # Demeaning by the mean of each voxel is a rank-1 update
+                    # of the tensor regressors, which is computed in place:
+                    design_matrix = np.empty(tensor_regressor.shape)
+
+            # The weights of the rows of the design matrix in each voxel:
+            weights = None
+            if (self.fit_method == "WLS" and
+                self.mean not in ["MD", "empirical"]):
+                weights = sig_out/np.max(sig_out, -1)[:, None]
+                weighted_design_matrix = np.empty(design_matrix.shape)
+
+            if (self.solver_str == "LR" and
+                design_matrix.shape[0] > design_matrix.shape[1]):
+                # Over-determined least-squares: all the voxels are fit
+                # together from their Gram matrices, without forming the
+                # design matrix of each voxel
+                if vox_means is None:
+                    params = weighted_gram_ols(design_matrix, fit_to,
+                                               weights=weights)
+                else:
+                    params = weighted_gram_ols(tensor_regressor, fit_to,
+                                               means=vox_means, weights=weights)
+            else:
+                params = np.empty((self._n_vox, design_matrix.shape[-1]))
+                for vox in xrange(self._n_vox):
+                    if vox_means is not None:
+                        np.subtract(tensor_regressor, vox_means[vox][:, None],
+                                    out=design_matrix)
+                    this_design_matrix = design_matrix
+                    vox_fit_to_demeaned = fit_to[vox]
+
+                    if weights is not None:
+                        # Scale the rows (instead of multiplying by a diagonal
+                        # matrix):
+                        this_design_matrix = np.multiply(weights[vox][:, None],
+                                                         design_matrix,
+                                                         out=weighted_design_matrix)
+                        vox_fit_to_demeaned = weights[vox] * vox_fit_to_demeaned
+
+                    params[vox] = self._fit_it(vox_fit_to_demeaned,
+                                               this_design_matrix,
+                                               self.solver_str)
+                    if self.verbose:
+                        prog_bar.animate(vox, f_name=f_name)
             
             # It doesn't matter what's in the last dimension since we only care
             # about the first 3.  Thus, just pick the array of signals from them
             # first b value.
-            out_params = ozu.nans(self.signal.shape[:3] + (design_matrix.shape[-1],))
-            
-            out_params[self.mask] = params
-            # Save the params to a file: 
-            params_ni = ni.Nifti1Image(out_params, self.affine)
+            out_params = self._masked(params)
             if self.params_file != 'temp':
+                # Save the params to a file: 
+                params_ni = ni.Nifti1Image(np.asarray(out_params), self.affine)
                 if self.verbose:
                     print("Saving params to file: %s"%self.params_file)
                 params_ni.to_filename(self.params_file)
@@ -1447,7 +1515,19 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         Get the signal in the b0 scans in flattened form (only in the mask)
         """
         return np.mean(self._flat_data[:,self.b0_inds], -1)
-        
+
+    def _relative_to_signal(self, relative):
+        """
+        Convert the predicted values of the quantity that is fit (depending
+        on the mode) to signal, in each voxel
+        """
+        if self.mode == 'log':
+            relative = np.exp(relative)
+        if self.mode == 'signal_attenuation':
+            relative = 1 - relative
+        # relative = S/S0
+        return relative * self._flat_S0[:, None]
+
     @desc.auto_attr
     def fit(self):
         """
@@ -1458,40 +1538,33 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
             msg += " with %s"%self.solver
             print(msg)
         
+        params = np.atleast_2d(self._flat_params)
+        params = np.where(np.isnan(params), 0, params)
         if self.mean == "MD":
             _,_,_,fit_to_means, design_matrix = self.regressors
         elif self.mean == "empirical":
             _,_,_,fit_to_means, design_matrix = self.empirical_regressors
+        elif self.mean == "no_demean":
+            _, design_matrix, _, _ = self.regressors
+            fit_to_means = 0
         else:
             _, tensor_regressor, _, fit_to_means = self.regressors
-            sig_out, _ = self.fit_flat_rel_sig_avg
-        
-        out_flat_arr = np.zeros(fit_to_means.shape)
-        for vox in xrange(self._n_vox):
-            if np.logical_and(self.mean != "MD", self.mean != "empirical"):
-                design_matrix = tensor_regressor - sig_out[vox][:, None]
-                
-            this_params = self._flat_params[vox]
-            this_params[np.isnan(this_params)] = 0.0
-            
-            if self.mode == 'log':
-                this_relative=np.exp(np.dot(this_params, design_matrix.T) +
-                                     fit_to_means[vox])
-            else:     
-                this_relative = np.dot(this_params, design_matrix.T) + fit_to_means[vox]
-            if (self.mode == 'relative_signal' or self.mode=='normalize' or
-                self.mode=='log'):
-                this_pred_sig = this_relative * self._flat_S0[vox] # this_relative = S/S0
-            elif self.mode == 'signal_attenuation':
-                this_pred_sig =  (1 - this_relative) * self._flat_S0[vox]
-
-            out_flat_arr[vox] = this_pred_sig
+            if self.mean_mix == "mm_emp":
+                _, _, _, _, design_matrix = self.empirical_regressors
+            else:
+                sig_out, _ = self.fit_flat_rel_sig_avg
+                # The design matrix of each voxel is tensor_regressor -
+                # sig_out[vox][:, None], so that its product with the params
+                # is:
+                design_matrix = None
+                relative = (np.dot(params, tensor_regressor.T) -
+                            sig_out * np.sum(params, -1)[:, None] + fit_to_means)
+
+        if design_matrix is not None:
+            relative = np.dot(params, design_matrix.T) + fit_to_means
+        out_flat_arr = self._relative_to_signal(relative)
             
-        out = ozu.nans((self.signal.shape[:3] + 
-                         (design_matrix.shape[-1],)))
-        out[self.mask] = out_flat_arr
-
-        return out
+        return self._masked(out_flat_arr)
         
     def predict(self, vertices, new_bvals, new_params = None, md = None):
         """
@@ -1521,96 +1594,59 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
             msg += " with %s"%self.solver
             print(msg)
         
+        vertices = np.reshape(vertices, (3, -1))
+        params = np.atleast_2d(self._flat_params)
+        params = np.where(np.isnan(params), 0, params)
+        # The design matrix of each voxel is tensor_regressor - fit_to_mean[vox],
+        # unless a design matrix common to all the voxels is set:
+        design_matrix = None
         if self.mean == "empirical":
-            out_flat_arr, fit_to_mean, design_matrix = self._empirical_predict(new_bvals, vertices)
+            fit_to_mean, design_matrix = self._empirical_predict(new_bvals, vertices)
         else:           
-            if len(vertices.shape) == 1:
-                vertices = np.reshape(vertices, (3,1))
-            
-            col_num = self.rot_vecs.shape[-1]
-            if self.mean == "no_demean":
-                col_num = col_num + 1
-          
             # If mixing the mean model with the empirical mean for the regressors,
             # use the design matrix from the empirical predict.
             if (self.mean == "mean_model") & (self.mean_mix == "mm_emp"):
-                _, _, design_matrix = self._empirical_predict(new_bvals, vertices)
+                _, design_matrix = self._empirical_predict(new_bvals, vertices)
                 
             # Just so everything works out, divide by the scaling factor
-            new_bvals = new_bvals/self.scaling_factor
-            if self.mean_mix != "mm_emp":
-                tensor_regressor = np.zeros((vertices.shape[-1], col_num))
-                design_matrix = np.zeros((vertices.shape[-1], self.rot_vecs.shape[-1]))
-                fit_to_mean = np.zeros((self._n_vox, vertices.shape[-1])) # For MD only
-                for idx, bval in enumerate(new_bvals):
-                    # Create a new design matrix from the given vertices
-                    cr = self._calc_rotations(np.reshape(vertices[:, idx], (3,1)), bval)
-                    if self.mean == "no_demean":
-                        tensor_regressor[idx] = np.concatenate((np.squeeze(cr), [1]))
-                    else:
-                        this_tensor_regressor = np.squeeze(cr)
-                        tensor_regressor[idx] = this_tensor_regressor
-                        
-                    if self.mean == "MD":
-                        bval_tensor = round(bval)*self.scaling_factor
-                        this_MD = (self.ad[bval_tensor]+2*self.rd[bval_tensor])/3.
-                        design_matrix[idx] = np.squeeze(this_tensor_regressor)-np.exp(-bval*this_MD)
-                        
-                        # Find the mean signal across the vertices corresponding to the b values
-                        # given.
-                        fit_to_mean[:, idx] = self._flat_MD_rel_sig_avg(new_bvals, idx, md = md)
+            new_bvals = np.ones(vertices.shape[-1]) * new_bvals/self.scaling_factor
+            # Create a new design matrix from the given vertices
+            ad, rd = self._response_diffusivities(new_bvals)
+            tensor_regressor = self._tensor_regressors(vertices, new_bvals,
+                                                       ad, rd).T
 
-            # If new parameters are given, use those instead.
-            if new_params is not None:
-                params_out = new_params
+            if self.mean == "MD":
+                this_MD = (ad + 2 * rd) / 3.
+                design_matrix = (tensor_regressor -
+                                 np.exp(-new_bvals * this_MD)[:, None])
+                # Find the mean signal across the vertices corresponding to the b values
+                # given.
+                fit_to_mean = self._flat_MD_rel_sig_avg(new_bvals,
+                                                        np.arange(len(new_bvals)),
+                                                        md = md)
+            elif self.mean == "no_demean":
+                design_matrix = np.concatenate([tensor_regressor,
+                                                np.ones((len(new_bvals), 1))], -1)
+                fit_to_mean = 0
             else:
-                # Grab the parameters for fitting the mean
-                _, params_out = self.fit_flat_rel_sig_avg
-            
-            out_flat_arr = np.zeros((self._n_vox, vertices.shape[-1]))
+                # If new parameters are given, use those instead.
+                if new_params is not None:
+                    params_out = new_params
+                else:
+                    # Grab the parameters for fitting the mean
+                    _, params_out = self.fit_flat_rel_sig_avg
+                fit_to_mean = self._mean_model_signal(new_bvals,
+                                                      np.atleast_2d(params_out))
         
         # Now that everything is set up, predict the signal in the given vertices.
-        for vox in xrange(self._n_vox):    
-            this_params = self._flat_params[vox]
-            this_params[np.isnan(this_params)] = 0.0
-
-            if np.logical_or(self.mean == "MD", self.mean == "empirical"):
-                this_fit_to_mean = fit_to_mean[vox]
-            else:                   
-                if self.mean == "mean_model":
-                    # Make sure that the signal output is appropriate.
-                    if self.mm_signal == "log":
-                        this_fit_to_mean = np.exp(self.func(new_bvals, *params_out[vox]))
-                    elif self.mm_signal == "relative_signal":
-                        this_fit_to_mean = self.func(new_bvals, *params_out[vox])
-                        
-                    this_fit_to_mean = this_fit_to_mean[:, None]
-                elif self.mean == "no_demean":
-                    this_fit_to_mean = 0.0
-                    
-                # Create a new design matrix if not mixing means.
-                if self.mean_mix != "mm_emp":
-                    design_matrix = tensor_regressor - this_fit_to_mean
-            # Relative signal:
-            if self.mode == 'log':
-                this_relative=np.exp(np.dot(this_params, design_matrix.T) +
-                                    np.squeeze(this_fit_to_mean))
-            else:
-                this_relative = (np.dot(this_params, design_matrix.T) +
-                                    np.squeeze(this_fit_to_mean))
-            # Predicted signal        
-            if (self.mode == 'relative_signal' or self.mode=='normalize' or
-                self.mode=='log'):
-                this_pred_sig = this_relative * self._flat_S0[vox] # this_relative = S/S0
-            elif self.mode == 'signal_attenuation':
-                this_pred_sig =  (1 - this_relative) * self._flat_S0[vox]
-                
-            out_flat_arr[vox] = this_pred_sig
-        
-        out = ozu.nans(self.data.shape[:3] + (out_flat_arr.shape[-1],))
-        out[self.mask] = out_flat_arr
+        if design_matrix is None:
+            relative = (np.dot(params, tensor_regressor.T) +
+                        fit_to_mean * (1 - np.sum(params, -1))[:, None])
+        else:
+            relative = np.dot(params, design_matrix.T) + fit_to_mean
+        out_flat_arr = self._relative_to_signal(relative)
         
-        return out
+        return self._masked(out_flat_arr)
         
     def _empirical_predict(self, new_bvals, vertices):
         """
@@ -1625,39 +1661,30 @@ class SparseDeconvolutionModelMultiB(SparseDeconvolutionModel):
         
         Returns
         -------
-        out_flat_arr: 2 dimensional array
-            Preallocated array for storing predicted values at each input b vector
         fit_to_mean: 2 dimensional array
             Mean across the vertices of each b value at each voxel
         design_matrix: 2 dimensional array
             Demeaned design matrix for fitting
         """
-        bval_list, b_inds, unique_b, rounded_bvals = separate_bvals(new_bvals)
         [bval_list_rm0, b_inds_rm0,
         unique_b_rm0, rounded_bvals_rm0] = separate_bvals(new_bvals, mode = 'remove0')
-        
-        design_matrix = np.zeros((vertices.shape[-1], self.rot_vecs.shape[-1]))
-        for mpi in np.arange(len(unique_b)):
-            tensor_regressor = self._calc_rotations(vertices, new_bvals, b_idx=mpi)
-            this_design_matrix = tensor_regressor.T - np.mean(tensor_regressor, -1)
-            if len(unique_b) == 1:
-                design_matrix[b_inds_rm0] = np.squeeze(this_design_matrix)
-            else:
-                design_matrix[b_inds_rm0[mpi]] = this_design_matrix
+        if not np.all(np.in1d(unique_b_rm0, self.unique_b)):
+            e_s = "Can only predict the signal in b values that were measured"
+            raise ValueError(e_s)
+
+        these_bvals = rounded_bvals_rm0/self.scaling_factor
+        ad, rd = self._response_diffusivities(these_bvals)
+        tensor_regressor = self._tensor_regressors(vertices, these_bvals,
+                                                   ad, rd).T
+        new_shells = np.searchsorted(unique_b_rm0, rounded_bvals_rm0)
+        design_matrix = (tensor_regressor -
+                         shell_means(tensor_regressor.T, new_shells)[:, new_shells].T)
             
         fit_to, _, _, _, _ = self.empirical_regressors
         
         # Find the mean signal across the vertices corresponding to the b values
         # given.
-        fit_to_mean = np.zeros((fit_to.shape[0], vertices.shape[-1]))
-        for vox in xrange(self._n_vox):
-            if len(unique_b) == 1:
-                fit_to_mean[vox, b_inds_rm0] = np.mean(fit_to[vox, self.b_inds_rm0])
-            else:
-                for b_fi in np.arange(len(unique_b)):
-                    idx = np.squeeze(np.where(self.unique_b == unique_b[b_fi]))
-                    fit_to_mean[vox, b_inds_rm0[b_fi]] = np.mean(fit_to[vox, self.b_inds_rm0[idx]])
-        
-        out_flat_arr = np.zeros(np.squeeze(fit_to_mean).shape)
+        fit_to_mean = shell_means(fit_to, self._shells)[
+                                :, np.searchsorted(self.unique_b, rounded_bvals_rm0)]
         
-        return out_flat_arr, fit_to_mean, design_matrix
+        return fit_to_mean, design_matrix
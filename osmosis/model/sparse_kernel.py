@@ -4,17 +4,28 @@
 """
 
 import os
-import inspect
 
 import numpy as np
 
 import nibabel as ni
-import dipy.reconst.recspeed as recspeed
 
 import osmosis.utils as ozu
 import osmosis.descriptors as desc
+import osmosis.lazy as ozl
 from osmosis.model.base import BaseModel, SCALE_FACTOR
 
+# Only imported when it's first used:
+recspeed = ozl.lazy_import('dipy.reconst.recspeed')
+
+
+def _fit_kernel_vox(sig, km):
+    """
+    Fit the kernel model km in a single voxel: the intercept, followed by the
+    weights of the basis functions
+    """
+    this_fit = km.fit(sig)
+    return np.hstack([this_fit.intercept, this_fit.beta])
+
 
 class SparseKernelModel(BaseModel):
     """
@@ -91,32 +102,21 @@ class SparseKernelModel(BaseModel):
             if self.verbose:
                 print("Loading params from file: %s"%self.params_file)
             # Get the cached values and be done with it:
-            return ni.load(self.params_file).get_data()
+            return self._load_params()
         else:
 
             if self.verbose:
                 print("Fitting params for SparseKernelModel")
-                prog_bar = ozu.ProgressBar(self._flat_signal.shape[0])
-                this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-                f_name = this_class + '.' + inspect.stack()[0][3]
 
             # 1 parameter for each basis function + 1 for the intercept:
-            out_flat = np.empty((self._flat_signal.shape[0], self.quad_points+1))
-            for vox in xrange(out_flat.shape[0]):
-                this_fit = self._km.fit(self._flat_relative_signal[vox])
-                beta = this_fit.beta
-                intercept = this_fit.intercept
-                # Fit the model, get the params:
-                out_flat[vox] = np.hstack([intercept, beta])
-                
-                if self.verbose:
-                    prog_bar.animate(vox, f_name=f_name)
-
-            out_params = ozu.nans(self.signal.shape[:3] + (self.quad_points+1,))
-            out_params[self.mask] = out_flat
+            out_params = self._voxel_map(_fit_kernel_vox,
+                                         self._flat_relative_signal,
+                                         (self.quad_points+1,),
+                                         args=(self._km,))
             if self.params_file != 'temp':
                 # Save the params for future use: 
-                params_ni = ni.Nifti1Image(out_params, self.affine)
+                params_ni = ni.Nifti1Image(np.asarray(out_params),
+                                           self.affine)
                 if self.verbose:
                     print("Saving params to file: %s"%self.params_file)
                 params_ni.to_filename(self.params_file)
@@ -132,8 +132,8 @@ class SparseKernelModel(BaseModel):
         if self.verbose:
             print("Predicting signal from SparseKernelModel")
             prog_bar = ozu.ProgressBar(self._flat_signal.shape[0])
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-            f_name = this_class + '.' + inspect.stack()[0][3]
+            this_class = self.__class__.__name__
+            f_name = this_class + '.fit'
 
 
         out_flat = np.zeros(self._flat_signal.shape)
@@ -160,9 +160,7 @@ class SparseKernelModel(BaseModel):
             if self.verbose:
                 prog_bar.animate(vox, f_name=f_name)
 
-        out = ozu.nans(self.signal.shape)
-        out[self.mask] = out_flat
-        return out
+        return self._masked(out_flat)
 
     @desc.auto_attr
     def odf_verts(self):
@@ -183,8 +181,8 @@ class SparseKernelModel(BaseModel):
                                    # the ODF 
         if self.verbose:
             prog_bar = ozu.ProgressBar(self._flat_signal.shape[0])
-            this_class = str(self.__class__).split("'")[-2].split('.')[-1]
-            f_name = this_class + '.' + inspect.stack()[0][3]
+            this_class = self.__class__.__name__
+            f_name = this_class + '.odf'
 
         out_flat = np.zeros((self._flat_signal.shape[0], _verts.shape[0]))
         flat_params = self.model_params[self.mask]
@@ -204,9 +202,7 @@ class SparseKernelModel(BaseModel):
             if self.verbose:
                 prog_bar.animate(vox, f_name=f_name)
 
-        out = ozu.nans(self.signal.shape[:3] + (out_flat.shape[-1],))
-        out[self.mask] = out_flat
-        return out
+        return self._masked(out_flat)
 
 
     @desc.auto_attr
@@ -233,9 +229,7 @@ class SparseKernelModel(BaseModel):
                                         self.odf_verts[0][i[0]],
                                         self.odf_verts[0][i[1]]))
 
-        out = ozu.nans(self.signal.shape[:3])
-        out[self.mask] = out_flat
-        return out
+        return self._masked(out_flat)
     
     @desc.auto_attr
     def principal_diffusion_direction(self):
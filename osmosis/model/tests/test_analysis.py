@@ -67,6 +67,18 @@ def test_noise_ceiling():
     npt.assert_almost_equal(out_lb, np.ones(out_lb.shape))
     npt.assert_almost_equal(out_ub, np.ones(out_ub.shape))
 
+    # The analytic approximation agrees in this case:
+    out_coeffs, out_lb, out_ub = ozm.noise_ceiling(TM1, TM2,
+                                                   method='analytic')
+    npt.assert_almost_equal(out_coeffs, np.ones(out_coeffs.shape))
+    npt.assert_almost_equal(out_lb, np.ones(out_lb.shape))
+    npt.assert_almost_equal(out_ub, np.ones(out_ub.shape))
+
+    # Simulations are reproducible with a seed, regardless of the blocking:
+    out1 = ozm.noise_ceiling(TM1, TM2, n_sims=100, seed=1)
+    out2 = ozm.noise_ceiling(TM1, TM2, n_sims=100, seed=1, block_size=3)
+    npt.assert_equal(out1, out2)
+
 
 def test_coefficient_of_determination():
     """
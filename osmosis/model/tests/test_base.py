@@ -2,6 +2,7 @@ import os
 
 import numpy as np
 import numpy.testing as npt
+import numpy.testing.decorators
 import scipy.stats as stats
 
 import nibabel as ni
@@ -167,3 +168,44 @@ def test_BaseModel():
         # Set it back:
         ozm.has_numexpr = True
 
+
+
+def _sum_and_max(sig, scale):
+    """
+    A per-voxel function for test_voxel_map (module-level, so that it can be
+    sent to worker processes)
+    """
+    return scale * np.array([np.sum(sig), np.max(sig)])
+
+
+def test_voxel_map():
+    """
+    Test the voxel-wise map of BaseModel, in blocks and with several workers
+    """
+    rng = np.random.RandomState(46)
+    bvecs = rng.randn(3, 10)
+    bvecs = np.hstack([np.zeros((3, 1)), bvecs / np.sqrt(np.sum(bvecs**2, 0))])
+    bvals = np.hstack([0, 1000 * np.ones(10)])
+    data = rng.rand(4, 4, 2, 11) + 1
+    mask = np.zeros(data.shape[:3], dtype=bool)
+    mask[1:3, 0:3, 0] = True
+    BM = BaseModel(data,
+                   bvecs,
+                   bvals,
+                   mask=mask,
+                   params_file='temp',
+                   verbose=False)
+
+    expected = ozu.nans(BM.signal.shape[:3] + (2,))
+    expected[BM.mask] = 2 * np.vstack([np.sum(BM._flat_signal, -1),
+                                       np.max(BM._flat_signal, -1)]).T
+    serial = BM._voxel_map(_sum_and_max, BM._flat_signal, (2,), args=(2,))
+    npt.assert_almost_equal(serial, expected)
+    threads = BM._voxel_map(_sum_and_max, BM._flat_signal, (2,), args=(2,),
+                            block_size=3, n_jobs=2)
+    npt.assert_almost_equal(threads, expected)
+    procs = BM._voxel_map(_sum_and_max, BM._flat_signal, (2,), args=(2,),
+                          block_size=3, n_jobs=2, backend='process')
+    npt.assert_almost_equal(procs, expected)
+    npt.assert_raises(ValueError, BM._voxel_map, _sum_and_max,
+                      BM._flat_signal, (2,), args=(2,), backend='gpu')
@@ -7,8 +7,10 @@ import numpy.testing as npt
 import nibabel as ni
 
 import osmosis as oz
+import osmosis.utils as ozu
 from osmosis.model.canonical_tensor import (CanonicalTensorModel,
-                                            CanonicalTensorModelOpt)
+                                            CanonicalTensorModelOpt,
+                                            opt_signal)
 
 data_path = os.path.split(oz.__file__)[0] + '/data/'
 
@@ -131,6 +133,48 @@ def test_CanonicalTensorModelOpt():
                       mask=mask_array,
                       params_file=tempfile.NamedTemporaryFile().name)
 
+def test_opt_signal():
+    """
+    Test the vectorized predictions of CanonicalTensorModelOpt
+    """
+    bvecs = ozu.get_camino_pts(40)
+    bvals = np.ones(40)
+    params = np.array([[0.3, 1.2, 0.7, 0.2],
+                       [1.0, 0.1, 0.5, 0.6],
+                       [2.5, -2.0, 0.2, 0.1]])
+    # A tensor pointing along theta, phi:
+    v = np.array([np.sin(params[:, 0]) * np.cos(params[:, 1]),
+                  np.sin(params[:, 0]) * np.sin(params[:, 1]),
+                  np.cos(params[:, 0])]).T
+    adc = 0.5 + (1.5 - 0.5) * np.dot(v, bvecs) ** 2
+    pred, jac = opt_signal(params, bvecs, bvals, 'flexible')
+    npt.assert_almost_equal(pred, params[:, 2:3] * np.exp(-adc) +
+                            params[:, 3:4] * np.exp(-3.0))
+
+    # The Jacobian, by finite differences:
+    eps = 1e-6
+    for model_form, these in [('flexible', params),
+                              ('constrained', params[:, :3]),
+                              ('ball_and_stick', params)]:
+        pred, jac = opt_signal(these, bvecs, bvals, model_form)
+        npt.assert_equal(jac.shape, pred.shape + (these.shape[-1],))
+        for p in range(these.shape[-1]):
+            step = np.zeros(these.shape[-1])
+            step[p] = eps
+            num = (opt_signal(these + step, bvecs, bvals, model_form)[0] -
+                   opt_signal(these - step, bvecs, bvals, model_form)[0])
+            npt.assert_almost_equal(jac[..., p], num / (2 * eps))
+
+    # Out of bounds:
+    pred, jac = opt_signal([[0.3, 1.2, 1.5]], bvecs, bvals, 'constrained')
+    npt.assert_(np.all(np.isinf(pred)))
+    pred, jac = opt_signal([[0.3, 1.2, 1.5]], bvecs, bvals, 'constrained',
+                           check_constraints=False)
+    npt.assert_(np.all(np.isfinite(pred)))
+    npt.assert_raises(ValueError, opt_signal, params, bvecs, bvals,
+                      'crazy_model')
+
+
 def test_predict():
     """
     Test the CanonicalTensorModel predict method
@@ -1,10 +1,13 @@
 import os
+import tempfile
 
 import numpy as np
 import numpy.testing as npt
+import numpy.testing.decorators
 
 import osmosis as oz
 import osmosis.io as mio
+import osmosis.fibers as ozf
 from osmosis.model.fiber import FiberModel
 
 data_path = os.path.split(oz.__file__)[0] + '/data/'
@@ -31,3 +34,76 @@ def test_FiberModel():
 
     npt.assert_equal(M.matrix[1].shape[0], np.prod(M.voxel_signal.shape))
     npt.assert_equal(M.matrix[1].shape[-1], len(M.fg_idx_unique.T))
+
+
+def test_FiberModel_chunks():
+    """
+    Test assembly of the model matrix from chunks of fibers
+    """
+    bvecs = np.random.randn(3, 10)
+    bvecs = np.hstack([np.zeros((3, 1)), bvecs / np.sqrt(np.sum(bvecs**2, 0))])
+    bvals = np.hstack([0, 1000 * np.ones(10)])
+    data = np.random.rand(5, 5, 5, 11) + 1
+    fibers = [ozf.Fiber(np.vstack([np.linspace(0, 4.9, 20),
+                                   np.ones(20) * ii,
+                                   np.linspace(0, ii, 20)]))
+              for ii in range(5)]
+    FG = ozf.FiberGroup(fibers)
+
+    M1 = FiberModel(data, bvecs, bvals, FG, params_file='temp', chunk_size=1)
+    M2 = FiberModel(data, bvecs, bvals, FG, params_file='temp', chunk_size=3)
+
+    npt.assert_almost_equal(M1.matrix[0].toarray(), M2.matrix[0].toarray())
+    npt.assert_equal(M1.fg_idx_unique, M2.fg_idx_unique)
+    npt.assert_equal(M1.matrix[0].shape[0], np.prod(M1.voxel_signal.shape))
+    npt.assert_equal(M1.matrix[0].shape[-1], len(FG.fibers))
+    npt.assert_equal(M1.matrix[1].shape[0], np.prod(M1.voxel_signal.shape))
+    npt.assert_equal(M1.matrix[1].shape[-1], len(M1.fg_idx_unique.T))
+
+    # Reading the fibers from file, chunk by chunk:
+    file_name = os.path.join(tempfile.gettempdir(), 'fiber_model.pdb')
+    mio.pdb_from_fg(FG, file_name)
+    M3 = FiberModel(data, bvecs, bvals, file_name, params_file='temp')
+    npt.assert_almost_equal(M1.matrix[0].toarray(), M3.matrix[0].toarray())
+    # The attributes that need all the fibers read the whole file:
+    npt.assert_equal(M3.fg_idx, M1.fg_idx)
+    npt.assert_equal(M3.voxel2fiber[0].shape[-1], len(FG.fibers))
+    for sig1, sig3 in zip(M1.fiber_signal, M3.fiber_signal):
+        npt.assert_almost_equal(sig1, sig3)
+
+
+def test_FiberModel_chunked_matrix():
+    """
+    Test that the model matrix assembled from chunks of fibers is the same as
+    the one assembled from the whole fiber-group
+    """
+    prng = np.random.RandomState(28)
+    bvecs = prng.randn(3, 10)
+    bvecs = np.hstack([np.zeros((3, 1)), bvecs / np.sqrt(np.sum(bvecs**2, 0))])
+    bvals = np.hstack([0, 1000 * np.ones(10)])
+    data = prng.rand(5, 5, 5, 11) + 1
+    # Some of these fibers go through the same voxels:
+    fibers = [ozf.Fiber(np.vstack([np.linspace(0, 4.9, 20),
+                                   np.ones(20) * ii,
+                                   np.linspace(0, ii, 20)]))
+              for ii in range(5)]
+    fibers.append(ozf.Fiber(np.vstack([np.ones(20) * 2,
+                                       np.linspace(0, 4.9, 20),
+                                       np.zeros(20)])))
+    FG = ozf.FiberGroup(fibers)
+
+    M0 = FiberModel(data, bvecs, bvals, FG, params_file='temp')
+    M1 = FiberModel(data, bvecs, bvals, FG, params_file='temp', chunk_size=2)
+    fiber_matrix, iso_matrix, idx_unique = M1._chunked_matrix
+
+    # The voxels are the same, but the chunked ones are in the order of their
+    # linear indices:
+    lin0 = np.ravel_multi_index(M0.fg_idx_unique.astype(int), data.shape[:3])
+    lin1 = np.ravel_multi_index(idx_unique, data.shape[:3])
+    npt.assert_equal(np.sort(lin0), lin1)
+    order = np.argsort(lin0)
+    rows = (order[:, None] * 10 + np.arange(10)).ravel()
+    npt.assert_almost_equal(M0.matrix[0].toarray()[rows],
+                            fiber_matrix.toarray())
+    npt.assert_equal(M0.matrix[1].toarray()[rows][:, order],
+                     iso_matrix.toarray())
@@ -93,6 +93,26 @@ def test_SparseDeconvolutionModel():
 
                       
 
+def test_cluster_fodf():
+    mask_array = np.zeros(ni.load(data_path+'small_dwi.nii.gz').shape[:3])
+    mask_array[1:3, 1:3, 1:3] = 1
+    SSD = SparseDeconvolutionModel(data_path+'small_dwi.nii.gz',
+                                   data_path + 'dwi.bvecs',
+                                   data_path + 'dwi.bvals',
+                                   mask=mask_array,
+                                   params_file='temp')
+    centroids, assignments, k = SSD.fodf_clusters
+    npt.assert_equal(centroids.shape[:3], SSD.signal.shape[:3])
+    npt.assert_equal(k[~SSD.mask], 0)
+    # The centroids in each voxel, without the padding:
+    for vox in zip(*np.where(SSD.mask)):
+        if k[vox] > 0:
+            npt.assert_equal(SSD.cluster_fodf[vox], centroids[vox][:k[vox]])
+        else:
+            npt.assert_equal(SSD.cluster_fodf[vox], [0, 0, 0])
+    npt.assert_(np.isnan(SSD.cluster_fodf[0, 0, 0]))
+
+
 def test_predict():
     """
     Test the SparseDeconvolutionModel predict method
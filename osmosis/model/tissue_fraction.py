@@ -208,14 +208,12 @@ class TissueFractionModel(SparseDeconvolutionModel):
         w2 = (self._flat_tf - self.alpha1 * w_ten) / self.alpha2
         w3 = (1 - w_ten - w2)
 
-        w2_out = ozu.nans(self.shape[:3])
-        w3_out = ozu.nans(self.shape[:3])
-
-        w2_out[self.mask] = w2
-        w3_out[self.mask] = w3
+        flat_tensor_params = tensor_params[self.mask]
 
         # Return tensor_idx, w1, w2, w3 
-        return tensor_params[...,0],tensor_params[...,1], w2_out, w3_out
+        return (self._masked(flat_tensor_params[:, 0]),
+                self._masked(flat_tensor_params[:, 1]),
+                self._masked(w2), self._masked(w3))
 
     
     @desc.auto_attr
@@ -257,10 +255,7 @@ class TissueFractionModel(SparseDeconvolutionModel):
             else:
                 out_flat[vox] = np.nan
                 
-        out = ozu.nans(self.signal.shape)
-        out[self.mask] = out_flat
-
-        return out
+        return self._masked(out_flat)
 
 
     @desc.auto_attr
@@ -271,8 +266,5 @@ class TissueFractionModel(SparseDeconvolutionModel):
         overloaded signal and relative_signal above, so we might not need this
         either... 
         """
-        out = ozu.nans(self.signal.shape[:3])
         flat_fit = self.fit[self.mask][:,:self.fit.shape[-1]-1]
-        flat_rmse = ozu.rmse(self._flat_signal, flat_fit)                
-        out[self.mask] = flat_rmse
-        return out
+        return self._masked(ozu.rmse(self._flat_signal, flat_fit))
@@ -0,0 +1,331 @@
+"""
+
+Large-scale (sparse) non-negative least-squares solvers
+
+All the solvers in this module solve y = Xh for h >= 0 and share a common
+signature: `solver(y, X, **kwargs)` returning a tuple `(h, info)`, where info
+is a dict with the following keys:
+
+'objective': the sum of squared residuals of the iterates (or error checks),
+    starting from the initial value for the iterative solvers.
+'rsquared': the percent variance explained by the returned solution.
+'n_iterations': how many iterations were run.
+'time': wall time (in seconds).
+
+The solvers are registered in `SOLVERS`, so that they can be selected by name
+(see `solve`).
+
+"""
+import time
+
+import numpy as np
+import scipy.sparse as sps
+
+import osmosis.sgd as sgd
+
+
+def _as_operator(X):
+    """
+    Helper function to get X in a format that allows fast products with
+    vectors (csr for sparse matrices)
+    """
+    if sps.issparse(X):
+        return X.tocsr()
+    return np.asarray(X)
+
+
+def _info(objective, y, n_iterations, t_start, ss_residuals=None):
+    """
+    Helper function to pack the information about a solver run. The sum of
+    squared residuals of the returned solution is the last objective, unless
+    it's provided as ss_residuals.
+    """
+    objective = np.asarray(objective)
+    ss_residuals_to_mean = np.sum((y - np.mean(y))**2)
+    if ss_residuals is None:
+        ss_residuals = objective[-1]
+    return dict(objective=objective,
+                rsquared=sgd.rsq(ss_residuals, ss_residuals_to_mean),
+                n_iterations=n_iterations,
+                time=time.time() - t_start)
+
+
+def spectral_norm_sq(X, n_iter=20, seed=None):
+    """
+    Estimate the largest eigen-value of X.T X (the squared spectral norm of
+    X), using the power method. This is the Lipschitz constant of the gradient
+    of the least-squares objective.
+
+    Parameters
+    ----------
+    X: ndarray or sparse matrix of shape (N, M)
+
+    n_iter: int, optional
+       Number of power iterations.
+
+    seed: int, optional
+       Seed for the random starting vector.
+    """
+    prng = np.random.RandomState(seed)
+    v = prng.rand(X.shape[1])
+    v /= np.sqrt(np.dot(v, v))
+    L = 0
+    for ii in range(n_iter):
+        w = sgd.spdot(X.T, sgd.spdot(X, v))
+        L = np.sqrt(np.dot(w, w))
+        if L == 0:
+            return 0.
+        v = w / L
+    # The power method approaches from below. Inflate a little bit to make
+    # sure we have an upper bound:
+    return 1.01 * L
+
+
+def fista(y, X, h0=None, max_iter=1000, tol=1e-6, target_rsq=None,
+          restart=True, verbose=False):
+    """
+    Projected fast iterative shrinkage-thresholding (FISTA) for
+    non-negative least squares.
+
+    Parameters
+    ----------
+    y: 1-d array of shape (N)
+        The data
+
+    X: ndarray or sparse matrix of shape (N, M)
+        The regressors
+
+    h0: 1-d array of shape (M), optional
+        Initial value of the parameters (warm start).
+
+    max_iter: int, optional
+        Maximal number of iterations
+
+    tol: float, optional
+        Stop when the relative decrease in the objective is smaller than this.
+
+    target_rsq: float, optional
+        Stop as soon as this percent variance explained is reached.
+
+    restart: bool, optional
+        Whether to reset the momentum whenever the objective goes up
+        (O'Donoghue & Candes, 2012).
+
+    verbose: bool, optional
+
+    Returns
+    -------
+    h, info (see module docstring)
+
+    Notes
+    -----
+    Each iteration costs one product with X and one with X.T. The product of
+    X with the extrapolated point is computed from the products with the
+    previous two iterates, which are kept around.
+    """
+    t_start = time.time()
+    y = np.asarray(y).ravel()
+    X = _as_operator(X)
+    step = 1. / spectral_norm_sq(X)
+    ss_residuals_to_mean = np.sum((y - np.mean(y))**2)
+
+    if h0 is None:
+        h = np.zeros(X.shape[1])
+    else:
+        h = np.maximum(np.array(h0, dtype=float).ravel(), 0)
+
+    Xh = sgd.spdot(X, h)
+    z, Xz = h, Xh
+    t = 1.
+    objective = [np.sum((y - Xh)**2)]
+
+    for iteration in range(1, max_iter + 1):
+        h_new = np.maximum(z - step * sgd.spdot(X.T, Xz - y), 0)
+        Xh_new = sgd.spdot(X, h_new)
+        objective.append(np.sum((y - Xh_new)**2))
+
+        if verbose:
+            print("Itn #:%03d | SSE: %.1f | R2=%.1f "%
+                  (iteration, objective[-1],
+                   sgd.rsq(objective[-1], ss_residuals_to_mean)))
+
+        if restart and objective[-1] > objective[-2]:
+            objective.pop()
+            if t == 1:
+                # Even a plain projected gradient step didn't help. We're
+                # at the numerical floor:
+                break
+            # Throw away the momentum and take a plain projected gradient
+            # step from where we were:
+            t = 1.
+            z, Xz = h, Xh
+            continue
+
+        t_new = (1 + np.sqrt(1 + 4 * t**2)) / 2
+        beta = (t - 1) / t_new
+        z = h_new + beta * (h_new - h)
+        Xz = Xh_new + beta * (Xh_new - Xh)
+        h, Xh, t = h_new, Xh_new, t_new
+
+        if (target_rsq is not None and
+            sgd.rsq(objective[-1], ss_residuals_to_mean) >= target_rsq):
+            break
+        if np.abs(objective[-2] - objective[-1]) <= tol * objective[-2]:
+            break
+
+    return h, _info(objective, y, iteration, t_start)
+
+
+def block_coordinate_descent(y, X, h0=None, block_size=100, max_iter=100,
+                             tol=1e-6, target_rsq=None, seed=None,
+                             verbose=False):
+    """
+    Randomized block coordinate descent for non-negative least squares.
+
+    The columns of X are split into blocks once. In each sweep, the blocks are
+    visited in random order and each one gets a projected gradient step with
+    a step-size set by the (squared) spectral norm of that block. The
+    residuals are updated in place after each block, so that a full sweep
+    costs about two products with X.
+
+    Parameters
+    ----------
+    y: 1-d array of shape (N)
+        The data
+
+    X: ndarray or sparse matrix of shape (N, M)
+        The regressors
+
+    h0: 1-d array of shape (M), optional
+        Initial value of the parameters (warm start).
+
+    block_size: int, optional
+        How many columns in each block. With block_size=1, this is exact
+        coordinate descent.
+
+    max_iter: int, optional
+        Maximal number of sweeps through all the blocks.
+
+    tol: float, optional
+        Stop when the relative decrease in the objective in a sweep is smaller
+        than this.
+
+    target_rsq: float, optional
+        Stop as soon as this percent variance explained is reached.
+
+    seed: int, optional
+        Seed for the random number generator used to partition the columns
+        and order the blocks.
+
+    verbose: bool, optional
+
+    Returns
+    -------
+    h, info (see module docstring)
+    """
+    t_start = time.time()
+    y = np.asarray(y).ravel()
+    if sps.issparse(X):
+        X = X.tocsc()
+    else:
+        X = np.asarray(X)
+    n_regressors = X.shape[1]
+    prng = np.random.RandomState(seed)
+    ss_residuals_to_mean = np.sum((y - np.mean(y))**2)
+
+    blocks = np.array_split(prng.permutation(n_regressors),
+                            int(np.ceil(n_regressors / float(block_size))))
+    X_blocks = [X[:, b] for b in blocks]
+    steps = []
+    for Xb in X_blocks:
+        if Xb.shape[1] == 1:
+            L = sgd.spdot(Xb.T, sgd.spdot(Xb, np.ones(1)))[0]
+        else:
+            L = spectral_norm_sq(Xb, seed=seed)
+        steps.append(1. / L if L > 0 else 0.)
+
+    if h0 is None:
+        h = np.zeros(n_regressors)
+    else:
+        h = np.maximum(np.array(h0, dtype=float).ravel(), 0)
+
+    resid = sgd.spdot(X, h) - y
+    objective = [np.dot(resid, resid)]
+
+    for iteration in range(1, max_iter + 1):
+        for b_idx in prng.permutation(len(blocks)):
+            b = blocks[b_idx]
+            Xb = X_blocks[b_idx]
+            h_b = np.maximum(h[b] - steps[b_idx] * sgd.spdot(Xb.T, resid), 0)
+            delta = h_b - h[b]
+            if np.any(delta):
+                resid += sgd.spdot(Xb, delta)
+                h[b] = h_b
+
+        objective.append(np.dot(resid, resid))
+        if verbose:
+            print("Sweep #:%03d | SSE: %.1f | R2=%.1f "%
+                  (iteration, objective[-1],
+                   sgd.rsq(objective[-1], ss_residuals_to_mean)))
+
+        if (target_rsq is not None and
+            sgd.rsq(objective[-1], ss_residuals_to_mean) >= target_rsq):
+            break
+        if np.abs(objective[-2] - objective[-1]) <= tol * objective[-2]:
+            break
+
+    return h, _info(objective, y, iteration, t_start)
+
+
+def stochastic_gradient_descent(y, X, **kwargs):
+    """
+    Kay-style stochastic gradient descent (see
+    `osmosis.sgd.stochastic_gradient_descent`), wrapped to share the
+    signature of the other solvers in this module.
+    """
+    t_start = time.time()
+    kwargs.setdefault('plot', False)
+    kwargs.setdefault('verbose', False)
+    kwargs['return_info'] = True
+    h, sgd_info = sgd.stochastic_gradient_descent(y, X, **kwargs)
+    y = np.asarray(y).ravel()
+    # The returned h is the best one, not the last one, and the objective
+    # includes the regularization, so get the residuals of h itself:
+    resid = y - sgd.spdot(_as_operator(X), h)
+    return h, _info(sgd_info['ss_residuals'], y, sgd_info['iterations'],
+                    t_start, ss_residuals=np.dot(resid, resid))
+
+
+SOLVERS = dict(sgd=stochastic_gradient_descent,
+               fista=fista,
+               bcd=block_coordinate_descent)
+
+
+def solve(y, X, solver='sgd', **kwargs):
+    """
+    Solve y = Xh for h >= 0 with one of the solvers in this module.
+
+    Parameters
+    ----------
+    y: 1-d array of shape (N)
+        The data
+
+    X: ndarray or sparse matrix of shape (N, M)
+        The regressors
+
+    solver: str or callable
+        Either one of the keys of `SOLVERS` ('sgd', 'fista', 'bcd'), or a
+        callable with the same signature.
+
+    kwargs: passed on to the solver.
+
+    Returns
+    -------
+    h, info (see module docstring)
+    """
+    if callable(solver):
+        return solver(y, X, **kwargs)
+    if solver not in SOLVERS:
+        e_s = "Solver '%s' is not one of: %s"%(solver, sorted(SOLVERS.keys()))
+        raise ValueError(e_s)
+    return SOLVERS[solver](y, X, **kwargs)
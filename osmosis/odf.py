@@ -0,0 +1,428 @@
+"""
+
+Vectorized analysis of orientation distribution functions (ODFs) sampled on
+a fixed set of directions.
+
+All the functions in this module take the ODFs (or model weights) of many
+voxels at once, in an array of shape (n_vox, n), with the values on the
+directions in `vertices`, an array of shape (n, 3). The tables that depend
+only on the directions (the neighbors of each vertex, the angles between the
+vertices) are the same for all voxels and are computed once.
+
+"""
+import numpy as np
+import scipy.linalg as la
+import dipy.core.sphere as dps
+
+import osmosis.lazy as ozl
+import osmosis.parallel.pool as ozp
+import osmosis.utils as ozu
+
+# Only imported when it's first used:
+ozc = ozl.lazy_import('osmosis.cluster')
+
+
+def sphere_neighbors(vertices):
+    """
+    The neighbors of each vertex on the sphere, as a table.
+
+    Parameters
+    ----------
+    vertices : array (n, 3)
+        Unit vectors. The neighbors are the vertices connected by the edges
+        of the triangulation of their convex hull.
+
+    Returns
+    -------
+    neighbors : int array (n, max_n_neighbors)
+        The indices of the neighbors of each vertex. Vertices with less than
+        the maximal number of neighbors are padded with their own index.
+    """
+    vertices = np.asarray(vertices)
+    n = vertices.shape[0]
+    edges = dps.Sphere(xyz=vertices).edges.astype(int)
+    edges = np.vstack([edges, edges[:, ::-1]])
+    edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+    n_neighbors = np.bincount(edges[:, 0], minlength=n)
+
+    neighbors = np.repeat(np.arange(n)[:, None], max(n_neighbors.max(), 1), 1)
+    # The position of each edge among the edges of its first vertex:
+    starts = np.cumsum(n_neighbors) - n_neighbors
+    col = np.arange(edges.shape[0]) - starts[edges[:, 0]]
+    neighbors[edges[:, 0], col] = edges[:, 1]
+    return neighbors
+
+
+def local_maxima(odf, neighbors):
+    """
+    Find the local maxima of functions on the sphere.
+
+    Parameters
+    ----------
+    odf : array (n_vox, n)
+        The function in each voxel.
+    neighbors : int array (n, max_n_neighbors)
+        See `sphere_neighbors`.
+
+    Returns
+    -------
+    is_peak : bool array (n_vox, n)
+
+    Notes
+    -----
+    As in `dipy.reconst.recspeed.local_maxima`, a vertex is a local maximum if
+    the function there is >= its value in all the neighbors and > in at least
+    one of them, so that a constant function has no local maxima.
+    """
+    odf = np.atleast_2d(odf)
+    is_peak = np.ones(odf.shape, dtype=bool)
+    is_higher = np.zeros(odf.shape, dtype=bool)
+    # Loop over the columns of the (short) table, not over voxels:
+    for col in range(neighbors.shape[-1]):
+        nbr_odf = odf[:, neighbors[:, col]]
+        is_peak &= odf >= nbr_odf
+        is_higher |= odf > nbr_odf
+    return is_peak & is_higher
+
+
+def odf_peaks(odf, neighbors):
+    """
+    The value of the ODF in its local maxima, and 0 elsewhere.
+
+    Parameters
+    ----------
+    odf : array (n_vox, n)
+    neighbors : int array (n, max_n_neighbors)
+        See `sphere_neighbors`.
+
+    Returns
+    -------
+    peaks : array (n_vox, n)
+        Voxels in which the ODF is not finite are all 0.
+    """
+    odf = np.atleast_2d(odf)
+    peaks = np.zeros(odf.shape)
+    finite = np.all(np.isfinite(odf), -1)
+    this_odf = odf[finite]
+    peaks[finite] = np.where(local_maxima(this_odf, neighbors), this_odf, 0)
+    return peaks
+
+
+def top_k(values, k):
+    """
+    The indices of the k largest values in each row, from largest to smallest.
+
+    Parameters
+    ----------
+    values : array (n_vox, n)
+    k : int
+
+    Returns
+    -------
+    idx : int array (n_vox, k)
+    """
+    values = np.atleast_2d(values)
+    k = min(k, values.shape[-1])
+    if k < values.shape[-1]:
+        idx = np.argpartition(-values, k - 1, -1)[:, :k]
+    else:
+        idx = np.repeat(np.arange(k)[None], values.shape[0], 0)
+    # Only the k selected values need to be sorted:
+    order = np.argsort(-np.take_along_axis(values, idx, -1), -1)
+    return np.take_along_axis(idx, order, -1)
+
+
+def peak_angle(vertices, idx1, idx2):
+    """
+    The angle (in degrees) between pairs of vertices, taking into account the
+    antipodal symmetry, so that they lie in [0, 90].
+
+    Parameters
+    ----------
+    vertices : array (n, 3)
+    idx1, idx2 : int arrays
+        Indices into the vertices.
+    """
+    vertices = np.asarray(vertices)
+    cos = np.sum(vertices[idx1] * vertices[idx2], -1)
+    cos /= np.sqrt(np.sum(vertices[idx1] ** 2, -1) *
+                   np.sum(vertices[idx2] ** 2, -1))
+    return np.rad2deg(np.arccos(np.clip(np.abs(cos), 0, 1)))
+
+
+def dispersion_index(weights, vertices, all_to_all=False):
+    """
+    A dispersion index of the weights in each voxel (see
+    `SparseDeconvolutionModel.dispersion_index`). Only the positive weights
+    are taken into account.
+
+    Parameters
+    ----------
+    weights : array (n_vox, n)
+    vertices : array (n, 3)
+        Unit vectors
+    all_to_all : bool
+        Whether to use the angles between all pairs of directions, or only
+        the angles to the direction with the largest weight.
+
+    Returns
+    -------
+    di : array (n_vox,)
+        Voxels without positive weights are set to 0.
+    """
+    weights = np.atleast_2d(weights)
+    vertices = np.asarray(vertices)
+    with np.errstate(invalid='ignore'):
+        w = np.where(weights > 0, weights, 0)
+    ss_w = np.sum(w ** 2, -1)
+    has_w = ss_w > 0
+    di = np.zeros(w.shape[0])
+    w = w[has_w]
+    if all_to_all:
+        # sin of the angle between each pair of directions:
+        cos = np.clip(np.dot(vertices, vertices.T), -1, 1)
+        sin = np.sin(np.arccos(cos))
+        # Directions that are not quite unit length would otherwise add a
+        # little bit of each weight with itself:
+        np.fill_diagonal(sin, 0)
+        n_w = np.sum(w > 0, -1)
+        # Each pair is counted once:
+        di[has_w] = (np.sum(np.dot(w, sin) * w, -1) / 2 / ss_w[has_w] /
+                     n_w ** 2)
+    else:
+        pdd = vertices[np.argmax(w, -1)]
+        cos = np.clip(np.abs(np.dot(pdd, vertices.T)), 0, 1)
+        angles = np.arccos(cos) / (np.pi / 2)
+        di[has_w] = np.sum(w ** 2 * np.sin(angles), -1) / ss_w[has_w]
+    return di
+
+
+def crossing_index(peaks):
+    """
+    An index of crossing, based on the standard deviation of the (positive)
+    peaks, normalized by that of a single peak (see
+    `SphericalHarmonicsModel.crossing_index`).
+
+    Parameters
+    ----------
+    peaks : array (n_vox, n)
+
+    Returns
+    -------
+    ci : array (n_vox,)
+        0 where there are no positive peaks and 1 where there is one.
+    """
+    peaks = np.atleast_2d(peaks)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        peaks_norm = peaks / np.sqrt(np.sum(peaks ** 2, -1))[:, None]
+        is_pos = peaks_norm > 0
+    n_pos = np.sum(is_pos, -1)
+    ci = np.zeros(peaks.shape[0])
+    ci[n_pos == 1] = 1
+    many = n_pos > 1
+    k = n_pos[many].astype(float)
+    p = np.where(is_pos[many], peaks_norm[many], 0)
+    mean = np.sum(p, -1) / k
+    std_peaks = np.sqrt(np.sum(np.where(is_pos[many],
+                                        (p - mean[:, None]) ** 2, 0), -1) / k)
+    # The standard deviation of [1, 0, ..., 0] (with k elements):
+    std_norm = np.sqrt(k - 1) / k
+    ci[many] = std_peaks / std_norm
+    return ci
+
+
+# Radial basis functions, as in `scipy.interpolate.Rbf`:
+RBF_FUNCTIONS = dict(
+    multiquadric=lambda r, eps: np.sqrt((r / eps) ** 2 + 1),
+    inverse=lambda r, eps: 1.0 / np.sqrt((r / eps) ** 2 + 1),
+    gaussian=lambda r, eps: np.exp(-(r / eps) ** 2),
+    linear=lambda r, eps: r,
+    cubic=lambda r, eps: r ** 3,
+    quintic=lambda r, eps: r ** 5)
+
+
+def _rbf_distance(vertices1, vertices2, norm):
+    """
+    Helper function for the distances between all pairs of vertices.
+    """
+    if norm == 'angle':
+        cos = np.clip(np.dot(vertices1, vertices2.T), -1, 1)
+        return np.nan_to_num(np.arccos(cos))
+    elif norm == 'euclidean_norm':
+        return np.sqrt(np.sum((vertices1[:, None] - vertices2[None]) ** 2,
+                              -1))
+    else:
+        e_s = "Norm '%s' is not one of: 'angle', 'euclidean_norm'"%norm
+        raise ValueError(e_s)
+
+
+def rbf_interpolator(vertices, target, function='multiquadric', epsilon=None,
+                     smooth=0.1, norm='angle'):
+    """
+    The linear operator that interpolates functions on the sphere from one set
+    of vertices to another with radial basis functions (as
+    `dipy.core.sphere.interp_rbf` does for one function at a time).
+
+    Parameters
+    ----------
+    vertices : array (n, 3)
+        The vertices the functions are sampled on.
+    target : array (m, 3)
+        The vertices to interpolate to.
+    function : str
+        One of the keys of `RBF_FUNCTIONS`.
+    epsilon : float, optional
+        The spread of the radial basis functions. Defaults to the approximate
+        average distance between the vertices (as in `scipy.interpolate.Rbf`).
+    smooth : float
+        Values greater than zero increase the smoothness of the approximation,
+        with 0 as pure interpolation.
+    norm : str
+        'angle' or 'euclidean_norm': how distances between vertices are
+        measured.
+
+    Returns
+    -------
+    interp : array (m, n)
+        Functions are interpolated from `data` (n_vox, n) as
+        `np.dot(data, interp.T)`.
+    """
+    if function not in RBF_FUNCTIONS:
+        e_s = "RBF function '%s' is not one of: %s"%(function,
+                                                     sorted(RBF_FUNCTIONS))
+        raise ValueError(e_s)
+    rbf = RBF_FUNCTIONS[function]
+    # Like dipy's Sphere, project the vertices onto the unit sphere:
+    vertices = np.asarray(vertices, dtype=float)
+    vertices = vertices / np.sqrt(np.sum(vertices ** 2, -1))[:, None]
+    target = np.asarray(target, dtype=float)
+    target = target / np.sqrt(np.sum(target ** 2, -1))[:, None]
+    if epsilon is None:
+        edges = np.ptp(vertices, 0)
+        edges = edges[np.nonzero(edges)]
+        epsilon = np.power(np.prod(edges) / vertices.shape[0],
+                           1.0 / edges.size)
+
+    A = (rbf(_rbf_distance(vertices, vertices, norm), epsilon) -
+         smooth * np.eye(vertices.shape[0]))
+    phi = rbf(_rbf_distance(target, vertices, norm), epsilon)
+    # The RBF weights are A^-1 data, so the operator is phi A^-1:
+    return la.solve(A.T, phi.T).T
+
+
+def _cluster_odf_block(args):
+    """
+    Helper function to cluster the directions of the positive weights in a
+    block of voxels (see `cluster_odf`). Takes a tuple, so that it can be
+    mapped over a pool of workers.
+    """
+    weights, vertices, k_max = args
+    n_vox = weights.shape[0]
+    with np.errstate(invalid='ignore'):
+        is_pos = weights > 0
+    n_pos = np.sum(is_pos, -1)
+    n_pad = max(n_pos.max() if n_vox else 0, 1)
+    # The indices of the positive weights, from largest to smallest, padded
+    # at the end:
+    order = np.argsort(-np.where(is_pos, weights, -np.inf), -1,
+                       kind='mergesort')[:, :n_pad]
+    mask = np.take_along_axis(is_pos, order, -1)
+    w = np.where(mask, np.take_along_axis(weights, order, -1), 0)
+    data = vertices[order] * mask[..., None]
+
+    k_cap = max(n_pad - 1, 1) if k_max is None else max(min(n_pad - 1,
+                                                             k_max), 1)
+    centroids = ozu.nans((n_vox, k_cap, vertices.shape[-1]))
+    # A single direction is its own centroid:
+    k = np.minimum(n_pos, 1)
+    centroids[k == 1, 0] = data[k == 1, 0]
+    assign = np.where(mask, 0, -1)
+
+    # With n directions, try up to n - 1 clusters, until the AIC goes up:
+    last_aic = np.inf * np.ones(n_vox)
+    active = n_pos > 1
+    this_k = 1
+    while np.any(active) and this_k <= k_cap:
+        idx = np.where(active)[0]
+        # Use the k largest weights as seeds:
+        mu, y_n, sse = ozc.spkm_batch(data[idx], this_k, weights=w[idx],
+                                      mask=mask[idx],
+                                      seeds=data[idx, :this_k])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            this_aic = ozu.aic(sse, n_pos[idx], this_k)
+        better = ~(this_aic > last_aic[idx])
+        keep = idx[better]
+        last_aic[keep] = this_aic[better]
+        k[keep] = this_k
+        assign[keep] = y_n[better]
+        centroids[keep, :this_k] = mu[better]
+        centroids[keep, this_k:] = np.nan
+
+        active[idx[~better]] = False
+        this_k += 1
+        active &= n_pos > this_k
+
+    centroids = centroids[:, :max(k.max() if n_vox else 0, 1)]
+    # Back to the original order of the weights:
+    assignments = -np.ones(weights.shape, dtype=int)
+    rows = np.repeat(np.arange(n_vox)[:, None], n_pad, 1)
+    assignments[rows[mask], order[mask]] = assign[mask]
+    return centroids, assignments, k
+
+
+def cluster_odf(weights, vertices, k_max=None, n_jobs=1, block_size=1000,
+                backend='process'):
+    """
+    Find the peaks of the ODFs with (weighted) spherical k-means of the
+    directions of their positive weights, choosing the number of clusters
+    in each voxel with the AIC.
+
+    In each voxel with n positive weights, k = 1, 2, ..., n - 1 clusters are
+    tried, seeded with the directions of the k largest weights, until the AIC
+    goes up. All the voxels that are still going are clustered together for
+    each k (see `osmosis.cluster.spkm_batch`), in blocks of voxels, which can
+    be processed in parallel.
+
+    Parameters
+    ----------
+    weights : array (n_vox, n)
+    vertices : array (n, 3)
+    k_max : int, optional
+        The largest number of clusters to try.
+    n_jobs : int, optional
+        How many workers to use. Defaults to 1 (no pool is started). If this
+        is None, all the CPUs are used.
+    block_size : int, optional
+        How many voxels are sent to each worker at a time.
+    backend : str, optional
+        'thread' or 'process' (see `osmosis.parallel.pool.map_blocks`).
+
+    Returns
+    -------
+    centroids : array (n_vox, max(k), 3)
+        The centroids in each voxel, padded with nan.
+    assignments : int array (n_vox, n)
+        The cluster of each of the weights (-1 for weights that are not
+        positive).
+    k : int array (n_vox,)
+        The chosen number of clusters. 1 in voxels with one positive weight
+        (which is then the centroid) and 0 in voxels with none.
+    """
+    weights = np.atleast_2d(np.asarray(weights, dtype=float))
+    vertices = np.asarray(vertices, dtype=float)
+    blocks = [(weights[start:start + block_size], vertices, k_max) for start
+              in range(0, weights.shape[0], block_size)]
+    results = list(ozp.map_blocks(_cluster_odf_block, blocks, n_jobs=n_jobs,
+                                  backend=backend))
+    if len(results) == 0:
+        return (ozu.nans((0, 1, vertices.shape[-1])),
+                -np.ones(weights.shape, dtype=int), np.zeros(0, dtype=int))
+
+    width = max(r[0].shape[1] for r in results)
+    centroids = ozu.nans((weights.shape[0], width, vertices.shape[-1]))
+    start = 0
+    for r in results:
+        centroids[start:start + r[0].shape[0], :r[0].shape[1]] = r[0]
+        start += r[0].shape[0]
+    return (centroids, np.concatenate([r[1] for r in results]),
+            np.concatenate([r[2] for r in results]))
@@ -0,0 +1,73 @@
+"""
+
+Pools of workers on this machine
+
+`map_blocks` is what all the block-wise computations in osmosis
+(`BaseModel._voxel_map`, `osmosis.levmar.fit_blocks`,
+`osmosis.odf.cluster_odf`, `osmosis.precision.fODF_EMD_batch`) use to send
+their blocks to workers, so that they all understand `n_jobs` and `backend`
+the same way.
+
+"""
+import multiprocessing
+import multiprocessing.pool
+
+
+def n_workers(n_jobs, n_blocks):
+    """
+    How many workers to start for n_jobs and n_blocks (1 means that no pool
+    is started). If n_jobs is None (or smaller than 1), all the CPUs are used.
+    """
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    return max(min(n_jobs, n_blocks), 1)
+
+
+def map_blocks(func, blocks, n_jobs=1, backend='process'):
+    """
+    Apply func to each of the blocks, in a pool of workers.
+
+    Parameters
+    ----------
+    func : callable
+        To run in processes, func needs to be a module-level function (so
+        that it can be pickled).
+
+    blocks : list
+
+    n_jobs : int, optional
+        How many workers to use. Defaults to 1 (no pool is started, the
+        blocks are processed in this process). If this is None, all the CPUs
+        are used.
+
+    backend : str, optional
+        'thread' or 'process'.
+
+    Returns
+    -------
+    A generator of the results for each of the blocks, in order. The pool is
+    closed once this is exhausted (or closed).
+    """
+    if backend not in ('thread', 'process'):
+        e_s = "Backend should be 'thread' or 'process', not %s"%backend
+        raise ValueError(e_s)
+    n = n_workers(n_jobs, len(blocks))
+    if n == 1:
+        return (func(block) for block in blocks)
+    if backend == 'thread':
+        pool = multiprocessing.pool.ThreadPool(n)
+    else:
+        pool = multiprocessing.Pool(n)
+    return _pool_results(pool, func, blocks)
+
+
+def _pool_results(pool, func, blocks):
+    """
+    Yield the results from pool, and close it when we're done
+    """
+    try:
+        for result in pool.imap(func, blocks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
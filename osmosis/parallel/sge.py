@@ -9,11 +9,14 @@ import getpass
 import inspect
 import traceback
 
-# We need to know whether we have a Qt shell on our hands:
-import IPython.zmq.zmqshell as zmqshell
+import osmosis.lazy as ozl
 
-# This does ssh:
-import paramiko
+# We need to know whether we have a Qt shell on our hands (this is only
+# imported when we ask for a password in IPython):
+zmqshell = ozl.lazy_import('IPython.zmq.zmqshell')
+
+# This does ssh (imported on first use):
+paramiko = ozl.lazy_import('paramiko')
 
 def getsourcelines(object):
     """Return a list of source lines and starting line number for an object.
@@ -0,0 +1,507 @@
+"""
+
+Vectorized measures of the agreement between fODFs, used to assess the
+precision (reliability) of model fits across the folds of k-fold
+cross-validation.
+
+The fODFs are given as arrays of model parameters of shape (n_vox, n) and
+(n_vox, m), together with the rotational vectors these parameters correspond
+to, of shape (3, n) and (3, m). The rotational vectors are shared by all the
+voxels, so all the tables that depend only on them (ground distances,
+mirrored vertices, angular bins) are computed once for each pair of folds (see
+`FoldPair`) and the measures are computed for all voxels at once.
+
+"""
+import numpy as np
+import scipy.sparse as sps
+
+import osmosis.descriptors as desc
+import osmosis.emd as emd
+import osmosis.parallel.pool as ozp
+import osmosis.utils as ozu
+
+
+def fODF_ground_distance(bvecs1, bvecs2):
+    """
+    The angular distances between two sets of (antipodally symmetric)
+    directions, used as the ground distance in the EMD between fODFs.
+
+    Parameters
+    ----------
+    bvecs1, bvecs2 : (3, n), (3, m) arrays
+        The bvectors used in the comparison.
+
+    Returns
+    -------
+    angles : (n, m) array
+        The pair-wise angles *in radians*, folded into the interval [0, pi/2].
+    """
+    # Clip round-off errors outside of [-1, 1]. These are all (anti)parallel
+    # directions, so after the antipodal folding, they get an angle of 0:
+    angles = np.arccos(np.clip(np.dot(np.squeeze(bvecs1).T,
+                                      np.squeeze(bvecs2)), -1, 1))
+
+    return np.min(np.array([angles, np.pi - angles]), 0)
+
+
+def sinkhorn_emd(weights1, weights2, cost, reg=0.01, max_iter=1000,
+                 tol=1e-6):
+    """
+    Entropy-regularized approximation of the EMD (Cuturi, 2013), computed with
+    Sinkhorn iterations for many pairs of signatures that share their ground
+    distance.
+
+    Each iteration costs two products of the (n_pairs, n) weights with the
+    (n, m) kernel, so this scales much better than the exact solver for large
+    signatures, at the price of a (small, positive) bias.
+
+    Parameters
+    ----------
+    weights1 : array (n_pairs, n)
+        The first set of weights. Only the positive weights are used.
+
+    weights2 : array (n_pairs, m)
+        The second set of weights. Only the positive weights are used.
+
+    cost : array (n, m)
+        The ground distance between item i in weights1 and item j in weights2.
+
+    reg : float, optional
+        The strength of the entropic regularization, relative to the largest
+        cost. Smaller values are more accurate, but converge more slowly. Below
+        about 0.002 the kernel underflows, so use the exact solver.
+
+    max_iter : int, optional
+        Maximal number of iterations.
+
+    tol : float, optional
+        Stop when the marginals of all the transport plans are within this
+        (L1) distance from the normalized weights.
+
+    Returns
+    -------
+    dist : array (n_pairs,)
+        The cost of transporting the normalized weights1 onto the normalized
+        weights2 under the regularized transport plan. Pairs in which either
+        set has no positive weights are set to nan.
+    """
+    w1 = np.atleast_2d(np.asarray(weights1, dtype=float))
+    w2 = np.atleast_2d(np.asarray(weights2, dtype=float))
+    w1 = np.where(w1 > 0, w1, 0)
+    w2 = np.where(w2 > 0, w2, 0)
+    cost = np.reshape(cost, (w1.shape[-1], w2.shape[-1]))
+    sum1 = np.sum(w1, -1)
+    sum2 = np.sum(w2, -1)
+
+    dist = ozu.nans(w1.shape[0])
+    valid = (sum1 > 0) & (sum2 > 0)
+    if not np.any(valid):
+        return dist
+    a = w1[valid] / sum1[valid][:, None]
+    b = w2[valid] / sum2[valid][:, None]
+
+    K = np.exp(-cost / (reg * np.max(cost)))
+    v = np.ones_like(b)
+    for iteration in range(max_iter):
+        u = a / np.dot(v, K.T)
+        Ktu = np.dot(u, K)
+        # Check the marginals every now and then:
+        if (iteration % 10 == 0 and
+            np.max(np.sum(np.abs(v * Ktu - b), -1)) < tol):
+            break
+        v = b / Ktu
+
+    dist[valid] = np.sum(np.dot(u, K * cost) * v, -1)
+    return dist
+
+
+def fODF_EMD_batch(fODF1, fODF2, bvecs1=None, bvecs2=None, dist=None,
+                   n_jobs=None, block_size=500, solver="exact", reg=0.01):
+    """
+    Calculates the earth mover's distance between many pairs of fODFs that
+    share their bvectors.
+
+    The ground distance is computed once for all the pairs. The signatures are
+    built only over the positive weights of each fODF (which are sparse for
+    SFM) and the EMD is computed in C, without holding the GIL, so blocks of
+    voxels are processed in parallel on a pool of threads.
+
+    Parameters
+    ----------
+    fODF1 : array (..., n)
+        The first fODFs in the comparison
+
+    fODF2 : array (..., m)
+        The second fODFs in the comparison. All the dimensions, except for the
+        last one, should match those of fODF1.
+
+    bvecs1, bvecs2 : (3, n), (3, m) arrays
+        The bvectors used in the comparison.
+
+    dist : array with n * m elements, optional
+        The angular pair-wise distances between bvecs1 and bvecs2 *in
+        radians* (see `fODF_EMD`). Calculated from the bvecs if not provided.
+
+    n_jobs : int, optional
+        How many threads to use. Defaults to the number of CPUs.
+
+    block_size : int, optional
+        The number of fODF pairs sent to each thread at a time.
+
+    solver : str, optional
+        "exact": the transportation simplex, restricted to the support of the
+        fODFs.
+        "sinkhorn": the entropy-regularized approximation (see
+        `sinkhorn_emd`), which is much faster for fODFs with many non-zero
+        weights (e.g. from over-sampled rotational vectors).
+
+    reg : float, optional
+        The regularization for the "sinkhorn" solver.
+
+    Returns
+    -------
+    emd_arr : array
+        The EMD between each pair of fODFs, normalized such that 1 is the EMD
+        of a weight of 1 moved 90 degrees, with the shape of fODF1 without its
+        last dimension. Pairs in which either fODF has no positive weights are
+        set to nan.
+    """
+    fODF1 = np.asarray(fODF1, dtype=float)
+    fODF2 = np.asarray(fODF2, dtype=float)
+    out_shape = fODF1.shape[:-1]
+    if fODF2.shape[:-1] != out_shape:
+        e_s = "fODF1 and fODF2 should have the same number of fODFs, "
+        e_s += "got shapes %s and %s"%(fODF1.shape, fODF2.shape)
+        raise ValueError(e_s)
+
+    w1 = np.ascontiguousarray(fODF1.reshape(-1, fODF1.shape[-1]))
+    w2 = np.ascontiguousarray(fODF2.reshape(-1, fODF2.shape[-1]))
+    if dist is None:
+        dist = fODF_ground_distance(bvecs1, bvecs2)
+    dist = np.ascontiguousarray(np.reshape(dist, (w1.shape[-1],
+                                                  w2.shape[-1])), dtype=float)
+
+    emd_arr = np.empty(w1.shape[0])
+    blocks = [slice(start, start + block_size) for start in
+              range(0, w1.shape[0], block_size)]
+
+    if solver == "exact":
+        def _emd_block(block):
+            emd.emd_batch(w1[block], w2[block], dist, emd_arr[block])
+    elif solver == "sinkhorn":
+        def _emd_block(block):
+            emd_arr[block] = sinkhorn_emd(w1[block], w2[block], dist, reg=reg)
+    else:
+        e_s = "Solver '%s' is not one of: 'exact', 'sinkhorn'"%solver
+        raise ValueError(e_s)
+
+    # The blocks fill emd_arr in place:
+    for _ in ozp.map_blocks(_emd_block, blocks, n_jobs=n_jobs,
+                            backend='thread'):
+        pass
+
+    return (emd_arr / (np.pi/2)).reshape(out_shape)
+
+
+def mirror(mp, rot_vecs):
+    """
+    Mirror fODFs onto the full sphere, using their antipodal symmetry.
+
+    Parameters
+    ----------
+    mp : array (..., n)
+        Model parameters (weights of the fODF)
+    rot_vecs : array (3, n)
+        The rotational vectors corresponding to the model parameters
+
+    Returns
+    -------
+    mp_mirr : array (..., 2n)
+        The parameters, repeated for the mirrored vectors
+    vertices : array (2n, 3)
+        The rotational vectors followed by their antipodes.
+    """
+    mp = np.asarray(mp)
+    rot_vecs = np.squeeze(rot_vecs)
+    return (np.concatenate((mp, mp), -1),
+            np.concatenate((rot_vecs, -rot_vecs), -1).T)
+
+
+def _pair_bins(vertices1, vertices2, n):
+    """
+    Helper function to get the center of the angular bins (in degrees) and the
+    bin of each pair of vertices, an int array (n1, n2).
+    """
+    cos = np.clip(np.dot(vertices1, np.transpose(vertices2)), -1, 1)
+    angles = np.rad2deg(np.arccos(cos))
+    edges = np.linspace(0, 180, n)
+    return (edges[:-1] + edges[1:]) / 2., np.digitize(angles, edges[1:-1])
+
+
+class SphericalCC(desc.ResetMixin):
+    """
+    Spherical cross-correlation between functions sampled on two fixed sets
+    of vertices, for many voxels at once.
+
+    The angular bin of every pair of vertices is found once. The sums needed
+    for the correlation in each bin are then sparse matrix products: with the
+    number of pairs each vertex has in each bin for the sums over each of the
+    functions, and with a (n_bins * n1, n2) matrix of the pairs themselves
+    for the sum of the cross-products. All of the n1 * n2 pairs are used
+    exactly once, so the cost per voxel is that of a single pass over the
+    pairs, without copying the data into each bin.
+    """
+    def __init__(self, vertices1, vertices2, n=20):
+        """
+        Parameters
+        ----------
+        vertices1, vertices2 : arrays (n1, 3), (n2, 3)
+            Unit vectors on the sphere
+        n : int
+            The interval [0, 180] degrees is divided into n-1 equal bins.
+        """
+        self.vertices1 = np.asarray(vertices1)
+        self.vertices2 = np.asarray(vertices2)
+        self.n = n
+
+    @desc.auto_attr
+    def _pair_bins(self):
+        return _pair_bins(self.vertices1, self.vertices2, self.n)
+
+    @desc.auto_attr
+    def deg(self):
+        """
+        The center of each angular bin (in degrees)
+        """
+        return self._pair_bins[0]
+
+    @property
+    def n_bins(self):
+        return self.n - 1
+
+    @desc.auto_attr
+    def n_pairs(self):
+        """
+        The number of pairs of vertices in each bin
+        """
+        return np.bincount(self._pair_bins[1].ravel(),
+                           minlength=self.n_bins).astype(float)
+
+    def _counts(self, axis):
+        """
+        Helper function to get a sparse matrix (n_vertices, n_bins), with the
+        number of pairs each vertex is in within each bin.
+        """
+        bin_idx = self._pair_bins[1]
+        n_vertices = bin_idx.shape[axis]
+        vert_idx = np.indices(bin_idx.shape)[axis]
+        return sps.csr_matrix((np.ones(bin_idx.size),
+                               (vert_idx.ravel(), bin_idx.ravel())),
+                              shape=(n_vertices, self.n_bins))
+
+    @desc.auto_attr
+    def counts1(self):
+        return self._counts(0)
+
+    @desc.auto_attr
+    def counts2(self):
+        return self._counts(1)
+
+    @desc.auto_attr
+    def pairs(self):
+        """
+        A sparse matrix (n_bins * n1, n2) with a one in row
+        (bin * n1 + i), column j for every pair of vertices (i, j) in each bin.
+        """
+        bin_idx = self._pair_bins[1]
+        n1, n2 = bin_idx.shape
+        idx1, idx2 = np.indices(bin_idx.shape)
+        rows = (bin_idx * n1 + idx1).ravel()
+        return sps.csr_matrix((np.ones(bin_idx.size), (rows, idx2.ravel())),
+                              shape=(self.n_bins * n1, n2))
+
+    def __call__(self, data1, data2, block_size=500):
+        """
+        The spherical cross-correlation between data1 and data2 in each voxel
+
+        Parameters
+        ----------
+        data1, data2 : arrays (n_vox, n1), (n_vox, n2)
+            Functions sampled on the vertices (one row per voxel)
+        block_size : int
+            How many voxels to process at a time.
+
+        Returns
+        -------
+        cc : array (n_vox, n_bins)
+            The correlation in each bin. Bins with no pairs, or in which
+            either of the functions is constant, are set to nan.
+        """
+        data1 = np.atleast_2d(np.asarray(data1, dtype=float))
+        data2 = np.atleast_2d(np.asarray(data2, dtype=float))
+        n_vox, n1 = data1.shape
+        n_pairs = self.n_pairs
+        cc = ozu.nans((n_vox, self.n_bins))
+        for start in range(0, n_vox, block_size):
+            # The correlation doesn't change when a constant is added to each
+            # voxel, and demeaning reduces the round-off error in the
+            # variances below:
+            x = data1[start:start + block_size]
+            x = x - np.mean(x, -1)[:, None]
+            y = data2[start:start + block_size]
+            y = y - np.mean(y, -1)[:, None]
+
+            sx = self.counts1.T.dot(x.T).T
+            sy = self.counts2.T.dot(y.T).T
+            sxx = self.counts1.T.dot((x ** 2).T).T
+            syy = self.counts2.T.dot((y ** 2).T).T
+            pairs_y = self.pairs.dot(y.T).reshape(self.n_bins, n1, -1)
+            sxy = np.einsum('kiv,vi->vk', pairs_y, x)
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                cov = sxy - sx * sy / n_pairs
+                var_x = sxx - sx ** 2 / n_pairs
+                var_y = syy - sy ** 2 / n_pairs
+                this_cc = cov / np.sqrt(var_x * var_y)
+            # What's left of the variance of a constant is round-off:
+            tol = 1e-10
+            this_cc[~((var_x > tol * sxx) & (var_y > tol * syy))] = np.nan
+            cc[start:start + block_size] = this_cc
+        return cc
+
+
+def pdd_agreement(mp1, mp2, rot_vecs1, rot_vecs2):
+    """
+    The angle between the principal diffusion directions (the rotational
+    vector with the largest weight) of two sets of fODFs.
+
+    Parameters
+    ----------
+    mp1, mp2 : arrays (n_vox, n), (n_vox, m)
+        Model parameters
+    rot_vecs1, rot_vecs2 : arrays (3, n), (3, m)
+        The corresponding rotational vectors
+
+    Returns
+    -------
+    angles : array (n_vox,)
+        The angles (in degrees), taking into account the antipodal symmetry,
+        so that they lie in [0, 90]. Voxels in which either fODF has no
+        positive weights are set to nan.
+    """
+    mp1 = np.atleast_2d(mp1)
+    mp2 = np.atleast_2d(mp2)
+    vecs1 = np.squeeze(rot_vecs1).T
+    vecs2 = np.squeeze(rot_vecs2).T
+    vecs1 = vecs1 / np.sqrt(np.sum(vecs1 ** 2, -1))[:, None]
+    vecs2 = vecs2 / np.sqrt(np.sum(vecs2 ** 2, -1))[:, None]
+
+    pdd1 = vecs1[np.argmax(mp1, -1)]
+    pdd2 = vecs2[np.argmax(mp2, -1)]
+    cos = np.clip(np.abs(np.sum(pdd1 * pdd2, -1)), 0, 1)
+    angles = np.rad2deg(np.arccos(cos))
+    angles[~((np.max(mp1, -1) > 0) & (np.max(mp2, -1) > 0))] = np.nan
+    return angles
+
+
+class FoldPair(desc.ResetMixin):
+    """
+    The tables needed to compare fODFs from a pair of folds of
+    cross-validation, each with its own rotational vectors.
+
+    All of these are computed (lazily) once, and then used for all voxels.
+    """
+    def __init__(self, rot_vecs1, rot_vecs2, n_bins=20):
+        """
+        Parameters
+        ----------
+        rot_vecs1, rot_vecs2 : arrays (3, n), (3, m)
+            The rotational vectors of the fODFs in each fold
+        n_bins : int
+            Passed as `n` to `SphericalCC`
+        """
+        self.rot_vecs1 = np.squeeze(rot_vecs1)
+        self.rot_vecs2 = np.squeeze(rot_vecs2)
+        self.n_bins = n_bins
+
+    @desc.auto_attr
+    def ground_distance(self):
+        """
+        Pairwise angles (antipodally folded) between the rotational vectors
+        """
+        return fODF_ground_distance(self.rot_vecs1, self.rot_vecs2)
+
+    @desc.auto_attr
+    def mirrored_vertices1(self):
+        return np.concatenate((self.rot_vecs1, -self.rot_vecs1), -1).T
+
+    @desc.auto_attr
+    def mirrored_vertices2(self):
+        return np.concatenate((self.rot_vecs2, -self.rot_vecs2), -1).T
+
+    @desc.auto_attr
+    def _sph_cc(self):
+        return SphericalCC(self.mirrored_vertices1, self.mirrored_vertices2,
+                           n=self.n_bins)
+
+    @property
+    def sph_cc_deg(self):
+        """
+        The center of the angular bins of the spherical cross-correlation
+        """
+        return self._sph_cc.deg
+
+    def emd(self, mp1, mp2, **kwargs):
+        """
+        The EMD between the fODFs in each voxel (see `fODF_EMD_batch`).
+        """
+        return fODF_EMD_batch(mp1, mp2, dist=self.ground_distance, **kwargs)
+
+    def sph_cc(self, mp1, mp2):
+        """
+        The spherical cross-correlation between the (mirrored) fODFs in each
+        voxel, an array (n_vox, n_bins - 1).
+        """
+        return self._sph_cc(mirror(mp1, self.rot_vecs1)[0],
+                            mirror(mp2, self.rot_vecs2)[0])
+
+    def pdd_agreement(self, mp1, mp2):
+        """
+        The angle between the principal diffusion directions in each voxel
+        (see `pdd_agreement`).
+        """
+        return pdd_agreement(mp1, mp2, self.rot_vecs1, self.rot_vecs2)
+
+    def precision(self, mp1, mp2, precision_type):
+        """
+        Compute one of the precision measures in each voxel.
+
+        Parameters
+        ----------
+        mp1, mp2 : arrays (n_vox, n), (n_vox, m)
+            Model parameters from each fold
+        precision_type : str
+            emd, emd_multi_combine: the EMD between the fODFs.
+            sph_cc: the maximal spherical cross-correlation (over the angular
+                    bins) between the fODFs.
+            pdd: the angle between the principal diffusion directions.
+
+        Returns
+        -------
+        p_arr : array (n_vox,)
+        """
+        if precision_type in ("emd", "emd_multi_combine"):
+            return self.emd(mp1, mp2)
+        elif precision_type == "sph_cc":
+            cc = self.sph_cc(mp1, mp2)
+            p_arr = ozu.nans(cc.shape[0])
+            has_cc = np.any(np.isfinite(cc), -1)
+            # Maximum of the non-nan values:
+            p_arr[has_cc] = np.nanmax(cc[has_cc], -1)
+            return p_arr
+        elif precision_type == "pdd":
+            return self.pdd_agreement(mp1, mp2)
+        else:
+            e_s = "Precision type '%s' is not one of: "%precision_type
+            e_s += "'emd', 'emd_multi_combine', 'sph_cc', 'pdd'"
+            raise ValueError(e_s)
@@ -13,7 +13,10 @@ import inspect
 import nibabel as nib
 import osmosis.utils as ozu
 import osmosis.emd as emd
+import osmosis.precision as prc
 from osmosis.utils import separate_bvals
+from osmosis.precision import (fODF_ground_distance, sinkhorn_emd,
+                               fODF_EMD_batch)
 
 import osmosis.model.sparse_deconvolution as sfm
 import osmosis.model.dti as dti
@@ -339,75 +342,12 @@ def _aggregate_fODFs(all_mp_list, all_mp_rot_vecs_list, unique_b, precision,
 
     return np.squeeze(out_mp_list), np.squeeze(out_rot_vecs_list)
 
-def _calc_precision(mp1, mp2, rot_vecs1, rot_vecs2, idx1, idx2, mp_count, vox,
-                    p_arr, precision_type):
-    """
-    Does the actual precision calculation.
-
-    Parameters
-    ----------
-    mp1: 2 dimensional array
-        First set of model parameters
-    mp2: 2 dimensional array
-        Second set of model parameters
-    rot_vecs1: 2 dimensional array
-        All the rotational vectors to which the weights in the first set of
-        model parameters correspond to
-    rot_vecs2: 2 dimensional array
-        All the rotational vectors to which the weights in the second set of
-        model parameters correspond to
-    idx1: int
-        Index pointing to the current model parameter in mp1
-    idx2: int
-        Index pointing to the current model parameter in mp2
-    mp_count: int
-        Current combination index of model parameters
-    vox: int
-        Current voxel
-    p_arr: 1 dimensional array
-        The current, aggregate, precision array
-    precision_type: str
-        emd: Computes the EMD between different fODFs
-        emd_multi_combine: Computes the EMD for the multi fODF between model
-                           parameters from all b-values combined.
-        sph_cc:  Computes the spherical cross-correlation between different
-                 model parameters
-
-    Returns
-    -------
-    p_arr: 1 dimensional array
-        An updated precision array
-    """
-    if precision_type == "sph_cc":
-        # Mirror the data and the rotational vectors
-        mp_mirr1 = np.concatenate((mp1, mp1), -1)
-        mp_mirr2 = np.concatenate((mp2, mp2), -1)
-        bvecs_mirr1 = np.squeeze(np.concatenate((rot_vecs1,-1*rot_vecs1), -1)).T
-        bvecs_mirr2 = np.squeeze(np.concatenate((rot_vecs2,-1*rot_vecs2), -1)).T
-        deg, p = ozu.sph_cc(mp_mirr1, mp_mirr2, bvecs_mirr1,
-                            vertices2=bvecs_mirr2)
-
-        if all(~np.isfinite(cc)):
-            p_arr[mp_count][vox] = np.nan
-        else:
-            p_arr[mp_count][vox] = np.max(cc[np.isfinite(cc)]) # Maximum of the
-                                        # non-nan values
-
-    elif (precision_type == "emd") | (precision_type == "emd_multi_combine"):
-        if ((len(np.where(mp1)[0]) != 0) & (len(np.where(mp2)[0]) != 0)):
-            emd = fODF_EMD(mp1[idx1], mp2[idx2], rot_vecs1[:, idx1],
-                           rot_vecs2[:, idx2])
-            p_arr[mp_count][vox] = emd
-        else:
-            p_arr[mp_count][vox] = np.nan
-
-    return p_arr
-
 def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
                mean_mod_func = "bi_exp_rs", mean = "mean_model",
                mean_mix = None, precision = False, fit_method = None,
                b_idx1 = None, b_idx2 = None, over_sample=None,
-               bounds = "preset", solver=None, viz = False, bias_var=False):
+               bounds = "preset", solver=None, viz = False, bias_var=False,
+               seed=None):
     """
     Does k-fold cross-validation leaving out a certain percentage of the vertices
     out at a time.  This function can be used for 7 different variations of
@@ -439,6 +379,7 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
                            parameters from all b-values combined.
         sph_cc:  Computes the spherical cross-correlation between different
                  model parameters
+        pdd: Computes the angle between the principal diffusion directions
         False: Performs k-fold cross-validation.
     fit_method: str
         "WLS": Weighted least squares.  Default is the least squares method
@@ -456,6 +397,8 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
         Bounds on the parameters for fitting the mean model
     solver: str
         Solver to be used in multi_bvals module for fitting the SFM.
+    seed: int
+        Seed for the random choice of the vertices in each fold.
 
     Returns
     -------
@@ -468,6 +411,7 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
         model parameters
     """
     t1 = time.time()
+    prng = np.random.RandomState(seed)
     [b_inds, unique_b, b_inds_rm0,
     all_b_idx, all_b_idx_rm0, predicted] = _kfold_xval_setup(bvals, mask)
 
@@ -593,7 +537,7 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
             vec_pool = np.arange(len(these_b_inds))
 
             # Need to choose random indices so shuffle them.
-            np.random.shuffle(vec_pool)
+            prng.shuffle(vec_pool)
             this_vec_pool = np.copy(vec_pool)
             vec_pool_list.append(np.copy(vec_pool))
         elif start_fODF_mode != "both_ms":
@@ -752,6 +696,14 @@ def kfold_xval(data, bvals, bvecs, mask, ad, rd, n, fODF_mode,
         actual = data[mod.mask][:, all_b_idx]
         return actual, predicted
 
+def _array_key(arr):
+    """
+    Helper function to get a key for the contents of an array (so that
+    different objects with the same values share a key)
+    """
+    arr = np.ascontiguousarray(arr)
+    return (arr.shape, arr.dtype.str, arr.tobytes())
+
 def kfold_xval_precision(mp_list, mask, rot_vecs_list,
                         precision_type, start_fODF_mode):
     """
@@ -773,14 +725,20 @@ def kfold_xval_precision(mp_list, mask, rot_vecs_list,
                            parameters from all b-values combined.
         sph_cc:  Computes the spherical cross-correlation between different
                  model parameters
+        pdd: Computes the angle between the principal diffusion directions
     start_fODF_mode: str
         The fODF mode for this round of k-fold cross-validation
 
     Returns
     -------
     cc_arr: 2 dimensional array
-        An array consisting of the spherical cross-correlations between each of
-        the combinations of model parameters at each voxel
+        An array consisting of the precision between each of the combinations
+        of model parameters at each voxel
+
+    Notes
+    -----
+    All voxels of a combination are computed at once, with the functions in
+    `osmosis.precision`.
     """
 
     if start_fODF_mode == "None":
@@ -797,29 +755,33 @@ def kfold_xval_precision(mp_list, mask, rot_vecs_list,
         num_combos = len(mp_list1_inds)*len(mp_list2_inds)
 
     # Preallocate an array to include one for each combination per voxel
-    p_arr = np.zeros((num_combos, int(np.sum(mask))))
-    mp_count = 0
-
-    for mp_inds in itr:
-        for vox in np.arange(int(np.sum(mask))):
-            if start_fODF_mode == "None":
-                mp1 = mp_list[mp_inds[0]][vox]
-                mp2 = mp_list[mp_inds[1]][vox]
-                rot_vecs1 = rot_vecs_list[mp_inds[0]]
-                rot_vecs2 = rot_vecs_list[mp_inds[1]]
-            elif start_fODF_mode[:4] == "both":
-                mp1 = mp_list[0][mp_inds[0]][vox]
-                mp2 = mp_list[1][mp_inds[1]][vox]
-                rot_vecs1 = rot_vecs_list[0][mp_inds[0]]
-                rot_vecs2 = rot_vecs_list[1][mp_inds[1]]
-
-            idx1 = np.where(mp1 > 0)
-            idx2 = np.where(mp2 > 0)
-
-            p_arr = _calc_precision(mp1, mp2, rot_vecs1, rot_vecs2, idx1, idx2,
-                                    mp_count, vox, p_arr, precision_type)
-
-        mp_count = mp_count + 1
+    n_vox = int(np.sum(mask))
+    p_arr = np.zeros((num_combos, n_vox))
+
+    # The tables that depend on the rotational vectors are computed once for
+    # each pair of rotational vectors (and shared between all the combinations
+    # of folds that have the same ones):
+    fold_pairs = {}
+    for mp_count, mp_inds in enumerate(itr):
+        if start_fODF_mode == "None":
+            all_mp1 = mp_list[mp_inds[0]]
+            all_mp2 = mp_list[mp_inds[1]]
+            rot_vecs1 = rot_vecs_list[mp_inds[0]]
+            rot_vecs2 = rot_vecs_list[mp_inds[1]]
+        elif start_fODF_mode[:4] == "both":
+            all_mp1 = mp_list[0][mp_inds[0]]
+            all_mp2 = mp_list[1][mp_inds[1]]
+            rot_vecs1 = rot_vecs_list[0][mp_inds[0]]
+            rot_vecs2 = rot_vecs_list[1][mp_inds[1]]
+
+        key = (_array_key(rot_vecs1), _array_key(rot_vecs2))
+        if key not in fold_pairs:
+            fold_pairs[key] = prc.FoldPair(rot_vecs1, rot_vecs2)
+
+        p_arr[mp_count] = fold_pairs[key].precision(
+                                            np.asarray(all_mp1)[:n_vox],
+                                            np.asarray(all_mp2)[:n_vox],
+                                            precision_type)
 
     return p_arr
 
@@ -1089,7 +1051,8 @@ def kfold_xval_gen(model_class, data, bvecs, bvals, k, mask = None,
     return actual, predicted
 
 def predict_bvals(data, bvals, bvecs, mask, ad, rd, b_idx1, b_idx2, n = 10,
-                  solver = "nnls", mode = None, mean = "mean_model"):
+                  solver = "nnls", mode = None, mean = "mean_model",
+                  seed = None):
     """
     Predict for each b value.
 
@@ -1107,6 +1070,9 @@ def predict_bvals(data, bvals, bvecs, mask, ad, rd, b_idx1, b_idx2, n = 10,
         Unique b value index of the b value to fit to.
     b_idx2: int
         Unique b value index of the b value to predict.
+    seed: int
+        Seed for the random choice of the vertices in each fold (see
+        `kfold_xval`).
 
     Returns
     -------
@@ -1133,7 +1099,8 @@ def predict_bvals(data, bvals, bvecs, mask, ad, rd, b_idx1, b_idx2, n = 10,
                                                             b_idx1 = b_idx1,
                                                             b_idx2 = b_idx2,
                                                             mean = mean,
-                                                            solver = solver)
+                                                            solver = solver,
+                                                            seed = seed)
     else:
         # If you want to predict normally, not using k-fold cross-validation
         mod = sfm.SparseDeconvolutionModelMultiB(data[:,:,:,all_inc_0],
@@ -1188,16 +1155,19 @@ def fODF_EMD(fODF1, fODF2, bvecs1=None, bvecs2=None, dist=None):
         so should lie in the interval [0-pi].
 
     """
+    fODF1 = np.asarray(fODF1, dtype=float).ravel()
+    fODF2 = np.asarray(fODF2, dtype=float).ravel()
     if dist is None:
-        angles = np.arccos(np.dot(np.squeeze(bvecs1).T, np.squeeze(bvecs2)))
-
-        if angles.shape:
-            angles[np.isnan(angles)] = 0
-        elif np.isnan(angles):
-            angles = 0
-
-        angles = np.min(np.array([angles, np.pi - angles]), 0)
-        dist = angles.ravel()
+        dist = fODF_ground_distance(bvecs1, bvecs2)
+    dist = np.reshape(dist, (fODF1.shape[0], fODF2.shape[0]))
+
+    # Directions with no weight don't move any mass, so the signatures only
+    # need to include the non-zero weights (SFM weights are sparse):
+    idx1 = np.nonzero(fODF1)[0]
+    idx2 = np.nonzero(fODF2)[0]
+    fODF1 = fODF1[idx1]
+    fODF2 = fODF2[idx2]
+    dist = dist[idx1][:, idx2].ravel()
 
     # The result is normalized such that 1 is the EMD of a weight of 1 moved 90
     # degrees:
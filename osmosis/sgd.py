@@ -5,6 +5,7 @@ Stochastic Gradient Descent
 This is adapted from Kendrick Kay's Matlab SGD code.
 
 """
+import time
 
 import scipy.sparse as sps
 import numpy as np
@@ -26,10 +27,21 @@ def stochastic_gradient_descent(y, X, momentum=0,
                                 verbose=True,
                                 plot=True,
                                 lamda=0,
-                                alpha=0.5):
+                                alpha=0.5,
+                                h0=None,
+                                max_iter=None,
+                                seed=None,
+                                return_info=False):
     """
 
     Solve y=Xh for h, using a stochastic gradient descent.
+
+    Each epoch, the rows of X are shuffled once and then visited in
+    contiguous mini-batches. The residuals y - Xh are tracked incrementally,
+    by updating them only with the columns of X whose parameters changed, so
+    that the full sum of squared errors is only needed (and, when many
+    parameters changed, recomputed) on the iterations in which convergence
+    is checked.
     
     Parameters
     ----------
@@ -39,16 +51,20 @@ def stochastic_gradient_descent(y, X, momentum=0,
         
     X: ndarray of regressors. May be either sparse or dense. of shape (N, M)
        The regressors
+
+    momentum: float (default: 0)
+        The weight of the previous update direction in the current one.
     
     prop_select: float (0-1, default 0.01)
         What proportion of the samples to evaluate in each iteration of the
-        algorithm.
+        algorithm (the size of each mini-batch).
 
     step_size: float, optional (default: 0.05). 
         The increment of parameter update in each iteration
                 
     non_neg: Boolean, optional (default: True)
-        Whether to enforce non-negativity of the solution.
+        Whether to enforce non-negativity of the solution, by projecting
+        the parameters onto the non-negative orthant after every update.
 
     prop_bad_checks: float (default: 0.1)
        If this proportion of error checks so far has not yielded an improvement
@@ -67,71 +83,134 @@ def stochastic_gradient_descent(y, X, momentum=0,
       that things are still going well.
 
     verbose: Boolean (default: True).
-       Whether to display information in each iteration
+       Whether to display information in each error check
 
     plot: whether to generate a plot of the progression of the optimization
 
     lamda, alpha: ElasticNet params
+
+    h0: 1-d array of shape (M), optional
+       Initial value of the parameters (warm start). Defaults to the origin.
+
+    max_iter: int, optional
+       Stop after this many iterations, even if the convergence criteria
+       haven't been met. Default: no limit.
+
+    seed: int, optional
+       Seed for the random number generator used to shuffle the rows.
+
+    return_info: bool (default: False)
+       Whether to also return a dict with the trace of the optimization.
     
     Returns
     -------
     h_best: The best estimate of the parameters.
-    
+
+    info: dict (only if `return_info` is True)
+        'ss_residuals': the objective in each error check, 'n_iterations': the
+        iteration in which h_best was found, 'iterations': the total number of
+        iterations and 'time': wall time (in seconds).
     
     """
-
+    t_start = time.time()
+    y = np.asarray(y).ravel()
     num_data = y.shape[0]
     num_regressors = X.shape[1]
-    n_select = np.round(prop_select * num_data)
+    n_select = int(np.max([np.round(prop_select * num_data), 1]))
+
+    if sps.issparse(X):
+        # Contiguous row-slices are cheap in csr, column-slices (for the
+        # residual updates) in csc:
+        X_rows = X.tocsr()
+        X_cols = X.tocsc()
+    else:
+        X_rows = X_cols = np.asarray(X)
+
+    # The cost of updating the residuals with each column of X:
+    if sps.issparse(X_cols):
+        col_nnz = np.diff(X_cols.indptr)
+    else:
+        col_nnz = np.ones(num_regressors, dtype=int) * num_data
+    total_nnz = np.sum(col_nnz)
 
-    # Initialize the parameters at the origin:
-    h = np.zeros(num_regressors)
+    prng = np.random.RandomState(seed)
+
+    # Initialize the parameters at the origin, unless told otherwise:
+    if h0 is None:
+        h = np.zeros(num_regressors)
+    else:
+        h = np.array(h0, dtype=float).ravel()
+        if non_neg:
+            h[h<0] = 0
 
     # If nothing good happens, we'll return that in the end:
-    h_best = np.zeros(num_regressors)
+    h_best = h.copy()
+    n_iterations = 0
     
-    gradient = np.zeros(num_regressors)
+    velocity = np.zeros(num_regressors)
     
     iteration = 1
-    count = 1
-    ss_residuals = []  # This will hold the residuals in each iteration
+    ss_residuals = []  # This will hold the residuals in each error check
     ss_residuals_min = np.inf  # This will keep track of the best solution so far
     ss_residuals_to_mean = np.sum((y - np.mean(y))**2) # The variance of y
     rsq_max = -np.inf   # This will keep track of the best r squared so far
     count_bad = 0  # Number of times estimation error has gone up.
     error_checks = 0  # How many error checks have we done so far
+    batch_start = num_data  # Forces a shuffle on the first iteration
+    resid_stale = True  # Whether resid needs to be recomputed from scratch
 
-        
     while 1:
-        # indices of data points to select
-        idx = np.floor(np.random.rand(n_select) * num_data).astype(int);
+        if batch_start >= num_data:
+            # Start a new epoch: shuffle the rows once and then walk through
+            # them in contiguous blocks:
+            perm = prng.permutation(num_data)
+            X_epoch = X_rows[perm]
+            y_epoch = y[perm]
+            batch_start = 0
+            # Refresh the residuals, so that errors from the incremental
+            # updates don't accumulate:
+            resid_stale = True
 
         # Select for this round 
-        y0 = y[idx]
-        X0 = X[idx]
-
-        if iteration>1: 
-            # The sum of squared error given the current parameter setting: 
-            sse = np.sum((y - spdot(X,h))**2)
-            # The gradient is (Kay 2008 supplemental page 27): 
-            gradient = ((spdot(X0.T, spdot(X0,h) - y0))
-                        +
-                        lamda *((1-alpha) + alpha * h)
-                       )
-            gradient += momentum*gradient
-            # Normalize to unit-length
-            unit_length_gradient = gradient / np.sqrt(np.dot(gradient, gradient))
-            # Update the parameters in the direction of the gradient:
-            h -= step_size * unit_length_gradient
+        X0 = X_epoch[batch_start:batch_start + n_select]
+        y0 = y_epoch[batch_start:batch_start + n_select]
+        batch_start += n_select
 
+        # The gradient is (Kay 2008 supplemental page 27): 
+        gradient = ((spdot(X0.T, spdot(X0, h) - y0))
+                    +
+                    lamda *((1-alpha) + alpha * h)
+                    )
+        grad_norm = np.sqrt(np.dot(gradient, gradient))
+        if grad_norm > 0:
+            # Normalize to unit-length and add the momentum term:
+            velocity = momentum * velocity + gradient / grad_norm
+            # Update the parameters in the direction of the gradient:
+            h_new = h - step_size * velocity
             if non_neg:
                 # Set negative values to 0:
-                h[h<0] = 0
+                h_new[h_new<0] = 0
+
+            # Only the columns of parameters that changed affect the
+            # residuals. If these are few, update the residuals in place,
+            # otherwise it's cheaper to recompute them at the next check:
+            changed = np.where(h_new != h)[0]
+            if not resid_stale and len(changed):
+                if col_nnz[changed].sum() * check_error_iter < total_nnz:
+                    resid -= spdot(X_cols[:, changed],
+                                   h_new[changed] - h[changed])
+                else:
+                    resid_stale = True
+            h = h_new
 
         # Every once in a while check whether it's converged:
-        if np.mod(iteration, check_error_iter):
-            # This calculates the sum of squared residuals at this point:
-            ss_residuals.append(np.sum(np.power(y - spdot(X,h), 2)) +
+        if (np.mod(iteration, check_error_iter) == 0 or
+            iteration == max_iter):
+            if resid_stale:
+                resid = y - spdot(X_cols, h)
+                resid_stale = False
+            # The sum of squared residuals at this point:
+            ss_residuals.append(np.dot(resid, resid) +
                                 lamda * (alpha*np.sum(h**2) +
                                          (1-alpha)*np.sum(h)))
             rsq_est = rsq(ss_residuals[-1], ss_residuals_to_mean)
@@ -147,34 +226,42 @@ def stochastic_gradient_descent(y, X, momentum=0,
                 ss_residuals_min = ss_residuals[-1]
                 n_iterations = iteration # This holds the number of iterations
                                         # for the best solution so far.
-                h_best = h # This holds the best params we have so far
+                h_best = h.copy() # This holds the best params we have so far
 
                 # Are we generally (over iterations) converging on
                 # improvement in r-squared?
-                if rsq_est>rsq_max*(1+converge_on_r/100):
+                if rsq_est>rsq_max*(1+converge_on_r/100.):
                     rsq_max = rsq_est
                     count_bad = 0 # We're doing good. Null this count for now
                 else:
                     count_bad += 1
             else:
                 count_bad += 1
-                
-            if count_bad >= np.max([max_error_checks,
-                                    np.round(prop_bad_checks*error_checks)]):
-                print("\nOptimization terminated after %s iterations"%iteration)
-                print("R2= %.1f "%rsq_max)
-                print("Sum of squared residuals= %.1f"%ss_residuals_min)
+
+            error_checks += 1
+            if (count_bad >= np.max([max_error_checks,
+                                     np.round(prop_bad_checks*error_checks)])
+                or (max_iter is not None and iteration >= max_iter)):
+                if verbose:
+                    print("\nOptimization terminated after %s iterations"%
+                          iteration)
+                    print("R2= %.1f "%rsq_max)
+                    print("Sum of squared residuals= %.1f"%ss_residuals_min)
 
                 if plot:
                     import matplotlib.pyplot as plt
                     fig, ax = plt.subplots()
                     ax.plot(ss_residuals)
-                    ax.set_xlabel("Iteration #")
+                    ax.set_xlabel("Error check #")
                     ax.set_ylabel(r"$\sum{(\hat{y} - y)^2}$")
                 # Break out here, because this means that not enough
                 # improvement has happened recently
+                if return_info:
+                    return h_best, dict(ss_residuals=np.array(ss_residuals),
+                                        n_iterations=n_iterations,
+                                        iterations=iteration,
+                                        time=time.time() - t_start)
                 return h_best
-            error_checks += 1
         iteration += 1
 
 
@@ -7,6 +7,7 @@ This module is used to simulate DWI data from ODFs, or from fiber groups
 import numpy as np
 
 import tensor as ozt
+import utils as ozu
 
 
 # Global constants for this module:
@@ -156,6 +157,106 @@ class Volume(object):
         raise NotImplementedError
 
 
+def multi_shell_volume(shape, n_dirs=30, bvals=(1000, 2000, 3000), n_b0=2,
+                       n_fibers=2, iso=0.2, S0=1000, snr=None, seed=None,
+                       axial_diffusivity=AD, radial_diffusivity=RD):
+    """
+    Simulate a volume of multi-shell DWI data, with a random configuration of
+    fibers crossing through each voxel
+
+    Parameters
+    ----------
+    shape: tuple
+        The spatial dimensions of the volume.
+
+    n_dirs: int
+        The number of directions measured in each shell (one of the sets of
+        points in the camino_pts directory, see `osmosis.utils.get_camino_pts`)
+
+    bvals: sequence of floats
+        The b value of each shell.
+
+    n_b0: int
+        The number of b=0 measurements.
+
+    n_fibers: int
+        How many fibers cross through each voxel. Their directions are drawn
+        uniformly on the sphere and their weights uniformly between 0.5 and 1.
+
+    iso: float
+        The weight of the isotropic component, relative to the total weight of
+        the fibers.
+
+    S0: float
+        The signal in the b=0 measurements.
+
+    snr: float, optional
+        If provided, Rician noise with a standard deviation of S0/snr is added
+        to the signal.
+
+    seed: int, optional
+        The seed of the random number generator, for repeatable volumes.
+
+    axial_diffusivity, radial_diffusivity: float
+        The diffusivities of the response function of a single fiber.
+
+    Returns
+    -------
+    data: array (shape + (n_b0 + n_dirs * len(bvals),))
+
+    bvecs: array (3, n_b0 + n_dirs * len(bvals))
+        The b=0 measurements come first and have all-zero bvecs.
+
+    bvals: array (n_b0 + n_dirs * len(bvals),)
+        In the units of the input (not scaled).
+    """
+    prng = np.random.RandomState(seed)
+    dirs = ozu.get_camino_pts(n_dirs)
+    # get_camino_pts flips a random half of the points, so flip them all back
+    # to one hemisphere, to get the same bvecs for the same seed:
+    dirs = np.where(dirs[2] < 0, -dirs, dirs)
+    n_shells = len(bvals)
+    dw_bvecs = np.hstack([dirs] * n_shells)
+    dw_bvals = np.repeat(np.asarray(bvals, dtype=float), n_dirs)
+
+    n_vox = int(np.prod(shape))
+    fiber_dirs = prng.randn(n_vox, n_fibers, 3)
+    fiber_dirs /= np.sqrt(np.sum(fiber_dirs ** 2, -1))[..., None]
+    weights = 0.5 + 0.5 * prng.rand(n_vox, n_fibers)
+
+    # All the voxels at once. The ADC of a fiber's (axially symmetric) tensor
+    # in a direction g is g' Q g = rd + (ad - rd) (g . v)^2, which depends
+    # only on the angle between g and the fiber direction v:
+    scaled_bvals = dw_bvals / SCALE_FACTOR
+    data = np.empty((n_vox, n_b0 + dw_bvals.shape[0]))
+    data[:, :n_b0] = S0
+    for start in xrange(0, n_vox, 1000):
+        block = slice(start, start + 1000)
+        cos_sq = np.dot(fiber_dirs[block], dw_bvecs) ** 2
+        adc = (radial_diffusivity +
+               (axial_diffusivity - radial_diffusivity) * cos_sq)
+        signal = S0 * np.sum(weights[block][..., None] *
+                             np.exp(-scaled_bvals * adc), 1)
+        sum_weights = np.sum(weights[block], -1)
+        if iso:
+            # The iso component has the mean diffusivity of the tensor:
+            md = (axial_diffusivity + 2 * radial_diffusivity) / 3.
+            vox_iso = iso * sum_weights
+            signal += (vox_iso[:, None] *
+                       ozt.stejskal_tanner(S0, scaled_bvals, md))
+            sum_weights = sum_weights + vox_iso
+        data[block, n_b0:] = signal / sum_weights[:, None]
+
+    if snr is not None:
+        sigma = S0 / float(snr)
+        data = np.sqrt((data + sigma * prng.randn(*data.shape)) ** 2 +
+                       (sigma * prng.randn(*data.shape)) ** 2)
+
+    bvecs = np.hstack([np.zeros((3, n_b0)), dw_bvecs])
+    bvals = np.hstack([np.zeros(n_b0), dw_bvals])
+    return data.reshape(tuple(shape) + (data.shape[-1],)), bvecs, bvals
+
+
 
 def signal_1d(theta, b, fiber_weights, d_para, d_ortho, phi, iso_weights,
               d_iso):  
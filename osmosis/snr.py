@@ -1,11 +1,15 @@
 import numpy as np
-import osmosis.viz.mpl as mpl
 import nibabel as nib
 import scipy.stats as stats
-import matplotlib.pyplot as plt
-import matplotlib
 from scipy.special import gamma
 
+import osmosis.lazy as ozl
+
+# Plotting is only imported when it's first used:
+mpl = ozl.lazy_import('osmosis.viz.mpl')
+plt = ozl.lazy_import('matplotlib.pyplot')
+cm = ozl.lazy_import('matplotlib.cm')
+
 def separate_bvals(bvals, mode = None, factor=1000.):
     """
     Separates b values into groups with similar values
@@ -293,7 +297,7 @@ def display(data):
     snr_data: 3 dimensional array
         SNR at each voxel
     """
-    fig = mpl.mosaic(data, cmap=matplotlib.cm.bone)
+    fig = mpl.mosaic(data, cmap=cm.bone)
     fig.set_size_inches([20,10])
 
     return mean_snr
\ No newline at end of file
@@ -5,6 +5,7 @@ Some functions that call to sph_cc in osmosis utilities.
 """
 
 import osmosis.utils as ozu
+import osmosis.precision as prc
 import numpy as np
 import os
 import itertools
@@ -58,10 +59,40 @@ def sph_cc_ineq(cod_single_mod, cod_multi_mod, bvals, single_thresh, multi_thres
                         (cod_multi_mod > multi_thresh - tol/2))
         
     return np.squeeze(inds), b_inds, all_b_inds
-    
+
+def _sph_cc_pairs(vol_b_list, bvecs, mask, b_inds, all_b_inds, vox_idx,
+                  vol_mp_single = None):
+    """
+    Helper function to get the (mirrored) model parameters in the chosen voxels
+    and the (mirrored) bvecs of each pair of fODFs to compare: either all the
+    combinations of b values, or the single fODF with each of the b values.
+
+    Returns
+    -------
+    pairs: list
+        (data1, data2, vertices1, vertices2) for each comparison, with the data
+        in arrays of shape (n_vox, n).
+    combos: list
+        The combinations of b values (None if vol_mp_single is given)
+    """
+    mask_idx = np.where(mask)
+    mirrored = [prc.mirror(vol_b_list[ii][mask_idx][vox_idx],
+                           bvecs[:, b_inds[ii+1]])
+                for ii in np.arange(len(vol_b_list))]
+    if vol_mp_single is None:
+        combos = list(itertools.combinations(np.arange(len(vol_b_list)), 2))
+        pairs = [mirrored[c0] + mirrored[c1] for c0, c1 in combos]
+    else:
+        combos = None
+        single = prc.mirror(vol_mp_single[mask_idx][vox_idx],
+                            bvecs[:, all_b_inds])
+        pairs = [single + this_mirrored for this_mirrored in mirrored]
+    # Reorder to (data1, data2, vertices1, vertices2):
+    return [(d1, d2, v1, v2) for d1, v1, d2, v2 in pairs], combos
+
 def across_sph_cc(vol_b_list, bvals, bvecs, mask, cod_single_mod = None, cod_multi_mod = None,
                   single_thresh = None, multi_thresh = None, idx = None, vol_mp_single = None,
-                  tol = 0.1, n = 20):
+                  tol = 0.1, n = 20, ri = None):
     """
     Calculates the spherical cross correlation at a certain index for all b values fit
     together and b values fit separately.
@@ -93,6 +124,9 @@ def across_sph_cc(vol_b_list, bvals, bvecs, mask, cod_single_mod = None, cod_mul
     n: int
         Integer indicating the number of directions to divide by for spherical
         cross-correlation
+    ri: int
+        Index into the voxels within the COD (in)equality to use when idx is
+        not given. Chosen at random if this is not given either.
     
     Returns
     -------
@@ -125,44 +159,16 @@ def across_sph_cc(vol_b_list, bvals, bvecs, mask, cod_single_mod = None, cod_mul
             ri = ri
         idx = inds[ri]
     
-    data_list = []
-    bvecs_b_list = []
+    # Just get the data (model parameters) and bvecs within the chosen voxel
+    # (idx) for each comparison and mirror them.
+    pairs, combos = _sph_cc_pairs(vol_b_list, bvecs, mask, b_inds,
+                                  all_b_inds, [idx],
+                                  vol_mp_single = vol_mp_single)
     deg_list = []
     cc_list = []
-    
-    pool = np.arange(len(vol_b_list))
-    
-    for ii in pool:
-        # Just get the data (model parameters) and bvecs within the chosen voxel (idx)
-        # for each b value and mirror them.
-        data_list.append(np.concatenate((vol_b_list[ii][np.where(mask)][idx],
-                                         vol_b_list[ii][np.where(mask)][idx]), -1))
-        bvecs_b_list.append(np.squeeze(np.concatenate((bvecs[:, b_inds[ii+1]],
-                                           -1*bvecs[:, b_inds[ii+1]]), -1)).T)
-    if vol_mp_single is None:
-        # Make combinations of b values for spherical cross correlation between b values
-        combos = list(itertools.combinations(pool, 2))
-        this_iter = np.arange(len(combos))
-    else:
-        # No need for combos since comparing between the the single fODF and the multi fODF
-        combos = None
-        this_iter = np.arange(len(vol_b_list))
-        bvecs_all = np.squeeze(np.concatenate((bvecs[:, all_b_inds],
-                               -1*bvecs[:, all_b_inds]), -1)).T
-        data_all = np.concatenate((vol_mp_single[np.where(mask)][idx],
-                                   vol_mp_single[np.where(mask)][idx]), -1)
-    
-    for itr in this_iter:
-        if vol_mp_single is None:
-            # Inputs are data and bvecs from two different b values that you want to find the
-            # spherical cross-correlation between
-            inputs = [np.squeeze(data_list[combos[itr][0]]), np.squeeze(data_list[combos[itr][1]]),
-                      bvecs_b_list[combos[itr][0]], bvecs_b_list[combos[itr][1]]]
-        else:
-            # Inputs are the data and bvecs from one b value and the single fODF
-            inputs = [np.squeeze(data_all), np.squeeze(data_list[itr]), bvecs_all, bvecs_b_list[itr]]
+    for data1, data2, vertices1, vertices2 in pairs:
         # Put the inputs into the spherical cross-correlation function
-        deg, cc = ozu.sph_cc(*inputs, n = n)
+        deg, cc = ozu.sph_cc(data1[0], data2[0], vertices1, vertices2, n = n)
         deg_list.append(deg)
         cc_list.append(cc)
     
@@ -183,6 +189,10 @@ def all_across_sph_cc(vol_b_list, bvals, bvecs, mask, cod_single_mod = None,
     """
     Calculates the spherical cross correlation at different indices for all b values
     fit to gether and b values fit separately.
+
+    The angular binning of the pairs of bvecs is done once for each comparison
+    and the cross-correlation of all the voxels is then computed together (see
+    `osmosis.precision.SphericalCC`).
     
     Parameters
     ----------
@@ -227,26 +237,20 @@ def all_across_sph_cc(vol_b_list, bvals, bvecs, mask, cod_single_mod = None,
     else:
         # Just get all the indices.
         inds = np.arange(int(np.sum(mask)))
+        bval_list, b_inds, unique_b, rounded_bvals = ozu.separate_bvals(bvals)
+        all_b_inds = np.where(rounded_bvals != 0)
+    inds = np.atleast_1d(inds)
 
+    pairs, combos = _sph_cc_pairs(vol_b_list, bvecs, mask, b_inds,
+                                  all_b_inds, inds,
+                                  vol_mp_single = vol_mp_single)
     all_deg_list = []
     all_cc_list = []
-    for vol_b in np.arange(len(vol_b_list)):
-        # Preallocate the arrays in each list.
-        all_deg_list.append(np.zeros((len(inds), n-1)))
-        all_cc_list.append(np.zeros((len(inds), n-1)))
-        
-    for ai_count, ai in enumerate(inds):
-        # Call to the main spherical cc function between the fODFs of different b values
-        # or between the single fODF and the fODFs of other b values for each voxel.
-        [deg_list, cc_list, combos,
-        idx, cod_s, cod_m]= across_sph_cc(vol_b_list, bvals, bvecs, mask,
-                                          cod_single_mod = cod_single_mod,
-                                          cod_multi_mod = cod_multi_mod,
-                                          single_thresh = single_thresh,
-                                          multi_thresh = multi_thresh,
-                                          idx = ai)
-        for dli in np.arange(len(deg_list)):
-            all_deg_list[dli][ai_count] = deg_list[dli]
-            all_cc_list[dli][ai_count] = cc_list[dli]
+    for data1, data2, vertices1, vertices2 in pairs:
+        # The angular bins of the pairs of bvecs are the same in all voxels, so
+        # they are found once and all the voxels are done together:
+        engine = prc.SphericalCC(vertices1, vertices2, n = n)
+        all_deg_list.append(np.tile(engine.deg, (len(inds), 1)))
+        all_cc_list.append(engine(data1, data2))
         
-    return all_deg_list, all_cc_list
\ No newline at end of file
+    return all_deg_list, all_cc_list
@@ -0,0 +1,179 @@
+"""
+
+Real, antipodally symmetric spherical harmonics and convolution on the sphere
+
+The basis follows the conventions of mrtrix (see
+`osmosis.model.csd.SphericalHarmonicsModel.sph_harm_set`). Only even orders
+are used and the coefficients are ordered as: [0] Y(0,0), [1] Im {Y(2,2)},
+[2] Im {Y(2,1)}, [3] Y(2,0), [4] Re {Y(2,1)}, [5] Re {Y(2,2)}, [6] Im
+{Y(4,4)}, etc.
+
+Evaluating the basis in a set of directions is cached, so that all the models
+fit to the same measurement share a single copy. Only the most recently used
+basis sets are kept (see `BASIS_CACHE_SIZE`).
+
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from numpy.polynomial.legendre import leggauss
+from scipy.special import sph_harm, eval_legendre
+
+import dipy.core.geometry as geo
+
+import osmosis.instrument as ozi
+
+
+# How many basis sets to keep around:
+BASIS_CACHE_SIZE = 8
+
+# The cache of the basis sets, keyed by the directions and the maximal order,
+# least recently used first:
+_BASIS_CACHE = OrderedDict()
+_BASIS_LOCK = threading.Lock()
+
+
+def sph_harm_orders(L):
+    """
+    The order (l) and degree (m) of each of the coefficients of an SH
+    expansion up to order L (inclusive).
+
+    Returns
+    -------
+    l, m : int arrays (n_coeffs,)
+    """
+    l = np.concatenate([order * np.ones(2 * order + 1, dtype=int)
+                        for order in range(0, int(round(L)) + 1, 2)])
+    m = np.concatenate([np.arange(-order, order + 1)
+                        for order in range(0, int(round(L)) + 1, 2)])
+    return l, m
+
+
+def n_coeffs(L):
+    """
+    The number of coefficients of an SH expansion up to order L:
+    (L + 1) (L + 2) / 2
+    """
+    L = int(round(L))
+    return (L + 1) * (L + 2) // 2
+
+
+def sph_harm_basis(bvecs, L):
+    """
+    The real SH basis set, evaluated in each of the directions in bvecs.
+
+    Parameters
+    ----------
+    bvecs : array (3, n)
+        Unit vectors.
+    L : int
+        The maximal order (inclusive).
+
+    Returns
+    -------
+    basis : array (n_coeffs, n)
+        The result is cached (and read-only), see `BASIS_CACHE_SIZE`.
+    """
+    bvecs = np.ascontiguousarray(bvecs, dtype=float)
+    L = int(round(L))
+    key = (bvecs.shape, bvecs.tobytes(), L)
+    with _BASIS_LOCK:
+        basis = _BASIS_CACHE.pop(key, None)
+        if basis is not None:
+            # Now the most recently used:
+            _BASIS_CACHE[key] = basis
+    ozi.cache_event('spherical_harmonics.sph_harm_basis', basis is not None)
+    if basis is not None:
+        return basis
+
+    r, theta, phi = geo.cart2sphere(bvecs[0], bvecs[1], bvecs[2])
+    l, m = sph_harm_orders(L)
+    # Note that scipy's sph_harm takes the degree first and the azimuth
+    # before the inclination:
+    Y = sph_harm(np.abs(m)[:, None], l[:, None], phi, theta)
+    # In negative degrees, take the imaginary part:
+    basis = np.where((m < 0)[:, None], np.imag(Y), np.real(Y))
+    basis.setflags(write=False)
+    with _BASIS_LOCK:
+        # Another thread might have put it there in the meantime:
+        basis = _BASIS_CACHE.setdefault(key, basis)
+        while len(_BASIS_CACHE) > BASIS_CACHE_SIZE:
+            _BASIS_CACHE.popitem(last=False)
+    return basis
+
+
+def zonal_coeffs(profile, L, n_points=100):
+    """
+    The coefficients of an axially symmetric function around the z axis in
+    the Y(l, 0) harmonics (its rotational harmonics).
+
+    Parameters
+    ----------
+    profile : callable
+        The function, of the cosine of the angle to the axis.
+    L : int
+        The maximal order (inclusive).
+    n_points : int, optional
+        The number of points in the Gauss-Legendre quadrature.
+
+    Returns
+    -------
+    coeffs : array (L / 2 + 1,)
+        For the orders 0, 2, ..., L.
+    """
+    x, w = leggauss(n_points)
+    f = profile(x)
+    orders = np.arange(0, int(round(L)) + 1, 2)
+    norm = np.sqrt((2 * orders + 1) / (4 * np.pi))
+    return 2 * np.pi * norm * np.dot(eval_legendre(orders[:, None], x), w * f)
+
+
+def convolution_kernel(rh_coeffs, L):
+    """
+    The factor that multiplies each SH coefficient of a function on the
+    sphere when it is convolved with an axially symmetric kernel (the
+    Funk-Hecke theorem).
+
+    Parameters
+    ----------
+    rh_coeffs : array
+        The Y(l, 0) coefficients of the kernel (see `zonal_coeffs`), for the
+        orders 0, 2, ... Orders that are missing are set to 0.
+    L : int
+        The maximal order of the function to convolve.
+
+    Returns
+    -------
+    kernel : array (n_coeffs,)
+    """
+    l, m = sph_harm_orders(L)
+    rh_coeffs = np.asarray(rh_coeffs, dtype=float)
+    rh = np.zeros(int(round(L)) // 2 + 1)
+    n = min(len(rh), len(rh_coeffs))
+    rh[:n] = rh_coeffs[:n]
+    return np.sqrt(4 * np.pi / (2 * l + 1)) * rh[l // 2]
+
+
+def zonal_rotations(bvecs, rh_coeffs):
+    """
+    An axially symmetric function aligned with each of the directions in
+    bvecs, evaluated in all of them.
+
+    Parameters
+    ----------
+    bvecs : array (3, n)
+    rh_coeffs : array
+        The Y(l, 0) coefficients of the function, for the orders 0, 2, ...
+
+    Returns
+    -------
+    rotations : array (n, n)
+        Row i is the function aligned with bvecs[:, i].
+    """
+    bvecs = np.asarray(bvecs, dtype=float)
+    cos = np.clip(np.dot(bvecs.T, bvecs), -1, 1)
+    orders = 2 * np.arange(len(rh_coeffs))
+    norm = np.sqrt((2 * orders + 1) / (4 * np.pi))
+    return np.einsum('l,lij->ij', norm * np.asarray(rh_coeffs),
+                     eval_legendre(orders[:, None, None], cos))
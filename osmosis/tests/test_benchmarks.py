@@ -0,0 +1,54 @@
+import os
+import tempfile
+
+import numpy.testing as npt
+
+import osmosis.benchmarks as ozb
+
+
+def test_run_case():
+    for isolate in [False, True]:
+        result = ozb.run_case('TensorModel.fit', (2, 2, 1), repeat=2,
+                              isolate=isolate)
+        npt.assert_(not 'error' in result)
+        npt.assert_equal(result['n_items'], 4)
+        npt.assert_equal(len(result['times']), 2)
+        npt.assert_equal(result['best'], min(result['times']))
+        npt.assert_(result['peak_rss'] >= result['peak_rss_delta'] >= 0)
+        npt.assert_('TensorModel.fit' in result['breakdown'])
+
+    npt.assert_raises(ValueError, ozb.run_case, 'NoSuchModel.fit')
+
+
+def test_run_and_compare():
+    fd, out_file = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        results = ozb.run(['TensorModel*', 'io.pdb'], scales=[(2, 2, 1)],
+                          repeat=1, out_file=out_file, verbose=False)
+        read = ozb.read_results(out_file)
+    finally:
+        os.remove(out_file)
+    npt.assert_equal([r['name'] for r in results['results']],
+                     ['TensorModel.fit', 'io.pdb'])
+    npt.assert_('commit' in results['info'])
+    npt.assert_equal(read['results'][1]['unit'], 'fibers')
+
+    # Halve the throughput of one of the cases:
+    read['results'][0]['items_per_s'] /= 2
+    comparison = ozb.compare(results, read)
+    npt.assert_equal(len(comparison), 2)
+    npt.assert_almost_equal(comparison[0]['ratio'], 0.5)
+    npt.assert_(comparison[0]['regression'])
+    npt.assert_(not comparison[1]['regression'])
+
+
+def test_run_import():
+    result = ozb.run_import('osmosis.model.sparse_deconvolution', repeat=1)
+    npt.assert_(not 'error' in result)
+    npt.assert_equal(result['unit'], 'imports')
+    npt.assert_(result['n_modules'] > 0)
+    # The optional dependencies are only imported when they are used:
+    npt.assert_equal(result['optional_modules'], [])
+    result = ozb.run_import('osmosis.no_such_module', repeat=1)
+    npt.assert_('error' in result)
@@ -19,6 +19,32 @@ def test_subsample():
     # optionally, you can provide elec_points as input. Here we test this with
     # the same points
     sub_sample = ozb.subsample(bvecs, 100, elec_points=ozu.get_camino_pts(100).T)
+    npt.assert_equal(sub_sample[0].shape, (3, 100))
+    npt.assert_equal(len(np.unique(sub_sample[1])), 100)
+    npt.assert_equal(sub_sample[0], bvecs[:, sub_sample[1]])
+
+    npt.assert_raises(ValueError, ozb.subsample, bvecs, 200)
+
+
+def test_subsample_batch():
+    """
+    Test generating many sub-samples at once
+    """
+    bvecs = ozu.get_camino_pts(150)
+    sample_bvecs, bvec_idx = ozb.subsample_batch(bvecs, 30, 20, seed=1)
+    npt.assert_equal(sample_bvecs.shape, (20, 3, 30))
+    npt.assert_equal(bvec_idx.shape, (20, 30))
+    for ii in range(20):
+        npt.assert_equal(len(np.unique(bvec_idx[ii])), 30)
+        npt.assert_equal(sample_bvecs[ii], bvecs[:, bvec_idx[ii]])
+
+    # The first sub-sample is the one you get on its own with the same seed:
+    sample, idx = ozb.subsample(bvecs, 30, seed=1)
+    npt.assert_equal(idx, bvec_idx[0])
+
+    # Sub-sampling all of them just shuffles them:
+    sample_bvecs, bvec_idx = ozb.subsample_batch(bvecs, 150, 3, seed=2)
+    npt.assert_equal(np.sort(bvec_idx, -1), np.tile(np.arange(150), (3, 1)))
     
 def test_dyad():
     """
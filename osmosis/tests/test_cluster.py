@@ -0,0 +1,57 @@
+import numpy as np
+import numpy.testing as npt
+
+import osmosis.cluster as ozc
+
+
+def _clustered_data(centers, prng, n_per=30, noise=0.05):
+    """
+    Helper function to make points scattered around a few unit vectors
+    """
+    data = np.vstack([c + noise * prng.randn(n_per, 3) for c in centers])
+    return data / np.sqrt(np.sum(data ** 2, -1))[:, np.newaxis]
+
+
+# Centers in the positive-y hemisphere, which is where spkm flips the data to:
+CENTERS = np.array([[1, 1, 0], [0, 1, 1], [-1, 1, 0]]) / np.sqrt(2)
+
+
+def test_spkm():
+    prng = np.random.RandomState(30)
+    data = _clustered_data(CENTERS, prng)
+    mu, y_n, sse = ozc.spkm(data, 3, seeds=data[[0, 30, 60]])
+    # Each group of points gets its own cluster:
+    for ii in range(3):
+        npt.assert_equal(len(np.unique(y_n[ii * 30:(ii + 1) * 30])), 1)
+    npt.assert_equal(len(np.unique(y_n)), 3)
+    # And the centroids are the centers:
+    npt.assert_almost_equal(mu[y_n[[0, 30, 60]]], CENTERS, decimal=1)
+    npt.assert_(sse < 1)
+
+    # With k-means++ and a few restarts, we get there without seeds:
+    mu, y_n, sse2 = ozc.spkm(data, 3, init='k-means++', n_init=5, seed=0)
+    npt.assert_almost_equal(sse, sse2)
+
+    npt.assert_raises(ValueError, ozc.spkm, data, 3, init='foo')
+
+
+def test_spkm_batch():
+    prng = np.random.RandomState(31)
+    data = np.array([_clustered_data(CENTERS[:2], prng) for ii in range(4)])
+    weights = prng.rand(*data.shape[:2])
+    mask = np.ones(data.shape[:2], dtype=bool)
+    # The last problem has fewer data points:
+    mask[-1, 50:] = False
+    seeds = data[:, [0, 30]]
+    mu, y_n, sse = ozc.spkm_batch(data, 2, weights=weights, mask=mask,
+                                  seeds=seeds)
+    npt.assert_equal(mu.shape, (4, 2, 3))
+    npt.assert_equal(y_n[-1, 50:], -1)
+    # Each problem gives the same answer as on its own:
+    for ii in range(4):
+        this_mu, this_y_n, this_sse = ozc.spkm(data[ii][mask[ii]], 2,
+                                               weights=weights[ii][mask[ii]],
+                                               seeds=seeds[ii])
+        npt.assert_almost_equal(mu[ii], this_mu)
+        npt.assert_equal(y_n[ii][mask[ii]], this_y_n)
+        npt.assert_almost_equal(sse[ii], this_sse)
@@ -40,3 +40,96 @@ def test_fodf_emd():
     emd2 = pn.fODF_EMD(fodf1, fodf2, bvecs1=bvecs, dist=angles)
 
     npt.assert_equal(emd1, emd2)
+
+
+def test_fodf_emd_batch():
+    """
+    Test the batched EMD against the one-pair-at-a-time EMD
+    """
+    bvecs = ozu.get_camino_pts(150)
+    prng = np.random.RandomState(42)
+    n_vox = 30
+    fodf1 = prng.rand(n_vox, bvecs.shape[-1])
+    fodf2 = prng.rand(n_vox, bvecs.shape[-1])
+    # Sparse, like SFM weights:
+    fodf1[fodf1 < 0.9] = 0
+    fodf2[fodf2 < 0.9] = 0
+    # A voxel with an empty fODF gets a nan:
+    fodf2[3] = 0
+
+    emd_batch = pn.fODF_EMD_batch(fodf1, fodf2, bvecs1=bvecs, bvecs2=bvecs,
+                                  n_jobs=3, block_size=7)
+    npt.assert_equal(emd_batch.shape, (n_vox,))
+    npt.assert_(np.isnan(emd_batch[3]))
+
+    for vox in range(n_vox):
+        if vox == 3:
+            continue
+        idx1 = np.where(fodf1[vox] > 0)[0]
+        idx2 = np.where(fodf2[vox] > 0)[0]
+        emd1 = pn.fODF_EMD(fodf1[vox][idx1], fodf2[vox][idx2],
+                           bvecs1=bvecs[:, idx1], bvecs2=bvecs[:, idx2])
+        npt.assert_almost_equal(emd_batch[vox], emd1, decimal=5)
+
+    # The shape of the input (except for the last dimension) is kept:
+    emd_3d = pn.fODF_EMD_batch(fodf1.reshape(2, 15, -1),
+                               fodf2.reshape(2, 15, -1),
+                               bvecs1=bvecs, bvecs2=bvecs, n_jobs=1)
+    npt.assert_equal(emd_3d, emd_batch.reshape(2, 15))
+
+
+def test_emd_large_signature():
+    """
+    Signatures are no longer limited to 500 features
+    """
+    n_features = 600
+    xx = np.linspace(0, 1, n_features)
+    cost = np.abs(xx[:, None] - xx[None])
+
+    # Translating a histogram by k bins costs k bins' distance:
+    k = 7
+    weights1 = np.zeros((1, n_features))
+    weights2 = np.zeros((1, n_features))
+    weights1[0, :-k] = 1
+    weights2[0, k:] = 1
+    out = np.empty(1)
+    emd.emd_batch(weights1, weights2, cost, out)
+    npt.assert_almost_equal(out, [k * (xx[1] - xx[0])], decimal=5)
+
+    # On a line, the EMD between distributions is the area between their
+    # cumulative distributions:
+    prng = np.random.RandomState(32)
+    weights1 = prng.rand(3, n_features)
+    weights2 = prng.rand(3, n_features)
+    weights1 /= np.sum(weights1, -1)[:, None]
+    weights2 /= np.sum(weights2, -1)[:, None]
+    out = np.empty(3)
+    emd.emd_batch(weights1, weights2, cost, out)
+    cdf_diff = np.abs(np.cumsum(weights1, -1) - np.cumsum(weights2, -1))
+    npt.assert_almost_equal(out, np.sum(cdf_diff[:, :-1] * np.diff(xx), -1),
+                            decimal=5)
+
+    # And the same distribution is at no distance from itself:
+    emd.emd_batch(weights1, weights1, cost, out)
+    npt.assert_almost_equal(out, [0, 0, 0])
+
+
+def test_sinkhorn_emd():
+    """
+    The Sinkhorn approximation is close to the exact EMD
+    """
+    bvecs = ozu.get_camino_pts(150)
+    prng = np.random.RandomState(42)
+    fodf1 = prng.rand(30, bvecs.shape[-1])
+    fodf2 = prng.rand(30, bvecs.shape[-1])
+    fodf1[fodf1 < 0.9] = 0
+    fodf2[fodf2 < 0.9] = 0
+    fodf2[3] = 0
+
+    exact = pn.fODF_EMD_batch(fodf1, fodf2, bvecs1=bvecs, bvecs2=bvecs)
+    approx = pn.fODF_EMD_batch(fodf1, fodf2, bvecs1=bvecs, bvecs2=bvecs,
+                               solver="sinkhorn")
+    npt.assert_(np.isnan(approx[3]))
+    npt.assert_array_almost_equal(approx, exact, decimal=2)
+    npt.assert_raises(ValueError, pn.fODF_EMD_batch, fodf1, fodf2, bvecs,
+                      bvecs, None, None, 500, "simplex")
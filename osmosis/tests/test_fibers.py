@@ -263,3 +263,14 @@ def test_FiberGroup_unique_coords():
                  mtf.Fiber([[x2,x1],[y2,y1],[z2,z1]])]).unique_coords,
             np.array([[x1,x2],[y1,y2],[z1,z2]]),decimal=4)
 
+
+def test_FiberGroup_iter_chunks():
+    fg = mtf.FiberGroup([mtf.Fiber(np.random.randn(3, 10) + ii,
+                                   fiber_stats=dict(a=ii))
+                         for ii in range(5)], affine=np.eye(4))
+    chunks = list(fg.iter_chunks(2))
+    npt.assert_equal([c.n_fibers for c in chunks], [2, 2, 1])
+    npt.assert_equal(np.hstack([c.coords for c in chunks]), fg.coords)
+    npt.assert_equal(np.hstack([c.fiber_stats['a'] for c in chunks]),
+                     fg.fiber_stats['a'])
+    npt.assert_equal(chunks[0].affine, fg.affine)
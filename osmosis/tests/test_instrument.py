@@ -0,0 +1,112 @@
+import json
+import StringIO
+import threading
+
+import numpy as np
+import numpy.testing as npt
+
+import osmosis.descriptors as desc
+import osmosis.instrument as ozi
+import osmosis.spherical_harmonics as sph
+import osmosis.utils as ozu
+
+
+class _Computation(desc.ResetMixin):
+    def __init__(self):
+        self.mask = np.ones((2, 3, 4), dtype=bool)
+        self.mask[0] = False
+
+    @desc.auto_attr
+    def inner(self):
+        return np.arange(10)
+
+    @desc.auto_attr
+    def outer(self):
+        return self.inner.sum()
+
+
+class _Threaded(desc.ResetMixin):
+    @desc.auto_attr
+    def outer(self):
+        # Computed in another thread, while this one is still running:
+        comp = _Computation()
+        thread = threading.Thread(target=lambda: comp.inner)
+        thread.start()
+        thread.join()
+        return comp.inner.sum()
+
+
+def test_registry_sink():
+    registry = ozi.add_sink(ozi.RegistrySink())
+    try:
+        comp = _Computation()
+        npt.assert_equal(comp.outer, 45)
+        # The second time around, it's a normal attribute:
+        npt.assert_equal(comp.outer, 45)
+    finally:
+        ozi.remove_sink(registry)
+
+    npt.assert_equal([r['name'] for r in registry.records],
+                     ['_Computation.inner', '_Computation.outer'])
+    inner, outer = registry.records
+    npt.assert_equal(inner['parent'], '_Computation.outer')
+    npt.assert_equal(outer['parent'], None)
+    npt.assert_equal(outer['n_vox'], 12)
+    npt.assert_(outer['wall_time'] >= inner['wall_time'] >= 0)
+    summary = registry.summary()
+    npt.assert_equal(summary['_Computation.outer']['n_compute'], 1)
+    npt.assert_equal(summary['_Computation.outer']['misses'], 1)
+
+    # Nothing is recorded once the sink is removed:
+    comp.reset()
+    comp.outer
+    npt.assert_equal(len(registry.records), 2)
+    npt.assert_(not ozi.is_enabled())
+
+
+def test_threads():
+    registry = ozi.add_sink(ozi.RegistrySink())
+    try:
+        npt.assert_equal(_Threaded().outer, 45)
+    finally:
+        ozi.remove_sink(registry)
+    # The computation in the other thread doesn't get this one as its parent:
+    npt.assert_equal([(r['name'], r['parent']) for r in registry.records],
+                     [('_Computation.inner', None), ('_Threaded.outer', None)])
+
+
+def test_cache_and_progress():
+    registry = ozi.add_sink(ozi.RegistrySink(progress=True))
+    try:
+        bvecs = np.eye(3) + 0.1
+        bvecs /= np.sqrt(np.sum(bvecs ** 2, 0))
+        sph.sph_harm_basis(bvecs, 2)
+        sph.sph_harm_basis(bvecs, 2)
+        prog_bar = ozu.ProgressBar(3)
+        for i in range(3):
+            prog_bar.animate(i, f_name='loop')
+    finally:
+        ozi.remove_sink(registry)
+
+    cache = [r['cache'] for r in registry.records if r['event'] == 'cache']
+    npt.assert_equal(cache[-1], 'hit')
+    summary = registry.summary()
+    npt.assert_equal(summary['spherical_harmonics.sph_harm_basis']['hits'],
+                     len(cache) - 1)
+    progress = [(r['done'], r['total']) for r in registry.records
+                if r['event'] == 'progress']
+    npt.assert_equal(progress, [(1, 3), (2, 3), (3, 3)])
+
+
+def test_json_lines_sink():
+    f = StringIO.StringIO()
+    sink = ozi.add_sink(ozi.JSONLinesSink(f))
+    try:
+        _Computation().outer
+    finally:
+        ozi.remove_sink(sink)
+    records = [json.loads(line) for line in f.getvalue().splitlines()]
+    npt.assert_equal([r['name'] for r in records],
+                     ['_Computation.inner', '_Computation.outer'])
+    npt.assert_equal(records[1]['event'], 'compute')
+    npt.assert_raises(ValueError, ozi.add_sink, object())
@@ -74,6 +74,37 @@ def test_pdb_from_fg():
     
     npt.assert_equal(fg2.fiber_stats, fg.fiber_stats)
 
+def test_fg_chunks_from_pdb():
+    """
+    Test streaming a pdb file in chunks of fibers
+    """
+    fibers = []
+    for ii in range(5):
+        n_nodes = 10 + ii
+        fibers.append(mtf.Fiber(np.random.randn(3, n_nodes),
+                                fiber_stats=dict(foo=ii, bar=2 * ii),
+                                node_stats=dict(ecc=np.random.rand(n_nodes))))
+    fg = mtf.FiberGroup(fibers)
+    file_name = os.path.join(tempfile.gettempdir(), 'fg_chunks.pdb')
+    mio.pdb_from_fg(fg, file_name)
+
+    chunks = list(mio.fg_chunks_from_pdb(file_name, chunk_size=2))
+    npt.assert_equal([c.n_fibers for c in chunks], [2, 2, 1])
+    # The chunks are named after the file, like the whole fiber-group:
+    npt.assert_equal([c.name for c in chunks], ['fg_chunks'] * 3)
+    npt.assert_equal(mio.fg_from_pdb(file_name, verbose=False).name,
+                     'fg_chunks')
+    fibers2 = [f for c in chunks for f in c.fibers]
+    for f1, f2 in zip(fg.fibers, fibers2):
+        npt.assert_almost_equal(f1.coords, f2.coords)
+        npt.assert_almost_equal(f1.node_stats['ecc'], f2.node_stats['ecc'])
+        npt.assert_equal(f1.fiber_stats, f2.fiber_stats)
+
+    # The dispatcher gives the same chunks for a file and a FiberGroup:
+    for c1, c2 in zip(mio.fg_chunks(file_name, 2), mio.fg_chunks(fg, 2)):
+        npt.assert_almost_equal(c1.coords, c2.coords)
+
+    
 def test_fg_from_trk():
     """
     Test reading of trk files into a FiberGroup
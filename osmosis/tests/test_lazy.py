@@ -0,0 +1,28 @@
+import sys
+
+import numpy.testing as npt
+
+import osmosis.lazy as ozl
+
+
+def test_lazy_import():
+    # A module that nothing else in here imports:
+    sys.modules.pop('colorsys', None)
+    colorsys = ozl.lazy_import('colorsys')
+    npt.assert_(isinstance(colorsys, ozl.LazyModule))
+    npt.assert_(not ozl.is_loaded(colorsys))
+    npt.assert_equal(colorsys.rgb_to_hsv(1, 0, 0), (0, 1, 1))
+    npt.assert_(ozl.is_loaded(colorsys))
+    # Once it's been imported, we get the module itself:
+    npt.assert_(ozl.lazy_import('colorsys') is sys.modules['colorsys'])
+
+    # Missing modules only fail when they are used:
+    missing = ozl.lazy_import('osmosis_no_such_module')
+    npt.assert_raises(ImportError, getattr, missing, 'anything')
+
+
+def test_has_module():
+    npt.assert_(ozl.has_module('numpy'))
+    npt.assert_(ozl.has_module('osmosis.model.base'))
+    npt.assert_(not ozl.has_module('osmosis_no_such_module'))
+    npt.assert_(not ozl.has_module('osmosis.no_such_module'))
@@ -0,0 +1,75 @@
+import numpy as np
+import numpy.testing as npt
+import scipy.optimize as opt
+
+import osmosis.levmar as levmar
+
+
+def _exp_decay(params, x):
+    """
+    a * exp(-b * x) + c, with b >= 0
+    """
+    a, b, c = [p[:, None] for p in params.T]
+    e = np.exp(-b * x)
+    pred = a * e + c
+    jac = np.stack([e, -a * x * e, np.ones_like(e)], -1)
+    pred[params[:, 1] < 0] = np.inf
+    return pred, jac
+
+
+def _no_decrease(params, n):
+    """
+    A model whose prediction doesn't depend on its parameter (but claims to)
+    """
+    return (np.zeros((params.shape[0], n)),
+            np.ones((params.shape[0], n, 1)))
+
+
+def test_levenberg_marquardt():
+    prng = np.random.RandomState(1)
+    x = np.linspace(0, 5, 40)
+    true_params = np.vstack([prng.rand(25) + 1, prng.rand(25) + 0.5,
+                             prng.rand(25)]).T
+    data = _exp_decay(true_params, x)[0] + 0.01 * prng.randn(25, 40)
+    params, info = levmar.levenberg_marquardt(_exp_decay, [1, 1, 0], data,
+                                              args=(x,), ftol=1e-10)
+    npt.assert_(np.all(info['converged']))
+    npt.assert_(np.all(info['n_iterations'] > 0))
+    for vox in range(25):
+        ref = opt.leastsq(lambda p: _exp_decay(p[None], x)[0][0] - data[vox],
+                          [1, 1, 0])[0]
+        npt.assert_almost_equal(params[vox], ref, decimal=4)
+        npt.assert_almost_equal(info['ssr'][vox],
+                                np.sum((_exp_decay(ref[None], x)[0] -
+                                        data[vox]) ** 2))
+
+    # Infeasible starting points don't go anywhere:
+    params, info = levmar.levenberg_marquardt(_exp_decay, [1, -1, 0],
+                                              data[:2], args=(x,))
+    npt.assert_equal(params, [[1, -1, 0], [1, -1, 0]])
+    npt.assert_(not np.any(info['converged']))
+    npt.assert_(not np.any(info['stalled']))
+
+    # In blocks (and in parallel):
+    blocks = levmar.fit_blocks(_exp_decay, [1, 1, 0], data, args=(x,),
+                               block_size=10, n_jobs=2)
+    threads = levmar.fit_blocks(_exp_decay, [1, 1, 0], data, args=(x,),
+                                block_size=10, n_jobs=2, backend='thread')
+    serial = levmar.fit_blocks(_exp_decay, [1, 1, 0], data, args=(x,),
+                               block_size=10, n_jobs=1)
+    whole = levmar.levenberg_marquardt(_exp_decay, [1, 1, 0], data,
+                                       args=(x,))
+    for this in [blocks, threads, serial]:
+        npt.assert_almost_equal(this[0], whole[0])
+        npt.assert_equal(this[1]['n_iterations'], whole[1]['n_iterations'])
+    npt.assert_(np.all(whole[1]['converged']))
+    npt.assert_(not np.any(whole[1]['stalled']))
+
+    # When no step helps, the damping blows up and the fit stalls. The
+    # rejected steps get very small, but that doesn't count as converging:
+    params, info = levmar.levenberg_marquardt(_no_decrease, [1.],
+                                              np.ones((3, 40)), args=(40,))
+    npt.assert_(np.all(info['n_iterations'] > 0))
+    npt.assert_(np.all(info['n_iterations'] < 200))
+    npt.assert_(not np.any(info['converged']))
+    npt.assert_(np.all(info['stalled']))
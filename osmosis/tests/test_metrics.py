@@ -0,0 +1,83 @@
+import numpy as np
+import numpy.testing as npt
+import scipy.stats as stats
+
+import osmosis.utils as ozu
+import osmosis.metrics as metrics
+
+
+def test_pearson_r():
+    prng = np.random.RandomState(1)
+    x = prng.rand(7, 20)
+    y = prng.rand(7, 20)
+    y[3] = 1
+    r = metrics.pearson_r(x, y, block_size=3)
+    for vox in range(7):
+        if vox == 3:
+            npt.assert_(np.isnan(r[vox]))
+        else:
+            npt.assert_almost_equal(r[vox], stats.pearsonr(x[vox], y[vox])[0])
+
+    # Any number of leading dimensions:
+    r = metrics.pearson_r(x.reshape(7, 1, 20), y.reshape(7, 1, 20))
+    npt.assert_equal(r.shape, (7, 1))
+
+
+def test_linregress():
+    prng = np.random.RandomState(2)
+    x = prng.rand(5, 30)
+    y = 2 * x + prng.rand(5, 30)
+    slope, intercept, r = metrics.linregress(x, y, block_size=2)
+    for vox in range(5):
+        npt.assert_almost_equal([slope[vox], intercept[vox], r[vox]],
+                                stats.linregress(x[vox], y[vox])[:3])
+
+
+def test_coeff_of_determination():
+    prng = np.random.RandomState(3)
+    data = prng.rand(6, 25)
+    model = data + 0.1 * prng.randn(6, 25)
+    data[2] = 5
+    cod = metrics.coeff_of_determination(data, model)
+    for vox in range(6):
+        if vox == 2:
+            npt.assert_(np.isnan(cod[vox]))
+        else:
+            npt.assert_almost_equal(cod[vox],
+                            ozu.coeff_of_determination(data[vox], model[vox]))
+
+
+def test_rmse():
+    prng = np.random.RandomState(4)
+    x = prng.rand(9, 15)
+    y = prng.rand(9, 15)
+    out = metrics.rmse(x, y, block_size=4)
+    npt.assert_almost_equal(out, [ozu.rmse(x[v], y[v]) for v in range(9)])
+
+
+def test_vector_angle():
+    prng = np.random.RandomState(5)
+    a = prng.randn(8, 3)
+    b = prng.randn(8, 3)
+    a[0] = 0
+    ang = metrics.vector_angle(a, b)
+    npt.assert_(np.isnan(ang[0]))
+    npt.assert_almost_equal(ang[1:],
+                            [ozu.vector_angle(a[v], b[v]) for v in range(1, 8)])
+
+    ang = metrics.vector_angle(a[1:], b[1:], antipodal=True)
+    npt.assert_(np.all(ang <= np.pi / 2))
+    npt.assert_almost_equal(metrics.vector_angle(a[1:], -a[1:],
+                                                 antipodal=True), 0)
+
+
+def test_rowwise_correlator():
+    npt.assert_equal(metrics.rowwise_correlator(stats.pearsonr, 0),
+                     metrics.pearson_r)
+    npt.assert_equal(metrics.rowwise_correlator(stats.pearsonr, 1), None)
+    npt.assert_equal(metrics.rowwise_correlator(np.corrcoef, 0), None)
+    prng = np.random.RandomState(6)
+    x = prng.rand(4, 10)
+    y = prng.rand(4, 10)
+    slope = metrics.rowwise_correlator(stats.linregress, 0)(x, y)
+    npt.assert_almost_equal(slope[0], stats.linregress(x[0], y[0])[0])
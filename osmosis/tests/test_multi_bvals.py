@@ -55,11 +55,11 @@ rd = {1000:0.5, 2000:0.5, 3000:0.5}
 mb = sfm.SparseDeconvolutionModelMultiB(data_t, bvecs_t, bvals_t, mask = mask_t,
                                         axial_diffusivity = ad,
                                         radial_diffusivity = rd, mean = "mean_model",
-                                        params_file = 'temp')
+                                        params_file = 'temp', verbose = False)
 mb_MD = sfm.SparseDeconvolutionModelMultiB(data_t, bvecs_t, bvals_t, mask = mask_t,
                                         axial_diffusivity = ad,
                                         radial_diffusivity = rd, mean = "MD",
-                                        params_file = 'temp')
+                                        params_file = 'temp', verbose = False)
 
 def test_response_function():
     rf_bvec = np.reshape(bvecs_t[:,4],(3,1))
@@ -84,7 +84,7 @@ def test_rotations():
         
         out_t[idx] = this_rot_t.predicted_signal(1)
         
-    npt.assert_equal(out_t, mb._calc_rotations(np.reshape(bvecs_t[:,4], (3,1)),
+    npt.assert_almost_equal(out_t, mb._calc_rotations(np.reshape(bvecs_t[:,4], (3,1)),
                                                bvals_scaled_t[4]/1000))
     
     return out_t
@@ -92,8 +92,8 @@ def test_rotations():
 def test_regressors():
     _, tensor_regressor_a, fit_to_a, _ = mb.regressors
 
-    fit_to_t = np.empty((np.sum(mask_t), len(bvals_scaled_t[3:])))
-    fit_to_means = np.empty((np.sum(mask_t), len(bval_ind_t[3:])))
+    fit_to_t = np.empty((int(np.sum(mask_t)), len(bvals_scaled_t[3:])))
+    fit_to_means = np.empty((int(np.sum(mask_t)), len(bval_ind_t[3:])))
 
     n_columns = len(bvals_scaled_t[np.where(bvals_scaled_t > 0)])
     tensor_regressor_t = np.empty((n_columns, n_columns))
@@ -165,3 +165,27 @@ def test_predict():
                             
         npt.assert_equal(abs(np.squeeze(out_t[vox]) - mb_MD.predict(bvec_t,
                                            np.array([2000]))[np.where(mask_t)][vox]) < 30, 1)
+
+
+def test_weighted_gram_ols():
+    prng = np.random.RandomState(2)
+    design_matrix = prng.rand(20, 6)
+    fit_to = prng.rand(7, 20)
+    means = prng.rand(7, 20)
+    weights = prng.rand(7, 20)
+    for this_means in [None, means]:
+        for this_weights in [None, weights]:
+            params = sfm.weighted_gram_ols(design_matrix, fit_to,
+                                           means=this_means,
+                                           weights=this_weights,
+                                           block_size=3)
+            for vox in range(7):
+                X = np.copy(design_matrix)
+                y = np.copy(fit_to[vox])
+                if this_means is not None:
+                    X = X - this_means[vox][:, None]
+                if this_weights is not None:
+                    X = this_weights[vox][:, None] * X
+                    y = this_weights[vox] * y
+                npt.assert_almost_equal(params[vox],
+                                        np.linalg.lstsq(X, y, rcond=None)[0])
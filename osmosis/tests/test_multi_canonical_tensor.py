@@ -0,0 +1,74 @@
+import itertools
+
+import numpy as np
+import numpy.testing as npt
+
+import osmosis.utils as ozu
+import osmosis.model.multi_canonical_tensor as mct
+
+
+def _engine(n, n_regressors=12, n_measurements=30, seed=1):
+    prng = np.random.RandomState(seed)
+    regressors = prng.rand(n_regressors, n_measurements)
+    iso_regressor = 0.5 * np.ones(n_measurements)
+    return mct.CombinationOLS(regressors, iso_regressor, n), prng
+
+
+def test_combination_rank():
+    for n, k in [(7, 1), (7, 2), (9, 3)]:
+        combos = np.array(list(itertools.combinations(range(n), k)))
+        npt.assert_equal(mct.combination_rank(combos, n),
+                         np.arange(combos.shape[0]))
+
+
+def test_combination_ols():
+    for n in [1, 2, 3]:
+        engine, prng = _engine(n)
+        fit_to = prng.rand(30, 17)
+        weights = engine.solve_all(fit_to)
+        npt.assert_equal(weights.shape, (engine.combinations.shape[0], n + 1,
+                                         17))
+        for row, idx in enumerate(engine.combinations):
+            d = np.vstack([engine.regressors[idx], engine.iso_regressor]).T
+            npt.assert_almost_equal(weights[row],
+                                    np.dot(ozu.ols_matrix(d), fit_to))
+
+
+def test_combination_ols_fit():
+    engine, prng = _engine(2)
+    # Signals made of two of the regressors, with some noise:
+    fit_to = (np.dot(prng.rand(2), engine.regressors[[2, 7]])[:, None] +
+              0.5 + 0.01 * prng.randn(30, 20))
+    # No combination can explain this one with non-negative weights:
+    fit_to[:, 3] = -1
+    combo_idx, weights = engine.fit(fit_to, block_size=7)
+    npt.assert_(np.isnan(combo_idx[3]))
+    npt.assert_(np.all(np.isnan(weights[3])))
+
+    all_weights = engine.solve_all(fit_to)
+    for vox in range(20):
+        if vox == 3:
+            continue
+        ssr = np.empty(engine.combinations.shape[0])
+        for row, idx in enumerate(engine.combinations):
+            w = all_weights[row, :, vox]
+            pred = np.dot(w[:-1], engine.regressors[idx])
+            pred += w[-1] * engine.iso_regressor
+            ssr[row] = np.sum((fit_to[:, vox] - pred) ** 2)
+            if np.any(w < 0):
+                ssr[row] = np.nan
+        npt.assert_equal(combo_idx[vox], np.nanargmin(ssr))
+        npt.assert_almost_equal(weights[vox],
+                                all_weights[int(combo_idx[vox]), :, vox])
+    npt.assert_(np.all(engine.combinations[combo_idx[~np.isnan(combo_idx)]
+                                           .astype(int)] == [2, 7]))
+
+    # Pruning with all the candidates is the exhaustive search:
+    pruned_idx, pruned_weights = engine.fit(fit_to,
+                                            n_candidates=engine.n_regressors)
+    npt.assert_equal(pruned_idx, combo_idx)
+    npt.assert_almost_equal(pruned_weights, weights)
+
+    # And with a few of them still finds the right pair here:
+    pruned_idx, pruned_weights = engine.fit(fit_to, n_candidates=4)
+    npt.assert_equal(pruned_idx, combo_idx)
@@ -0,0 +1,63 @@
+import numpy as np
+import numpy.testing as npt
+
+import scipy.sparse as sps
+
+import osmosis.nnls as nnls
+
+
+def test_solvers():
+    # Set up a non-negative regression:
+    prng = np.random.RandomState(27)
+    beta = prng.rand(20)
+    beta[::4] = 0
+    X = prng.randn(1000, 20)
+    y = np.dot(X, beta)
+
+    for solver in ['fista', 'bcd']:
+        for this_X in [X, sps.csr_matrix(X)]:
+            beta_hat, info = nnls.solve(y, this_X, solver=solver)
+            npt.assert_array_almost_equal(beta, beta_hat, decimal=3)
+            npt.assert_(info['rsquared'] > 99.9)
+            npt.assert_(info['n_iterations'] > 0)
+            # The objective should never go up:
+            npt.assert_(np.all(np.diff(info['objective']) <= 1e-10))
+
+    beta_hat, info = nnls.solve(y, X, solver='sgd', seed=27)
+    npt.assert_array_almost_equal(beta, beta_hat, decimal=1)
+    # The R squared describes the returned solution:
+    resid = y - np.dot(X, beta_hat)
+    npt.assert_almost_equal(info['rsquared'],
+                            100 * (1 - np.dot(resid, resid) /
+                                   np.sum((y - np.mean(y))**2)))
+
+    # Coordinate descent with blocks of one:
+    beta_hat, info = nnls.block_coordinate_descent(y, X, block_size=1)
+    npt.assert_array_almost_equal(beta, beta_hat, decimal=3)
+
+
+def test_non_neg():
+    prng = np.random.RandomState(28)
+    beta = prng.rand(10)
+    beta[::2] = -beta[::2]
+    X = prng.randn(1000, 10)
+    y = np.dot(X, beta)
+    for solver in nnls.SOLVERS:
+        beta_hat, info = nnls.solve(y, X, solver=solver)
+        npt.assert_(np.all(beta_hat >= 0))
+
+
+def test_target_rsq():
+    prng = np.random.RandomState(29)
+    beta = prng.rand(50)
+    X = sps.rand(2000, 50, density=0.1, format='csr', random_state=prng)
+    y = X * beta
+    beta_hat, info = nnls.fista(y, X, target_rsq=90, tol=0)
+    npt.assert_(info['rsquared'] >= 90)
+    beta_full, info_full = nnls.fista(y, X, tol=0)
+    npt.assert_(info['n_iterations'] <= info_full['n_iterations'])
+
+
+def test_solve_raises():
+    npt.assert_raises(ValueError, nnls.solve, np.ones(10), np.eye(10),
+                      'no_such_solver')
@@ -0,0 +1,135 @@
+import numpy as np
+import numpy.testing as npt
+
+import dipy.core.sphere as dps
+import dipy.reconst.recspeed as recspeed
+
+import osmosis.utils as ozu
+import osmosis.cluster as ozc
+import osmosis.odf as ozo
+
+
+def test_odf_peaks():
+    vertices = ozu.get_camino_pts(150).T
+    neighbors = ozo.sphere_neighbors(vertices)
+    edges = dps.Sphere(xyz=vertices).edges
+    prng = np.random.RandomState(1)
+    odf = prng.rand(10, 150)
+    # No peaks in a constant function, and none where the odf isn't finite:
+    odf[3] = 1
+    odf[4, 0] = np.nan
+    peaks = ozo.odf_peaks(odf, neighbors)
+    npt.assert_equal(peaks[3:5], 0)
+    for vox in [0, 1, 2, 5, 6, 7, 8, 9]:
+        values, inds = recspeed.local_maxima(odf[vox], edges)
+        npt.assert_equal(np.sort(np.where(peaks[vox])[0]), np.sort(inds))
+        npt.assert_equal(peaks[vox][inds], values)
+
+
+def test_top_k():
+    prng = np.random.RandomState(2)
+    values = prng.rand(6, 20)
+    npt.assert_equal(ozo.top_k(values, 3), np.argsort(values)[:, ::-1][:, :3])
+    npt.assert_equal(ozo.top_k(values, 30), np.argsort(values)[:, ::-1])
+
+
+def test_peak_angle():
+    vertices = np.array([[1, 0, 0], [0, 1, 0], [-1, 0, 0], [1, 1, 0.]])
+    npt.assert_almost_equal(ozo.peak_angle(vertices, [0, 0, 0], [1, 2, 3]),
+                            [90, 0, 45])
+
+
+def test_dispersion_index():
+    vertices = ozu.get_camino_pts(50).T
+    prng = np.random.RandomState(3)
+    weights = prng.rand(5, 50) - 0.8
+    weights[2] = 0
+    for all_to_all in [False, True]:
+        di = ozo.dispersion_index(weights, vertices, all_to_all=all_to_all)
+        npt.assert_equal(di[2], 0)
+        for vox in [0, 1, 3, 4]:
+            idx = np.where(weights[vox] > 0)[0]
+            mp = weights[vox][idx]
+            dirs = vertices[idx]
+            if all_to_all:
+                ref = 0
+                angles = np.arccos(np.clip(np.dot(dirs, dirs.T), -1, 1))
+                for ii in range(len(idx)):
+                    for jj in range(ii + 1, len(idx)):
+                        ref += (np.sin(angles[ii, jj]) * mp[ii] * mp[jj] /
+                                np.sum(mp ** 2))
+                ref = ref / len(idx) ** 2
+            else:
+                pdd = dirs[np.argmax(mp)]
+                angles = np.arccos(np.clip(np.dot(dirs, pdd), -1, 1))
+                angles = np.min([angles, np.pi - angles], 0) / (np.pi / 2)
+                ref = np.dot(mp ** 2 / np.sum(mp ** 2), np.sin(angles))
+            npt.assert_almost_equal(di[vox], ref)
+
+
+def test_crossing_index():
+    peaks = np.array([[0, 0, 0, 0],
+                      [0, 2, 0, 0],
+                      [1, 1, 0, 0],
+                      [3, 1, 0.5, 0]])
+    ci = ozo.crossing_index(peaks)
+    npt.assert_equal(ci[:2], [0, 1])
+    # Two equal peaks have no spread:
+    npt.assert_almost_equal(ci[2], 0)
+    peaks_norm = peaks[3, :3] / np.sqrt(np.sum(peaks[3] ** 2))
+    npt.assert_almost_equal(ci[3], np.std(peaks_norm) / np.std([1, 0, 0]))
+
+
+def test_rbf_interpolator():
+    vertices = ozu.get_camino_pts(60).T
+    target = ozu.get_camino_pts(150).T
+    prng = np.random.RandomState(4)
+    data = prng.rand(3, 60)
+    s0 = dps.Sphere(xyz=vertices)
+    s1 = dps.Sphere(xyz=target)
+    for function in ['multiquadric', 'inverse', 'gaussian']:
+        interp = ozo.rbf_interpolator(vertices, target, function=function,
+                                      smooth=0)
+        npt.assert_equal(interp.shape, (150, 60))
+        out = np.dot(data, interp.T)
+        for vox in range(3):
+            npt.assert_almost_equal(out[vox],
+                                    dps.interp_rbf(data[vox], s0, s1,
+                                                   function=function,
+                                                   smooth=0))
+    npt.assert_raises(ValueError, ozo.rbf_interpolator, vertices, target,
+                      function='spline')
+
+
+def test_cluster_odf():
+    vertices = ozu.get_camino_pts(60).T
+    prng = np.random.RandomState(5)
+    weights = prng.rand(12, 60)
+    weights[weights < 0.9] = 0
+    weights[0] = 0
+    weights[1] = 0
+    weights[1, 7] = 1
+    centroids, assignments, k = ozo.cluster_odf(weights, vertices,
+                                                n_jobs=1, block_size=5)
+    npt.assert_equal(k[:2], [0, 1])
+    npt.assert_(np.all(np.isnan(centroids[0])))
+    npt.assert_almost_equal(centroids[1, 0], vertices[7])
+    npt.assert_equal(assignments[weights <= 0], -1)
+    for vox in range(2, 12):
+        # Run the AIC sweep on this voxel on its own:
+        nz = np.where(weights[vox] > 0)[0]
+        seeds = vertices[nz[np.argsort(weights[vox][nz])[::-1]]]
+        last_aic = np.inf
+        for this_k in range(1, len(nz)):
+            mu, y_n, sse = ozc.spkm(vertices[nz], this_k,
+                                    seeds=seeds[:this_k],
+                                    weights=weights[vox][nz])
+            aic = ozu.aic(sse, len(nz), this_k)
+            if aic > last_aic:
+                break
+            last_aic = aic
+            choose_k, choose_mu, choose_y_n = this_k, mu, y_n
+        npt.assert_equal(k[vox], choose_k)
+        npt.assert_almost_equal(centroids[vox, :choose_k], choose_mu)
+        npt.assert_(np.all(np.isnan(centroids[vox, choose_k:])))
+        npt.assert_equal(assignments[vox][nz], choose_y_n)
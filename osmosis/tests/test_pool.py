@@ -0,0 +1,27 @@
+import numpy as np
+import numpy.testing as npt
+
+import osmosis.parallel.pool as ozp
+
+
+def _block_sum(block):
+    return np.sum(block, -1)
+
+
+def test_map_blocks():
+    rng = np.random.RandomState(46)
+    blocks = [rng.randn(n, 4) for n in [3, 1, 5]]
+    expected = [np.sum(block, -1) for block in blocks]
+    for n_jobs in [1, 2, None]:
+        for backend in ['thread', 'process']:
+            results = list(ozp.map_blocks(_block_sum, blocks, n_jobs=n_jobs,
+                                          backend=backend))
+            npt.assert_equal(len(results), len(blocks))
+            for r, e in zip(results, expected):
+                npt.assert_almost_equal(r, e)
+
+    npt.assert_equal(list(ozp.map_blocks(_block_sum, [], n_jobs=2)), [])
+    npt.assert_equal(ozp.n_workers(4, 2), 2)
+    npt.assert_equal(ozp.n_workers(2, 0), 1)
+    npt.assert_raises(ValueError, ozp.map_blocks, _block_sum, blocks,
+                      backend='gpu')
@@ -0,0 +1,110 @@
+import numpy as np
+import numpy.testing as npt
+import scipy.stats as stats
+
+import osmosis.utils as ozu
+import osmosis.precision as prc
+import osmosis.predict_n as pn
+
+
+def _sparse_fodfs(n_vox, n_dirs, prng):
+    mp = prng.rand(n_vox, n_dirs)
+    mp[mp < 0.9] = 0
+    return mp
+
+
+def test_pdd_agreement():
+    rot_vecs = np.eye(3)
+    mp1 = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 0.]])
+    mp2 = np.array([[0, 0.5, 0], [0, 1, 0], [0, 0, 1.]])
+    angles = prc.pdd_agreement(mp1, mp2, rot_vecs, rot_vecs)
+    npt.assert_almost_equal(angles[:2], [90, 0])
+    npt.assert_(np.isnan(angles[2]))
+
+    # Antipodal symmetry:
+    angles = prc.pdd_agreement(mp1[:1], mp1[:1], rot_vecs, -rot_vecs)
+    npt.assert_almost_equal(angles, [0])
+
+
+def _brute_sph_cc(data1, data2, vertices1, vertices2, n):
+    """
+    Spherical cross-correlation, one bin and one voxel at a time, to compare
+    against.
+    """
+    angles = np.rad2deg(np.arccos(np.clip(np.dot(vertices1, vertices2.T),
+                                          -1, 1)))
+    edges = np.linspace(0, 180, n)
+    bin_idx = np.digitize(angles, edges[1:-1])
+    n_pairs = np.zeros(n - 1, dtype=int)
+    cc = ozu.nans((data1.shape[0], n - 1))
+    for b_idx in range(n - 1):
+        idx1, idx2 = np.where(bin_idx == b_idx)
+        n_pairs[b_idx] = len(idx1)
+        if len(idx1) < 2:
+            continue
+        for vox in range(data1.shape[0]):
+            x = data1[vox, idx1]
+            y = data2[vox, idx2]
+            if np.all(x == x[0]) or np.all(y == y[0]):
+                continue
+            cc[vox, b_idx] = stats.pearsonr(x, y)[0]
+    return (edges[:-1] + edges[1:]) / 2., n_pairs, cc
+
+
+def test_kfold_xval_precision():
+    bvecs = ozu.get_camino_pts(150)
+    prng = np.random.RandomState(2)
+    n_vox = 20
+    mp_list = [_sparse_fodfs(n_vox, bvecs.shape[-1], prng) for i in range(3)]
+    mp_list[1][4] = 0
+    rot_vecs_list = [bvecs] * 3
+    mask = np.ones(n_vox)
+
+    p_arr = pn.kfold_xval_precision(mp_list, mask, rot_vecs_list, "emd",
+                                    "None")
+    npt.assert_equal(p_arr.shape, (3, n_vox))
+    # The first combination is (0, 1):
+    npt.assert_(np.isnan(p_arr[0, 4]))
+    for vox in range(n_vox):
+        if vox == 4:
+            continue
+        npt.assert_almost_equal(p_arr[0, vox],
+                                pn.fODF_EMD(mp_list[0][vox], mp_list[1][vox],
+                                            bvecs, bvecs), decimal=5)
+
+    p_arr = pn.kfold_xval_precision(mp_list, mask, rot_vecs_list, "pdd",
+                                    "None")
+    npt.assert_equal(p_arr[2], prc.pdd_agreement(mp_list[1], mp_list[2],
+                                                 bvecs, bvecs))
+
+    p_arr = pn.kfold_xval_precision(mp_list, mask, rot_vecs_list, "sph_cc",
+                                    "None")
+    npt.assert_(np.all(p_arr[np.isfinite(p_arr)] <= 1))
+    npt.assert_(np.isnan(p_arr[0, 4]))
+
+    npt.assert_raises(ValueError, pn.kfold_xval_precision, mp_list, mask,
+                      rot_vecs_list, "cc", "None")
+
+
+def test_spherical_cc():
+    bvecs = ozu.get_camino_pts(150)
+    prng = np.random.RandomState(3)
+    mp1, vertices1 = prc.mirror(prng.rand(6, 150), bvecs)
+    mp2, vertices2 = prc.mirror(prng.rand(6, 150), bvecs)
+    # Constant functions have no correlation:
+    mp1[2] = 1
+    deg, n_pairs, ref = _brute_sph_cc(mp1, mp2, vertices1, vertices2, 15)
+    engine = prc.SphericalCC(vertices1, vertices2, n=15)
+    npt.assert_almost_equal(engine.deg, deg)
+    npt.assert_equal(engine.n_pairs, n_pairs)
+    npt.assert_equal(np.sum(engine.n_pairs), vertices1.shape[0] ** 2)
+
+    cc = engine(mp1, mp2, block_size=4)
+    npt.assert_equal(np.isnan(cc), np.isnan(ref))
+    npt.assert_(np.all(np.isnan(cc[2])))
+    npt.assert_almost_equal(cc[np.isfinite(ref)], ref[np.isfinite(ref)])
+
+    # One voxel at a time:
+    deg1, cc1 = ozu.sph_cc(mp1[0], mp2[0], vertices1, vertices2, n=15)
+    npt.assert_equal(cc1.shape, (14,))
+    npt.assert_almost_equal(cc1, cc[0])
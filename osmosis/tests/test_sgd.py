@@ -23,6 +23,37 @@ def test_sgd():
     npt.assert_array_almost_equal(beta, beta_hat, decimal=1)
     npt.assert_array_almost_equal(beta, beta_hat_sparse, decimal=1)
 
+
+def test_sgd_warm_start():
+    prng = np.random.RandomState(1)
+    beta = prng.rand(10)
+    X = prng.randn(1000,10)
+    y = np.dot(X, beta)
+
+    # Starting from the answer, we should stay there:
+    beta_hat, info = sgd(y, X, plot=False, verbose=False, h0=beta, seed=1,
+                         return_info=True)
+    npt.assert_array_almost_equal(beta, beta_hat, decimal=1)
+    npt.assert_(info['iterations'] >= info['n_iterations'])
+
+    # The trace of the objective is bounded by max_iter:
+    beta_hat, info = sgd(y, sps.csr_matrix(X), plot=False, verbose=False,
+                         max_iter=25, check_error_iter=5, seed=1,
+                         return_info=True)
+    npt.assert_equal(info['iterations'], 25)
+    npt.assert_equal(len(info['ss_residuals']), 5)
+
+
+def test_sgd_non_neg():
+    prng = np.random.RandomState(2)
+    beta = prng.rand(10)
+    beta[::2] = -beta[::2]
+    X = prng.randn(1000,10)
+    y = np.dot(X, beta)
+    beta_hat = sgd(y, X, plot=False, verbose=False, non_neg=True, seed=0)
+    npt.assert_(np.all(beta_hat >= 0))
+    npt.assert_array_almost_equal(beta_hat[1::2], beta[1::2], decimal=1)
+
     
 if __name__=="__main__":
      test_sgd()
@@ -64,3 +64,51 @@ def test_signal_1d():
 
     sims.signal_1d(theta, 1, fiber_weights, d_para, d_ortho, phi, iso_weights,
                    d_iso)
+
+
+def test_multi_shell_volume():
+    """
+    Test simulation of a multi-shell volume
+    """
+    data, bvecs, bvals = sims.multi_shell_volume((2, 3, 2), n_dirs=20,
+                                                 bvals=(1000, 2000), seed=1)
+    npt.assert_equal(data.shape, (2, 3, 2, 42))
+    npt.assert_equal(bvecs.shape, (3, 42))
+    npt.assert_equal(bvals[:2], [0, 0])
+    npt.assert_equal(np.unique(bvals[2:]), [1000, 2000])
+    npt.assert_equal(data[..., :2], 1000)
+    # The signal decays with b:
+    npt.assert_(np.all(data[..., 2:22] < 1000))
+    npt.assert_(np.all(data[..., 22:].mean(-1) < data[..., 2:22].mean(-1)))
+
+    # The same as the signal of explicit tensors along the same fibers,
+    # Q = rd * I + (ad - rd) * v v', mixed with an isotropic component:
+    prng = np.random.RandomState(1)
+    fiber_dirs = prng.randn(12, 2, 3)
+    fiber_dirs /= np.sqrt(np.sum(fiber_dirs ** 2, -1))[..., None]
+    weights = 0.5 + 0.5 * prng.rand(12, 2)
+    flat_data = data.reshape(12, -1)
+    scaled_bvals = bvals[2:] / 1000.
+    md = (sims.AD + 2 * sims.RD) / 3.
+    for vox in range(12):
+        signal = np.zeros(40)
+        for v, w in zip(fiber_dirs[vox], weights[vox]):
+            Q = sims.RD * np.eye(3) + (sims.AD - sims.RD) * np.outer(v, v)
+            adc = np.sum(bvecs[:, 2:] * np.dot(Q, bvecs[:, 2:]), 0)
+            signal += w * 1000 * np.exp(-scaled_bvals * adc)
+        vox_iso = 0.2 * np.sum(weights[vox])
+        signal += vox_iso * 1000 * np.exp(-scaled_bvals * md)
+        signal /= np.sum(weights[vox]) + vox_iso
+        # Up to the precision of the camino points, which are not exactly
+        # unit vectors:
+        npt.assert_almost_equal(flat_data[vox, 2:], signal, decimal=3)
+
+    # Same seed, same volume:
+    data2, bvecs2, bvals2 = sims.multi_shell_volume((2, 3, 2), n_dirs=20,
+                                                    bvals=(1000, 2000), seed=1,
+                                                    snr=20)
+    npt.assert_equal(bvecs2, bvecs)
+    data3 = sims.multi_shell_volume((2, 3, 2), n_dirs=20, bvals=(1000, 2000),
+                                    seed=1, snr=20)[0]
+    npt.assert_equal(data3, data2)
+    npt.assert_(not np.allclose(data2, data))
@@ -0,0 +1,28 @@
+import numpy as np
+import numpy.testing as npt
+
+import osmosis.utils as ozu
+import osmosis.sph_cc_funcs as scf
+
+
+def test_all_across_sph_cc():
+    n_dirs = 40
+    bvecs = np.hstack([np.zeros((3, 2)), ozu.get_camino_pts(n_dirs),
+                       ozu.get_camino_pts(n_dirs)])
+    bvals = np.hstack([[0, 0], 1000 * np.ones(n_dirs),
+                       2000 * np.ones(n_dirs)])
+    mask = np.zeros((2, 2, 2))
+    mask[0] = 1
+    prng = np.random.RandomState(4)
+    vol_b_list = [prng.rand(2, 2, 2, n_dirs) for i in range(2)]
+
+    deg_list, cc_list = scf.all_across_sph_cc(vol_b_list, bvals, bvecs, mask,
+                                              n=10)
+    npt.assert_equal(len(cc_list), 1)
+    npt.assert_equal(cc_list[0].shape, (4, 9))
+    for idx in range(4):
+        deg, cc, combos, this_idx, cod_s, cod_m = scf.across_sph_cc(
+            vol_b_list, bvals, bvecs, mask, idx=idx, n=10)
+        npt.assert_equal(combos, [(0, 1)])
+        npt.assert_almost_equal(deg_list[0][idx], deg[0])
+        npt.assert_almost_equal(cc_list[0][idx], cc[0])
@@ -0,0 +1,60 @@
+import numpy as np
+import numpy.testing as npt
+from scipy.special import sph_harm, eval_legendre
+
+import dipy.core.geometry as geo
+
+import osmosis.utils as ozu
+import osmosis.spherical_harmonics as ozh
+
+
+def test_sph_harm_basis():
+    bvecs = ozu.get_camino_pts(60)
+    L = 6
+    basis = ozh.sph_harm_basis(bvecs, L)
+    npt.assert_equal(basis.shape, (ozh.n_coeffs(L), 60))
+    # Compare to a loop over orders and degrees:
+    r, theta, phi = geo.cart2sphere(bvecs[0], bvecs[1], bvecs[2])
+    i = 0
+    for order in range(0, L + 1, 2):
+        for degree in range(-order, order + 1):
+            if degree < 0:
+                ref = np.imag(sph_harm(-degree, order, phi, theta))
+            else:
+                ref = np.real(sph_harm(degree, order, phi, theta))
+            npt.assert_almost_equal(basis[i], ref)
+            i += 1
+
+    # It's computed only once:
+    npt.assert_(ozh.sph_harm_basis(bvecs.copy(), L) is basis)
+    npt.assert_(ozh.sph_harm_basis(bvecs, 4) is not basis)
+    npt.assert_(not basis.flags.writeable)
+
+    # Only the most recently used basis sets are kept:
+    basis4 = ozh.sph_harm_basis(bvecs, 4)
+    for this_L in range(8, 8 + 2 * ozh.BASIS_CACHE_SIZE, 2):
+        ozh.sph_harm_basis(bvecs, this_L)
+        # Using this one keeps it around:
+        npt.assert_(ozh.sph_harm_basis(bvecs, L) is basis)
+    npt.assert_equal(len(ozh._BASIS_CACHE), ozh.BASIS_CACHE_SIZE)
+    npt.assert_(ozh.sph_harm_basis(bvecs, 4) is not basis4)
+
+
+def test_zonal():
+    bvecs = ozu.get_camino_pts(60)
+    profile = lambda x: 1 + 2 * x ** 2 - x ** 4
+    rh = ozh.zonal_coeffs(profile, 4)
+    npt.assert_equal(rh.shape, (3,))
+    rotations = ozh.zonal_rotations(bvecs, rh)
+    npt.assert_almost_equal(rotations, profile(np.dot(bvecs.T, bvecs)))
+
+    # Funk-Hecke: convolving with P_2 multiplies the order 2 harmonics by
+    # 4 pi / 5 and removes all the others:
+    rh = ozh.zonal_coeffs(lambda x: eval_legendre(2, x), 4)
+    kernel = ozh.convolution_kernel(rh, 4)
+    l, m = ozh.sph_harm_orders(4)
+    npt.assert_almost_equal(kernel, np.where(l == 2, 4 * np.pi / 5, 0))
+    # Missing orders are zero:
+    kernel = ozh.convolution_kernel([1, 2], 4)
+    npt.assert_equal(kernel[l == 4], 0)
+    npt.assert_almost_equal(kernel[l == 2], 2 * np.sqrt(4 * np.pi / 5))
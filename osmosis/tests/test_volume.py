@@ -5,6 +5,7 @@ import numpy.testing as npt
 import nibabel as ni
 
 import osmosis as oz
+import osmosis.utils as ozu
 import osmosis.volume as ozv
 import osmosis.io as oio
 import osmosis.fibers as ozf
@@ -36,6 +37,63 @@ def test_fg2volume():
     vol = ozv.fg2volume(fg, 'fp20110912_ecc.nii.gz',
                         shape=ni.load(nii_file).get_shape())
 
+def test_fg2volume_chunks():
+    """
+    Projecting a stream of chunks gives the same result as projecting the
+    entire fiber group
+    """
+    fibers = [ozf.Fiber(np.random.rand(3, 20) * 9, fiber_stats=dict(a=ii))
+              for ii in range(7)]
+    fg = ozf.FiberGroup(fibers)
+    vol = ozv.fg2volume(fg, 'a', shape=(10, 10, 10))
+    vol_chunks = ozv.fg2volume(fg.iter_chunks(3), 'a', shape=(10, 10, 10))
+    npt.assert_equal(vol, vol_chunks)
+
+
+def test_sample_volume():
+    vol = np.random.rand(10, 10, 10)
+    vol[:5] = np.nan
+    coords = np.random.rand(3, 50) * 9
+
+    # With a tolerance, this should be the same as nearest_coord:
+    sampled = ozv.sample_volume(vol, coords, tol=10)
+    for ii in range(coords.shape[-1]):
+        npt.assert_equal(sampled[ii],
+                         vol[ozu.nearest_coord(vol, coords[:, ii])][0])
+
+    # Without one, we just get the voxel containing the point:
+    sampled = ozv.sample_volume(vol, coords)
+    vox = np.round(coords).astype(int)
+    npt.assert_equal(sampled, vol[vox[0], vox[1], vox[2]])
+
+    # Points outside the volume get nan:
+    npt.assert_(np.isnan(ozv.sample_volume(vol, np.array([20, 0, 0]))[0]))
+    npt.assert_(np.isnan(ozv.sample_volume(vol, np.array([20, 0, 0]),
+                                           tol=3)[0]))
+
+    # Trilinear interpolation is exact for linear functions:
+    x, y, z = np.mgrid[:10, :10, :10]
+    lin_vol = x + 2 * y - z
+    sampled = ozv.sample_volume(lin_vol.astype(float), coords,
+                                interpolation='trilinear')
+    npt.assert_almost_equal(sampled, coords[0] + 2 * coords[1] - coords[2])
+
+
+def test_fg2volume_weighting():
+    # One fiber spends two nodes in voxel (0, 0, 0), the other only one:
+    fg = ozf.FiberGroup([ozf.Fiber(np.array([[0, 0.5, 1], [0, 0, 0],
+                                             [0, 0, 0]]),
+                                   fiber_stats=dict(a=1.)),
+                         ozf.Fiber(np.array([[0], [0], [0]]),
+                                   fiber_stats=dict(a=4.))])
+    vol = ozv.fg2volume(fg, 'a', shape=(2, 2, 2))
+    npt.assert_equal(vol[0, 0, 0], 2.5)
+    npt.assert_equal(vol[1, 0, 0], 1.)
+    npt.assert_(np.isnan(vol[1, 1, 1]))
+    vol = ozv.fg2volume(fg, 'a', shape=(2, 2, 2), weighting='node')
+    npt.assert_equal(vol[0, 0, 0], 2.)
+
+
 def test_resample_volume():
     """
     Testing resampling of one volume into another volumes space (a t1 into a
@@ -49,3 +107,74 @@ def test_resample_volume():
     npt.assert_equal(new_vol.shape, target.shape[:3])
     
     
+
+
+def test_MaskedVolume():
+    mask = np.zeros((3, 4, 2), dtype=bool)
+    mask[0, 1:3, 1] = True
+    mask[2, 0, 0] = True
+    vol = ozu.nans(mask.shape + (5,))
+    vol[mask] = np.random.RandomState(47).rand(np.sum(mask), 5)
+
+    mv = ozv.MaskedVolume.from_volume(vol, mask)
+    npt.assert_equal(mv.shape, vol.shape)
+    npt.assert_equal(mv.data.shape, (3, 5))
+    npt.assert_equal(mv.to_volume(), vol)
+    npt.assert_equal(np.asarray(mv), vol)
+
+    # Indexing with the mask doesn't need the dense volume:
+    npt.assert_equal(mv[mask], vol[mask])
+    npt.assert_equal(mv[mask, 2], vol[mask, 2])
+    # Like boolean indexing of an array, that's a copy:
+    flat = mv[mask]
+    flat[:] = 0
+    npt.assert_equal(mv[mask], vol[mask])
+
+    # Other indexing and numpy functions use the dense volume:
+    npt.assert_equal(mv[..., 1], vol[..., 1])
+    npt.assert_equal(mv[0, 1], vol[0, 1])
+    npt.assert_equal(np.nanmean(mv, -1), np.nanmean(vol, -1))
+    npt.assert_equal(mv.reshape(-1, 5), vol.reshape(-1, 5))
+    # The dense volume is kept, but what you get from it can be changed
+    # without changing the volume:
+    sl = mv[..., 1]
+    sl[:] = 0
+    npt.assert_equal(mv[..., 1], vol[..., 1])
+    flat = mv.reshape(-1)
+    flat[:] = 0
+    npt.assert_equal(mv.to_volume(), vol)
+
+    # Arithmetic stays in the mask:
+    npt.assert_(isinstance(2 * mv - mv, ozv.MaskedVolume))
+    npt.assert_almost_equal(np.asarray(2 * mv - mv), vol)
+    npt.assert_equal(mv > 0.5, vol > 0.5)
+    npt.assert_equal(mv + np.ones(5), vol + np.ones(5))
+    npt.assert_almost_equal(np.asarray(2 ** mv), 2 ** vol)
+    npt.assert_almost_equal(np.asarray(mv % 0.3), vol % 0.3)
+    npt.assert_almost_equal(np.asarray(mv // 0.3), vol // 0.3)
+    npt.assert_almost_equal(np.asarray(1 // mv), 1 // vol)
+    npt.assert_almost_equal(np.asarray(1 % mv), 1 % vol)
+
+    # Comparisons are element-wise, and can be combined:
+    npt.assert_(isinstance(mv == 0, ozv.MaskedVolume))
+    npt.assert_equal((mv == vol[mask][0, 0])[mask],
+                     vol[mask] == vol[mask][0, 0])
+    npt.assert_equal((mv != mv)[mask], np.zeros((3, 5), dtype=bool))
+    in_range = (mv > 0.2) & (mv < 0.8)
+    npt.assert_(isinstance(in_range, ozv.MaskedVolume))
+    npt.assert_equal(in_range, (vol > 0.2) & (vol < 0.8))
+    npt.assert_equal((mv < 0.2) | (mv > 0.8), (vol < 0.2) | (vol > 0.8))
+    npt.assert_equal((mv < 0.2) ^ (mv < 0.8), (vol < 0.2) ^ (vol < 0.8))
+    npt.assert_equal(~(mv > 0.5), mask[..., None] & ~(vol > 0.5))
+
+    mv[mask, 0] = 1
+    vol[mask, 0] = 1
+    npt.assert_equal(mv.to_volume(), vol)
+    # Changing the values also changes the dense volume:
+    npt.assert_equal(mv[..., 0], vol[..., 0])
+    mv[0, 1, 1, 2] = 5
+    vol[0, 1, 1, 2] = 5
+    npt.assert_equal(mv[..., 2], vol[..., 2])
+
+    npt.assert_equal(mv.to_nifti().get_data(), vol)
+    npt.assert_raises(ValueError, ozv.MaskedVolume, np.ones((2, 5)), mask)
@@ -4,9 +4,12 @@ import numpy as np
 import dipy.reconst.interpolate as interp
 import dipy.tracking.markov as dpt
 import dipy.tracking.utils as dpu
-import dipy.data as dpd
 
 import osmosis.fibers as ozf
+import osmosis.lazy as ozl
+
+# Only imported when it's first used:
+dpd = ozl.lazy_import('dipy.data')
 
 def track(model, data, sphere=None, step_size=1, angle_limit=20, seeds=None,
           density=[2,2,2], voxel_size=[1,1,1]):
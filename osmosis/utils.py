@@ -12,22 +12,24 @@ import scipy.stats as stats
 
 import dipy.core.geometry as geo
 
-# We want to try importing numexpr for some array computations, but we can do
-# without:
-try:
-    import numexpr
-    has_numexpr = True
-except ImportError: 
-    has_numexpr = False
-
-# IPython is needed if you want to use the progress bar: 
-try:
-    from IPython.core.display import clear_output
-    have_ipython = True
-except ImportError:
-    have_ipython = False
-
 import osmosis as oz
+import osmosis.instrument as ozi
+import osmosis.lazy as ozl
+
+# We want to use numexpr for some array computations, but we can do without
+# (it's only imported when it's first used):
+has_numexpr = ozl.has_module('numexpr')
+numexpr = ozl.lazy_import('numexpr')
+
+
+def _in_ipython():
+    """
+    Whether we are running in IPython (which is then already imported, so this
+    doesn't import it)
+    """
+    ipython = sys.modules.get('IPython')
+    get_ipython = getattr(ipython, 'get_ipython', None)
+    return get_ipython is not None and get_ipython() is not None
 
 def intersect(arr_list):
     """
@@ -786,6 +788,42 @@ def nans(shape):
     out.fill(np.nan)
     return out
 
+def sph_cc(data1, data2, vertices1, vertices2, n=20):
+    """
+    Spherical cross-correlation between two functions on the sphere: the
+    correlation between their values in all the pairs of vertices that are
+    separated by a similar angle.
+
+    Parameters
+    ----------
+    data1, data2 : arrays (n1,), (n2,) or (n_vox, n1), (n_vox, n2)
+        Functions sampled on the vertices (optionally one row per voxel)
+    vertices1, vertices2 : arrays (n1, 3), (n2, 3)
+        Unit vectors on the sphere
+    n : int
+        The interval [0, 180] degrees is divided into n-1 equal bins.
+
+    Returns
+    -------
+    deg : array (n-1,)
+        The center of each bin (in degrees)
+    cc : array (n-1,) or (n_vox, n-1)
+        The correlation in each bin (nan where it is not defined).
+
+    Notes
+    -----
+    When comparing many voxels sampled on the same vertices, pass them all in
+    one call, or keep an `osmosis.precision.SphericalCC` around, so that the
+    binning of the vertex pairs is only done once.
+    """
+    # Imported here, because osmosis.precision imports this module:
+    import osmosis.precision as prc
+    engine = prc.SphericalCC(vertices1, vertices2, n=n)
+    cc = engine(data1, data2)
+    if np.ndim(data1) == 1:
+        cc = cc[0]
+    return engine.deg, cc
+
 def vecs2hemi(vecs):
     """
     Take vecs in x,y,z and make sure that they are all pointing towards the
@@ -968,6 +1006,10 @@ class ProgressBar:
         """
         Progress bar for tracking the progress of long calculations.
 
+        The bar is redrawn in place in IPython and written to stdout in a
+        terminal (or any other headless session). Progress is also recorded in
+        the sinks of `osmosis.instrument`, when there are any.
+
         Parameters
         ----------
 
@@ -986,21 +1028,25 @@ class ProgressBar:
         self.fill_char = '*'
         self.width = 40
         self.__update_amount(0)
-        if have_ipython:
+        if _in_ipython():
             self.animate = self.animate_ipython
         else:
-            e_s = "No progress bar implementation without IPython" 
-            raise NotImplementedError(e_s)
+            self.animate = self.animate_terminal
 
     def animate_ipython(self, iter, f_name=None):
         try:
+            from IPython.display import clear_output
             clear_output()
         except Exception:
             # terminal IPython has no clear_output
             pass
-        print '\r', f_name, self, 
+        self.animate_terminal(iter, f_name)
+
+    def animate_terminal(self, iter, f_name=None):
+        sys.stdout.write('\r%s %s' % (f_name, self))
         sys.stdout.flush()
         self.update_iteration(iter + 1)
+        ozi.progress(f_name, iter + 1, self.iterations)
 
     def update_iteration(self, elapsed_iter):
         self.__update_amount((elapsed_iter / float(self.iterations)) * 100.0)
@@ -56,7 +56,9 @@ PACKAGES = ['osmosis',
             'osmosis.leastsqbound',
             'osmosis.viz',
             'osmosis.model',
-            'osmosis.emd']
+            'osmosis.parallel',
+            'osmosis.emd',
+            'osmosis.benchmarks']
             
 PACKAGE_DATA = {"osmosis": ["LICENSE", "data/*.pdb", "data/*.mat",
                             "data/*.nii.gz", "data/*.trk","data/*.bvals",
@@ -4,19 +4,328 @@ osmosis.volume
 
 Integration of data from volumes and into volumes
 
+Derived maps of models are represented as `MaskedVolume` objects, which only
+hold the values in the voxels of a mask, until a dense volume is needed.
 
 """
 import os
 
 import numpy as np
+import scipy.ndimage as ndimage
+import scipy.spatial as spatial
 import nibabel as ni
-from nipy.labs.datasets import as_volume_img
 
 import osmosis.fibers as ozf
 import osmosis.utils as ozu
 
 
-def nii2fg(fg, nii, data_node=0, stat_name=None):
+class MaskedVolume(object):
+    """
+    A volume with values only in the voxels of a mask.
+
+    The values are stored as an array (n_vox, ...), with one row for each
+    `True` voxel in the mask (in the order of `vol[mask]`). Indexing with the
+    mask itself, as in `mv[mask]` or `mv[mask, 1]`, returns (a copy of) these
+    rows without building the dense volume. Anything else (other indexing, numpy
+    functions, writing to a nifti file) works on the dense volume, with nans
+    outside of the mask. That is built once, when it is first needed, and kept
+    until the values change (through item assignment, or by assigning a new
+    `data` array). Results that would be views of it are copies.
+    """
+    # Make numpy defer to our binary operators:
+    __array_priority__ = 20
+
+    def __init__(self, data, mask, affine=None):
+        """
+        Parameters
+        ----------
+        data: array (n_vox, ...)
+            The values in the voxels of the mask.
+
+        mask: bool array (x, y, z)
+
+        affine: array (4, 4), optional
+            Used when writing to a nifti file. Defaults to np.eye(4)
+        """
+        self.mask = np.asarray(mask, dtype=bool)
+        data = np.asarray(data)
+        n_vox = int(np.sum(self.mask))
+        # A single voxel might come in without the voxel dimension:
+        if n_vox == 1 and (data.ndim == 0 or data.shape[0] != 1):
+            data = data[np.newaxis]
+        if data.shape[0] != n_vox:
+            e_s = "The data has %s rows, but there are %s voxels in the mask"%(
+                data.shape[0], n_vox)
+            raise ValueError(e_s)
+        self.data = data
+        self.affine = affine
+
+    @property
+    def data(self):
+        """
+        The values in the voxels of the mask (n_vox, ...)
+        """
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        # The dense volume is out of date:
+        self._dense = None
+
+    @classmethod
+    def from_volume(cls, vol, mask, affine=None):
+        """
+        Make a MaskedVolume from the values of a dense volume in the mask
+        """
+        mask = np.asarray(mask, dtype=bool)
+        return cls(np.asarray(vol)[mask], mask, affine=affine)
+
+    @property
+    def shape(self):
+        """
+        The shape of the dense volume
+        """
+        return self.mask.shape + self.data.shape[1:]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def to_volume(self, fill=None):
+        """
+        The dense volume, with `fill` outside of the mask. Per default, that
+        is False for boolean data and nan for anything else (integer data
+        is converted to float for that).
+        """
+        dtype = self.data.dtype
+        if fill is None:
+            fill = False if dtype == bool else np.nan
+        if fill is np.nan and not np.issubdtype(dtype, np.inexact):
+            dtype = float
+        out = np.empty(self.shape, dtype=dtype)
+        out.fill(fill)
+        out[self.mask] = self.data
+        return out
+
+    def to_nifti(self):
+        """
+        A nibabel Nifti1Image of the dense volume
+        """
+        if self.affine is None:
+            affine = np.eye(4)
+        else:
+            affine = np.asarray(self.affine)
+        return ni.Nifti1Image(self.to_volume(), affine)
+
+    def to_filename(self, file_name):
+        """
+        Write the dense volume to a nifti file
+        """
+        self.to_nifti().to_filename(file_name)
+
+    def _dense_view(self):
+        """
+        The (read-only) dense volume, built the first time it's needed
+        """
+        if self._dense is None:
+            dense = self.to_volume()
+            dense.flags.writeable = False
+            self._dense = dense
+        return self._dense
+
+    def _own(self, out):
+        """
+        A copy of out, if it is a view of the dense volume (so that it can be
+        changed without changing us)
+        """
+        if (isinstance(out, np.ndarray) and self._dense is not None and
+            np.may_share_memory(out, self._dense)):
+            return out.copy()
+        return out
+
+    def __array__(self, dtype=None):
+        out = self._dense_view().copy()
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
+
+    def _is_mask(self, idx):
+        """
+        Whether idx selects exactly the voxels of our mask
+        """
+        if not isinstance(idx, np.ndarray) or idx.dtype != bool:
+            return False
+        return idx is self.mask or (idx.shape == self.mask.shape and
+                                    np.array_equal(idx, self.mask))
+
+    def _split_index(self, idx):
+        """
+        For an index that starts with our mask, the index into the rows of
+        self.data. Otherwise, None
+        """
+        if isinstance(idx, tuple) and len(idx) > 0 and self._is_mask(idx[0]):
+            return (slice(None),) + idx[1:]
+        elif self._is_mask(idx):
+            return (slice(None),)
+        return None
+
+    def __getitem__(self, idx):
+        flat_idx = self._split_index(idx)
+        if flat_idx is None:
+            return self._own(self._dense_view()[idx])
+        # As with boolean indexing of an array, this is a copy:
+        return self.data[flat_idx].copy()
+
+    def __setitem__(self, idx, value):
+        flat_idx = self._split_index(idx)
+        if flat_idx is not None:
+            self.data[flat_idx] = value
+            self._dense = None
+        else:
+            # Only the values inside the mask are kept:
+            vol = self.to_volume()
+            vol[idx] = value
+            self.data = vol[self.mask]
+
+    def __getattr__(self, name):
+        # Anything else an array has (e.g. reshape, squeeze, T) is taken from
+        # the dense volume:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attr = getattr(self._dense_view(), name)
+        if not callable(attr):
+            return self._own(attr)
+
+        def method(*args, **kwargs):
+            return self._own(attr(*args, **kwargs))
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        return method
+
+    def _binary_op(self, other, op):
+        if np.isscalar(other):
+            return MaskedVolume(op(self.data, other), self.mask, self.affine)
+        if (isinstance(other, MaskedVolume) and other.shape == self.shape and
+            self._is_mask(other.mask)):
+            return MaskedVolume(op(self.data, other.data), self.mask,
+                                self.affine)
+        return op(self._dense_view(), np.asarray(other))
+
+    def __add__(self, other):
+        return self._binary_op(other, np.add)
+
+    def __radd__(self, other):
+        return self._binary_op(other, lambda a, b: np.add(b, a))
+
+    def __sub__(self, other):
+        return self._binary_op(other, np.subtract)
+
+    def __rsub__(self, other):
+        return self._binary_op(other, lambda a, b: np.subtract(b, a))
+
+    def __mul__(self, other):
+        return self._binary_op(other, np.multiply)
+
+    def __rmul__(self, other):
+        return self._binary_op(other, lambda a, b: np.multiply(b, a))
+
+    def __truediv__(self, other):
+        return self._binary_op(other, np.true_divide)
+
+    def __rtruediv__(self, other):
+        return self._binary_op(other, lambda a, b: np.true_divide(b, a))
+
+    def __div__(self, other):
+        return self._binary_op(other, np.divide)
+
+    def __rdiv__(self, other):
+        return self._binary_op(other, lambda a, b: np.divide(b, a))
+
+    def __floordiv__(self, other):
+        return self._binary_op(other, np.floor_divide)
+
+    def __rfloordiv__(self, other):
+        return self._binary_op(other, lambda a, b: np.floor_divide(b, a))
+
+    def __mod__(self, other):
+        return self._binary_op(other, np.mod)
+
+    def __rmod__(self, other):
+        return self._binary_op(other, lambda a, b: np.mod(b, a))
+
+    def __pow__(self, other):
+        return self._binary_op(other, np.power)
+
+    def __rpow__(self, other):
+        return self._binary_op(other, lambda a, b: np.power(b, a))
+
+    def __and__(self, other):
+        return self._binary_op(other, np.bitwise_and)
+
+    def __rand__(self, other):
+        return self._binary_op(other, lambda a, b: np.bitwise_and(b, a))
+
+    def __or__(self, other):
+        return self._binary_op(other, np.bitwise_or)
+
+    def __ror__(self, other):
+        return self._binary_op(other, lambda a, b: np.bitwise_or(b, a))
+
+    def __xor__(self, other):
+        return self._binary_op(other, np.bitwise_xor)
+
+    def __rxor__(self, other):
+        return self._binary_op(other, lambda a, b: np.bitwise_xor(b, a))
+
+    def __eq__(self, other):
+        return self._binary_op(other, np.equal)
+
+    def __ne__(self, other):
+        return self._binary_op(other, np.not_equal)
+
+    # Like arrays, these can't be dictionary keys:
+    __hash__ = None
+
+    def __lt__(self, other):
+        return self._binary_op(other, np.less)
+
+    def __le__(self, other):
+        return self._binary_op(other, np.less_equal)
+
+    def __gt__(self, other):
+        return self._binary_op(other, np.greater)
+
+    def __ge__(self, other):
+        return self._binary_op(other, np.greater_equal)
+
+    def __neg__(self):
+        return MaskedVolume(-self.data, self.mask, self.affine)
+
+    def __abs__(self):
+        return MaskedVolume(np.abs(self.data), self.mask, self.affine)
+
+    def __invert__(self):
+        return MaskedVolume(np.invert(self.data), self.mask, self.affine)
+
+    def __repr__(self):
+        return "MaskedVolume(shape=%s, n_vox=%s)"%(self.shape,
+                                                   self.data.shape[0])
+
+
+def nii2fg(fg, nii, data_node=0, stat_name=None, interpolation='nearest',
+           tol=10):
     """
     Attach data from a nifti volume to the fiber-group fiber_stats dict
 
@@ -33,6 +342,15 @@ def nii2fg(fg, nii, data_node=0, stat_name=None):
     stat_name: What will be the name of the statistic in the fiber group (this
     will be the key into the FiberGroup fiber_stats dict.
 
+    interpolation: str, optional
+        'nearest' (default) takes the value of the nearest voxel with data
+        (not nan) within `tol` voxels of the fiber node. 'trilinear'
+        interpolates the data at the fiber node.
+
+    tol: float, optional
+        For 'nearest' interpolation, how far (in voxels) to look for data.
+        Default: 10
+
     Returns
     -------
     fg: FiberGroup class instance with the generated statistic as one of the
@@ -40,6 +358,38 @@ def nii2fg(fg, nii, data_node=0, stat_name=None):
     
     """
 
+    nii, stat_name = _nii2fg_setup(nii, data_node, stat_name)
+    return _nii2fg_chunk(fg, nii, data_node, stat_name, interpolation, tol)
+
+
+def nii2fg_chunks(fg_chunks, nii, data_node=0, stat_name=None,
+                  interpolation='nearest', tol=10):
+    """
+    Attach data from a nifti volume to the fiber_stats of each of a stream
+    of fiber-group chunks
+
+    Parameters
+    ----------
+    fg_chunks: iterable of FiberGroup class instances (for example, the
+        output of `osmosis.io.fg_chunks_from_pdb`).
+
+    nii, data_node, stat_name, interpolation, tol: see `nii2fg`
+
+    Returns
+    -------
+    A generator of FiberGroup chunks, with the generated statistic as one of
+    the fiber_stat dictionary values in each.
+
+    """
+    nii, stat_name = _nii2fg_setup(nii, data_node, stat_name)
+    for fg in fg_chunks:
+        yield _nii2fg_chunk(fg, nii, data_node, stat_name, interpolation, tol)
+
+
+def _nii2fg_setup(nii, data_node, stat_name):
+    """
+    Helper function to check the inputs to nii2fg and load the nifti
+    """
     if data_node not in [0,-1]:
         e_s = "Can only attach data from voxels near the"
         e_s += " beginning or end of the fiber"
@@ -54,32 +404,104 @@ def nii2fg(fg, nii, data_node=0, stat_name=None):
     if not isinstance(nii, ni.Nifti1Image):
         nii = ni.load(nii)
 
+    return nii, stat_name
+
+
+def _nii2fg_chunk(fg, nii, data_node, stat_name, interpolation, tol):
+    """
+    Helper function that attaches the data to one fiber-group 
+    """
     affine = np.matrix(nii.get_affine()).getI()
     data = nii.get_data()
 
     # Do not mutate the original fiber-group. Instead, return a copy with the
     # transformation applied to it:
     fg = fg.xform(affine, inplace=False)
-    
-    stat_arr = np.empty(fg.n_fibers)
-    for f_idx, fib in enumerate(fg.fibers):
-        this_coord = ozu.nearest_coord(data, fib.coords[:, data_node])
-        if this_coord is not None:
-            stat_arr[f_idx] = data[this_coord]
-        else: 
-            stat_arr[f_idx] = None
-    
-    fg.fiber_stats[stat_name] = stat_arr
+
+    # Sample the data at all the fiber end-points at once:
+    end_coords = np.array([fib.coords[:, data_node] for fib in fg.fibers]).T
+    fg.fiber_stats[stat_name] = sample_volume(data, end_coords,
+                                              interpolation=interpolation,
+                                              tol=tol)
 
     return fg
+
+
+def sample_volume(vol, coords, interpolation='nearest', tol=None):
+    """
+    Sample a volume at many (non-integer) voxel coordinates at once
+
+    Parameters
+    ----------
+    vol: 3D array
+
+    coords: 3 by n array
+        Coordinates (in voxel units) of the points to sample.
+
+    interpolation: str, optional
+        'nearest' (default) or 'trilinear'.
+
+    tol: float, optional
+        For 'nearest' interpolation: if this is provided, take the nearest
+        voxel that contains data (not nan), provided that it is within this
+        distance (in voxels) from the point (this is what
+        `osmosis.utils.nearest_coord` does for a single point). Otherwise, the
+        value in the nearest voxel is taken.
+
+    Returns
+    -------
+    1D array of length n, with nans for points that fall outside the volume
+    (or, with tol, that have no data within tol).
+
+    Notes
+    -----
+    'nearest' treats the integer coordinates as the centers of the voxels, so
+    a point goes to the voxel at its *rounded* coordinates (the same as in
+    `osmosis.utils.nearest_coord`). This is not the same as `fg2volume` (and
+    the fiber models), which put a node in the voxel at its *truncated*
+    coordinates.
+    """
+    vol = np.asarray(vol)
+    coords = np.asarray(coords, dtype=float).reshape((3, -1))
+    out = ozu.nans(coords.shape[-1])
+    if interpolation == 'trilinear':
+        return ndimage.map_coordinates(vol, coords, order=1,
+                                       mode='constant', cval=np.nan)
+    elif interpolation != 'nearest':
+        e_s = "interpolation should be 'nearest' or 'trilinear', not '%s'"%(
+            interpolation)
+        raise ValueError(e_s)
+
+    vox = np.round(coords).astype(int)
+    in_vol = np.all((vox >= 0) &
+                    (vox < np.array(vol.shape[:3])[:, np.newaxis]), 0)
+    out[in_vol] = vol[vox[0, in_vol], vox[1, in_vol], vox[2, in_vol]]
+    if tol is None:
+        return out
+
+    # Where the containing voxel has data, that is the nearest voxel with
+    # data. For all the other points, search for the nearest voxel with data:
+    search = np.where(np.isnan(out))[0]
+    vol_idx = np.array(np.where(~np.isnan(vol))).T
+    if len(search) and len(vol_idx):
+        delta, nearest = spatial.cKDTree(vol_idx).query(coords[:, search].T,
+                                                        distance_upper_bound=tol)
+        found = np.isfinite(delta)
+        vox = vol_idx[nearest[found]].T
+        out[search[found]] = vol[vox[0], vox[1], vox[2]]
+
+    return out
+
     
-def fg2volume(fg, stat, nii=None, shape=None, affine=None):
+def fg2volume(fg, stat, nii=None, shape=None, affine=None, weighting='fiber'):
     """
     Take a statistic from a fiber-group and project it into a volume
 
     Parameters
     ----------
-    fg: A FiberGroup class instance.
+    fg: A FiberGroup class instance, or an iterable of FiberGroup chunks (for
+        example, the output of `osmosis.io.fg_chunks_from_pdb`). In the latter
+        case, only one chunk is held in memory at a time.
 
     stat: str
         The key into fg.fiber_stats to extract the statistic of interest.
@@ -95,7 +517,23 @@ def fg2volume(fg, stat, nii=None, shape=None, affine=None):
     affine: If no nifti is provided, an affine can still be provided as
         input. If no affine is provided, defaults to np.eye(4)
 
+    weighting: str, optional
+        'fiber' (default): each voxel gets the average of the statistic over
+        all the fibers that pass through it. 'node': each node of every fiber
+        counts separately, so that fibers with more nodes in a voxel get more
+        weight there.
+
+    Notes
+    -----
+    A node is in the voxel at its *truncated* coordinates (`astype(int)`,
+    as in the `fg_idx` of the fiber models), so voxel i holds the nodes with
+    coordinates in [i, i + 1). This is not the same as `sample_volume`, which
+    rounds the coordinates to the nearest voxel center.
     """
+    if weighting not in ['fiber', 'node']:
+        e_s = "weighting should be 'fiber' or 'node', not '%s'"%weighting
+        raise ValueError(e_s)
+
     if nii is not None:
         if shape is not None or affine is not None:
             e_s = "Provide either nii input OR shape and affine, not both"
@@ -116,16 +554,17 @@ def fg2volume(fg, stat, nii=None, shape=None, affine=None):
         if affine is None:
             affine = np.matrix(np.eye(4))
 
-    stat_dict = fg.fiber_stats[stat]
-    vol = np.zeros(shape)
-    count_fibs = np.zeros(shape)    
-    fg = fg.xform(affine, inplace=False)
+    if isinstance(fg, ozf.FiberGroup):
+        fg = [fg]
 
-    for fidx, fib in enumerate(fg.fibers):
-        coords = fib.coords.astype(int)
-        vol[coords[0], coords[1], coords[2]] += stat_dict[fidx]
-        count_fibs[coords[0], coords[1], coords[2]] += 1
+    vol = np.zeros(np.prod(shape[:3]))
+    count_fibs = np.zeros(np.prod(shape[:3]))
+    for this_fg in fg:
+        _fg2volume_chunk(this_fg, stat, affine, shape[:3], vol, count_fibs,
+                         weighting)
 
+    vol = vol.reshape(shape[:3])
+    count_fibs = count_fibs.reshape(shape[:3])
     # Put nans where there were no fibers:
     vol[np.where(count_fibs==0)] = np.nan
     vol /=count_fibs
@@ -133,12 +572,38 @@ def fg2volume(fg, stat, nii=None, shape=None, affine=None):
     return vol
 
 
+def _fg2volume_chunk(fg, stat, affine, shape, vol, count_fibs, weighting):
+    """
+    Helper function that adds the statistic from the fibers of one
+    fiber-group into the flat vol (in place), counting in count_fibs
+    """
+    stat_arr = np.asarray(fg.fiber_stats[stat], dtype=float)
+    n_nodes = np.array([fib.coords.shape[-1] for fib in fg.fibers])
+    coords = ozu.xform(np.hstack([fib.coords for fib in fg.fibers]),
+                       np.matrix(affine))
+    vox_lin = np.ravel_multi_index(coords.astype(int), shape)
+    fib_idx = np.repeat(np.arange(fg.n_fibers), n_nodes)
+
+    if weighting == 'fiber':
+        # Each fiber counts only once in every voxel it passes through:
+        pairs = np.unique(fib_idx * vol.shape[0] + vox_lin)
+        fib_idx = pairs // vol.shape[0]
+        vox_lin = pairs % vol.shape[0]
+
+    vol += np.bincount(vox_lin, weights=stat_arr[fib_idx],
+                       minlength=vol.shape[0])
+    count_fibs += np.bincount(vox_lin, minlength=vol.shape[0])
+
+
 def resample_volume(source, target):
     """
     Resample the file in file_orig (full path string) to the resolution and
     affine of file_target (also a full path string)
     
     """
+    # nipy is slow to import and only needed here:
+    from nipy.labs.datasets import as_volume_img
+
     if not isinstance(source, ni.Nifti1Image):
         source = ni.load(source)
 